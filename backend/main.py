@@ -2,6 +2,7 @@ from fastapi import FastAPI, HTTPException, Body, Query
 from fastapi.responses import StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from contextlib import contextmanager
 from pathlib import Path
 from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional, Literal, Any
@@ -9,9 +10,9 @@ from datetime import datetime
 import math
 import json
 import os
-import csv
 import random
-from io import StringIO
+import threading
+import time
 import pickle
 import psycopg2
 from psycopg2.extras import RealDictCursor
@@ -622,6 +623,103 @@ def init_db():
             )
         """)
 
+    # Prediction store (utils/prediction_store.py): manifest + en rad per position
+    if is_postgres:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ml_prediction_runs (
+                id SERIAL PRIMARY KEY,
+                filename TEXT NOT NULL UNIQUE,
+                track_ids TEXT,
+                track_names TEXT,
+                prediction_timestamp TEXT,
+                total_positions INTEGER NOT NULL DEFAULT 0,
+                positions_with_actual_corrections INTEGER NOT NULL DEFAULT 0,
+                mean_predicted_m REAL,
+                max_predicted_m REAL,
+                mean_error_m REAL,
+                size_bytes INTEGER,
+                header_json TEXT,
+                statistics_json TEXT,
+                created_at TEXT NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ml_predictions (
+                id SERIAL PRIMARY KEY,
+                run_id INTEGER NOT NULL REFERENCES ml_prediction_runs(id) ON DELETE CASCADE,
+                seq INTEGER NOT NULL,
+                position_id INTEGER,
+                track_id INTEGER,
+                track_name TEXT,
+                track_type TEXT,
+                timestamp TEXT,
+                original_lat DOUBLE PRECISION,
+                original_lng DOUBLE PRECISION,
+                predicted_distance_m DOUBLE PRECISION,
+                ml_confidence DOUBLE PRECISION,
+                predicted_lat DOUBLE PRECISION,
+                predicted_lng DOUBLE PRECISION,
+                actual_distance_m DOUBLE PRECISION,
+                actual_lat DOUBLE PRECISION,
+                actual_lng DOUBLE PRECISION,
+                was_approved_as_is INTEGER,
+                prediction_error_m DOUBLE PRECISION,
+                verified_status TEXT,
+                gps_accuracy DOUBLE PRECISION
+            )
+        """)
+    else:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ml_prediction_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT NOT NULL UNIQUE,
+                track_ids TEXT,
+                track_names TEXT,
+                prediction_timestamp TEXT,
+                total_positions INTEGER NOT NULL DEFAULT 0,
+                positions_with_actual_corrections INTEGER NOT NULL DEFAULT 0,
+                mean_predicted_m REAL,
+                max_predicted_m REAL,
+                mean_error_m REAL,
+                size_bytes INTEGER,
+                header_json TEXT,
+                statistics_json TEXT,
+                created_at TEXT NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ml_predictions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id INTEGER NOT NULL REFERENCES ml_prediction_runs(id) ON DELETE CASCADE,
+                seq INTEGER NOT NULL,
+                position_id INTEGER,
+                track_id INTEGER,
+                track_name TEXT,
+                track_type TEXT,
+                timestamp TEXT,
+                original_lat REAL,
+                original_lng REAL,
+                predicted_distance_m REAL,
+                ml_confidence REAL,
+                predicted_lat REAL,
+                predicted_lng REAL,
+                actual_distance_m REAL,
+                actual_lat REAL,
+                actual_lng REAL,
+                was_approved_as_is INTEGER,
+                prediction_error_m REAL,
+                verified_status TEXT,
+                gps_accuracy REAL
+            )
+        """)
+    try:
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ml_prediction_runs_created ON ml_prediction_runs(created_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ml_predictions_run_seq ON ml_predictions(run_id, seq)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ml_predictions_position ON ml_predictions(position_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ml_prediction_feedback_file ON ml_prediction_feedback(prediction_filename)")
+    except Exception:
+        pass
+
     # FAS 1: audit_log för spårning av korrigeringar och godkännanden
     if is_postgres:
         cursor.execute("""
@@ -639,8 +737,13 @@ def init_db():
             )
         """)
         try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_position_id ON audit_log(position_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_track_id ON audit_log(track_id)")
+            # Keyset-sidindelning på (timestamp, id) per spår/position (utils/audit_log.py);
+            # ersätter de tidigare enkolumnsindexen på track_id och position_id
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_track_ts_id ON audit_log(track_id, timestamp, id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_position_ts_id ON audit_log(position_id, timestamp, id)")
+            cursor.execute("DROP INDEX IF EXISTS idx_audit_log_track_id")
+            cursor.execute("DROP INDEX IF EXISTS idx_audit_log_position_id")
+            # Retention (arkivering av rader äldre än en brytpunkt)
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_timestamp ON audit_log(timestamp)")
         except Exception:
             pass
@@ -660,18 +763,211 @@ def init_db():
             )
         """)
         try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_position_id ON audit_log(position_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_track_id ON audit_log(track_id)")
+            # Keyset-sidindelning på (timestamp, id) per spår/position (utils/audit_log.py);
+            # ersätter de tidigare enkolumnsindexen på track_id och position_id
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_track_ts_id ON audit_log(track_id, timestamp, id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_position_ts_id ON audit_log(position_id, timestamp, id)")
+            cursor.execute("DROP INDEX IF EXISTS idx_audit_log_track_id")
+            cursor.execute("DROP INDEX IF EXISTS idx_audit_log_position_id")
+            # Retention (arkivering av rader äldre än en brytpunkt)
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_timestamp ON audit_log(timestamp)")
         except Exception:
             pass
 
+    # Bakgrundsjobb (utils/job_runner.py): kö + status/progress/resultat
+    if is_postgres:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id SERIAL PRIMARY KEY,
+                job_type TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                params_json TEXT,
+                progress REAL NOT NULL DEFAULT 0,
+                progress_message TEXT,
+                result_json TEXT,
+                error TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                worker_id TEXT,
+                created_at TEXT NOT NULL,
+                started_at TEXT,
+                heartbeat_at TEXT,
+                finished_at TEXT
+            )
+        """)
+    else:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_type TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                params_json TEXT,
+                progress REAL NOT NULL DEFAULT 0,
+                progress_message TEXT,
+                result_json TEXT,
+                error TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                worker_id TEXT,
+                created_at TEXT NOT NULL,
+                started_at TEXT,
+                heartbeat_at TEXT,
+                finished_at TEXT
+            )
+        """)
+    try:
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_type ON jobs(job_type, id)")
+    except Exception:
+        pass
+
+    # Feature store (utils/position_features.py): ML-features per position
+    real = "DOUBLE PRECISION" if is_postgres else "REAL"
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS position_features (
+            position_id INTEGER PRIMARY KEY REFERENCES track_positions(id) ON DELETE CASCADE,
+            track_id INTEGER NOT NULL,
+            schema_version INTEGER NOT NULL,
+            speed {real},
+            acceleration {real},
+            distance_prev_1 {real},
+            distance_prev_2 {real},
+            distance_prev_3 {real},
+            bearing {real},
+            curvature {real},
+            speed_consistency {real},
+            position_jump {real},
+            updated_at TEXT NOT NULL
+        )
+    """)
+    # Spårsammanfattning (utils/track_summary.py): tidsintervall + bbox per spår
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS track_summaries (
+            track_id INTEGER PRIMARY KEY REFERENCES tracks(id) ON DELETE CASCADE,
+            t_start {real},
+            t_end {real},
+            duration_s {real},
+            position_count INTEGER NOT NULL DEFAULT 0,
+            min_lat {real},
+            max_lat {real},
+            min_lng {real},
+            max_lng {real},
+            updated_at TEXT NOT NULL
+        )
+    """)
+    # Experimenträknare per spår (utils/experiment_stats.py)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS experiment_track_stats (
+            track_id INTEGER PRIMARY KEY REFERENCES tracks(id) ON DELETE CASCADE,
+            experiment_count INTEGER NOT NULL DEFAULT 0,
+            pending_count INTEGER NOT NULL DEFAULT 0,
+            sample_key {real} NOT NULL,
+            updated_at TEXT
+        )
+    """)
+    # Leasade experiment per granskare (utils/experiment_leases.py)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS experiment_leases (
+            experiment_id INTEGER PRIMARY KEY,
+            reviewer TEXT NOT NULL,
+            expires_at {real} NOT NULL
+        )
+    """)
+    # Globala experimenträknare för progress/statistik (utils/experiment_stats.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS experiment_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    try:
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_experiment_leases_reviewer ON experiment_leases(reviewer)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_experiment_track_stats_pick ON experiment_track_stats(pending_count, experiment_count, sample_key)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_track_summaries_start ON track_summaries(t_start, t_end)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_track_summaries_duration ON track_summaries(duration_s)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_position_features_track ON position_features(track_id, schema_version)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_track_positions_track_time ON track_positions(track_id, timestamp, id)")
+    except Exception:
+        pass
+
+    # ml_experiments skapas av scripts/migrate_ml_experiments.py (Postgres);
+    # kompakt spårlagring (utils/experiment_snapshot.py) kräver track_snapshot.
+    # ALTER körs bara när schemat faktiskt behöver ändras (ALTER tar ett
+    # exklusivt lås på tabellen).
+    if DATABASE_URL:
+        cursor.execute("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name='ml_experiments' AND column_name='track_snapshot'
+                ) AND EXISTS (
+                    SELECT 1 FROM information_schema.tables
+                    WHERE table_name='ml_experiments'
+                ) THEN
+                    ALTER TABLE ml_experiments ADD COLUMN track_snapshot BYTEA;
+                END IF;
+                IF EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name='ml_experiments' AND column_name='original_track_json'
+                      AND is_nullable='NO'
+                ) THEN
+                    ALTER TABLE ml_experiments ALTER COLUMN original_track_json DROP NOT NULL;
+                END IF;
+                IF EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name='ml_experiments' AND column_name='corrected_track_json'
+                      AND is_nullable='NO'
+                ) THEN
+                    ALTER TABLE ml_experiments ALTER COLUMN corrected_track_json DROP NOT NULL;
+                END IF;
+            END $$;
+        """)
+
     conn.commit()
     conn.close()
 
 
+def _audit_log_many(cursor, entries: List[dict]):
+    """
+    Skriv flera rader till audit_log med en sats i anroparens transaktion
+    (utils/audit_writer.write_entries). Kastar vid fel – anroparen avgör om
+    det ska fälla transaktionen.
+    """
+    from utils.audit_writer import write_entries
+
+    write_entries(cursor, DATABASE_URL is not None, entries)
+
+
+_audit_writer = None
+_audit_writer_lock = threading.Lock()
+
+
+def _get_audit_writer():
+    """
+    Hämta (och starta vid första anrop) den gemensamma buffrade audit-skrivaren.
+    Kö, batch och intervall styrs med AUDIT_LOG_BUFFER (default 10000),
+    AUDIT_LOG_BATCH (500) och AUDIT_LOG_FLUSH_S (1.0).
+    """
+    global _audit_writer
+    from utils.audit_writer import AuditWriter
+
+    with _audit_writer_lock:
+        if _audit_writer is None:
+            init_db()
+            _audit_writer = AuditWriter(
+                get_db,
+                get_cursor,
+                is_postgres=DATABASE_URL is not None,
+                max_buffer=int(os.getenv("AUDIT_LOG_BUFFER", "10000")),
+                batch_size=int(os.getenv("AUDIT_LOG_BATCH", "500")),
+                flush_interval_s=float(os.getenv("AUDIT_LOG_FLUSH_S", "1.0")),
+            )
+    _audit_writer.start()
+    return _audit_writer
+
+
 def _audit_log(
     cursor,
+    pending: List[dict],
     *,
     position_id: Optional[int] = None,
     track_id: Optional[int] = None,
@@ -679,48 +975,59 @@ def _audit_log(
     old_value: Optional[dict] = None,
     new_value: Optional[dict] = None,
     user_id: Optional[str] = None,
+    sync: bool = False,
 ):
-    """Skriv en rad till audit_log. old_value/new_value serialiseras som JSON."""
+    """
+    Logga en rad till audit_log. old_value/new_value serialiseras som JSON.
+
+    pending är listan från _audit_transaction: som standard läggs raden där
+    och lämnas till den buffrade skrivaren först när transaktionen har
+    committats – en rollback ger alltså ingen audit-rad. sync=True (eller
+    AUDIT_LOG_SYNC=1) skriver den direkt i anroparens transaktion, för
+    ändringar där loggen måste vara beständig samtidigt som ändringen.
+    """
+    entry = {
+        "position_id": position_id,
+        "track_id": track_id,
+        "action": action,
+        "old_value": old_value,
+        "new_value": new_value,
+        "user_id": user_id,
+    }
     try:
-        import json
-        ts = datetime.now().isoformat()
-        ph = "%s" if DATABASE_URL else "?"
-        if DATABASE_URL:
-            # Postgres: JSONB
-            execute_query(
-                cursor,
-                """
-                INSERT INTO audit_log (position_id, track_id, action, old_value, new_value, user_id, timestamp)
-                VALUES (""" + ", ".join([ph] * 7) + """)
-                """,
-                (
-                    position_id,
-                    track_id,
-                    action,
-                    json.dumps(old_value) if old_value is not None else None,
-                    json.dumps(new_value) if new_value is not None else None,
-                    user_id,
-                    ts,
-                ),
-            )
+        if sync or os.getenv("AUDIT_LOG_SYNC", "").lower() in ("1", "true", "yes"):
+            _audit_log_many(cursor, [entry])
         else:
-            # SQLite: TEXT för JSON
-            execute_query(
-                cursor,
-                """
-                INSERT INTO audit_log (position_id, track_id, action, old_value, new_value, user_id, timestamp)
-                VALUES (""" + ", ".join([ph] * 7) + """)
-                """,
-                (
-                    position_id,
-                    track_id,
-                    action,
-                    json.dumps(old_value) if old_value is not None else None,
-                    json.dumps(new_value) if new_value is not None else None,
-                    user_id,
-                    ts,
-                ),
-            )
+            entry["timestamp"] = datetime.now().isoformat()
+            pending.append(entry)
+    except Exception as e:
+        print(f"audit_log insert failed: {e}")  # Log but don't fail the request
+
+
+@contextmanager
+def _audit_transaction(conn):
+    """
+    Transaktion med audit-rader. Committar conn när blocket slutar normalt
+    och lämnar sedan raderna till den buffrade skrivaren; vid undantag görs
+    rollback och raderna släpps.
+
+        with _audit_transaction(conn) as audit:
+            execute_query(cursor, "UPDATE ...", params)
+            _audit_log(cursor, audit, action=..., ...)
+    """
+    pending: List[dict] = []
+    try:
+        yield pending
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    if not pending:
+        return
+    try:
+        writer = _get_audit_writer()
+        for entry in pending:
+            writer.record(entry)
     except Exception as e:
         print(f"audit_log insert failed: {e}")  # Log but don't fail the request
 
@@ -731,7 +1038,108 @@ def startup_event():
     # Databasen initieras när den faktiskt behövs (t.ex. i /ping eller /tracks)
     # Detta gör att appen kan starta även om Postgres inte är tillgänglig direkt vid startup
     # eller om den interna nätverket inte är klart än
-    pass
+    #
+    # Jobb-arbetarna startas i en egen tråd så att köade jobb från före en omstart
+    # plockas upp utan att startup blockeras av databasanslutningen.
+    def _start_jobs():
+        try:
+            _get_job_runner()
+            _top_up_experiment_pool()
+        except Exception as e:
+            print(f"Kunde inte starta jobb-arbetare: {e}")
+
+    threading.Thread(target=_start_jobs, name="job-runner-start", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    if _job_runner is not None:
+        _job_runner.shutdown()
+    # Skriv audit-rader som fortfarande ligger i kön
+    if _audit_writer is not None:
+        _audit_writer.shutdown()
+
+
+# ============================================================================
+# BAKGRUNDSJOBB
+# ============================================================================
+
+_job_runner = None
+_job_runner_lock = threading.Lock()
+
+
+def _get_job_runner():
+    """
+    Hämta (och starta vid första anrop) den gemensamma jobbkön.
+    Antal arbetare styrs med JOB_WORKERS (default 2).
+    """
+    global _job_runner
+    from utils.job_runner import JobRunner
+
+    with _job_runner_lock:
+        if _job_runner is None:
+            init_db()
+            runner = JobRunner(
+                get_db,
+                get_cursor,
+                is_postgres=DATABASE_URL is not None,
+                max_workers=int(os.getenv("JOB_WORKERS", "2")),
+            )
+            runner.register("ml_analyze", _run_ml_analysis_job)
+            runner.register("ml_update", _run_ml_update_job)
+            runner.register("tiles_convert", _convert_tiles_job)
+            runner.register("experiments_generate", _generate_experiments_job)
+            runner.register("features_rebuild", _rebuild_features_job)
+            runner.register("experiments_pool", _experiment_pool_job)
+            runner.register("tracks_auto_pair", _auto_pair_tracks_job)
+            runner.register("audit_archive", _archive_audit_log_job)
+            _job_runner = runner
+    _job_runner.start()
+    return _job_runner
+
+
+def _enqueue_job(job_type: str, params: dict) -> dict:
+    """Lägg ett jobb i kön och returnera svaret som klienten pollar vidare med."""
+    job_id = _get_job_runner().enqueue(job_type, params)
+    return {
+        "status": "queued",
+        "job_id": job_id,
+        "job_type": job_type,
+        "status_url": f"/jobs/{job_id}",
+    }
+
+
+@app.get("/jobs")
+@app.get("/api/jobs")  # Stöd för frontend som använder /api prefix
+def list_jobs(
+    status: Optional[str] = None, job_type: Optional[str] = None, limit: int = 50
+):
+    """Lista jobb (senaste först), valfritt filtrerat på status och typ."""
+    try:
+        jobs = _get_job_runner().list(status=status, job_type=job_type, limit=limit)
+        return {"status": "success", "count": len(jobs), "jobs": jobs}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Fel vid listning av jobb: {str(e)}")
+
+
+@app.get("/jobs/{job_id}")
+@app.get("/api/jobs/{job_id}")  # Stöd för frontend som använder /api prefix
+def get_job(job_id: int):
+    """Status, progress och (när klart) resultat för ett jobb."""
+    job = _get_job_runner().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Jobb hittades inte")
+    return job
+
+
+@app.post("/jobs/{job_id}/cancel")
+@app.post("/api/jobs/{job_id}/cancel")  # Stöd för frontend som använder /api prefix
+def cancel_job(job_id: int):
+    """Begär avbrott. Köade jobb avbryts direkt, pågående vid nästa kontrollpunkt."""
+    job = _get_job_runner().cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Jobb hittades inte")
+    return job
 
 
 class LatLng(BaseModel):
@@ -1540,6 +1948,55 @@ def rename_generic_tracks():
     }
 
 
+def _auto_pair_tracks_job(job, params: dict) -> dict:
+    """Jobb: para importerade hundspår med människaspåret som överlappar mest i tid."""
+    from utils.track_summary import auto_pair
+
+    dry_run = bool(params.get("dry_run"))
+    conn = get_db()
+    try:
+        cursor = get_cursor(conn)
+        result = auto_pair(
+            cursor,
+            DATABASE_URL is not None,
+            overwrite=bool(params.get("overwrite")),
+            dry_run=dry_run,
+            commit=conn.commit,
+            progress=lambda done, total: job.progress(
+                done / total, f"{done} av {total} hundspår"
+            ),
+        )
+        if not dry_run:
+            conn.commit()
+    finally:
+        conn.close()
+    verb = "Skulle para" if dry_run else "Parade"
+    return {
+        "status": "success",
+        "message": f"{verb} {result['paired']} av {result['dog_tracks']} hundspår ({result['unmatched']} utan överlapp)",
+        **result,
+    }
+
+
+@app.post("/tracks/auto-pair")
+@app.post("/api/tracks/auto-pair")  # Stöd för frontend som använder /api prefix
+def auto_pair_tracks(overwrite: bool = False, dry_run: bool = False):
+    """
+    Para alla importerade hundspår med det importerade människaspår vars
+    tidsintervall överlappar mest (sätter human_track_id), som bakgrundsjobb.
+
+    Args:
+        overwrite: Para om även hundspår som redan har ett människaspår
+        dry_run: Räkna bara ut parningarna, skriv inget
+    """
+    try:
+        return _enqueue_job(
+            "tracks_auto_pair", {"overwrite": overwrite, "dry_run": dry_run}
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Fel vid auto-parning: {str(e)}")
+
+
 @app.post("/tracks/{track_id}/smooth")
 def smooth_track(
     track_id: int,
@@ -1765,10 +2222,19 @@ def delete_track(track_id: int):
     conn = get_db()
     cursor = get_cursor(conn)
     placeholder = "%s" if DATABASE_URL else "?"
+    if DATABASE_URL:
+        # Spårets experiment kaskaderas bort; dra av dem från räknarna först
+        # (ml_experiments finns bara på Postgres, se migrate_ml_experiments.py)
+        from utils.experiment_stats import track_deleted
+
+        track_deleted(cursor, True, track_id)
     execute_query(cursor, f"DELETE FROM tracks WHERE id = {placeholder}", (track_id,))
     if cursor.rowcount == 0:
         conn.close()
         raise HTTPException(status_code=404, detail="Track not found")
+    # SQLite kaskaderar inte utan PRAGMA foreign_keys
+    execute_query(cursor, f"DELETE FROM track_summaries WHERE track_id = {placeholder}", (track_id,))
+    execute_query(cursor, f"DELETE FROM experiment_track_stats WHERE track_id = {placeholder}", (track_id,))
     conn.commit()
     conn.close()
     return {"deleted": track_id}
@@ -2307,6 +2773,14 @@ def add_position_to_track(track_id: int, payload: TrackPositionAdd):
             "none",
         ),
     )
+    position_id = cursor.fetchone()["id"] if is_postgres else cursor.lastrowid
+
+    # Feature store: bara den nya positionen och grannarna inom fönstret
+    from utils.position_features import refresh_window
+    from utils.track_summary import extend_track
+
+    refresh_window(cursor, is_postgres, position_id)
+    extend_track(cursor, is_postgres, track_id, payload.position.lat, payload.position.lng, now)
 
     conn.commit()
     conn.close()
@@ -2402,35 +2876,36 @@ def update_track_position(position_id: int, payload: TrackPositionUpdate):
     }
     track_id_val = get_row_value(row, "track_id")
 
-    execute_query(
-        cursor,
-        f"UPDATE track_positions SET {', '.join(update_fields)} WHERE id = {placeholder}",
-        params,
-    )
+    with _audit_transaction(conn) as audit:
+        execute_query(
+            cursor,
+            f"UPDATE track_positions SET {', '.join(update_fields)} WHERE id = {placeholder}",
+            params,
+        )
 
-    execute_query(
-        cursor,
-        f"SELECT * FROM track_positions WHERE id = {placeholder}",
-        (position_id,),
-    )
-    updated_row = cursor.fetchone()
-    new_snapshot = {
-        "corrected_lat": get_row_value(updated_row, "corrected_lat"),
-        "corrected_lng": get_row_value(updated_row, "corrected_lng"),
-        "truth_level": get_row_value(updated_row, "truth_level"),
-        "correction_source": get_row_value(updated_row, "correction_source"),
-        "verified_status": get_row_value(updated_row, "verified_status"),
-    }
-    action_name = "clear_correction" if payload.clear_correction else "manual_correction" if payload.corrected_position else "position_update"
-    _audit_log(
-        cursor,
-        position_id=position_id,
-        track_id=track_id_val,
-        action=action_name,
-        old_value=old_snapshot,
-        new_value=new_snapshot,
-    )
-    conn.commit()
+        execute_query(
+            cursor,
+            f"SELECT * FROM track_positions WHERE id = {placeholder}",
+            (position_id,),
+        )
+        updated_row = cursor.fetchone()
+        new_snapshot = {
+            "corrected_lat": get_row_value(updated_row, "corrected_lat"),
+            "corrected_lng": get_row_value(updated_row, "corrected_lng"),
+            "truth_level": get_row_value(updated_row, "truth_level"),
+            "correction_source": get_row_value(updated_row, "correction_source"),
+            "verified_status": get_row_value(updated_row, "verified_status"),
+        }
+        action_name = "clear_correction" if payload.clear_correction else "manual_correction" if payload.corrected_position else "position_update"
+        _audit_log(
+            cursor,
+            audit,
+            position_id=position_id,
+            track_id=track_id_val,
+            action=action_name,
+            old_value=old_snapshot,
+            new_value=new_snapshot,
+        )
     conn.close()
 
     return row_to_track_position(updated_row)
@@ -2463,40 +2938,41 @@ def approve_ml_correction(position_id: int, payload: ApproveMlPayload):
         "truth_level": get_row_value(row, "truth_level"),
         "correction_source": get_row_value(row, "correction_source"),
     }
-    execute_query(
-        cursor,
-        f"""
-        UPDATE track_positions
-        SET corrected_lat = {placeholder}, corrected_lng = {placeholder}, corrected_at = {placeholder},
-            truth_level = 'T2', correction_source = 'ml',
-            ml_confidence = {placeholder}, ml_model_version = {placeholder}
-        WHERE id = {placeholder}
-        """,
-        (
-            payload.predicted_lat,
-            payload.predicted_lng,
-            datetime.now().isoformat(),
-            payload.ml_confidence,
-            payload.ml_model_version,
-            position_id,
-        ),
-    )
-    _audit_log(
-        cursor,
-        position_id=position_id,
-        track_id=track_id_val,
-        action="approve_ml",
-        old_value=old_snapshot,
-        new_value={
-            "corrected_lat": payload.predicted_lat,
-            "corrected_lng": payload.predicted_lng,
-            "truth_level": "T2",
-            "correction_source": "ml",
-            "ml_confidence": payload.ml_confidence,
-            "ml_model_version": payload.ml_model_version,
-        },
-    )
-    conn.commit()
+    with _audit_transaction(conn) as audit:
+        execute_query(
+            cursor,
+            f"""
+            UPDATE track_positions
+            SET corrected_lat = {placeholder}, corrected_lng = {placeholder}, corrected_at = {placeholder},
+                truth_level = 'T2', correction_source = 'ml',
+                ml_confidence = {placeholder}, ml_model_version = {placeholder}
+            WHERE id = {placeholder}
+            """,
+            (
+                payload.predicted_lat,
+                payload.predicted_lng,
+                datetime.now().isoformat(),
+                payload.ml_confidence,
+                payload.ml_model_version,
+                position_id,
+            ),
+        )
+        _audit_log(
+            cursor,
+            audit,
+            position_id=position_id,
+            track_id=track_id_val,
+            action="approve_ml",
+            old_value=old_snapshot,
+            new_value={
+                "corrected_lat": payload.predicted_lat,
+                "corrected_lng": payload.predicted_lng,
+                "truth_level": "T2",
+                "correction_source": "ml",
+                "ml_confidence": payload.ml_confidence,
+                "ml_model_version": payload.ml_model_version,
+            },
+        )
     execute_query(cursor, f"SELECT * FROM track_positions WHERE id = {placeholder}", (position_id,))
     updated_row = cursor.fetchone()
     conn.close()
@@ -2530,31 +3006,32 @@ def reject_ml_correction(position_id: int):
         "truth_level": get_row_value(row, "truth_level"),
         "correction_source": get_row_value(row, "correction_source"),
     }
-    execute_query(
-        cursor,
-        f"""
-        UPDATE track_positions
-        SET corrected_lat = NULL, corrected_lng = NULL, corrected_at = NULL,
-            truth_level = 'T3', correction_source = 'none',
-            ml_confidence = NULL, ml_model_version = NULL
-        WHERE id = {placeholder}
-        """,
-        (position_id,),
-    )
-    _audit_log(
-        cursor,
-        position_id=position_id,
-        track_id=track_id_val,
-        action="reject_ml",
-        old_value=old_snapshot,
-        new_value={
-            "corrected_lat": None,
-            "corrected_lng": None,
-            "truth_level": "T3",
-            "correction_source": "none",
-        },
-    )
-    conn.commit()
+    with _audit_transaction(conn) as audit:
+        execute_query(
+            cursor,
+            f"""
+            UPDATE track_positions
+            SET corrected_lat = NULL, corrected_lng = NULL, corrected_at = NULL,
+                truth_level = 'T3', correction_source = 'none',
+                ml_confidence = NULL, ml_model_version = NULL
+            WHERE id = {placeholder}
+            """,
+            (position_id,),
+        )
+        _audit_log(
+            cursor,
+            audit,
+            position_id=position_id,
+            track_id=track_id_val,
+            action="reject_ml",
+            old_value=old_snapshot,
+            new_value={
+                "corrected_lat": None,
+                "corrected_lng": None,
+                "truth_level": "T3",
+                "correction_source": "none",
+            },
+        )
     execute_query(cursor, f"SELECT * FROM track_positions WHERE id = {placeholder}", (position_id,))
     updated_row = cursor.fetchone()
     conn.close()
@@ -2563,65 +3040,110 @@ def reject_ml_correction(position_id: int):
 
 @app.get("/tracks/{track_id}/audit-log")
 @app.get("/api/tracks/{track_id}/audit-log")
-def get_audit_log(track_id: int, limit: int = 100):
-    """Hämta audit trail för ett spår (senaste ändringar först)."""
+def get_audit_log(
+    track_id: int,
+    response: Response,
+    limit: int = 100,
+    before: Optional[str] = None,
+    action: Optional[str] = None,
+    position_id: Optional[int] = None,
+):
+    """
+    Hämta audit trail för ett spår (senaste ändringar först), valfritt
+    filtrerat på action och position. Sidindelning med keyset på
+    (timestamp, id): finns det fler rader sätts headern X-Next-Cursor, som
+    skickas tillbaka som before för nästa sida.
+    """
+    from utils.audit_log import page
+
     init_db()
+    # Rader som ligger i den buffrade skrivarens kö ska synas direkt
+    if _audit_writer is not None:
+        _audit_writer.flush()
     conn = get_db()
-    cursor = get_cursor(conn)
-    placeholder = "%s" if DATABASE_URL else "?"
-    execute_query(cursor, f"SELECT * FROM tracks WHERE id = {placeholder}", (track_id,))
-    if cursor.fetchone() is None:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Track not found")
-    execute_query(
-        cursor,
-        f"""
-        SELECT id, position_id, track_id, action, old_value, new_value, user_id, timestamp
-        FROM audit_log
-        WHERE track_id = {placeholder}
-        ORDER BY timestamp DESC
-        LIMIT {min(limit, 500)}
-        """,
-        (track_id,),
-    )
-    rows = cursor.fetchall()
-    conn.close()
-    # Normalisera old_value/new_value (Postgres JSONB kommer som dict, SQLite som str)
-    out = []
-    for r in rows:
-        old_v = get_row_value(r, "old_value")
-        new_v = get_row_value(r, "new_value")
-        if isinstance(old_v, str):
-            try:
-                old_v = json.loads(old_v) if old_v else None
-            except Exception:
-                pass
-        if isinstance(new_v, str):
-            try:
-                new_v = json.loads(new_v) if new_v else None
-            except Exception:
-                pass
-        out.append({
-            "id": get_row_value(r, "id"),
-            "position_id": get_row_value(r, "position_id"),
-            "track_id": get_row_value(r, "track_id"),
-            "action": get_row_value(r, "action"),
-            "old_value": old_v,
-            "new_value": new_v,
-            "user_id": get_row_value(r, "user_id"),
-            "timestamp": get_row_value(r, "timestamp"),
-        })
-    return out
+    try:
+        cursor = get_cursor(conn)
+        placeholder = "%s" if DATABASE_URL else "?"
+        execute_query(cursor, f"SELECT * FROM tracks WHERE id = {placeholder}", (track_id,))
+        if cursor.fetchone() is None:
+            raise HTTPException(status_code=404, detail="Track not found")
+        try:
+            entries, next_cursor = page(
+                cursor,
+                DATABASE_URL is not None,
+                track_id=track_id,
+                position_id=position_id,
+                action=action,
+                before=before,
+                limit=limit,
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        conn.close()
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return entries
 
 
-def fetch_track_positions(
+def _audit_archive_dir() -> Path:
+    """Katalog för arkiverad audit_log (AUDIT_LOG_ARCHIVE_DIR, default backend/audit_archive)."""
+    return Path(os.getenv("AUDIT_LOG_ARCHIVE_DIR") or Path(__file__).parent / "audit_archive")
+
+
+def _archive_audit_log_job(job, params: dict) -> dict:
+    """Jobb: flytta audit_log-rader äldre än older_than_days till komprimerade arkivfiler."""
+    from datetime import timedelta
+    from utils.audit_log import archive
+
+    days = int(params["older_than_days"])
+    older_than = (datetime.now() - timedelta(days=days)).isoformat()
+    if _audit_writer is not None:
+        _audit_writer.flush()
+    conn = get_db()
+    try:
+        result = archive(
+            get_cursor(conn),
+            DATABASE_URL is not None,
+            older_than=older_than,
+            archive_dir=_audit_archive_dir(),
+            commit=conn.commit,
+            progress=lambda done: job.progress(None, f"{done} rader arkiverade"),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return {
+        "status": "success",
+        "message": f"Arkiverade {result['archived']} audit-rader äldre än {days} dagar",
+        "older_than": older_than,
+        **result,
+    }
+
+
+@app.post("/audit-log/archive")
+@app.post("/api/audit-log/archive")  # Stöd för frontend som använder /api prefix
+def archive_audit_log(older_than_days: Optional[int] = None):
+    """
+    Retention för audit_log: flytta rader äldre än older_than_days (default
+    AUDIT_LOG_RETENTION_DAYS eller 180) till gzip-komprimerade NDJSON-filer i
+    AUDIT_LOG_ARCHIVE_DIR och radera dem ur tabellen. Körs som bakgrundsjobb.
+    """
+    days = older_than_days if older_than_days is not None else int(os.getenv("AUDIT_LOG_RETENTION_DAYS", "180"))
+    if days < 1:
+        raise HTTPException(status_code=400, detail="older_than_days måste vara minst 1")
+    try:
+        return _enqueue_job("audit_archive", {"older_than_days": days})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Fel vid start av arkivering: {str(e)}")
+
+
+def _track_positions_query(
     track_id: Optional[int] = None,
     verified_status: Optional[Literal["pending", "correct", "incorrect"]] = None,
     include_uncorrected: bool = True,
 ):
-    conn = get_db()
-    cursor = get_cursor(conn)
-
+    """Bygg SELECT + parametrar för track_positions med de vanliga filtren."""
     query = """
         SELECT
             id,
@@ -2662,7 +3184,18 @@ def fetch_track_positions(
         query += " WHERE " + " AND ".join(conditions)
 
     query += " ORDER BY timestamp"
+    return query, params
+
+
+def fetch_track_positions(
+    track_id: Optional[int] = None,
+    verified_status: Optional[Literal["pending", "correct", "incorrect"]] = None,
+    include_uncorrected: bool = True,
+):
+    conn = get_db()
+    cursor = get_cursor(conn)
 
+    query, params = _track_positions_query(track_id, verified_status, include_uncorrected)
     execute_query(cursor, query, params)
     rows = cursor.fetchall()
     conn.close()
@@ -2685,70 +3218,190 @@ def export_track_positions(
     track_id: Optional[int] = None,
     verified_status: Optional[Literal["pending", "correct", "incorrect"]] = None,
     include_uncorrected: bool = True,
+    gzip: bool = False,
 ):
-    rows = fetch_track_positions(track_id, verified_status, include_uncorrected)
+    """
+    CSV-export av track_positions. Raderna läses via server-side cursor och
+    skickas i block – headern går iväg direkt, inget buffras för hela tabellen.
+    gzip=1 ger komprimerad överföring (Content-Encoding: gzip).
+    """
+    from utils.streaming_export import encode_csv, gzip_stream, iter_rows, to_bytes
 
-    output = StringIO()
-    writer = csv.writer(output)
-    writer.writerow(
-        [
-            "id",
-            "track_id",
-            "timestamp",
-            "position_lat",
-            "position_lng",
-            "accuracy",
-            "verified_status",
-            "corrected_lat",
-            "corrected_lng",
-            "corrected_at",
-            "annotation_notes",
-        ]
-    )
+    query, params = _track_positions_query(track_id, verified_status, include_uncorrected)
 
-    for row in rows:
-        writer.writerow(
-            [
-                row["id"],
-                row["track_id"],
-                row["timestamp"],
-                row["position_lat"],
-                row["position_lng"],
-                row["accuracy"],
-                row["verified_status"],
-                row["corrected_lat"],
-                row["corrected_lng"],
-                row["corrected_at"],
-                row["annotation_notes"] or "",
-            ]
-        )
+    def _rows():
+        conn = get_db()
+        try:
+            for row in iter_rows(
+                conn, query, params, is_postgres=DATABASE_URL is not None
+            ):
+                yield [
+                    row["id"],
+                    row["track_id"],
+                    row["timestamp"],
+                    row["position_lat"],
+                    row["position_lng"],
+                    row["accuracy"],
+                    row["verified_status"],
+                    row["corrected_lat"],
+                    row["corrected_lng"],
+                    row["corrected_at"],
+                    row["annotation_notes"] or "",
+                ]
+        finally:
+            conn.close()
 
-    output.seek(0)
+    header = [
+        "id",
+        "track_id",
+        "timestamp",
+        "position_lat",
+        "position_lng",
+        "accuracy",
+        "verified_status",
+        "corrected_lat",
+        "corrected_lng",
+        "corrected_at",
+        "annotation_notes",
+    ]
+    body = to_bytes(encode_csv(header, _rows()), min_chunk_bytes=1)
     filename = "track_positions.csv"
-
-    return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if gzip:
+        body = gzip_stream(body)
+        headers["Content-Encoding"] = "gzip"
+
+    return StreamingResponse(body, media_type="text/csv", headers=headers)
+
+
+def _annotation_row_to_ml(row) -> dict:
+    """Gör om en annoterad position till ML-träningsformat."""
+    # Hämta original position
+    orig_lat = row["position_lat"]
+    orig_lng = row["position_lng"]
+    verified_status = row["verified_status"]
+    corr_lat = row["corrected_lat"]
+    corr_lng = row["corrected_lng"]
+    track_id = row["track_id"]
+    track_type = row["track_type"]
+
+    # För 'correct' positioner utan corrected_lat/lng: använd original som corrected
+    # (de var korrekta från början, correction_distance = 0)
+    if verified_status == "correct" and (corr_lat is None or corr_lng is None):
+        corr_lat = orig_lat
+        corr_lng = orig_lng
+
+    # Beräkna korrigeringsavstånd (Haversine distance)
+    R = 6371000  # Earth radius in meters
+    phi1 = math.radians(orig_lat)
+    phi2 = math.radians(corr_lat)
+    delta_phi = math.radians(corr_lat - orig_lat)
+    delta_lambda = math.radians(corr_lng - orig_lng)
+
+    a = (
+        math.sin(delta_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2) ** 2
     )
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    correction_distance = R * c
+
+    annotation = {
+        "id": row["id"],
+        "track_id": track_id,
+        "track_name": row["track_name"],
+        "track_type": track_type,
+        "timestamp": str(row["timestamp"]),
+        "verified_status": verified_status,
+        "original_position": {"lat": orig_lat, "lng": orig_lng},
+        "corrected_position": {"lat": corr_lat, "lng": corr_lng},
+        "correction_distance_meters": round(correction_distance, 2),
+        "accuracy": row["accuracy"],
+        "annotation_notes": row["annotation_notes"] or "",
+        "environment": row["environment"],  # Kan vara None
+    }
+
+    # Lägg till human_track_id för hundspår (för matchning features)
+    human_track_id = row["human_track_id"]
+    if track_type == "dog" and human_track_id:
+        annotation["human_track_id"] = human_track_id
+
+    # Kinematiska features från feature store, beräknade över hela spåret
+    # (exporten innehåller bara annoterade positioner)
+    from utils.position_features import FEATURE_COLUMNS, FEATURE_SCHEMA_VERSION
+
+    if row.get("feature_schema_version") is not None:
+        annotation["features"] = {name: row[f"pf_{name}"] for name in FEATURE_COLUMNS}
+        annotation["feature_schema_version"] = FEATURE_SCHEMA_VERSION
+
+    return annotation
+
+
+_columnar_module = None
+
+
+def _columnar_writer(batch_id: str, source_file: Optional[str] = None):
+    """
+    ColumnarWriter från ml/columnar_dataset.py (laddas via sökväg – backend
+    importerar annars inget från ml/). None om modulen eller numpy saknas.
+    """
+    global _columnar_module
+    try:
+        if _columnar_module is None:
+            import importlib.util
+
+            path = Path(__file__).parent.parent / "ml" / "columnar_dataset.py"
+            spec = importlib.util.spec_from_file_location("ml_columnar_dataset", path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _columnar_module = module
+        return _columnar_module.ColumnarWriter(batch_id, source_file=source_file)
+    except Exception as e:
+        print(f"Kolumnär export inte tillgänglig: {e}")
+        return None
+
+
+def _iter_file(fh, block_size: int = 256 * 1024):
+    """Läs en öppen binär fil i block och stäng den när den är slut."""
+    try:
+        while True:
+            block = fh.read(block_size)
+            if not block:
+                break
+            yield block
+    finally:
+        fh.close()
 
 
 @app.get("/export/annotations-to-ml")
 @app.post("/export/annotations-to-ml")
 def export_annotations_to_ml(
-    filename: str = "annotations.json", track_ids: Optional[str] = None
+    filename: str = "annotations.json",
+    track_ids: Optional[str] = None,
+    export_format: Literal["json", "ndjson", "columnar"] = Query("json", alias="format"),
+    gzip: bool = False,
 ):
     """
-    Export annoterade positioner direkt till ml/data/ mappen för ML-träning.
+    Exportera annoterade positioner för ML-träning som nedladdningsbar fil.
+
+    Raderna strömmas från en server-side cursor i chunkar (JSON-array eller NDJSON,
+    valfritt gzip). format=columnar ger en kolumnär partition som zip
+    (se ml/columnar_dataset.py). Antal positioner och spårnamn skickas i headers
+    (X-Export-Count, X-Export-Tracks som URL-kodad JSON-lista).
 
     Args:
         filename: Namnet på filen (läggs automatiskt till .json om inte angivet)
         track_ids: Komma-separerad lista av track_ids att exportera (om None, exportera alla)
-
-    Returns:
-        Success message med filnamn och antal positioner
     """
     try:
+        from urllib.parse import quote
+        from utils.streaming_export import (
+            MEDIA_TYPES,
+            encode_items,
+            gzip_stream,
+            iter_rows,
+            to_bytes,
+        )
+
         # Säkerställ att filnamnet slutar med .json
         if not filename.endswith(".json"):
             filename = f"{filename}.json"
@@ -2758,12 +3411,6 @@ def export_annotations_to_ml(
         # - Alla 'correct' positioner (även om de inte har corrected_lat/lng - de var korrekta från början)
         # - Alla 'incorrect' positioner som har corrected_lat/lng (färdigjusterade)
         # Detta ger modellen både korrekta och felaktiga positioner att lära sig av
-        conn = get_db()
-        cursor = get_cursor(conn)
-
-        # Bygg WHERE-klausul
-        # 'correct' positioner: inkludera alla (oavsett om de har corrected_lat/lng)
-        # 'incorrect' positioner: inkludera bara de som har corrected_lat/lng (färdigjusterade)
         where_conditions = [
             "(tp.verified_status = 'correct' OR (tp.verified_status = 'incorrect' AND tp.corrected_lat IS NOT NULL AND tp.corrected_lng IS NOT NULL))",
         ]
@@ -2783,6 +3430,51 @@ def export_annotations_to_ml(
 
         where_clause = " AND ".join(where_conditions)
 
+        # Antal och spårnamn först (små aggregat) – behövs i headers innan strömmen startar
+        conn = get_db()
+        cursor = get_cursor(conn)
+        execute_query(
+            cursor,
+            f"""
+            SELECT t.id, t.name, COUNT(*) AS cnt
+            FROM track_positions tp
+            JOIN tracks t ON tp.track_id = t.id
+            WHERE {where_clause}
+            GROUP BY t.id, t.name
+            """,
+            params if params else None,
+        )
+        track_rows = cursor.fetchall()
+
+        annotation_count = sum(int(get_row_value(r, "cnt") or 0) for r in track_rows)
+        if annotation_count == 0:
+            conn.close()
+            raise HTTPException(
+                status_code=404, detail="Inga annoterade positioner hittades"
+            )
+
+        # Feature store: exporten skriver inte. Spår utan aktuella features
+        # exporteras utan "features" (ml/analysis.py beräknar dem då själv) och
+        # byggs om i bakgrunden (features_rebuild) till nästa export.
+        from utils.position_features import (
+            FEATURE_COLUMNS,
+            FEATURE_SCHEMA_VERSION,
+            stale_track_ids,
+        )
+
+        exported_ids = {get_row_value(r, "id") for r in track_rows}
+        stale = [
+            t for t in stale_track_ids(cursor, DATABASE_URL is not None) if t in exported_ids
+        ]
+        conn.close()
+        rebuild_job_id = _enqueue_features_rebuild(stale) if stale else None
+        unique_tracks = sorted(
+            {
+                get_row_value(r, "name") or f"Track_{get_row_value(r, 'id')}"
+                for r in track_rows
+            }
+        )
+
         query = f"""
             SELECT
                 tp.id,
@@ -2798,98 +3490,67 @@ def export_annotations_to_ml(
                 tp.corrected_lat,
                 tp.corrected_lng,
                 tp.annotation_notes,
-                tp.environment
+                tp.environment,
+                pf.schema_version AS feature_schema_version,
+                {", ".join(f"pf.{name} AS pf_{name}" for name in FEATURE_COLUMNS)}
             FROM track_positions tp
             JOIN tracks t ON tp.track_id = t.id
+            LEFT JOIN position_features pf
+              ON pf.position_id = tp.id AND pf.schema_version = {int(FEATURE_SCHEMA_VERSION)}
             WHERE {where_clause}
             ORDER BY tp.track_id, tp.timestamp
         """
 
-        execute_query(cursor, query, params if params else None)
-        rows = cursor.fetchall()
-        conn.close()
-
-        if not rows:
-            raise HTTPException(
-                status_code=404, detail="Inga annoterade positioner hittades"
-            )
-
-        # Konvertera till JSON-format
-        annotations = []
-        for row in rows:
-            # Hämta original position
-            orig_lat = get_row_value(row, "position_lat")
-            orig_lng = get_row_value(row, "position_lng")
-            verified_status = get_row_value(row, "verified_status")
-            corr_lat = get_row_value(row, "corrected_lat")
-            corr_lng = get_row_value(row, "corrected_lng")
-            track_id = get_row_value(row, "track_id")
-            track_type = get_row_value(row, "track_type")
-
-            # För 'correct' positioner utan corrected_lat/lng: använd original som corrected
-            # (de var korrekta från början, correction_distance = 0)
-            if verified_status == "correct" and (corr_lat is None or corr_lng is None):
-                corr_lat = orig_lat
-                corr_lng = orig_lng
-
-            # Beräkna korrigeringsavstånd (Haversine distance)
-            R = 6371000  # Earth radius in meters
-            phi1 = math.radians(orig_lat)
-            phi2 = math.radians(corr_lat)
-            delta_phi = math.radians(corr_lat - orig_lat)
-            delta_lambda = math.radians(corr_lng - orig_lng)
-
-            a = (
-                math.sin(delta_phi / 2) ** 2
-                + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2) ** 2
-            )
-            c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-            correction_distance = R * c
-
-            annotation = {
-                "id": get_row_value(row, "id"),
-                "track_id": track_id,
-                "track_name": get_row_value(row, "track_name"),
-                "track_type": track_type,
-                "timestamp": str(get_row_value(row, "timestamp")),
-                "verified_status": verified_status,
-                "original_position": {"lat": orig_lat, "lng": orig_lng},
-                "corrected_position": {"lat": corr_lat, "lng": corr_lng},
-                "correction_distance_meters": round(correction_distance, 2),
-                "accuracy": get_row_value(row, "accuracy"),
-                "annotation_notes": get_row_value(row, "annotation_notes") or "",
-                "environment": get_row_value(row, "environment"),  # Kan vara None
-            }
-
-            # Lägg till human_track_id för hundspår (för matchning features)
-            # Hämta från tracks-tabellen (redan i query)
-            human_track_id = get_row_value(row, "human_track_id")
-            if track_type == "dog" and human_track_id:
-                annotation["human_track_id"] = human_track_id
-
-            annotations.append(annotation)
-
-        # Returnera JSON-data direkt (frontend sparar lokalt)
-        # Vi försöker INTE spara till fil på Railway (ephemeral filesystem)
-
-        # Hämta unika spårnamn (filtrera bort None/empty)
-        unique_tracks = []
-        if annotations:
-            unique_tracks = list(
-                set(
-                    a.get("track_name") or f"Track_{a.get('track_id', 'unknown')}"
-                    for a in annotations
-                    if a.get("track_name") or a.get("track_id")
+        def _annotations():
+            stream_conn = get_db()
+            try:
+                for row in iter_rows(
+                    stream_conn, query, params, is_postgres=DATABASE_URL is not None
+                ):
+                    yield _annotation_row_to_ml(row)
+            finally:
+                stream_conn.close()
+
+        # Vi sparar INTE till fil på servern (Railway har ephemeral filesystem) –
+        # frontend sparar den nedladdade filen lokalt
+        if export_format == "columnar":
+            # Kolumnär partition (.npy per kolumn) som okomprimerat zip –
+            # läggs i ml/data/columnar/ och packas upp av load_annotations
+            import tempfile
+
+            batch_id = filename[: -len(".json")]
+            writer = _columnar_writer(batch_id)
+            if writer is None:
+                raise HTTPException(
+                    status_code=501,
+                    detail="Kolumnär export kräver numpy och ml/columnar_dataset.py",
                 )
-            )
-
-        return {
-            "message": f"Annotationer exporterade ({len(annotations)} positioner)",
-            "filename": filename,
-            "annotation_count": len(annotations),
-            "tracks": unique_tracks,
-            "data": annotations,  # Returnera själva datan så frontend kan spara
+            writer.extend(_annotations())
+            spool = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+            writer.write_zip(spool)
+            spool.seek(0)
+            filename = f"{batch_id}.columnar.zip"
+            body = _iter_file(spool)
+            media_type = "application/zip"
+        else:
+            if export_format == "ndjson":
+                filename = filename[: -len(".json")] + ".ndjson"
+            body = to_bytes(encode_items(_annotations(), export_format, indent=2))
+            media_type = MEDIA_TYPES[export_format]
+        headers = {
+            "Content-Disposition": f'attachment; filename="{_ascii_header_value(filename, 200)}"',
+            "X-Export-Filename": _ascii_header_value(filename, 200),
+            "X-Export-Count": str(annotation_count),
+            "X-Export-Tracks": quote(json.dumps(unique_tracks, ensure_ascii=False)),
         }
+        if stale:
+            headers["X-Features-Missing-Tracks"] = str(len(stale))
+            if rebuild_job_id is not None:
+                headers["X-Features-Rebuild-Job"] = str(rebuild_job_id)
+        if gzip and export_format != "columnar":
+            body = gzip_stream(body)
+            headers["Content-Encoding"] = "gzip"
+        return StreamingResponse(body, media_type=media_type, headers=headers)
     except HTTPException:
         # Re-raise HTTP exceptions (som 404)
         raise
@@ -3222,20 +3883,168 @@ def get_tiles_status():
         }
 
 
-@app.post("/tiles/convert")
-def convert_tiles(payload: TileConvertRequest):
+# Tile server URLs (esri_satellite har bäst upplösning för terräng/skog)
+TILE_SERVERS = {
+    "osm": "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png",
+    "esri_street": "https://server.arcgisonline.com/ArcGIS/rest/services/World_Street_Map/MapServer/tile/{z}/{y}/{x}",
+    "esri_satellite": "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+    "cartodb_light": "https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}.png",
+}
+
+
+def _tile_deg2num(lat_deg: float, lon_deg: float, zoom: int):
+    """Konvertera lat/lng till tile koordinater"""
+    lat_rad = math.radians(lat_deg)
+    n = 2.0**zoom
+    xtile = int((lon_deg + 180.0) / 360.0 * n)
+    ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return (xtile, ytile)
+
+
+def _tile_bounds(min_lat: float, min_lon: float, max_lat: float, max_lon: float, zoom: int):
+    """Hämta tile bounds för ett område"""
+    x_min, y_max = _tile_deg2num(max_lat, min_lon, zoom)
+    x_max, y_min = _tile_deg2num(min_lat, max_lon, zoom)
+    return (x_min, y_min, x_max, y_max)
+
+
+def _convert_tiles_job(job, params: dict) -> dict:
     """
-    Konvertera och förstora tiles för aktuellt kartområde.
-    Anropar tile-konverteringsfunktioner direkt istället för via subprocess.
+    Jobb: ladda ner, förstora och spara tiles för ett område.
+    Progress = andel bearbetade tiles; avbrott kontrolleras per tile.
     """
     import io
     import requests
     from PIL import Image
-    from pathlib import Path
     import time
 
+    backend_dir = Path(__file__).parent
+    output_dir = backend_dir / "tiles"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    server_url = TILE_SERVERS[params["server"]]
+    scale_factor = int(params.get("scale_factor") or 2)
+    min_lat, min_lon, max_lat, max_lon = params["bounds"]
+    zoom_levels = params["zoom_levels"]
+
+    output_messages = []
+
+    def download_tile(url_template: str, x: int, y: int, z: int, subdomain: str = "a"):
+        """Ladda ner en tile"""
+        try:
+            url = url_template.format(s=subdomain, x=x, y=y, z=z)
+            response = requests.get(url, timeout=10)
+            response.raise_for_status()
+            if response.status_code == 200 and response.content:
+                return response.content
+        except requests.exceptions.Timeout:
+            output_messages.append(f"Timeout vid nedladdning av tile {z}/{x}/{y}")
+        except requests.exceptions.RequestException as e:
+            output_messages.append(f"Fel vid nedladdning av tile {z}/{x}/{y}: {str(e)}")
+        except Exception as e:
+            output_messages.append(
+                f"Oväntat fel vid nedladdning av tile {z}/{x}/{y}: {str(e)}"
+            )
+        return None
+
+    def upscale_tile(image: Image.Image, scale_factor: int = 2):
+        """Förstora en tile"""
+        width, height = image.size
+        return image.resize(
+            (width * scale_factor, height * scale_factor), Image.Resampling.LANCZOS
+        )
+
+    # Räkna totalen först så att progress blir meningsfull
+    ranges = []
+    for zoom in zoom_levels:
+        x_min, y_min, x_max, y_max = _tile_bounds(min_lat, min_lon, max_lat, max_lon, zoom)
+        ranges.append((zoom, x_min, y_min, x_max, y_max))
+    total_tiles = sum((x1 - x0 + 1) * (y1 - y0 + 1) for _, x0, y0, x1, y1 in ranges)
+
+    processed = 0
+    downloaded_tiles = 0
+    job.progress(0.0, f"0 av {total_tiles} tiles")
+
+    for zoom, x_min, y_min, x_max, y_max in ranges:
+        zoom_dir = output_dir / str(zoom)
+        zoom_dir.mkdir(exist_ok=True)
+
+        for x in range(x_min, x_max + 1):
+            x_dir = zoom_dir / str(x)
+            x_dir.mkdir(exist_ok=True)
+
+            for y in range(y_min, y_max + 1):
+                processed += 1
+                job.progress(
+                    processed / total_tiles if total_tiles else 1.0,
+                    f"{processed} av {total_tiles} tiles ({downloaded_tiles} nedladdade)",
+                )
+                tile_path = x_dir / f"{y}.png"
+
+                # Hoppa över om redan nedladdad
+                if tile_path.exists():
+                    continue
+
+                tile_data = download_tile(server_url, x, y, zoom)
+                if tile_data is None:
+                    continue
+
+                try:
+                    img = Image.open(io.BytesIO(tile_data))
+
+                    # Validera bildformat
+                    if img.format not in ["PNG", "JPEG", "JPG"]:
+                        output_messages.append(
+                            f"Okänt bildformat för {zoom}/{x}/{y}: {img.format}"
+                        )
+                        continue
+
+                    if scale_factor > 1:
+                        img = upscale_tile(img, scale_factor)
+
+                    img.save(tile_path, "PNG", optimize=True)
+                    downloaded_tiles += 1
+
+                    if downloaded_tiles % 10 == 0:
+                        output_messages.append(f"Nedladdade {downloaded_tiles} tiles...")
+
+                    # Vänta lite för att inte överbelasta servern
+                    time.sleep(0.1)
+
+                except Image.UnidentifiedImageError:
+                    output_messages.append(
+                        f"Kunde inte identifiera bildformat för {zoom}/{x}/{y}"
+                    )
+                    continue
+                except Exception as e:
+                    output_messages.append(
+                        f"Fel vid bearbetning av {zoom}/{x}/{y}: {str(e)}"
+                    )
+                    continue
+
+    output_text = "\n".join(output_messages)
+    output_text += f"\n\nKlar! Nedladdade {downloaded_tiles} av {total_tiles} tiles."
+    output_text += f"\nTiles sparade i: {output_dir.absolute()}"
+
+    return {
+        "status": "success",
+        "message": "Tiles konverterade och förstorade",
+        "output_dir": str(output_dir.relative_to(backend_dir)),
+        "tile_size": 256 * scale_factor,
+        "stdout": output_text,
+        "downloaded_tiles": downloaded_tiles,
+        "total_tiles": total_tiles,
+    }
+
+
+@app.post("/tiles/convert")
+def convert_tiles(payload: TileConvertRequest):
+    """
+    Konvertera och förstora tiles för aktuellt kartområde.
+    Validerar indata direkt och kör själva nedladdningen som bakgrundsjobb;
+    returnerar job_id som pollas via /jobs/{job_id}.
+    """
     try:
-        # Hämta projektets root directory
         backend_dir = Path(__file__).parent
 
         # Spara tiles i backend/tiles så de kan serveras som statiska filer
@@ -3254,81 +4063,18 @@ def convert_tiles(payload: TileConvertRequest):
                 detail=f"Cannot write to output directory {output_dir}: {str(write_error)}",
             )
 
-        # Tile server URLs (esri_satellite har bäst upplösning för terräng/skog)
-        TILE_SERVERS = {
-            "osm": "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png",
-            "esri_street": "https://server.arcgisonline.com/ArcGIS/rest/services/World_Street_Map/MapServer/tile/{z}/{y}/{x}",
-            "esri_satellite": "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
-            "cartodb_light": "https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}.png",
-        }
-
-        server_url = TILE_SERVERS.get(payload.server)
-        if not server_url:
+        if payload.server not in TILE_SERVERS:
             raise HTTPException(
                 status_code=400, detail=f"Unknown server: {payload.server}"
             )
 
-        # Helper functions (från tile_converter.py)
-        def deg2num(lat_deg: float, lon_deg: float, zoom: int):
-            """Konvertera lat/lng till tile koordinater"""
-            lat_rad = math.radians(lat_deg)
-            n = 2.0**zoom
-            xtile = int((lon_deg + 180.0) / 360.0 * n)
-            ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
-            return (xtile, ytile)
-
-        def get_tile_bounds(
-            min_lat: float, min_lon: float, max_lat: float, max_lon: float, zoom: int
-        ):
-            """Hämta tile bounds för ett område"""
-            x_min, y_max = deg2num(max_lat, min_lon, zoom)
-            x_max, y_min = deg2num(min_lat, max_lon, zoom)
-            return (x_min, y_min, x_max, y_max)
-
-        def download_tile(
-            url_template: str, x: int, y: int, z: int, subdomain: str = "a"
-        ):
-            """Ladda ner en tile"""
-            try:
-                url = url_template.format(s=subdomain, x=x, y=y, z=z)
-                response = requests.get(url, timeout=10)
-                response.raise_for_status()
-                if response.status_code == 200 and response.content:
-                    return response.content
-            except requests.exceptions.Timeout:
-                output_messages.append(f"Timeout vid nedladdning av tile {z}/{x}/{y}")
-            except requests.exceptions.RequestException as e:
-                output_messages.append(
-                    f"Fel vid nedladdning av tile {z}/{x}/{y}: {str(e)}"
-                )
-            except Exception as e:
-                output_messages.append(
-                    f"Oväntat fel vid nedladdning av tile {z}/{x}/{y}: {str(e)}"
-                )
-            return None
-
-        def upscale_tile(image: Image.Image, scale_factor: int = 2):
-            """Förstora en tile"""
-            width, height = image.size
-            new_width = width * scale_factor
-            new_height = height * scale_factor
-            upscaled = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            return upscaled
-
         # Konvertera bounds till tuple och validera
         if len(payload.bounds) != 4:
             raise HTTPException(
                 status_code=400,
                 detail="Bounds must contain exactly 4 values: [min_lat, min_lon, max_lat, max_lon]",
             )
-
-        bounds = (
-            payload.bounds[0],
-            payload.bounds[1],
-            payload.bounds[2],
-            payload.bounds[3],
-        )
-        min_lat, min_lon, max_lat, max_lon = bounds
+        min_lat, min_lon, max_lat, max_lon = payload.bounds
 
         # Validera bounds
         if not (-90 <= min_lat <= 90) or not (-90 <= max_lat <= 90):
@@ -3357,89 +4103,18 @@ def convert_tiles(payload: TileConvertRequest):
                     detail=f"Invalid zoom level: {zoom} (must be integer between 0 and 23)",
                 )
 
-        total_tiles = 0
-        downloaded_tiles = 0
-        output_messages = []
-
-        for zoom in payload.zoom_levels:
-            x_min, y_min, x_max, y_max = get_tile_bounds(
-                min_lat, min_lon, max_lat, max_lon, zoom
-            )
-
-            zoom_dir = output_dir / str(zoom)
-            zoom_dir.mkdir(exist_ok=True)
-
-            for x in range(x_min, x_max + 1):
-                x_dir = zoom_dir / str(x)
-                x_dir.mkdir(exist_ok=True)
-
-                for y in range(y_min, y_max + 1):
-                    total_tiles += 1
-                    tile_path = x_dir / f"{y}.png"
-
-                    # Hoppa över om redan nedladdad
-                    if tile_path.exists():
-                        continue
-
-                    # Ladda ner tile
-                    tile_data = download_tile(server_url, x, y, zoom)
-                    if tile_data is None:
-                        continue
-
-                    try:
-                        # Öppna bild
-                        img = Image.open(io.BytesIO(tile_data))
-
-                        # Validera bildformat
-                        if img.format not in ["PNG", "JPEG", "JPG"]:
-                            output_messages.append(
-                                f"Okänt bildformat för {zoom}/{x}/{y}: {img.format}"
-                            )
-                            continue
-
-                        # Förstora om scale_factor > 1
-                        if payload.scale_factor > 1:
-                            img = upscale_tile(img, payload.scale_factor)
-
-                        # Spara förstorad tile
-                        img.save(tile_path, "PNG", optimize=True)
-                        downloaded_tiles += 1
-
-                        if downloaded_tiles % 10 == 0:
-                            output_messages.append(
-                                f"Nedladdade {downloaded_tiles} tiles..."
-                            )
-
-                        # Vänta lite för att inte överbelasta servern
-                        time.sleep(0.1)
-
-                    except Image.UnidentifiedImageError:
-                        output_messages.append(
-                            f"Kunde inte identifiera bildformat för {zoom}/{x}/{y}"
-                        )
-                        continue
-                    except Exception as e:
-                        output_messages.append(
-                            f"Fel vid bearbetning av {zoom}/{x}/{y}: {str(e)}"
-                        )
-                        continue
-
-        output_text = "\n".join(output_messages)
-        output_text += (
-            f"\n\nKlar! Nedladdade {downloaded_tiles} av {total_tiles} tiles."
+        return _enqueue_job(
+            "tiles_convert",
+            {
+                "bounds": [min_lat, min_lon, max_lat, max_lon],
+                "zoom_levels": list(payload.zoom_levels),
+                "server": payload.server,
+                "scale_factor": payload.scale_factor,
+            },
         )
-        output_text += f"\nTiles sparade i: {output_dir.absolute()}"
-
-        return {
-            "status": "success",
-            "message": "Tiles konverterade och förstorade",
-            "output_dir": str(output_dir.relative_to(backend_dir)),
-            "tile_size": 256 * payload.scale_factor,
-            "stdout": output_text,
-            "downloaded_tiles": downloaded_tiles,
-            "total_tiles": total_tiles,
-        }
 
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
 
@@ -3475,36 +4150,145 @@ def _load_ml_pkl(path: Path):
         return pickle.load(f)
 
 
-def _predict_with_confidence(model, X_scaled, *, use_tree_std=True):
-    """
-    Förutsäg korrigeringsavstånd och confidence (0–1) från modellen.
-    X_scaled: shape (1, n_features). Returnerar (prediction_meters, confidence).
-    För ensemble-modeller (RandomForest, ExtraTrees, GradientBoosting) används
-    standardavvikelsen över trädens förutsägelser som osäkerhet: lägre std → högre confidence.
-    """
-    import numpy as np
+_tree_ensemble_module = None
+_serving_model_cache = {"key": None, "value": None}
 
-    pred = float(model.predict(X_scaled)[0])
-    confidence = 0.5  # fallback om vi inte kan beräkna från modellen
 
-    if use_tree_std and hasattr(model, "estimators_") and getattr(model, "estimators_", None) is not None:
-        try:
-            ests = model.estimators_
+def _tree_ensemble():
+    """ml/tree_ensemble.py (laddas via sökväg, som _columnar_writer)."""
+    global _tree_ensemble_module
+    if _tree_ensemble_module is None:
+        import importlib.util
+
+        path = Path(__file__).parent.parent / "ml" / "tree_ensemble.py"
+        spec = importlib.util.spec_from_file_location("ml_tree_ensemble", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _tree_ensemble_module = module
+    return _tree_ensemble_module
+
+
+def _load_serving_model():
+    """
+    (modell, scaler) för förutsägelser, cachade tills modellfilerna ändras.
+
+    Kompakta filer (ml/tree_ensemble.py) för samma model_version som modellinfo
+    används i första hand: NumPy-arrayer istället för pickle, lägre latens per
+    anrop och mindre minne, och de är inte LFS-filer. Ordning:
+
+    1. gps_correction_model_serving.npz – destillerad variant inom träningens
+       MAE-tolerans (ml/distill.py); ML_SERVING_MODEL=0 hoppar över den
+    2. gps_correction_model_compact.npz – bästa modellen
+    3. pickle-filerna (även med ML_COMPACT_MODEL=0)
+    """
+    ml_dir = Path(__file__).parent.parent / "ml" / "output"
+    model_path = ml_dir / "gps_correction_model_best.pkl"
+    scaler_path = ml_dir / "gps_correction_scaler.pkl"
+    model_info_path = ml_dir / "gps_correction_model_info.json"
+    compact_paths = []
+    if os.getenv("ML_COMPACT_MODEL", "1") != "0":
+        if os.getenv("ML_SERVING_MODEL", "1") != "0":
+            compact_paths.append(ml_dir / "gps_correction_model_serving.npz")
+        compact_paths.append(ml_dir / "gps_correction_model_compact.npz")
+
+    key = []
+    for path in [model_path, scaler_path, model_info_path] + compact_paths:
+        try:
+            st = path.stat()
+            key.append((path.name, st.st_mtime_ns, st.st_size))
+        except OSError:
+            key.append((path.name, None))
+    key = tuple(key)
+    if _serving_model_cache["key"] == key:
+        return _serving_model_cache["value"]
+
+    value = None
+    model_version = None
+    if model_info_path.exists():
+        with open(model_info_path, "r", encoding="utf-8") as f:
+            model_version = json.load(f).get("model_version")
+    for compact_path in compact_paths:
+        if not compact_path.exists():
+            continue
+        try:
+            ensemble = _tree_ensemble().TreeEnsemble.load(compact_path)
+        except Exception as e:
+            print(f"Kunde inte ladda {compact_path.name}: {e}")
+            continue
+        if ensemble.scaler is not None and ensemble.model_version == model_version:
+            value = (ensemble, ensemble.scaler)
+            break
+        print(
+            f"{compact_path.name} ({ensemble.model_version}) matchar inte modellinfo "
+            f"({model_version}) – hoppas över"
+        )
+
+    if value is None:
+        if not model_path.exists():
+            raise HTTPException(
+                status_code=404,
+                detail="Ingen tränad modell hittades. Kör python ml/analysis.py först.",
+            )
+        value = (_load_ml_pkl(model_path), _load_ml_pkl(scaler_path))
+
+    _serving_model_cache["key"] = key
+    _serving_model_cache["value"] = value
+    return value
+
+
+def _predict_with_confidence(model, X_scaled, *, use_tree_std=True):
+    """
+    Förutsäg korrigeringsavstånd och confidence (0–1) från modellen.
+    X_scaled: shape (1, n_features). Returnerar (prediction_meters, confidence).
+    Se _predict_with_confidence_batch.
+    """
+    preds, confidences = _predict_with_confidence_batch(model, X_scaled, use_tree_std=use_tree_std)
+    return float(preds[0]), float(confidences[0])
+
+
+def _predict_with_confidence_batch(model, X_scaled, *, use_tree_std=True):
+    """
+    Som _predict_with_confidence men för alla rader i X_scaled (n, n_features)
+    i ett anrop. Returnerar (predictions, confidences) som arrayer med längd n.
+    För ensemble-modeller (RandomForest, ExtraTrees, GradientBoosting) används
+    standardavvikelsen över trädens förutsägelser som osäkerhet: lägre std → högre confidence.
+    Kompakta modeller (ml/tree_ensemble.py) ger prediktion och trädens utdata i
+    samma genomgång.
+    """
+    import numpy as np
+
+    def to_confidence(std_meters):
+        # confidence: hög std → låg confidence. 1/(1+2*std) ger std=0→1, std≈0.5→0.5
+        return np.clip(1.0 / (1.0 + 2.0 * std_meters), 0.0, 1.0)
+
+    n = len(X_scaled)
+    if hasattr(model, "tree_outputs"):
+        tree_preds = model.tree_outputs(X_scaled)
+        preds = np.asarray(model.combine(tree_preds), dtype=float)
+        confidences = np.full(n, 0.5)
+        if use_tree_std and model.kind in ("forest", "gradient_boosting"):
+            confidences = to_confidence(np.std(tree_preds, axis=1))
+        return preds, confidences
+
+    preds = np.asarray(model.predict(X_scaled), dtype=float)
+    confidences = np.full(n, 0.5)  # fallback om vi inte kan beräkna från modellen
+
+    if use_tree_std and hasattr(model, "estimators_") and getattr(model, "estimators_", None) is not None:
+        try:
+            ests = model.estimators_
             if len(ests) > 0:
                 # RandomForest / ExtraTrees: estimators_ är lista av träd
                 first = ests[0]
                 if hasattr(first, "predict"):
-                    tree_preds = np.array([float(t.predict(X_scaled)[0]) for t in ests])
+                    tree_preds = np.array([t.predict(X_scaled) for t in ests], dtype=float)
                 else:
                     # GradientBoosting: estimators_ är array av [träd] per steg
-                    tree_preds = np.array([float(e[0].predict(X_scaled)[0]) for e in ests])
-                std_meters = float(np.std(tree_preds))
-                # confidence: hög std → låg confidence. 1/(1+2*std) ger std=0→1, std≈0.5→0.5
-                confidence = min(1.0, max(0.0, 1.0 / (1.0 + 2.0 * std_meters)))
+                    tree_preds = np.array([e[0].predict(X_scaled) for e in ests], dtype=float)
+                confidences = to_confidence(np.std(tree_preds, axis=0))
         except Exception:
             pass
 
-    return pred, confidence
+    return preds, confidences
 
 
 @app.get("/ml/debug")
@@ -3578,19 +4362,145 @@ def get_model_info():
         )
 
 
+def _run_ml_script(job, script_name: str, env: dict, start_message: str) -> str:
+    """
+    Kör ett script i ml/ som subprocess. stdout skrivs till en loggfil vars
+    sista rad rapporteras som progress; avbrott dödar processen. Returnerar stdout.
+    """
+    import subprocess
+    import sys
+    import tempfile
+    import time
+    from utils.job_runner import JobCancelled
+
+    ml_dir = Path(__file__).parent.parent / "ml"
+    script = ml_dir / script_name
+    if not script.exists():
+        raise RuntimeError(f"Script hittades inte: {script}")
+
+    env = dict(env, PYTHONUNBUFFERED="1")
+    timeout_s = float(os.getenv("ML_ANALYZE_TIMEOUT_S", "3600"))
+    job.progress(0.0, start_message)
+
+    with tempfile.TemporaryFile(mode="w+", encoding="utf-8", errors="replace") as out, \
+            tempfile.TemporaryFile(mode="w+", encoding="utf-8", errors="replace") as err:
+        proc = subprocess.Popen(
+            [sys.executable, str(script)],
+            cwd=str(ml_dir),
+            stdout=out,
+            stderr=err,
+            text=True,
+            env=env,
+        )
+        started = time.monotonic()
+        try:
+            while proc.poll() is None:
+                time.sleep(1.0)
+                if time.monotonic() - started > timeout_s:
+                    proc.kill()
+                    raise RuntimeError(f"{script_name} tog för lång tid (>{int(timeout_s)} s)")
+                out.seek(0)
+                lines = [ln for ln in out.read().splitlines() if ln.strip()]
+                # Ingen känd total – progress visas via meddelandet (sista raden i loggen)
+                job.progress(None, lines[-1][:200] if lines else "Pågår...")
+        except JobCancelled:
+            proc.kill()
+            proc.wait()
+            raise
+
+        out.seek(0)
+        stdout = out.read()
+        err.seek(0)
+        stderr = err.read()
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"{script_name} misslyckades:\n{stderr}\n\nOutput:\n{stdout}")
+    return stdout
+
+
+def _run_ml_analysis_job(job, params: dict) -> dict:
+    """Jobb: kör ml/analysis.py (full träning) via _run_ml_script."""
+    ml_dir = Path(__file__).parent.parent / "ml"
+    if not (ml_dir / "analysis.py").exists():
+        raise RuntimeError(f"Analysscript hittades inte: {ml_dir / 'analysis.py'}")
+
+    env = os.environ.copy()
+    track_ids = params.get("track_ids")
+    if track_ids:
+        # Skicka valda spår som environment variable till scriptet
+        track_id_list = [int(tid.strip()) for tid in str(track_ids).split(",") if tid.strip()]
+        env["ML_TRACK_IDS"] = ",".join(map(str, track_id_list))
+    if params.get("search_mode"):
+        env["ML_SEARCH_MODE"] = params["search_mode"]
+    if params.get("search_budget_s"):
+        env["ML_SEARCH_BUDGET_S"] = str(params["search_budget_s"])
+    if params.get("models"):
+        env["ML_MODELS"] = params["models"]
+    if params.get("headless"):
+        # Inga grafer: matplotlib/seaborn importeras aldrig i subprocessen
+        env["ML_HEADLESS"] = "1"
+
+    stdout = _run_ml_script(job, "analysis.py", env, "Startar analys...")
+
+    # Läs modellinfo
+    output_dir = ml_dir / "output"
+    model_info_path = output_dir / "gps_correction_model_info.json"
+
+    if model_info_path.exists():
+        with open(model_info_path, "r", encoding="utf-8") as f:
+            model_info = json.load(f)
+
+        # Generera URL för grafer (om de finns)
+        graph_url = None
+        graph_path = output_dir / "gps_analysis.png"
+        if graph_path.exists() and not params.get("headless"):
+            # I production skulle vi behöva serve statiska filer
+            # För nu returnerar vi bara info
+            graph_url = f"/ml/output/gps_analysis.png"
+
+        return {
+            "status": "success",
+            "message": "ML-analys klar",
+            "total_positions": model_info.get("total_positions", 0),
+            "unique_tracks": model_info.get("unique_tracks", 0),
+            "best_model": model_info.get("best_model"),
+            "test_mae": model_info.get("test_mae"),
+            "test_rmse": model_info.get("test_rmse"),
+            "test_r2": model_info.get("test_r2"),
+            "search": model_info.get("search"),
+            "stages": model_info.get("stages"),
+            "graph_url": graph_url,
+            "stdout": stdout[-1000:],  # Sista 1000 tecknen
+        }
+    return {
+        "status": "success",
+        "message": "Analys kördes men modellinfo hittades inte",
+        "stdout": stdout[-1000:],
+    }
+
+
 @app.post("/ml/analyze")
 @app.post("/api/ml/analyze")  # Stöd för frontend som använder /api prefix
-def run_ml_analysis(track_ids: Optional[str] = None):
+def run_ml_analysis(
+    track_ids: Optional[str] = None,
+    search_mode: Optional[Literal["exhaustive", "budget"]] = None,
+    search_budget_s: Optional[float] = Query(None, gt=0),
+    models: Optional[str] = None,
+    headless: bool = False,
+):
     """
-    Kör fullständig ML-analys (tränar modell och genererar visualiseringar)
+    Starta fullständig ML-analys (tränar modell och genererar visualiseringar)
+    som bakgrundsjobb. Returnerar job_id direkt; resultatet hämtas via /jobs/{job_id}.
 
     Args:
         track_ids: Komma-separerad lista av track_ids att använda (om None, använd alla)
+        search_mode: exhaustive (RandomizedSearchCV, default) eller budget
+            (successive halving inom search_budget_s sekunder)
+        search_budget_s: Tidsbudget för hyperparametersökningen i budgetläget
+        models: Komma-separerade modellnycklar (rf, gb, et, xgb); None = alla
+        headless: Hoppa över grafer – bara träning, med tid per steg i resultatet
     """
     try:
-        import subprocess
-        import sys
-
         ml_dir = Path(__file__).parent.parent / "ml"
         analysis_script = ml_dir / "analysis.py"
 
@@ -3599,86 +4509,181 @@ def run_ml_analysis(track_ids: Optional[str] = None):
                 status_code=404, detail=f"Analysscript hittades inte: {analysis_script}"
             )
 
-        # Om specifika spår är valda, exportera bara dessa först
         if track_ids:
-            # Exportera valda spår till ML-data
-            track_id_list = [
-                int(tid.strip()) for tid in track_ids.split(",") if tid.strip()
-            ]
-            track_ids_str = ",".join(map(str, track_id_list))
+            try:
+                [int(tid.strip()) for tid in track_ids.split(",") if tid.strip()]
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Ogiltiga track_ids")
 
-            # Anropa export-endpoint för att skapa JSON-fil med valda spår
-            from fastapi import Request
+        if models:
+            model_keys = [key.strip().lower() for key in models.split(",") if key.strip()]
+            if not model_keys or any(key not in ("rf", "gb", "et", "xgb") for key in model_keys):
+                raise HTTPException(
+                    status_code=400, detail="Ogiltiga modeller (tillatna: rf, gb, et, xgb)"
+                )
+            models = ",".join(model_keys)
 
-            # Vi behöver exportera datan först
-            # För nu, skicka track_ids som environment variable till scriptet
-            env = os.environ.copy()
-            env["ML_TRACK_IDS"] = track_ids_str
-        else:
-            env = os.environ.copy()
+        return _enqueue_job(
+            "ml_analyze",
+            {
+                "track_ids": track_ids,
+                "search_mode": search_mode,
+                "search_budget_s": search_budget_s,
+                "models": models,
+                "headless": headless,
+            },
+        )
 
-        # Kör analysen
-        result = subprocess.run(
-            [sys.executable, str(analysis_script)],
-            cwd=str(ml_dir),
-            capture_output=True,
-            text=True,
-            timeout=600,  # 10 minuter timeout
-            env=env,
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+
+        raise HTTPException(
+            status_code=500,
+            detail=f"Fel vid ML-analys: {str(e)}\n\n{traceback.format_exc()}",
         )
 
-        if result.returncode != 0:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Analys misslyckades:\n{result.stderr}\n\nOutput:\n{result.stdout}",
-            )
 
-        # Läs modellinfo
-        output_dir = ml_dir / "output"
-        model_info_path = output_dir / "gps_correction_model_info.json"
+def _run_ml_update_job(job, params: dict) -> dict:
+    """
+    Jobb: kör ml/update_model.py – inkrementell uppdatering av modellen med
+    rader som inte finns i vattenmärket. Publiceras bara om valideringsfelet
+    inte ökar; sammanfattningen läses från ml/output/incremental_update.json.
+    """
+    env = os.environ.copy()
+    if params.get("max_regression") is not None:
+        env["INCREMENTAL_MAX_REGRESSION"] = str(params["max_regression"])
+    if params.get("min_rows") is not None:
+        env["INCREMENTAL_MIN_ROWS"] = str(params["min_rows"])
+
+    stdout = _run_ml_script(job, "update_model.py", env, "Startar modelluppdatering...")
+
+    report_path = Path(__file__).parent.parent / "ml" / "output" / "incremental_update.json"
+    summary = {}
+    if report_path.exists():
+        with open(report_path, "r", encoding="utf-8") as f:
+            summary = json.load(f)
+    messages = {
+        "published": "Ny modellversion publicerad",
+        "rejected": "Uppdateringen försämrade valideringsfelet – modellen oförändrad",
+        "skipped": "För lite ny data – modellen oförändrad",
+    }
+    return {
+        "status": "success",
+        "message": messages.get(summary.get("status"), "Uppdatering klar"),
+        "update": summary,
+        "stdout": stdout[-1000:],
+    }
 
-        if model_info_path.exists():
-            with open(model_info_path, "r", encoding="utf-8") as f:
-                model_info = json.load(f)
 
-            # Generera URL för grafer (om de finns)
-            graph_url = None
-            graph_path = output_dir / "gps_analysis.png"
-            if graph_path.exists():
-                # I production skulle vi behöva serve statiska filer
-                # För nu returnerar vi bara info
-                graph_url = f"/ml/output/gps_analysis.png"
+@app.post("/ml/update")
+@app.post("/api/ml/update")  # Stöd för frontend som använder /api prefix
+def run_ml_update(
+    max_regression: Optional[float] = Query(None, ge=0),
+    min_rows: Optional[int] = Query(None, ge=1),
+):
+    """
+    Starta en inkrementell modelluppdatering (warm start på ny feedback sedan
+    senaste träningen) som bakgrundsjobb. Kräver en modell tränad med
+    ml/analysis.py efter att vattenmärket infördes.
+
+    Args:
+        max_regression: Tillåten relativ ökning av validerings-MAE (default 0)
+        min_rows: Minsta antal nya träningsrader för att uppdatera (default 50)
+    """
+    try:
+        return _enqueue_job(
+            "ml_update", {"max_regression": max_regression, "min_rows": min_rows}
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Fel vid modelluppdatering: {str(e)}")
+
+
+def _rebuild_features_job(job, params: dict) -> dict:
+    """Jobb: bygg om position_features för spår med saknade/inaktuella rader."""
+    from utils.position_features import FEATURE_SCHEMA_VERSION, rebuild
+
+    conn = get_db()
+    try:
+        cursor = get_cursor(conn)
+        result = rebuild(
+            cursor,
+            DATABASE_URL is not None,
+            params.get("track_ids"),
+            commit=conn.commit,
+            progress=lambda done, total: job.progress(
+                done / total, f"{done} av {total} spår"
+            ),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return {
+        "status": "success",
+        "message": f"Byggde om features för {result['tracks']} spår ({result['rows']} positioner)",
+        "schema_version": FEATURE_SCHEMA_VERSION,
+        **result,
+    }
+
+
+def _enqueue_features_rebuild(track_ids: List[int]) -> Optional[int]:
+    """
+    Lägg ett features_rebuild-jobb för track_ids, om inget redan är köat
+    eller pågår (det tar i så fall även med dessa spår eller nästa export
+    gör det). Returnerar job_id, None om kön inte gick att nå.
+    """
+    try:
+        runner = _get_job_runner()
+        for status in ("queued", "running"):
+            existing = runner.list(status=status, job_type="features_rebuild", limit=1)
+            if existing:
+                return existing[0]["id"]
+        return runner.enqueue("features_rebuild", {"track_ids": track_ids})
+    except Exception as e:
+        print(f"Kunde inte köa ombyggnad av features: {e}")
+        return None
 
-            return {
-                "status": "success",
-                "message": "ML-analys klar",
-                "total_positions": model_info.get("total_positions", 0),
-                "unique_tracks": model_info.get("unique_tracks", 0),
-                "best_model": model_info.get("best_model"),
-                "test_mae": model_info.get("test_mae"),
-                "test_rmse": model_info.get("test_rmse"),
-                "test_r2": model_info.get("test_r2"),
-                "graph_url": graph_url,
-                "stdout": result.stdout[-1000:],  # Sista 1000 tecknen
-            }
-        else:
-            return {
-                "status": "success",
-                "message": "Analys kördes men modellinfo hittades inte",
-                "stdout": result.stdout[-1000:],
-            }
 
-    except subprocess.TimeoutExpired:
-        raise HTTPException(status_code=500, detail="Analys tog för lång tid (>10 min)")
+@app.post("/ml/features/rebuild")
+@app.post("/api/ml/features/rebuild")  # Stöd för frontend som använder /api prefix
+def rebuild_position_features(track_ids: Optional[str] = None):
+    """
+    Bygg om feature store (position_features) som bakgrundsjobb, t.ex. efter
+    att FEATURE_SCHEMA_VERSION i utils/position_features.py höjts.
+
+    Args:
+        track_ids: Komma-separerad lista av spår (None = alla med saknade eller
+            inaktuella features)
+    """
+    try:
+        ids = None
+        if track_ids:
+            try:
+                ids = [int(t.strip()) for t in track_ids.split(",") if t.strip()]
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Ogiltiga track_ids")
+        return _enqueue_job("features_rebuild", {"track_ids": ids})
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
+        raise HTTPException(status_code=500, detail=f"Fel vid ombyggnad av features: {str(e)}")
 
-        raise HTTPException(
-            status_code=500,
-            detail=f"Fel vid ML-analys: {str(e)}\n\n{traceback.format_exc()}",
-        )
+
+@app.get("/ml/features/status")
+@app.get("/api/ml/features/status")  # Stöd för frontend som använder /api prefix
+def position_features_status():
+    """Schemaversion och antal positioner med aktuella/inaktuella/saknade features."""
+    try:
+        from utils.position_features import status
+
+        conn = get_db()
+        try:
+            return {"status": "success", **status(get_cursor(conn), DATABASE_URL is not None)}
+        finally:
+            conn.close()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Fel vid hämtning av feature-status: {str(e)}")
 
 
 @app.post("/ml/apply-correction/{track_id}")
@@ -3692,18 +4697,9 @@ def apply_ml_correction(track_id: int):
         from datetime import datetime
         import math
 
-        # Ladda modell och scaler
+        # Ladda modell och scaler (kompakt format om det finns, se _load_serving_model)
         ml_dir = Path(__file__).parent.parent / "ml" / "output"
-        model_path = ml_dir / "gps_correction_model_best.pkl"
-        scaler_path = ml_dir / "gps_correction_scaler.pkl"
-        feature_names_path = ml_dir / "gps_correction_feature_names.pkl"
-
-        if not model_path.exists():
-            raise HTTPException(status_code=404, detail="Ingen tränad modell hittades")
-
-        model = _load_ml_pkl(model_path)
-        scaler = _load_ml_pkl(scaler_path)
-        _ = _load_ml_pkl(feature_names_path)
+        model, scaler = _load_serving_model()
 
         # Hämta spåret och positioner
         conn = get_db()
@@ -3750,10 +4746,23 @@ def apply_ml_correction(track_id: int):
         except Exception:
             pass
 
-        # Förbered features för varje position
-        corrected_count = 0
+        # Kinematiska features läses från feature store (utils/position_features.py)
+        from utils.position_features import load_track_features
 
-        for i, pos in enumerate(positions):
+        stored_features = load_track_features(
+            cursor,
+            DATABASE_URL is not None,
+            track_id,
+            [get_row_value(p, "id") for p in positions],
+        )
+
+        # Förbered features för alla positioner (en rad per position)
+        n_positions = len(positions)
+        if n_positions > 1:
+            mean_lat = float(np.mean([get_row_value(p, "position_lat") for p in positions]))
+            mean_lng = float(np.mean([get_row_value(p, "position_lng") for p in positions]))
+        rows = []
+        for pos in positions:
             pos_id = get_row_value(pos, "id")
             orig_lat = get_row_value(pos, "position_lat")
             orig_lng = get_row_value(pos, "position_lng")
@@ -3771,13 +4780,7 @@ def apply_ml_correction(track_id: int):
             features.extend([orig_lat, orig_lng])
 
             # Normaliserad position (använd medelvärde för spåret)
-            if len(positions) > 1:
-                mean_lat = np.mean(
-                    [get_row_value(p, "position_lat") for p in positions]
-                )
-                mean_lng = np.mean(
-                    [get_row_value(p, "position_lng") for p in positions]
-                )
+            if n_positions > 1:
                 features.extend([orig_lat - mean_lat, orig_lng - mean_lng])
             else:
                 features.extend([0.0, 0.0])
@@ -3800,78 +4803,18 @@ def apply_ml_correction(track_id: int):
             except Exception:
                 features.extend([0.0, 1.0, 0.0, 1.0])
 
-            # Hastighet, acceleration, etc. (förenklad - använd tidigare positioner)
-            speed = 0.0
-            acceleration = 0.0
-            distance_prev_1 = 0.0
-            distance_prev_2 = 0.0
-            distance_prev_3 = 0.0
-            bearing = 0.0
-
-            if i > 0:
-                prev_pos = positions[i - 1]
-                prev_lat = get_row_value(prev_pos, "position_lat")
-                prev_lng = get_row_value(prev_pos, "position_lng")
-
-                # Haversine distance
-                R = 6371000
-                phi1 = math.radians(prev_lat)
-                phi2 = math.radians(orig_lat)
-                delta_phi = math.radians(orig_lat - prev_lat)
-                delta_lambda = math.radians(orig_lng - prev_lng)
-                a = (
-                    math.sin(delta_phi / 2) ** 2
-                    + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2) ** 2
-                )
-                c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-                distance_prev_1 = R * c
-
-                # Hastighet
-                try:
-                    curr_time = datetime.fromisoformat(
-                        timestamp_str.replace("Z", "+00:00")
-                    )
-                    prev_timestamp = _to_iso_str(
-                        get_row_value(prev_pos, "timestamp")
-                    )
-                    prev_time = datetime.fromisoformat(
-                        prev_timestamp.replace("Z", "+00:00")
-                    )
-                    time_diff = (curr_time - prev_time).total_seconds()
-                    if time_diff > 0:
-                        speed = distance_prev_1 / time_diff
-                except Exception:
-                    pass
-
-                # Bearing
-                try:
-                    lat1_rad = math.radians(prev_lat)
-                    lat2_rad = math.radians(orig_lat)
-                    delta_lng = math.radians(orig_lng - prev_lng)
-                    y = math.sin(delta_lng) * math.cos(lat2_rad)
-                    x = math.cos(lat1_rad) * math.sin(lat2_rad) - math.sin(
-                        lat1_rad
-                    ) * math.cos(lat2_rad) * math.cos(delta_lng)
-                    bearing = math.degrees(math.atan2(y, x))
-                    if bearing < 0:
-                        bearing += 360
-                except Exception:
-                    pass
-
-                # Acceleration
-                if i > 1:
-                    # Förenklad - hoppa över komplexa beräkningar
-                    distance_prev_2 = 0.0
-                    distance_prev_3 = 0.0
-
+            # Hastighet, acceleration, avstånd bakåt och riktning (feature store)
+            stored = stored_features[pos_id]
+            speed = stored["speed"]
+            distance_prev_1 = stored["distance_prev_1"]
             features.extend(
                 [
-                    speed,
-                    acceleration,
-                    distance_prev_1,
-                    distance_prev_2,
-                    distance_prev_3,
-                    bearing,
+                    stored["speed"],
+                    stored["acceleration"],
+                    stored["distance_prev_1"],
+                    stored["distance_prev_2"],
+                    stored["distance_prev_3"],
+                    stored["bearing"],
                 ]
             )
 
@@ -3884,80 +4827,83 @@ def apply_ml_correction(track_id: int):
             features.extend(
                 [accuracy * speed, accuracy * distance_prev_1, speed * distance_prev_1]
             )
+            rows.append(features)
 
-            # Förutsäg korrigeringsavstånd och confidence (ensemble tree std → osäkerhet)
-            X = np.array([features])
-            X_scaled = scaler.transform(X)
-            predicted_correction, confidence = _predict_with_confidence(
-                model, X_scaled, use_tree_std=True
-            )
+        # Förutsäg korrigeringsavstånd och confidence för hela spåret i ett anrop
+        # (ensemble tree std → osäkerhet)
+        X_scaled = scaler.transform(np.array(rows, dtype=float))
+        predicted, confidences = _predict_with_confidence_batch(
+            model, X_scaled, use_tree_std=True
+        )
 
-            # Beräkna korrigerad position (förenklad - använd riktning från bearing)
-            # I verkligheten skulle vi behöva mer sofistikerad logik
-            if predicted_correction > 0.1:  # Bara korrigera om förutsägelsen är > 10cm
-                # Förenklad korrigering: flytta mot medelvärdet för spåret
-                if len(positions) > 1:
-                    mean_lat = np.mean(
-                        [get_row_value(p, "position_lat") for p in positions]
-                    )
-                    mean_lng = np.mean(
-                        [get_row_value(p, "position_lng") for p in positions]
+        # Beräkna korrigerade positioner (förenklad: flytta mot medelvärdet för
+        # spåret, proportionellt till förutsagt fel, max 50 %). Bara om
+        # förutsägelsen är > 10 cm och spåret har fler än en position.
+        corrections = []
+        if n_positions > 1:
+            orig = np.array(
+                [[get_row_value(p, "position_lat"), get_row_value(p, "position_lng")] for p in positions],
+                dtype=float,
+            )
+            factor = np.minimum(predicted / 10.0, 0.5)
+            corrected_lat = orig[:, 0] + (mean_lat - orig[:, 0]) * factor
+            corrected_lng = orig[:, 1] + (mean_lng - orig[:, 1]) * factor
+            for i in np.flatnonzero(predicted > 0.1):
+                corrections.append(
+                    (
+                        get_row_value(positions[i], "id"),
+                        float(corrected_lat[i]),
+                        float(corrected_lng[i]),
+                        float(confidences[i]),
                     )
+                )
 
-                    # Korrigera mot medelvärdet (proportionellt till förutsägt fel)
-                    correction_factor = min(
-                        predicted_correction / 10.0, 0.5
-                    )  # Max 50% korrigering
-                    corrected_lat = orig_lat + (mean_lat - orig_lat) * correction_factor
-                    corrected_lng = orig_lng + (mean_lng - orig_lng) * correction_factor
+        # FAS 1: truth_level=T2, ml_confidence, ml_model_version, correction_source='ml'.
+        # Positioner och audit-rader skrivs mängdbaserat i samma transaktion –
+        # hela spåret eller inget.
+        from utils.position_corrections import write_ml_corrections
 
-                    # FAS 1: Uppdatera positionen med truth_level=T2, ml_confidence, ml_model_version, correction_source='ml'
-                    execute_query(
-                        cursor,
-                        """
-                        UPDATE track_positions
-                        SET corrected_lat = %s, 
-                            corrected_lng = %s,
-                            corrected_at = %s,
-                            truth_level = 'T2',
-                            ml_confidence = %s,
-                            ml_model_version = %s,
-                            correction_source = 'ml'
-                        WHERE id = %s
-                        """,
-                        (
-                            corrected_lat,
-                            corrected_lng,
-                            datetime.now().isoformat(),
-                            confidence,
-                            model_version,
-                            pos_id,
-                        ),
-                    )
-                    _audit_log(
-                        cursor,
-                        position_id=pos_id,
-                        track_id=track_id,
-                        action="ml_correction",
-                        new_value={
-                            "corrected_lat": corrected_lat,
-                            "corrected_lng": corrected_lng,
+        try:
+            corrected_count = write_ml_corrections(
+                cursor,
+                DATABASE_URL is not None,
+                corrections,
+                corrected_at=datetime.now().isoformat(),
+                model_version=model_version,
+            )
+            _audit_log_many(
+                cursor,
+                [
+                    {
+                        "position_id": pos_id,
+                        "track_id": track_id,
+                        "action": "ml_correction",
+                        "new_value": {
+                            "corrected_lat": lat,
+                            "corrected_lng": lng,
                             "truth_level": "T2",
                             "correction_source": "ml",
                             "ml_confidence": confidence,
                             "ml_model_version": model_version,
                         },
-                    )
-                    corrected_count += 1
-
-        conn.commit()
-        conn.close()
+                    }
+                    for pos_id, lat, lng, confidence in corrections
+                ],
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
 
         return {
             "status": "success",
             "message": f"ML-korrigering tillämpad på {corrected_count} positioner",
             "corrected_count": corrected_count,
-            "total_positions": len(positions),
+            "total_positions": n_positions,
+            "below_threshold": n_positions - len(corrections),
+            "audit_rows": len(corrections),
         }
 
     except HTTPException:
@@ -3984,18 +4930,8 @@ def predict_ml_corrections(track_id: int):
         from datetime import datetime
         import math
 
-        # Ladda modell och scaler
-        ml_dir = Path(__file__).parent.parent / "ml" / "output"
-        model_path = ml_dir / "gps_correction_model_best.pkl"
-        scaler_path = ml_dir / "gps_correction_scaler.pkl"
-        feature_names_path = ml_dir / "gps_correction_feature_names.pkl"
-
-        if not model_path.exists():
-            raise HTTPException(status_code=404, detail="Ingen tränad modell hittades")
-
-        model = _load_ml_pkl(model_path)
-        scaler = _load_ml_pkl(scaler_path)
-        _ = _load_ml_pkl(feature_names_path)
+        # Ladda modell och scaler (kompakt format om det finns, se _load_serving_model)
+        model, scaler = _load_serving_model()
 
         # Hämta spåret och positioner
         conn = get_db()
@@ -4026,13 +4962,25 @@ def predict_ml_corrections(track_id: int):
             (track_id,),
         )
         positions = cursor.fetchall()
-        conn.close()
 
         if not positions:
+            conn.close()
             raise HTTPException(
                 status_code=404, detail="Inga positioner hittades för spåret"
             )
 
+        # Kinematiska features läses från feature store (utils/position_features.py)
+        from utils.position_features import load_track_features
+
+        stored_features = load_track_features(
+            cursor,
+            DATABASE_URL is not None,
+            track_id,
+            [get_row_value(p, "id") for p in positions],
+        )
+        conn.commit()
+        conn.close()
+
         # Beräkna medelvärde för normalisering
         mean_lat = np.mean([get_row_value(p, "position_lat") for p in positions])
         mean_lng = np.mean([get_row_value(p, "position_lng") for p in positions])
@@ -4087,145 +5035,36 @@ def predict_ml_corrections(track_id: int):
             except Exception:
                 features.extend([0.0, 1.0, 0.0, 1.0])
 
-            # Hastighet, acceleration, etc.
-            speed = 0.0
-            acceleration = 0.0
-            distance_prev_1 = 0.0
-            distance_prev_2 = 0.0
-            distance_prev_3 = 0.0
-            bearing = 0.0
-
-            if i > 0:
-                prev_pos = positions[i - 1]
-                prev_lat = get_row_value(prev_pos, "position_lat")
-                prev_lng = get_row_value(prev_pos, "position_lng")
+            # Hastighet, acceleration, avstånd bakåt och riktning (feature store)
+            stored = stored_features[pos_id]
+            speed = stored["speed"]
+            distance_prev_1 = stored["distance_prev_1"]
+            features.extend(
+                [
+                    stored["speed"],
+                    stored["acceleration"],
+                    stored["distance_prev_1"],
+                    stored["distance_prev_2"],
+                    stored["distance_prev_3"],
+                    stored["bearing"],
+                ]
+            )
 
-                # Haversine distance
-                R = 6371000
-                phi1 = math.radians(prev_lat)
-                phi2 = math.radians(orig_lat)
-                delta_phi = math.radians(orig_lat - prev_lat)
-                delta_lambda = math.radians(orig_lng - prev_lng)
-                a = (
-                    math.sin(delta_phi / 2) ** 2
-                    + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2) ** 2
+            # Rolling statistics - beräkna från tidigare förutsägelser
+            # Använd historiken från tidigare positioner i samma spår
+            if i >= 2 and len(predicted_corrections_history) >= 2:
+                # Använd de senaste 2 förutsägelserna (för att matcha träningen som använder max(0, i-2) till i)
+                recent_corrections = predicted_corrections_history[-2:]
+                recent_mean = float(np.mean(recent_corrections))
+                recent_std = (
+                    float(np.std(recent_corrections))
+                    if len(recent_corrections) > 1
+                    else 0.0
                 )
-                c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-                distance_prev_1 = R * c
-
-                # Hastighet
-                try:
-                    curr_time = datetime.fromisoformat(
-                        timestamp_str.replace("Z", "+00:00")
-                    )
-                    prev_timestamp = _to_iso_str(
-                        get_row_value(prev_pos, "timestamp")
-                    )
-                    prev_time = datetime.fromisoformat(
-                        prev_timestamp.replace("Z", "+00:00")
-                    )
-                    time_diff = (curr_time - prev_time).total_seconds()
-                    if time_diff > 0:
-                        speed = distance_prev_1 / time_diff
-                except Exception:
-                    pass
-
-                # Bearing
-                try:
-                    lat1_rad = math.radians(prev_lat)
-                    lat2_rad = math.radians(orig_lat)
-                    delta_lng = math.radians(orig_lng - prev_lng)
-                    y = math.sin(delta_lng) * math.cos(lat2_rad)
-                    x = math.cos(lat1_rad) * math.sin(lat2_rad) - math.sin(
-                        lat1_rad
-                    ) * math.cos(lat2_rad) * math.cos(delta_lng)
-                    bearing = math.degrees(math.atan2(y, x))
-                    if bearing < 0:
-                        bearing += 360
-                except Exception:
-                    pass
-
-                # Acceleration och distance_prev_2/3
-                if i > 1:
-                    prev2_pos = positions[i - 2]
-                    prev2_lat = get_row_value(prev2_pos, "position_lat")
-                    prev2_lng = get_row_value(prev2_pos, "position_lng")
-
-                    # Distance prev 2
-                    phi1_prev = math.radians(prev2_lat)
-                    phi2_prev = math.radians(prev_lat)
-                    delta_phi_prev = math.radians(prev_lat - prev2_lat)
-                    delta_lambda_prev = math.radians(prev_lng - prev2_lng)
-                    a_prev = (
-                        math.sin(delta_phi_prev / 2) ** 2
-                        + math.cos(phi1_prev)
-                        * math.cos(phi2_prev)
-                        * math.sin(delta_lambda_prev / 2) ** 2
-                    )
-                    c_prev = 2 * math.atan2(math.sqrt(a_prev), math.sqrt(1 - a_prev))
-                    distance_prev_2 = R * c_prev
-
-                    # Acceleration
-                    try:
-                        prev2_timestamp = get_row_value(prev2_pos, "timestamp")
-                        prev2_time = datetime.fromisoformat(
-                            prev2_timestamp.replace("Z", "+00:00")
-                        )
-                        time_diff_prev = (prev_time - prev2_time).total_seconds()
-                        if time_diff_prev > 0:
-                            prev_speed = distance_prev_2 / time_diff_prev
-                            if time_diff > 0:
-                                acceleration = (speed - prev_speed) / time_diff
-                    except Exception:
-                        pass
-
-                    # Distance prev 3
-                    if i > 2:
-                        prev3_pos = positions[i - 3]
-                        prev3_lat = get_row_value(prev3_pos, "position_lat")
-                        prev3_lng = get_row_value(prev3_pos, "position_lng")
-
-                        phi1_prev3 = math.radians(prev3_lat)
-                        phi2_prev3 = math.radians(prev2_lat)
-                        delta_phi_prev3 = math.radians(prev2_lat - prev3_lat)
-                        delta_lambda_prev3 = math.radians(prev2_lng - prev3_lng)
-                        a_prev3 = (
-                            math.sin(delta_phi_prev3 / 2) ** 2
-                            + math.cos(phi1_prev3)
-                            * math.cos(phi2_prev3)
-                            * math.sin(delta_lambda_prev3 / 2) ** 2
-                        )
-                        c_prev3 = 2 * math.atan2(
-                            math.sqrt(a_prev3), math.sqrt(1 - a_prev3)
-                        )
-                        distance_prev_3 = R * c_prev3
-
-            features.extend(
-                [
-                    speed,
-                    acceleration,
-                    distance_prev_1,
-                    distance_prev_2,
-                    distance_prev_3,
-                    bearing,
-                ]
-            )
-
-            # Rolling statistics - beräkna från tidigare förutsägelser
-            # Använd historiken från tidigare positioner i samma spår
-            if i >= 2 and len(predicted_corrections_history) >= 2:
-                # Använd de senaste 2 förutsägelserna (för att matcha träningen som använder max(0, i-2) till i)
-                recent_corrections = predicted_corrections_history[-2:]
-                recent_mean = float(np.mean(recent_corrections))
-                recent_std = (
-                    float(np.std(recent_corrections))
-                    if len(recent_corrections) > 1
-                    else 0.0
-                )
-            else:
-                recent_mean = 0.0
-                recent_std = 0.0
-            features.extend([recent_mean, recent_std])
+            else:
+                recent_mean = 0.0
+                recent_std = 0.0
+            features.extend([recent_mean, recent_std])
 
             # Interaktioner
             features.extend(
@@ -4248,136 +5087,14 @@ def predict_ml_corrections(track_id: int):
                 env_value = 1.0 if environment == env_cat else 0.0
                 features.append(env_value)
 
-            # Smoothing features (spår-jämnhet)
-            # Kurvatur
-            curvature = 0.0
-            if i > 0 and i < len(positions) - 1:
-                try:
-                    prev_pos = positions[i - 1]
-                    next_pos = positions[i + 1]
-                    prev_lat = get_row_value(prev_pos, "position_lat")
-                    prev_lng = get_row_value(prev_pos, "position_lng")
-                    next_lat = get_row_value(next_pos, "position_lat")
-                    next_lng = get_row_value(next_pos, "position_lng")
-
-                    # Beräkna riktning för segment 1 (prev -> curr)
-                    lat1_rad = math.radians(prev_lat)
-                    lat2_rad = math.radians(orig_lat)
-                    delta_lng1 = math.radians(orig_lng - prev_lng)
-                    y1 = math.sin(delta_lng1) * math.cos(lat2_rad)
-                    x1 = math.cos(lat1_rad) * math.sin(lat2_rad) - math.sin(
-                        lat1_rad
-                    ) * math.cos(lat2_rad) * math.cos(delta_lng1)
-                    bearing1 = math.atan2(y1, x1)
-
-                    # Beräkna riktning för segment 2 (curr -> next)
-                    lat3_rad = math.radians(next_lat)
-                    delta_lng2 = math.radians(next_lng - orig_lng)
-                    y2 = math.sin(delta_lng2) * math.cos(lat3_rad)
-                    x2 = math.cos(lat2_rad) * math.sin(lat3_rad) - math.sin(
-                        lat2_rad
-                    ) * math.cos(lat3_rad) * math.cos(delta_lng2)
-                    bearing2 = math.atan2(y2, x2)
-
-                    # Kurvatur = skillnaden i riktning
-                    curvature = abs(bearing1 - bearing2)
-                    if curvature > math.pi:
-                        curvature = 2 * math.pi - curvature
-                except Exception:
-                    pass
-
-            # Hastighetsvariation (speed consistency)
-            speed_consistency = 0.0
-            if len(positions) >= 2:
-                try:
-                    speeds = []
-                    window = 5
-                    start_idx = max(0, i - window)
-                    end_idx = min(len(positions), i + window + 1)
-
-                    for j in range(start_idx, end_idx - 1):
-                        if j >= len(positions) - 1:
-                            break
-                        p1 = positions[j]
-                        p2 = positions[j + 1]
-                        lat1 = get_row_value(p1, "position_lat")
-                        lng1 = get_row_value(p1, "position_lng")
-                        lat2 = get_row_value(p2, "position_lat")
-                        lng2 = get_row_value(p2, "position_lng")
-
-                        R = 6371000
-                        phi1 = math.radians(lat1)
-                        phi2 = math.radians(lat2)
-                        delta_phi = math.radians(lat2 - lat1)
-                        delta_lambda = math.radians(lng2 - lng1)
-                        a = (
-                            math.sin(delta_phi / 2) ** 2
-                            + math.cos(phi1)
-                            * math.cos(phi2)
-                            * math.sin(delta_lambda / 2) ** 2
-                        )
-                        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-                        dist = R * c
-
-                        try:
-                            time1 = datetime.fromisoformat(
-                                get_row_value(p1, "timestamp").replace("Z", "+00:00")
-                            )
-                            time2 = datetime.fromisoformat(
-                                get_row_value(p2, "timestamp").replace("Z", "+00:00")
-                            )
-                            time_diff = (time2 - time1).total_seconds()
-                            if time_diff > 0:
-                                speeds.append(dist / time_diff)
-                        except Exception:
-                            pass
-
-                    if len(speeds) >= 2:
-                        speed_consistency = float(np.std(speeds))
-                except Exception:
-                    pass
-
-            # Position-jump
-            position_jump = 0.0
-            if i > 0 and speed > 0:
-                try:
-                    prev_pos = positions[i - 1]
-                    prev_lat = get_row_value(prev_pos, "position_lat")
-                    prev_lng = get_row_value(prev_pos, "position_lng")
-                    prev_time_str = get_row_value(prev_pos, "timestamp")
-
-                    curr_time = datetime.fromisoformat(
-                        timestamp_str.replace("Z", "+00:00")
-                    )
-                    prev_time = datetime.fromisoformat(
-                        prev_time_str.replace("Z", "+00:00")
-                    )
-                    time_diff = (curr_time - prev_time).total_seconds()
-
-                    if time_diff > 0:
-                        # Förväntad avstånd
-                        expected_distance = speed * time_diff
-
-                        # Faktiskt avstånd
-                        R = 6371000
-                        phi1 = math.radians(prev_lat)
-                        phi2 = math.radians(orig_lat)
-                        delta_phi = math.radians(orig_lat - prev_lat)
-                        delta_lambda = math.radians(orig_lng - prev_lng)
-                        a = (
-                            math.sin(delta_phi / 2) ** 2
-                            + math.cos(phi1)
-                            * math.cos(phi2)
-                            * math.sin(delta_lambda / 2) ** 2
-                        )
-                        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-                        actual_distance = R * c
-
-                        position_jump = abs(actual_distance - expected_distance)
-                except Exception:
-                    pass
-
-            features.extend([curvature, speed_consistency, position_jump])
+            # Smoothing features (spår-jämnhet): kurvatur, hastighetsvariation, position-jump
+            features.extend(
+                [
+                    stored["curvature"],
+                    stored["speed_consistency"],
+                    stored["position_jump"],
+                ]
+            )
 
             # Matchning features (närhetsmatchning med människaspår för hundspår)
             distance_to_human = 999.0
@@ -4687,16 +5404,12 @@ def predict_ml_corrections(track_id: int):
                 "median_error_meters": float(np.median(prediction_errors)),
             }
 
-        # Spara till JSON-fil
-        predictions_dir = Path(__file__).parent.parent / "ml" / "predictions"
-        predictions_dir.mkdir(exist_ok=True)
-
+        # Spara i prediction store (filnamnet är körningens id)
         timestamp_str = datetime.now().strftime("%Y%m%d_%H%M%S")
         safe_track_name = "".join(
             c if c.isalnum() or c in ("-", "_") else "_" for c in track_name
         )
         filename = f"predictions_{safe_track_name}_{track_id}_{timestamp_str}.json"
-        filepath = predictions_dir / filename
 
         result = {
             "track_id": track_id,
@@ -4707,19 +5420,13 @@ def predict_ml_corrections(track_id: int):
             "predictions": predictions,
         }
 
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(
-                result,
-                f,
-                indent=2,
-                ensure_ascii=False,
-                default=lambda o: o.isoformat() if hasattr(o, "isoformat") else str(o),
-            )
+        _save_prediction_run(filename, result)
 
         return {
             "status": "success",
             "message": f"Förutsägelser genererade för {total_positions} positioner",
-            "filepath": str(filepath.relative_to(Path(__file__).parent.parent)),
+            "filename": filename,
+            "filepath": f"ml/predictions/{filename}",
             "statistics": statistics,
             "predictions_count": len(predictions),
         }
@@ -4757,18 +5464,10 @@ def predict_ml_corrections_multiple(
         if not track_id_list:
             raise HTTPException(status_code=400, detail="Inga track_ids angivna")
 
-        # Ladda modell och scaler
-        ml_dir = Path(__file__).parent.parent / "ml" / "output"
-        model_path = ml_dir / "gps_correction_model_best.pkl"
-        scaler_path = ml_dir / "gps_correction_scaler.pkl"
-        feature_names_path = ml_dir / "gps_correction_feature_names.pkl"
-
-        if not model_path.exists():
-            raise HTTPException(status_code=404, detail="Ingen tränad modell hittades")
+        # Ladda modell och scaler (kompakt format om det finns, se _load_serving_model)
+        model, scaler = _load_serving_model()
 
-        model = _load_ml_pkl(model_path)
-        scaler = _load_ml_pkl(scaler_path)
-        _ = _load_ml_pkl(feature_names_path)
+        from utils.position_features import load_track_features
 
         # Hämta alla spår och positioner
         conn = get_db()
@@ -4812,9 +5511,17 @@ def predict_ml_corrections_multiple(
                     "track_name": track_name,
                     "track_type": track_type,
                     "positions": positions,
+                    # Kinematiska features från feature store (utils/position_features.py)
+                    "features": load_track_features(
+                        cursor,
+                        DATABASE_URL is not None,
+                        track_id,
+                        [get_row_value(p, "id") for p in positions],
+                    ),
                 }
             )
 
+        conn.commit()
         conn.close()
 
         if not all_tracks_data:
@@ -4838,6 +5545,7 @@ def predict_ml_corrections_multiple(
             track_name = track_data["track_name"]
             track_type = track_data["track_type"]
             positions = track_data["positions"]
+            stored_features = track_data["features"]
 
             predicted_corrections_history = []  # Per spår
 
@@ -4885,131 +5593,18 @@ def predict_ml_corrections_multiple(
                 except Exception:
                     features.extend([0.0, 1.0, 0.0, 1.0])
 
-                # Hastighet, acceleration, etc. (samma logik som i predict_ml_corrections)
-                speed = 0.0
-                acceleration = 0.0
-                distance_prev_1 = 0.0
-                distance_prev_2 = 0.0
-                distance_prev_3 = 0.0
-                bearing = 0.0
-
-                if i > 0:
-                    prev_pos = positions[i - 1]
-                    prev_lat = get_row_value(prev_pos, "position_lat")
-                    prev_lng = get_row_value(prev_pos, "position_lng")
-
-                    # Haversine distance
-                    R = 6371000
-                    phi1 = math.radians(prev_lat)
-                    phi2 = math.radians(orig_lat)
-                    delta_phi = math.radians(orig_lat - prev_lat)
-                    delta_lambda = math.radians(orig_lng - prev_lng)
-                    a = (
-                        math.sin(delta_phi / 2) ** 2
-                        + math.cos(phi1)
-                        * math.cos(phi2)
-                        * math.sin(delta_lambda / 2) ** 2
-                    )
-                    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-                    distance_prev_1 = R * c
-
-                    # Hastighet
-                    try:
-                        curr_time = datetime.fromisoformat(
-                            timestamp_str.replace("Z", "+00:00")
-                        )
-                        prev_timestamp = _to_iso_str(
-                            get_row_value(prev_pos, "timestamp")
-                        )
-                        prev_time = datetime.fromisoformat(
-                            prev_timestamp.replace("Z", "+00:00")
-                        )
-                        time_diff = (curr_time - prev_time).total_seconds()
-                        if time_diff > 0:
-                            speed = distance_prev_1 / time_diff
-                    except Exception:
-                        pass
-
-                    # Bearing
-                    try:
-                        lat1_rad = math.radians(prev_lat)
-                        lat2_rad = math.radians(orig_lat)
-                        delta_lng = math.radians(orig_lng - prev_lng)
-                        y = math.sin(delta_lng) * math.cos(lat2_rad)
-                        x = math.cos(lat1_rad) * math.sin(lat2_rad) - math.sin(
-                            lat1_rad
-                        ) * math.cos(lat2_rad) * math.cos(delta_lng)
-                        bearing = math.degrees(math.atan2(y, x))
-                        if bearing < 0:
-                            bearing += 360
-                    except Exception:
-                        pass
-
-                    # Acceleration och distance_prev_2/3
-                    if i > 1:
-                        prev2_pos = positions[i - 2]
-                        prev2_lat = get_row_value(prev2_pos, "position_lat")
-                        prev2_lng = get_row_value(prev2_pos, "position_lng")
-
-                        # Distance prev 2
-                        phi1_prev = math.radians(prev2_lat)
-                        phi2_prev = math.radians(prev_lat)
-                        delta_phi_prev = math.radians(prev_lat - prev2_lat)
-                        delta_lambda_prev = math.radians(prev_lng - prev2_lng)
-                        a_prev = (
-                            math.sin(delta_phi_prev / 2) ** 2
-                            + math.cos(phi1_prev)
-                            * math.cos(phi2_prev)
-                            * math.sin(delta_lambda_prev / 2) ** 2
-                        )
-                        c_prev = 2 * math.atan2(
-                            math.sqrt(a_prev), math.sqrt(1 - a_prev)
-                        )
-                        distance_prev_2 = R * c_prev
-
-                        # Acceleration
-                        try:
-                            prev2_timestamp = get_row_value(prev2_pos, "timestamp")
-                            prev2_time = datetime.fromisoformat(
-                                prev2_timestamp.replace("Z", "+00:00")
-                            )
-                            time_diff_prev = (prev_time - prev2_time).total_seconds()
-                            if time_diff_prev > 0:
-                                prev_speed = distance_prev_2 / time_diff_prev
-                                if time_diff > 0:
-                                    acceleration = (speed - prev_speed) / time_diff
-                        except Exception:
-                            pass
-
-                        # Distance prev 3
-                        if i > 2:
-                            prev3_pos = positions[i - 3]
-                            prev3_lat = get_row_value(prev3_pos, "position_lat")
-                            prev3_lng = get_row_value(prev3_pos, "position_lng")
-
-                            phi1_prev3 = math.radians(prev3_lat)
-                            phi2_prev3 = math.radians(prev2_lat)
-                            delta_phi_prev3 = math.radians(prev2_lat - prev3_lat)
-                            delta_lambda_prev3 = math.radians(prev2_lng - prev3_lng)
-                            a_prev3 = (
-                                math.sin(delta_phi_prev3 / 2) ** 2
-                                + math.cos(phi1_prev3)
-                                * math.cos(phi2_prev3)
-                                * math.sin(delta_lambda_prev3 / 2) ** 2
-                            )
-                            c_prev3 = 2 * math.atan2(
-                                math.sqrt(a_prev3), math.sqrt(1 - a_prev3)
-                            )
-                            distance_prev_3 = R * c_prev3
-
+                # Hastighet, acceleration, avstånd bakåt och riktning (feature store)
+                stored = stored_features[pos_id]
+                speed = stored["speed"]
+                distance_prev_1 = stored["distance_prev_1"]
                 features.extend(
                     [
-                        speed,
-                        acceleration,
-                        distance_prev_1,
-                        distance_prev_2,
-                        distance_prev_3,
-                        bearing,
+                        stored["speed"],
+                        stored["acceleration"],
+                        stored["distance_prev_1"],
+                        stored["distance_prev_2"],
+                        stored["distance_prev_3"],
+                        stored["bearing"],
                     ]
                 )
 
@@ -5052,140 +5647,14 @@ def predict_ml_corrections_multiple(
                     env_value = 1.0 if environment == env_cat else 0.0
                     features.append(env_value)
 
-                # Smoothing features (spår-jämnhet) - samma som i predict_ml_corrections
-                # Kurvatur
-                curvature = 0.0
-                if i > 0 and i < len(positions) - 1:
-                    try:
-                        prev_pos = positions[i - 1]
-                        next_pos = positions[i + 1]
-                        prev_lat = get_row_value(prev_pos, "position_lat")
-                        prev_lng = get_row_value(prev_pos, "position_lng")
-                        next_lat = get_row_value(next_pos, "position_lat")
-                        next_lng = get_row_value(next_pos, "position_lng")
-
-                        # Beräkna riktning för segment 1 (prev -> curr)
-                        lat1_rad = math.radians(prev_lat)
-                        lat2_rad = math.radians(orig_lat)
-                        delta_lng1 = math.radians(orig_lng - prev_lng)
-                        y1 = math.sin(delta_lng1) * math.cos(lat2_rad)
-                        x1 = math.cos(lat1_rad) * math.sin(lat2_rad) - math.sin(
-                            lat1_rad
-                        ) * math.cos(lat2_rad) * math.cos(delta_lng1)
-                        bearing1 = math.atan2(y1, x1)
-
-                        # Beräkna riktning för segment 2 (curr -> next)
-                        lat3_rad = math.radians(next_lat)
-                        delta_lng2 = math.radians(next_lng - orig_lng)
-                        y2 = math.sin(delta_lng2) * math.cos(lat3_rad)
-                        x2 = math.cos(lat2_rad) * math.sin(lat3_rad) - math.sin(
-                            lat2_rad
-                        ) * math.cos(lat3_rad) * math.cos(delta_lng2)
-                        bearing2 = math.atan2(y2, x2)
-
-                        # Kurvatur = skillnaden i riktning
-                        curvature = abs(bearing1 - bearing2)
-                        if curvature > math.pi:
-                            curvature = 2 * math.pi - curvature
-                    except Exception:
-                        pass
-
-                # Hastighetsvariation (speed consistency)
-                speed_consistency = 0.0
-                if len(positions) >= 2:
-                    try:
-                        speeds = []
-                        window = 5
-                        start_idx = max(0, i - window)
-                        end_idx = min(len(positions), i + window + 1)
-
-                        for j in range(start_idx, end_idx - 1):
-                            if j >= len(positions) - 1:
-                                break
-                            p1 = positions[j]
-                            p2 = positions[j + 1]
-                            lat1 = get_row_value(p1, "position_lat")
-                            lng1 = get_row_value(p1, "position_lng")
-                            lat2 = get_row_value(p2, "position_lat")
-                            lng2 = get_row_value(p2, "position_lng")
-
-                            R = 6371000
-                            phi1 = math.radians(lat1)
-                            phi2 = math.radians(lat2)
-                            delta_phi = math.radians(lat2 - lat1)
-                            delta_lambda = math.radians(lng2 - lng1)
-                            a = (
-                                math.sin(delta_phi / 2) ** 2
-                                + math.cos(phi1)
-                                * math.cos(phi2)
-                                * math.sin(delta_lambda / 2) ** 2
-                            )
-                            c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-                            dist = R * c
-
-                            try:
-                                time1 = datetime.fromisoformat(
-                                    get_row_value(p1, "timestamp").replace(
-                                        "Z", "+00:00"
-                                    )
-                                )
-                                time2 = datetime.fromisoformat(
-                                    get_row_value(p2, "timestamp").replace(
-                                        "Z", "+00:00"
-                                    )
-                                )
-                                time_diff = (time2 - time1).total_seconds()
-                                if time_diff > 0:
-                                    speeds.append(dist / time_diff)
-                            except Exception:
-                                pass
-
-                        if len(speeds) >= 2:
-                            speed_consistency = float(np.std(speeds))
-                    except Exception:
-                        pass
-
-                # Position-jump
-                position_jump = 0.0
-                if i > 0 and speed > 0:
-                    try:
-                        prev_pos = positions[i - 1]
-                        prev_lat = get_row_value(prev_pos, "position_lat")
-                        prev_lng = get_row_value(prev_pos, "position_lng")
-                        prev_time_str = get_row_value(prev_pos, "timestamp")
-
-                        curr_time = datetime.fromisoformat(
-                            timestamp_str.replace("Z", "+00:00")
-                        )
-                        prev_time = datetime.fromisoformat(
-                            prev_time_str.replace("Z", "+00:00")
-                        )
-                        time_diff = (curr_time - prev_time).total_seconds()
-
-                        if time_diff > 0:
-                            # Förväntad avstånd
-                            expected_distance = speed * time_diff
-
-                            # Faktiskt avstånd
-                            R = 6371000
-                            phi1 = math.radians(prev_lat)
-                            phi2 = math.radians(orig_lat)
-                            delta_phi = math.radians(orig_lat - prev_lat)
-                            delta_lambda = math.radians(orig_lng - prev_lng)
-                            a = (
-                                math.sin(delta_phi / 2) ** 2
-                                + math.cos(phi1)
-                                * math.cos(phi2)
-                                * math.sin(delta_lambda / 2) ** 2
-                            )
-                            c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-                            actual_distance = R * c
-
-                            position_jump = abs(actual_distance - expected_distance)
-                    except Exception:
-                        pass
-
-                features.extend([curvature, speed_consistency, position_jump])
+                # Smoothing features (spår-jämnhet): kurvatur, hastighetsvariation, position-jump
+                features.extend(
+                    [
+                        stored["curvature"],
+                        stored["speed_consistency"],
+                        stored["position_jump"],
+                    ]
+                )
 
                 # Matchning features (närhetsmatchning med människaspår för hundspår)
                 distance_to_human = 999.0
@@ -5493,10 +5962,7 @@ def predict_ml_corrections_multiple(
                 "median_error_meters": float(np.median(prediction_errors)),
             }
 
-        # Spara till JSON-fil
-        predictions_dir = Path(__file__).parent.parent / "ml" / "predictions"
-        predictions_dir.mkdir(exist_ok=True)
-
+        # Spara i prediction store (filnamnet är körningens id)
         timestamp_str = datetime.now().strftime("%Y%m%d_%H%M%S")
         track_names_str = "_".join(
             [
@@ -5508,7 +5974,6 @@ def predict_ml_corrections_multiple(
             ]
         )
         filename = f"predictions_{track_names_str}_{'_'.join(map(str, track_id_list))}_{timestamp_str}.json"
-        filepath = predictions_dir / filename
 
         result = {
             "track_ids": track_id_list,
@@ -5518,19 +5983,13 @@ def predict_ml_corrections_multiple(
             "predictions": all_predictions,
         }
 
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(
-                result,
-                f,
-                indent=2,
-                ensure_ascii=False,
-                default=lambda o: o.isoformat() if hasattr(o, "isoformat") else str(o),
-            )
+        _save_prediction_run(filename, result)
 
         return {
             "status": "success",
             "message": f"Förutsägelser genererade för {total_positions} positioner från {len(track_id_list)} spår",
-            "filepath": str(filepath.relative_to(Path(__file__).parent.parent)),
+            "filename": filename,
+            "filepath": f"ml/predictions/{filename}",
             "statistics": statistics,
             "predictions_count": len(all_predictions),
             "data": result,  # Inkludera full data för direkt användning
@@ -5608,36 +6067,79 @@ def ml_feedback_stats(
         )
 
 
+_prediction_store_ready = False
+
+
+def _prediction_store_conn():
+    """
+    Anslutning för prediction store. Första anropet per process säkerställer
+    tabellerna och importerar gamla predictions_*.json från ml/predictions/.
+    """
+    global _prediction_store_ready
+    if not _prediction_store_ready:
+        from utils.prediction_store import import_legacy_files
+
+        init_db()
+        conn = get_db()
+        try:
+            cursor = get_cursor(conn)
+            imported = import_legacy_files(
+                cursor,
+                DATABASE_URL is not None,
+                Path(__file__).resolve().parent.parent / "ml" / "predictions",
+            )
+            conn.commit()
+            if imported:
+                print(f"Prediction store: importerade {imported} gamla predictions-filer")
+        finally:
+            conn.close()
+        _prediction_store_ready = True
+    return get_db()
+
+
+def _save_prediction_run(filename: str, result: dict):
+    """Spara en förutsägelsekörning (manifest + positioner) i en transaktion."""
+    from utils.prediction_store import save_run
+
+    conn = _prediction_store_conn()
+    try:
+        save_run(get_cursor(conn), DATABASE_URL is not None, filename, result)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _validate_prediction_filename(filename: str):
+    if not filename.startswith("predictions_") or not filename.endswith(".json"):
+        raise HTTPException(
+            status_code=400, detail="Ogiltigt filnamn för förutsägelse"
+        )
+
+
 @app.get("/ml/predictions")
 @app.get("/api/ml/predictions")  # Stöd för frontend som använder /api prefix
-def list_ml_predictions():
-    """Lista alla sparade ML-förutsägelser. Returnerar tom lista om ml/predictions saknas (t.ex. Railway ephemeral)."""
+def list_ml_predictions(
+    limit: int = Query(200, ge=1, le=1000), offset: int = Query(0, ge=0)
+):
+    """Lista sparade ML-förutsägelser (manifestet, nyaste först) med sammanfattande mått."""
     try:
-        base = Path(__file__).resolve().parent.parent
-        predictions_dir = base / "ml" / "predictions"
-        predictions_dir.mkdir(parents=True, exist_ok=True)
+        from utils.prediction_store import count_runs, list_runs
 
-        predictions = []
-        for filepath in sorted(
-            predictions_dir.glob("predictions_*.json"), reverse=True
-        ):
-            try:
-                stat = filepath.stat()
-                predictions.append(
-                    {
-                        "filename": filepath.name,
-                        "filepath": str(filepath.relative_to(base)),
-                        "size_bytes": stat.st_size,
-                        "created": datetime.fromtimestamp(stat.st_mtime).isoformat(),
-                    }
-                )
-            except Exception:
-                pass
+        conn = _prediction_store_conn()
+        try:
+            cursor = get_cursor(conn)
+            predictions = list_runs(
+                cursor, DATABASE_URL is not None, limit=limit, offset=offset
+            )
+            total = count_runs(cursor)
+        finally:
+            conn.close()
 
         return {
             "status": "success",
             "predictions": predictions,
             "count": len(predictions),
+            "total": total,
         }
 
     except Exception as e:
@@ -5655,25 +6157,24 @@ def list_ml_predictions():
 @app.get("/ml/predictions/{filename}")
 @app.get("/api/ml/predictions/{filename}")  # Stöd för frontend som använder /api prefix
 def get_ml_prediction(filename: str):
-    """Hämta en specifik ML-förutsägelse från fil. Mergar in ML-feedback från ml_prediction_feedback."""
+    """Hämta en specifik ML-förutsägelse. Mergar in ML-feedback från ml_prediction_feedback."""
     try:
-        predictions_dir = Path(__file__).parent.parent / "ml" / "predictions"
-        filepath = predictions_dir / filename
+        from utils.prediction_store import load_run
 
-        if not filepath.exists():
-            raise HTTPException(
-                status_code=404, detail=f"Förutsägelse '{filename}' hittades inte"
-            )
+        _validate_prediction_filename(filename)
 
-        # Säkerhetskontroll - bara tillåt JSON-filer i predictions-mappen
-        if not filename.startswith("predictions_") or not filename.endswith(".json"):
+        conn = _prediction_store_conn()
+        try:
+            cursor = get_cursor(conn)
+            data = load_run(cursor, DATABASE_URL is not None, filename)
+        finally:
+            conn.close()
+
+        if data is None:
             raise HTTPException(
-                status_code=400, detail="Ogiltigt filnamn för förutsägelse"
+                status_code=404, detail=f"Förutsägelse '{filename}' hittades inte"
             )
 
-        with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
         # Merga in ML-feedback (ändrar INTE grunddata – bara vad som visas för denna förutsägelse)
         try:
             conn = get_db()
@@ -5696,7 +6197,7 @@ def get_ml_prediction(filename: str):
                     if pid in feedback_map:
                         p["verified_status"] = feedback_map[pid]
         except Exception:
-            pass  # Om tabell saknas eller DB ej tillgänglig, använd filens data
+            pass  # Om tabell saknas eller DB ej tillgänglig, använd körningens data
 
         return {"status": "success", "data": data}
 
@@ -5711,6 +6212,73 @@ def get_ml_prediction(filename: str):
         )
 
 
+@app.get("/ml/predictions/{filename}/positions")
+@app.get("/api/ml/predictions/{filename}/positions")  # Stöd för frontend
+def get_ml_prediction_positions(
+    filename: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(500, ge=1, le=5000),
+):
+    """Bläddra i en förutsägelses positioner (i ordning) med ML-feedback inmergad."""
+    try:
+        from utils.prediction_store import get_positions, get_run_row
+
+        _validate_prediction_filename(filename)
+        is_postgres = DATABASE_URL is not None
+        ph = "%s" if is_postgres else "?"
+
+        conn = _prediction_store_conn()
+        try:
+            cursor = get_cursor(conn)
+            run = get_run_row(cursor, is_postgres, filename)
+            if run is None:
+                raise HTTPException(
+                    status_code=404, detail=f"Förutsägelse '{filename}' hittades inte"
+                )
+            positions = get_positions(cursor, is_postgres, run, offset=offset, limit=limit)
+            pids = [p["position_id"] for p in positions if p.get("position_id") is not None]
+            if pids:
+                execute_query(
+                    cursor,
+                    f"""
+                    SELECT position_id, verified_status FROM ml_prediction_feedback
+                    WHERE prediction_filename = {ph}
+                      AND position_id IN ({", ".join([ph] * len(pids))})
+                    """,
+                    tuple([filename] + pids),
+                )
+                feedback_map = {
+                    get_row_value(r, "position_id"): get_row_value(r, "verified_status")
+                    for r in cursor.fetchall()
+                }
+                for p in positions:
+                    if p.get("position_id") in feedback_map:
+                        p["verified_status"] = feedback_map[p["position_id"]]
+        finally:
+            conn.close()
+
+        total = int(run.get("total_positions") or 0)
+        return {
+            "status": "success",
+            "filename": filename,
+            "offset": offset,
+            "limit": limit,
+            "total": total,
+            "has_more": offset + len(positions) < total,
+            "predictions": positions,
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+
+        raise HTTPException(
+            status_code=500,
+            detail=f"Fel vid läsning av förutsägelse: {str(e)}\n\n{traceback.format_exc()}",
+        )
+
+
 @app.delete("/ml/predictions/{filename}")
 @app.delete("/api/ml/predictions/{filename}")  # Stöd för frontend
 def delete_ml_prediction(filename: str):
@@ -5719,44 +6287,38 @@ def delete_ml_prediction(filename: str):
     Använd för att exkludera dåliga spår innan export – de ingår inte längre i exporten.
     """
     try:
+        from utils.prediction_store import delete_run
+
         if not filename.startswith("predictions_") or not filename.endswith(".json"):
             raise HTTPException(
                 status_code=400,
                 detail="Ogiltigt filnamn – måste vara predictions_*.json",
             )
 
-        predictions_dir = Path(__file__).parent.parent / "ml" / "predictions"
-        filepath = predictions_dir / filename
-
-        if not filepath.exists():
-            raise HTTPException(
-                status_code=404,
-                detail=f"Förutsägelse '{filename}' hittades inte",
-            )
-
-        # Radera ml_prediction_feedback för denna fil
-        try:
-            init_db()
-        except Exception:
-            pass
-
-        conn = get_db()
+        conn = _prediction_store_conn()
         cursor = get_cursor(conn)
         ph = "%s" if DATABASE_URL else "?"
         try:
+            deleted = delete_run(cursor, DATABASE_URL is not None, filename)
+            if not deleted:
+                conn.rollback()
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"Förutsägelse '{filename}' hittades inte",
+                )
+            # Radera ml_prediction_feedback för denna körning
             execute_query(
                 cursor,
                 f"DELETE FROM ml_prediction_feedback WHERE prediction_filename = {ph}",
                 (filename,),
             )
             conn.commit()
-        except Exception:
-            conn.rollback()
         finally:
             conn.close()
 
-        # Radera JSON-filen
-        filepath.unlink(missing_ok=True)
+        # Radera ev. gammal JSON-fil så den inte importeras igen
+        legacy_path = Path(__file__).parent.parent / "ml" / "predictions" / filename
+        legacy_path.unlink(missing_ok=True)
 
         return {"status": "success", "message": f"Raderade förutsägelse: {filename}"}
 
@@ -5771,6 +6333,48 @@ def delete_ml_prediction(filename: str):
         )
 
 
+_feedback_schema_checked = False
+
+
+def _ensure_feedback_schema():
+    """Säkerställ att ml_prediction_feedback finns (t.ex. efter ny deploy) – en gång per process."""
+    global _feedback_schema_checked
+    if _feedback_schema_checked:
+        return
+    try:
+        init_db()
+        _feedback_schema_checked = True
+    except Exception:
+        pass
+
+
+def _write_prediction_feedback(filename: str, updates: list) -> dict:
+    """Bulk-upsert av [(position_id, verified_status), ...] i en transaktion (en round trip på Postgres)."""
+    from utils.prediction_store import upsert_feedback
+
+    _ensure_feedback_schema()
+    conn = get_db()
+    try:
+        result = upsert_feedback(get_cursor(conn), DATABASE_URL is not None, filename, updates)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return result
+
+
+class PredictionFeedbackItem(BaseModel):
+    position_id: int
+    verified_status: Literal["correct", "incorrect", "pending"]
+
+
+class PredictionFeedbackBatch(BaseModel):
+    """Feedback för flera positioner i en förutsägelse"""
+    updates: List[PredictionFeedbackItem] = Field(..., max_length=50000)
+
+
 @app.put("/ml/predictions/{filename}/feedback/{position_id}")
 @app.put("/api/ml/predictions/{filename}/feedback/{position_id}")  # Stöd för frontend
 def update_prediction_feedback(
@@ -5783,59 +6387,19 @@ def update_prediction_feedback(
     Sparas i ml_prediction_feedback – ändrar INTE track_positions (grunddata).
     """
     try:
-        # Säkerställ att ml_prediction_feedback finns (t.ex. efter ny deploy)
-        try:
-            init_db()
-        except Exception:
-            pass
-
         if verified_status not in ["correct", "incorrect", "pending"]:
             raise HTTPException(
                 status_code=400,
                 detail="verified_status måste vara 'correct', 'incorrect' eller 'pending'",
             )
 
-        conn = get_db()
-        cursor = get_cursor(conn)
-        ph = "%s" if DATABASE_URL else "?"
-        now = datetime.now().isoformat()
-
+        result = _write_prediction_feedback(filename, [(position_id, verified_status)])
         # Verifiera att positionen finns (referensintegritet)
-        execute_query(
-            cursor,
-            f"SELECT 1 FROM track_positions WHERE id = {ph}",
-            (position_id,),
-        )
-        if cursor.fetchone() is None:
-            conn.close()
+        if result["missing"]:
             raise HTTPException(
                 status_code=404, detail=f"Position {position_id} hittades inte"
             )
 
-        if DATABASE_URL:
-            cursor.execute(
-                """
-                INSERT INTO ml_prediction_feedback (prediction_filename, position_id, verified_status, created_at)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (prediction_filename, position_id)
-                DO UPDATE SET verified_status = EXCLUDED.verified_status, created_at = EXCLUDED.created_at
-                """,
-                (filename, position_id, verified_status, now),
-            )
-        else:
-            # SQLite: delete + insert för upsert (saknar ON CONFLICT)
-            cursor.execute(
-                "DELETE FROM ml_prediction_feedback WHERE prediction_filename = ? AND position_id = ?",
-                (filename, position_id),
-            )
-            cursor.execute(
-                "INSERT INTO ml_prediction_feedback (prediction_filename, position_id, verified_status, created_at) VALUES (?, ?, ?, ?)",
-                (filename, position_id, verified_status, now),
-            )
-
-        conn.commit()
-        conn.close()
-
         return {
             "status": "success",
             "message": f"ML-feedback uppdaterad för position {position_id}",
@@ -5854,6 +6418,36 @@ def update_prediction_feedback(
         )
 
 
+@app.post("/ml/predictions/{filename}/feedback")
+@app.post("/api/ml/predictions/{filename}/feedback")  # Stöd för frontend
+def update_prediction_feedback_batch(filename: str, batch: PredictionFeedbackBatch):
+    """
+    Uppdatera ML-feedback för många positioner i en förfrågan (bulk-upsert i
+    en transaktion). Positioner som inte finns hoppas över och listas i
+    "missing". Ändrar INTE track_positions (grunddata).
+    """
+    try:
+        result = _write_prediction_feedback(
+            filename, [(u.position_id, u.verified_status) for u in batch.updates]
+        )
+        return {
+            "status": "success",
+            "message": f"ML-feedback uppdaterad för {result['written']} positioner",
+            "updated": result["written"],
+            "missing": result["missing"],
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+
+        raise HTTPException(
+            status_code=500,
+            detail=f"Fel vid uppdatering av feedback: {str(e)}\n\n{traceback.format_exc()}",
+        )
+
+
 @app.post("/ml/predictions/{filename}/auto-feedback")
 @app.post("/api/ml/predictions/{filename}/auto-feedback")
 def auto_feedback_by_error(
@@ -5871,25 +6465,23 @@ def auto_feedback_by_error(
     Uppdaterar databasen så modellen får bättre träningsdata över tid.
     """
     try:
-        # Säkerställ att ml_prediction_feedback finns (t.ex. efter ny deploy)
-        try:
-            init_db()
-        except Exception:
-            pass
+        from utils.prediction_store import get_positions, get_run_row
 
-        predictions_dir = Path(__file__).parent.parent / "ml" / "predictions"
-        filepath = predictions_dir / filename
-        if not filepath.exists() or not (
-            filename.startswith("predictions_") and filename.endswith(".json")
-        ):
+        run = None
+        predictions = []
+        if filename.startswith("predictions_") and filename.endswith(".json"):
+            conn = _prediction_store_conn()
+            try:
+                cursor = get_cursor(conn)
+                run = get_run_row(cursor, DATABASE_URL is not None, filename)
+                if run is not None:
+                    predictions = get_positions(cursor, DATABASE_URL is not None, run)
+            finally:
+                conn.close()
+        if run is None:
             raise HTTPException(
                 status_code=404, detail=f"Förutsägelse '{filename}' hittades inte"
             )
-
-        with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-        predictions = data.get("predictions") or []
         marked_correct = 0
         marked_incorrect = 0
         skipped = 0
@@ -5922,36 +6514,11 @@ def auto_feedback_by_error(
                 "total_with_actual": 0,
             }
 
-        conn = get_db()
-        cursor = get_cursor(conn)
-        now = datetime.now().isoformat()
-        if DATABASE_URL:
-            for pos_id, status in updates:
-                cursor.execute(
-                    """
-                    INSERT INTO ml_prediction_feedback (prediction_filename, position_id, verified_status, created_at)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (prediction_filename, position_id)
-                    DO UPDATE SET verified_status = EXCLUDED.verified_status, created_at = EXCLUDED.created_at
-                    """,
-                    (filename, pos_id, status, now),
-                )
-        else:
-            for pos_id, status in updates:
-                cursor.execute(
-                    "DELETE FROM ml_prediction_feedback WHERE prediction_filename = ? AND position_id = ?",
-                    (filename, pos_id),
-                )
-                cursor.execute(
-                    "INSERT INTO ml_prediction_feedback (prediction_filename, position_id, verified_status, created_at) VALUES (?, ?, ?, ?)",
-                    (filename, pos_id, status, now),
-                )
-        conn.commit()
-        conn.close()
+        written = _write_prediction_feedback(filename, updates)["written"]
 
         return {
             "status": "success",
-            "message": f"Uppdaterade {len(updates)} positioner i ML-feedback (tröskel {threshold}m). Grunddata oförändrad.",
+            "message": f"Uppdaterade {written} positioner i ML-feedback (tröskel {threshold}m). Grunddata oförändrad.",
             "marked_correct": marked_correct,
             "marked_incorrect": marked_incorrect,
             "skipped": skipped,
@@ -5967,33 +6534,186 @@ def auto_feedback_by_error(
         )
 
 
-@app.get("/ml/export-feedback")
-@app.get("/api/ml/export-feedback")  # Stöd för frontend
-def export_feedback_data(
-    download: bool = Query(False, description="Returnera fil för nedladdning"),
-):
-    """
-    Exportera all data med feedback för ML-träning.
-    Inkluderar både manuellt korrigerade spår och ML-förutsägelser med feedback.
-    """
-    try:
-        from datetime import datetime
-        import json
+# Positioner med faktisk korrigering eller verifierade som correct (grunddata)
+FEEDBACK_EXPORT_DB_WHERE = """
+    (
+        (tp.corrected_lat IS NOT NULL AND tp.corrected_lng IS NOT NULL)
+        OR tp.verified_status = 'correct'
+    )
+"""
 
-        export_batch_id = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-        conn = get_db()
+def _feedback_db_row_to_export(row, export_batch_id: str) -> dict:
+    """Exportrad för en position i track_positions (korrigerad eller verifierad)."""
+    orig_lat = row["original_lat"]
+    orig_lng = row["original_lng"]
+    corr_lat = row["corrected_lat"]
+    corr_lng = row["corrected_lng"]
+    verified_status = row["verified_status"] or "pending"
+
+    # Beräkna correction_distance om korrigering finns (is not None: 0.0 är giltig lat/lng)
+    correction_distance = None
+    has_human_corr = corr_lat is not None and corr_lng is not None
+    if has_human_corr:
+        try:
+            correction_distance = haversine_meters(
+                LatLng(lat=orig_lat, lng=orig_lng),
+                LatLng(lat=corr_lat, lng=corr_lng),
+            )
+        except Exception:
+            correction_distance = None
+
+    return {
+        "id": row["id"],
+        "track_id": row["track_id"],
+        "track_name": row["track_name"],
+        "track_type": row["track_type"],
+        "timestamp": _to_iso_str(row["timestamp"]),
+        "verified_status": verified_status,
+        "original_position": {"lat": orig_lat, "lng": orig_lng},
+        "corrected_position": (
+            {"lat": corr_lat, "lng": corr_lng}
+            if has_human_corr
+            else None
+        ),
+        "correction_distance_meters": correction_distance,
+        "accuracy": row["accuracy"],
+        "annotation_notes": row["annotation_notes"] or "",
+        "environment": row["environment"],
+        "source": (
+            "manual_track_correction"
+            if has_human_corr
+            else "db_verified_correct"
+        ),
+        "data_lineage": (
+            "testlab_or_manual_correction"
+            if has_human_corr
+            else "db_verified_correct_no_human_correction"
+        ),
+        "training_weight_suggested": 1.0 if has_human_corr else 0.9,
+        "export_batch_id": export_batch_id,
+    }
+
+
+def _feedback_prediction_to_export(item: dict, export_batch_id: str) -> Optional[dict]:
+    """Exportrad för en ML-förutsägelse med feedback (se prediction_store.FEEDBACK_POSITIONS_SQL)."""
+    pred = item["prediction"]
+    pred_data = item["header"]
+    pred_file_name = item["filename"]
+    verified_status = item["effective_status"]
+    pred_pid = pred.get("position_id")
+
+    tid = pred.get("track_id")
+    if tid is None:
+        tid = pred_data.get("track_id")
+    tname = pred.get("track_name") or pred_data.get("track_name")
+    ttype = pred.get("track_type") or pred_data.get("track_type")
+    producer_ver = pred_data.get("model_version") or pred.get("model_version")
+
+    # "correct": ML-förutsägelse som mål när ingen human-corrected i grunddata
+    if (
+        verified_status == "correct"
+        and pred.get("predicted_corrected_position")
+        and not pred.get("actual_corrected_position")
+    ):
+        return {
+            "id": pred_pid,
+            "track_id": tid,
+            "track_name": tname,
+            "track_type": ttype,
+            "timestamp": pred.get("timestamp"),
+            "verified_status": "correct",
+            "original_position": pred.get("original_position"),
+            "corrected_position": pred.get("predicted_corrected_position"),
+            "correction_distance_meters": pred.get(
+                "predicted_correction_distance_meters"
+            ),
+            "accuracy": pred.get("gps_accuracy"),
+            "annotation_notes": "ML-förutsägelse markerad som korrekt (ej i grunddata)",
+            "environment": None,
+            "source": "ml_feedback_correct",
+            "data_lineage": "ml_prediction_feedback_correct",
+            "label_type": "accept_ml_prediction",
+            "training_weight_suggested": 0.85,
+            "export_batch_id": export_batch_id,
+            "prediction_source_file": pred_file_name,
+            "producer_model_version": producer_ver,
+        }
+    # "incorrect": ingen flytt önskas → träna target 0 m (svagare vikt)
+    if (
+        verified_status == "incorrect"
+        and pred.get("predicted_corrected_position")
+        and pred.get("original_position")
+    ):
+        op = pred["original_position"]
+        return {
+            "id": pred_pid,
+            "track_id": tid,
+            "track_name": tname,
+            "track_type": ttype,
+            "timestamp": pred.get("timestamp"),
+            "verified_status": "incorrect",
+            "original_position": op,
+            "corrected_position": {
+                "lat": op.get("lat"),
+                "lng": op.get("lng"),
+            },
+            "correction_distance_meters": 0.0,
+            "accuracy": pred.get("gps_accuracy"),
+            "annotation_notes": (
+                "ML-förutsägelse underkänd: ingen korrigering som mål (0 m)"
+            ),
+            "environment": None,
+            "source": "ml_feedback_incorrect",
+            "data_lineage": "ml_prediction_feedback_incorrect",
+            "label_type": "reject_ml_prediction",
+            "training_weight_suggested": 0.35,
+            "export_batch_id": export_batch_id,
+            "prediction_source_file": pred_file_name,
+            "producer_model_version": producer_ver,
+        }
+    return None
+
+
+def _count_feedback_export() -> int:
+    """Antal rader exporten kommer att innehålla (två COUNT-frågor, inga rader i minnet)."""
+    from utils.prediction_store import FEEDBACK_POSITIONS_COUNT_SQL
+
+    conn = _prediction_store_conn()
+    try:
         cursor = get_cursor(conn)
+        execute_query(
+            cursor,
+            f"SELECT COUNT(*) AS cnt FROM track_positions tp WHERE {FEEDBACK_EXPORT_DB_WHERE}",
+        )
+        n_db = int(get_row_value(cursor.fetchone(), "cnt") or 0)
+        execute_query(cursor, FEEDBACK_POSITIONS_COUNT_SQL)
+        n_pred = int(get_row_value(cursor.fetchone(), "cnt") or 0)
+        return n_db + n_pred
+    finally:
+        conn.close()
 
-        # Hämta alla positioner med korrigeringar eller feedback
+
+def _iter_feedback_export(export_batch_id: str):
+    """
+    Generator över alla exportrader: först grunddata (track_positions), sedan
+    ML-förutsägelser med feedback från prediction store. Båda läses i chunkar
+    via server-side cursor; anslutningen hålls öppen tills generatorn är klar.
+    """
+    from utils.prediction_store import FEEDBACK_POSITIONS_SQL, feedback_item
+    from utils.streaming_export import iter_rows
+
+    is_postgres = DATABASE_URL is not None
+    conn = _prediction_store_conn()
+    try:
         # Logik:
         # - Alla positioner med faktisk korrigering (corrected_lat/lng) → Inkludera ALLTID
         #   (Feedback "felaktig" betyder bara att ML-förutsägelsen var fel, inte att den faktiska korrigeringen är fel)
         # - Positioner utan faktisk korrigering men med feedback "correct" → Inkludera (använd ML-förutsägelsen)
-        # - ML-feedback "incorrect" i predictions-JSON → exporteras som corrected=original, target 0 m (lägre vikt)
-        execute_query(
-            cursor,
-            """
+        # - ML-feedback "incorrect" → exporteras som corrected=original, target 0 m (lägre vikt)
+        for row in iter_rows(
+            conn,
+            f"""
             SELECT 
                 tp.id,
                 tp.track_id,
@@ -6010,248 +6730,159 @@ def export_feedback_data(
                 tp.environment
             FROM track_positions tp
             JOIN tracks t ON tp.track_id = t.id
-            WHERE (
-                (tp.corrected_lat IS NOT NULL AND tp.corrected_lng IS NOT NULL)
-                OR tp.verified_status = 'correct'
-            )
+            WHERE {FEEDBACK_EXPORT_DB_WHERE}
             ORDER BY tp.track_id, tp.timestamp
             """,
-        )
+            is_postgres=is_postgres,
+        ):
+            yield _sanitize_ml_export_tree(
+                _feedback_db_row_to_export(row, export_batch_id)
+            )
 
-        rows = cursor.fetchall()
+        # ML-förutsägelser med feedback (ändrar INTE track_positions – grunddata oförändrad)
+        header_cache = {}
+        for row in iter_rows(conn, FEEDBACK_POSITIONS_SQL, is_postgres=is_postgres):
+            rec = _feedback_prediction_to_export(
+                feedback_item(row, header_cache), export_batch_id
+            )
+            if rec is not None:
+                yield _sanitize_ml_export_tree(rec)
+    finally:
         conn.close()
 
-        # Konvertera till JSON-format
-        export_data = []
-        db_position_ids = set()
-        for row in rows:
-            orig_lat = get_row_value(row, "original_lat")
-            orig_lng = get_row_value(row, "original_lng")
-            corr_lat = get_row_value(row, "corrected_lat")
-            corr_lng = get_row_value(row, "corrected_lng")
-            verified_status = get_row_value(row, "verified_status") or "pending"
-            pid = get_row_value(row, "id")
-            if pid is not None:
-                db_position_ids.add(pid)
-
-            # Beräkna correction_distance om korrigering finns (is not None: 0.0 är giltig lat/lng)
-            correction_distance = None
-            has_human_corr = corr_lat is not None and corr_lng is not None
-            if has_human_corr:
-                try:
-                    correction_distance = haversine_meters(
-                        LatLng(lat=orig_lat, lng=orig_lng),
-                        LatLng(lat=corr_lat, lng=corr_lng),
-                    )
-                except Exception:
-                    correction_distance = None
 
-            export_data.append(
-                {
-                    "id": pid,
-                    "track_id": get_row_value(row, "track_id"),
-                    "track_name": get_row_value(row, "track_name"),
-                    "track_type": get_row_value(row, "track_type"),
-                    "timestamp": _to_iso_str(get_row_value(row, "timestamp")),
-                    "verified_status": verified_status,
-                    "original_position": {"lat": orig_lat, "lng": orig_lng},
-                    "corrected_position": (
-                        {"lat": corr_lat, "lng": corr_lng}
-                        if has_human_corr
-                        else None
-                    ),
-                    "correction_distance_meters": correction_distance,
-                    "accuracy": get_row_value(row, "accuracy"),
-                    "annotation_notes": get_row_value(row, "annotation_notes") or "",
-                    "environment": get_row_value(row, "environment"),
-                    "source": (
-                        "manual_track_correction"
-                        if has_human_corr
-                        else "db_verified_correct"
-                    ),
-                    "data_lineage": (
-                        "testlab_or_manual_correction"
-                        if has_human_corr
-                        else "db_verified_correct_no_human_correction"
-                    ),
-                    "training_weight_suggested": 1.0 if has_human_corr else 0.9,
-                    "export_batch_id": export_batch_id,
-                }
-            )
-
-        # Lägg till ML-förutsägelser markerade som "correct" från predictions-filer
-        # Använder ml_prediction_feedback (ändrar INTE track_positions – grunddata oförändrad)
-        predictions_dir = Path(__file__).parent.parent / "ml" / "predictions"
-        if predictions_dir.exists():
-            # Hämta all ML-feedback för att merga in
-            feedback_map = {}  # filename -> {position_id -> verified_status}
-            try:
-                conn2 = get_db()
-                cur2 = get_cursor(conn2)
-                ph = "%s" if DATABASE_URL else "?"
-                execute_query(
-                    cur2,
-                    "SELECT prediction_filename, position_id, verified_status FROM ml_prediction_feedback",
-                    None,
-                )
-                for r in cur2.fetchall():
-                    fn = get_row_value(r, "prediction_filename")
-                    pid = get_row_value(r, "position_id")
-                    vs = get_row_value(r, "verified_status")
-                    if fn not in feedback_map:
-                        feedback_map[fn] = {}
-                    feedback_map[fn][pid] = vs
-                conn2.close()
-            except Exception:
-                pass
+def _tee_columnar(items, writer, root: Path):
+    """
+    Samla exportraderna kolumnvis medan de strömmas vidare och skriv
+    partitionen när strömmen är klar (avbruten ström ger ingen partition).
+    """
+    for item in items:
+        writer.append(item)
+        yield item
+    try:
+        partition = writer.write(root)
+        print(f"Kolumnär export sparad: {partition} ({len(writer)} rader)")
+    except Exception as e:
+        print(f"Kunde inte spara kolumnär export: {e}")
 
-            for pred_file in predictions_dir.glob("predictions_*.json"):
-                try:
-                    with open(pred_file, "r", encoding="utf-8") as f:
-                        pred_data = json.load(f)
-
-                    if pred_data.get("predictions"):
-                        for pred in pred_data["predictions"]:
-                            # Merga in ML-feedback (överstyr filens verified_status)
-                            verified_status = pred.get("verified_status")
-                            if pred_file.name in feedback_map:
-                                pid = pred.get("position_id")
-                                if pid in feedback_map[pred_file.name]:
-                                    verified_status = feedback_map[pred_file.name][pid]
-
-                            pred_pid = pred.get("position_id")
-                            if pred_pid is not None and pred_pid in db_position_ids:
-                                continue
-
-                            tid = pred.get("track_id")
-                            if tid is None:
-                                tid = pred_data.get("track_id")
-                            tname = pred.get("track_name") or pred_data.get(
-                                "track_name"
-                            )
-                            ttype = pred.get("track_type") or pred_data.get(
-                                "track_type"
-                            )
-                            producer_ver = pred_data.get("model_version") or pred.get(
-                                "model_version"
-                            )
 
-                            # "correct": ML-förutsägelse som mål när ingen human-corrected i grunddata
-                            if (
-                                verified_status == "correct"
-                                and pred.get("predicted_corrected_position")
-                                and not pred.get("actual_corrected_position")
-                            ):
-                                export_data.append(
-                                    {
-                                        "id": pred_pid,
-                                        "track_id": tid,
-                                        "track_name": tname,
-                                        "track_type": ttype,
-                                        "timestamp": pred.get("timestamp"),
-                                        "verified_status": "correct",
-                                        "original_position": pred.get(
-                                            "original_position"
-                                        ),
-                                        "corrected_position": pred.get(
-                                            "predicted_corrected_position"
-                                        ),
-                                        "correction_distance_meters": pred.get(
-                                            "predicted_correction_distance_meters"
-                                        ),
-                                        "accuracy": pred.get("gps_accuracy"),
-                                        "annotation_notes": "ML-förutsägelse markerad som korrekt (ej i grunddata)",
-                                        "environment": None,
-                                        "source": "ml_feedback_correct",
-                                        "data_lineage": "ml_prediction_feedback_correct",
-                                        "label_type": "accept_ml_prediction",
-                                        "training_weight_suggested": 0.85,
-                                        "export_batch_id": export_batch_id,
-                                        "prediction_source_file": pred_file.name,
-                                        "producer_model_version": producer_ver,
-                                    }
-                                )
-                            # "incorrect": ingen flytt önskas → träna target 0 m (svagare vikt)
-                            elif (
-                                verified_status == "incorrect"
-                                and pred.get("predicted_corrected_position")
-                                and pred.get("original_position")
-                            ):
-                                op = pred["original_position"]
-                                export_data.append(
-                                    {
-                                        "id": pred_pid,
-                                        "track_id": tid,
-                                        "track_name": tname,
-                                        "track_type": ttype,
-                                        "timestamp": pred.get("timestamp"),
-                                        "verified_status": "incorrect",
-                                        "original_position": op,
-                                        "corrected_position": {
-                                            "lat": op.get("lat"),
-                                            "lng": op.get("lng"),
-                                        },
-                                        "correction_distance_meters": 0.0,
-                                        "accuracy": pred.get("gps_accuracy"),
-                                        "annotation_notes": (
-                                            "ML-förutsägelse underkänd: ingen korrigering som mål (0 m)"
-                                        ),
-                                        "environment": None,
-                                        "source": "ml_feedback_incorrect",
-                                        "data_lineage": "ml_prediction_feedback_incorrect",
-                                        "label_type": "reject_ml_prediction",
-                                        "training_weight_suggested": 0.35,
-                                        "export_batch_id": export_batch_id,
-                                        "prediction_source_file": pred_file.name,
-                                        "producer_model_version": producer_ver,
-                                    }
-                                )
-                except Exception as e:
-                    print(f"Kunde inte läsa predictions-fil {pred_file.name}: {e}")
-                    continue
+@app.get("/ml/export-feedback")
+@app.get("/api/ml/export-feedback")  # Stöd för frontend
+def export_feedback_data(
+    download: bool = Query(False, description="Returnera fil för nedladdning"),
+    export_format: Literal["json", "ndjson"] = Query(
+        "json", alias="format", description="json (array) eller ndjson (ett objekt per rad)"
+    ),
+    gzip: bool = Query(False, description="Gzip-komprimera nedladdningen"),
+):
+    """
+    Exportera all data med feedback för ML-träning.
+    Inkluderar både manuellt korrigerade spår och ML-förutsägelser med feedback.
 
-        export_data = _sanitize_ml_export_tree(export_data)
+    Raderna strömmas (chunkad server-side cursor) – minnet begränsas per chunk.
+    Filen sparas samtidigt i ml/data/ om filsystemet är skrivbart, tillsammans
+    med en kolumnär partition i ml/data/columnar/ (se ml/columnar_dataset.py).
+    """
+    try:
+        from datetime import datetime
+        from utils.streaming_export import (
+            MEDIA_TYPES,
+            encode_items,
+            gzip_stream,
+            tee_to_file,
+            to_bytes,
+        )
 
-        filename = f"ml_feedback_export_{export_batch_id}.json"
+        export_batch_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+        ext = "ndjson" if export_format == "ndjson" else "json"
+        filename = f"ml_feedback_export_{export_batch_id}.{ext}"
         repo_root = Path(__file__).parent.parent
         filepath = repo_root / "ml" / "data" / filename
 
+        # Öppna målfilen innan strömmen startar så att fel kan rapporteras i headers.
+        # Den skrivs som *.tmp och byter namn först när exporten är komplett
+        # (tee_to_file), så att load_annotations aldrig ser en avbruten fil.
         persist_path = None
         persist_error = None
+        persist_fh = None
+        persist_tmp = filepath.with_name(filepath.name + ".tmp")
         try:
             filepath.parent.mkdir(parents=True, exist_ok=True)
-            with open(filepath, "w", encoding="utf-8") as f:
-                json.dump(
-                    export_data,
-                    f,
-                    indent=2,
-                    ensure_ascii=False,
-                    default=_export_feedback_json_default,
-                )
+            persist_fh = open(persist_tmp, "wb")
             persist_path = str(filepath.relative_to(repo_root))
         except OSError as e:
             # Railway m.fl.: skrivskyddat eller effemärt filsystem — nedladdning ska ändå fungera
             persist_error = str(e)
 
-        dump_kw = dict(indent=2, ensure_ascii=False, default=_export_feedback_json_default)
+        def _items():
+            # Samma rader sparas även kolumnärt i ml/data/columnar/batch=<id>/
+            items = _iter_feedback_export(export_batch_id)
+            if persist_fh is None:
+                return items
+            writer = _columnar_writer(export_batch_id, source_file=filename)
+            if writer is None:
+                return items
+            return _tee_columnar(items, writer, filepath.parent / "columnar")
+
+        def _stream():
+            chunks = to_bytes(
+                encode_items(
+                    _items(),
+                    export_format,
+                    default=_export_feedback_json_default,
+                    indent=2,
+                )
+            )
+            if persist_fh is not None:
+                chunks = tee_to_file(chunks, persist_fh, persist_tmp, filepath)
+            return chunks
 
         if download:
-            body = json.dumps(export_data, **dump_kw).encode("utf-8")
+            count = _count_feedback_export()
             headers = {
                 "Content-Disposition": f'attachment; filename="{filename}"',
                 "X-Export-Filename": filename,
-                "X-Export-Count": str(len(export_data)),
+                "X-Export-Count": str(count),
             }
             if persist_error:
                 headers["X-Export-Persist-Error"] = _ascii_header_value(
                     persist_error, 500
                 )
-            return Response(content=body, media_type="application/json", headers=headers)
+            body = _stream()
+            if gzip:
+                body = gzip_stream(body)
+                headers["Content-Encoding"] = "gzip"
+            return StreamingResponse(
+                body, media_type=MEDIA_TYPES[export_format], headers=headers
+            )
+
+        # Utan download: skriv filen (strömmat) och returnera sammanfattning
+        if persist_fh is not None:
+            counter = {"n": 0}
+
+            def _counted():
+                for item in _items():
+                    counter["n"] += 1
+                    yield item
+
+            chunks = to_bytes(
+                encode_items(
+                    _counted(),
+                    export_format,
+                    default=_export_feedback_json_default,
+                    indent=2,
+                )
+            )
+            for _ in tee_to_file(chunks, persist_fh, persist_tmp, filepath):
+                pass
+            count = counter["n"]
+        else:
+            count = _count_feedback_export()
 
         payload = {
             "status": "success",
-            "message": f"Exporterade {len(export_data)} positioner med feedback",
-            "count": len(export_data),
+            "message": f"Exporterade {count} positioner med feedback",
+            "count": count,
             "filename": filename,
         }
         if persist_path:
@@ -6281,114 +6912,422 @@ class ExperimentRating(BaseModel):
     feedback_notes: Optional[str] = None
 
 
-def _parse_experiment_track_json(val):
-    """JSONB kan komma som dict (Postgres) eller str (SQLite/serialisering)."""
-    if val is None:
+class ExperimentLeaseRequest(BaseModel):
+    """Begäran om att leasa nästa experiment åt en granskare"""
+    reviewer: str = Field(..., min_length=1, max_length=100, description="Granskarens id (t.ex. per webbläsare)")
+    count: int = Field(3, ge=1, le=20, description="Antal experiment granskaren ska hålla")
+    ttl_s: int = Field(600, ge=30, le=3600, description="Leasens livslängd i sekunder")
+    exclude_ids: List[int] = Field(default_factory=list, description="Redan hämtade (förnyas men skickas inte igen)")
+
+
+class ExperimentLeaseRelease(BaseModel):
+    """Lämna tillbaka en granskares leasar"""
+    reviewer: str = Field(..., min_length=1, max_length=100)
+
+
+def _experiment_positions_to_json(positions):
+    return [
+        {
+            "id": get_row_value(p, "id"),
+            "lat": float(get_row_value(p, "position_lat")),
+            "lng": float(get_row_value(p, "position_lng")),
+            "timestamp": _to_iso_str(get_row_value(p, "timestamp")),
+            "accuracy": float(get_row_value(p, "accuracy")) if get_row_value(p, "accuracy") else None
+        }
+        for p in positions
+    ]
+
+
+def _compact_experiment(row, original: dict, corrected: dict) -> dict:
+    """
+    Kompakt form av ett experiment för leasing: per spår (human/dog) en
+    starttid t0 och positioner som [lat, lng, ms sedan t0] för original och
+    korrigerat. Bara det kartan och avståndsstatistiken behöver.
+    """
+
+    def parse_ts(value):
+        try:
+            return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        except (TypeError, ValueError):
+            return None
+
+    def encode(positions, t0):
+        out = []
+        for p in positions:
+            ts = parse_ts(p.get("timestamp"))
+            offset_ms = None
+            if ts is not None and t0 is not None:
+                try:
+                    offset_ms = int(round((ts - t0).total_seconds() * 1000))
+                except TypeError:
+                    offset_ms = None
+            out.append([round(float(p["lat"]), 7), round(float(p["lng"]), 7), offset_ms])
+        return out
+
+    tracks = {}
+    for key in ("human", "dog"):
+        orig_positions = ((original.get(key) or {}).get("positions")) or []
+        corr_positions = ((corrected.get(key) or {}).get("positions")) or []
+        if not orig_positions and not corr_positions:
+            tracks[key] = None
+            continue
+        t0_str = (orig_positions or corr_positions)[0].get("timestamp")
+        t0 = parse_ts(t0_str)
+        tracks[key] = {
+            "t0": t0_str if t0 is not None else None,
+            "original": encode(orig_positions, t0),
+            "corrected": encode(corr_positions, t0),
+        }
+    return {
+        "id": get_row_value(row, "id"),
+        "track_id": get_row_value(row, "track_id"),
+        "track_name": original.get("track_name"),
+        "model_version": get_row_value(row, "model_version"),
+        "created_at": _to_iso_str(get_row_value(row, "created_at")),
+        "tracks": tracks,
+    }
+
+
+def _experiment_ml_correction(positions, track_type_int, human_pos_for_target, m, scl, stored_features):
+    """
+    Kör ML-korrigering på positions. track_type_int: 0=dog, 1=human.
+    stored_features: {position_id: features} från utils/position_features.py.
+    """
+    import numpy as np
+
+    if not positions:
+        return []
+    mean_lat = np.mean([get_row_value(p, "position_lat") for p in positions])
+    mean_lng = np.mean([get_row_value(p, "position_lng") for p in positions])
+    corrected = []
+    pred_history = []
+    for i, pos in enumerate(positions):
+        orig_lat = get_row_value(pos, "position_lat")
+        orig_lng = get_row_value(pos, "position_lng")
+        accuracy = get_row_value(pos, "accuracy") or 0.0
+        timestamp_str = _to_iso_str(get_row_value(pos, "timestamp"))
+
+        features = []
+        features.append(accuracy)
+        features.append(accuracy**2)
+        features.extend([orig_lat, orig_lng])
+        if len(positions) > 1:
+            features.extend([orig_lat - mean_lat, orig_lng - mean_lng])
+        else:
+            features.extend([0.0, 0.0])
+        features.append(track_type_int)
+
+        try:
+            if timestamp_str:
+                dt = datetime.fromisoformat(timestamp_str.replace("Z", "+00:00"))
+                hour, weekday = dt.hour, dt.weekday()
+                features.append(math.sin(2 * math.pi * hour / 24))
+                features.append(math.cos(2 * math.pi * hour / 24))
+                features.append(math.sin(2 * math.pi * weekday / 7))
+                features.append(math.cos(2 * math.pi * weekday / 7))
+            else:
+                features.extend([0.0, 1.0, 0.0, 1.0])
+        except Exception:
+            features.extend([0.0, 1.0, 0.0, 1.0])
+
+        # Hastighet, acceleration, avstånd bakåt och riktning (feature store)
+        stored = stored_features[get_row_value(pos, "id")]
+        speed = stored["speed"]
+        dist_prev_1 = stored["distance_prev_1"]
+        features.extend([
+            speed, stored["acceleration"], dist_prev_1,
+            stored["distance_prev_2"], stored["distance_prev_3"], stored["bearing"],
+        ])
+
+        if len(pred_history) >= 2:
+            rm = float(np.mean(pred_history[-2:]))
+            rs = float(np.std(pred_history[-2:])) if len(pred_history) > 1 else 0.0
+        else:
+            rm, rs = 0.0, 0.0
+        features.extend([rm, rs])
+        features.extend([accuracy * speed, accuracy * dist_prev_1, speed * dist_prev_1])
+        features.extend([0.0] * 8)
+        features.extend([stored["curvature"], stored["speed_consistency"], stored["position_jump"]])
+        features.extend([999.0, 0.0, 0.0, 0.0])  # human track features default
+
+        try:
+            pred_dist = float(m.predict(scl.transform(np.array([features])))[0])
+        except Exception:
+            pred_dist = 0.0
+        pred_history.append(pred_dist)
+
+        corr_lat, corr_lng = orig_lat, orig_lng
+        target_lat, target_lng = None, None
+
+        if pred_dist > 0.1 and len(positions) > 1:
+            if track_type_int == 0 and human_pos_for_target:
+                try:
+                    curr_t = datetime.fromisoformat(timestamp_str.replace("Z", "+00:00")) if timestamp_str else None
+                    if curr_t:
+                        min_td = float('inf')
+                        for hp in human_pos_for_target:
+                            h_ts = _to_iso_str(get_row_value(hp, "timestamp"))
+                            if h_ts:
+                                h_t = datetime.fromisoformat(h_ts.replace("Z", "+00:00"))
+                                td = abs((curr_t - h_t).total_seconds())
+                                if td < min_td:
+                                    min_td = td
+                                    target_lat = get_row_value(hp, "position_lat")
+                                    target_lng = get_row_value(hp, "position_lng")
+                except Exception:
+                    pass
+            if target_lat is None:
+                prev_lat = get_row_value(positions[i - 1], "position_lat") if i > 0 else None
+                prev_lng = get_row_value(positions[i - 1], "position_lng") if i > 0 else None
+                next_lat = get_row_value(positions[i + 1], "position_lat") if i < len(positions) - 1 else None
+                next_lng = get_row_value(positions[i + 1], "position_lng") if i < len(positions) - 1 else None
+                if prev_lat is not None and next_lat is not None:
+                    target_lat = (prev_lat + next_lat) / 2
+                    target_lng = (prev_lng + next_lng) / 2
+                elif prev_lat is not None:
+                    target_lat, target_lng = prev_lat, prev_lng
+                elif next_lat is not None:
+                    target_lat, target_lng = next_lat, next_lng
+            if target_lat is not None and target_lng is not None:
+                d = haversine_distance(orig_lat, orig_lng, target_lat, target_lng)
+                if d > 0.001:
+                    frac = min(1.0, pred_dist / d)
+                    corr_lat = orig_lat + frac * (target_lat - orig_lat)
+                    corr_lng = orig_lng + frac * (target_lng - orig_lng)
+
+        corrected.append({
+            "id": get_row_value(pos, "id"),
+            "lat": float(corr_lat),
+            "lng": float(corr_lng),
+            "timestamp": timestamp_str,
+            "predicted_correction_distance": float(pred_dist)
+        })
+    return corrected
+
+
+def _load_experiment_model():
+    """Ladda modell, scaler och modellversion för experimentgenerering."""
+    ml_dir = Path(__file__).parent.parent / "ml" / "output"
+    model_info_path = ml_dir / "gps_correction_model_info.json"
+
+    model, scaler = _load_serving_model()
+
+    # Hämta model version
+    model_version = "unknown"
+    if model_info_path.exists():
+        with open(model_info_path, "r", encoding="utf-8") as f:
+            model_info = json.load(f)
+            model_version = model_info.get("model_version", "unknown")
+    return model, scaler, model_version
+
+
+def _find_overlapping_human_track(cursor, dog_track_id):
+    """
+    Hitta importerat människaspår vars tidsintervall överlappar hundspåret mest
+    (en indexerad range-query mot track_summaries, se utils/track_summary.py).
+    """
+    from utils.track_summary import find_best_overlap, get_summary, refresh_track
+
+    is_postgres = DATABASE_URL is not None
+    _ensure_track_summaries()
+    dog = get_summary(cursor, is_postgres, dog_track_id) or refresh_track(
+        cursor, is_postgres, dog_track_id
+    )
+    if not dog or dog["t_start"] is None:
         return None
-    if isinstance(val, dict):
-        return val
-    if isinstance(val, str):
+    match = find_best_overlap(cursor, is_postgres, dog["t_start"], dog["t_end"])
+    return match["track_id"] if match else None
+
+
+_track_summaries_checked = False
+
+
+def _ensure_track_summaries():
+    """Bygg sammanfattningar som saknas (spår från före tabellen) en gång per process."""
+    global _track_summaries_checked
+    if _track_summaries_checked:
+        return
+    from utils.track_summary import rebuild
+
+    conn = get_db()
+    try:
+        rebuild(get_cursor(conn), DATABASE_URL is not None, commit=conn.commit)
+        conn.commit()
+    finally:
+        conn.close()
+    _track_summaries_checked = True
+
+
+def _create_experiment_for_track(cursor, track_row, model, scaler, model_version) -> bool:
+    """
+    Kör ML-korrigering för ett importerat hundspår (och dess människaspår) och
+    spara ett pending-experiment. Returnerar False om spåret saknar positioner.
+    """
+    track_id = get_row_value(track_row, "id")
+    track_name = get_row_value(track_row, "name") or f"Track_{track_id}"
+    human_track_id = get_row_value(track_row, "human_track_id")
+
+    execute_query(
+        cursor,
+        """
+        SELECT id, position_lat, position_lng, timestamp, accuracy
+        FROM track_positions
+        WHERE track_id = %s
+        ORDER BY timestamp ASC
+        """,
+        (track_id,),
+    )
+    dog_positions = cursor.fetchall()
+
+    if not dog_positions:
+        return False
+
+    # Om human_track_id saknas: hitta matchande människaspår via överlappande tidsintervall
+    if not human_track_id:
+        best_match_id = _find_overlapping_human_track(cursor, track_id)
+        if best_match_id:
+            human_track_id = best_match_id
+
+    # Hämta människaspårets positioner (om det finns)
+    human_positions_db = []
+    if human_track_id:
+        execute_query(
+            cursor,
+            """
+            SELECT id, position_lat, position_lng, timestamp, accuracy
+            FROM track_positions
+            WHERE track_id = %s
+            ORDER BY timestamp ASC
+            """,
+            (human_track_id,),
+        )
+        human_positions_db = cursor.fetchall()
+
+    from utils.position_features import load_track_features
+
+    is_postgres = DATABASE_URL is not None
+    dog_features = load_track_features(
+        cursor, is_postgres, track_id, [get_row_value(p, "id") for p in dog_positions]
+    )
+    dog_corrected = _experiment_ml_correction(dog_positions, 0, human_positions_db, model, scaler, dog_features)
+    human_corrected = []
+    if human_positions_db:
+        human_features = load_track_features(
+            cursor, is_postgres, human_track_id, [get_row_value(p, "id") for p in human_positions_db]
+        )
+        human_corrected = _experiment_ml_correction(human_positions_db, 1, None, model, scaler, human_features)
+
+    human_original = {"positions": _experiment_positions_to_json(human_positions_db)} if human_positions_db else None
+    dog_original = {"positions": _experiment_positions_to_json(dog_positions)}
+    original_track = {
+        "track_name": track_name,
+        "human": human_original,
+        "dog": dog_original
+    }
+    corrected_track = {
+        "track_name": track_name,
+        "human": {"positions": human_corrected} if human_corrected else None,
+        "dog": {"positions": dog_corrected}
+    }
+
+    # Spara experiment: position-id + korrigeringsdeltan (JSON bara om det inte går)
+    from utils.experiment_snapshot import pack
+
+    try:
+        snapshot = pack(original_track, corrected_track)
+        original_json = corrected_json = None
+    except ValueError:
+        snapshot = None
+        original_json, corrected_json = json.dumps(original_track), json.dumps(corrected_track)
+    execute_query(
+        cursor,
+        """
+        INSERT INTO ml_experiments 
+        (track_id, original_track_json, corrected_track_json, track_snapshot, model_version, status)
+        VALUES (%s, %s, %s, %s, %s, 'pending')
+        """,
+        (track_id, original_json, corrected_json, snapshot, model_version)
+    )
+    from utils.experiment_stats import experiment_created
+
+    experiment_created(cursor, DATABASE_URL is not None, track_id)
+    return True
+
+
+def _select_experiment_tracks(cursor, limit: Optional[int] = None) -> list:
+    """
+    Importerade hundspår med positioner, utan redan *pending* experiment.
+    Färre tidigare experiment först, sedan slump → varierad batch (indexerat
+    urval via experiment_track_stats). limit=None betyder alla valbara spår.
+    """
+    from utils.experiment_stats import select_tracks
+
+    _ensure_experiment_stats()
+    return select_tracks(cursor, DATABASE_URL is not None, limit)
+
+
+_experiment_stats_checked = False
+_experiment_stats_lock = threading.Lock()
+# Nyckel för pg_advisory_xact_lock kring omräkningen (godtycklig men fast)
+_EXPERIMENT_STATS_LOCK_KEY = 7240431
+
+
+def _ensure_experiment_stats():
+    """
+    Räkna om experiment_track_stats/experiment_counters från ml_experiments en
+    gång per process. Trådlåset hindrar att poolpåfyllningen vid start och
+    första requesten räknar om samtidigt; på Postgres serialiserar ett
+    advisory-lås dessutom omräkningar från flera arbetare (rebuild låser även
+    tabellerna mot samtidiga räknaruppdateringar).
+    """
+    global _experiment_stats_checked
+    if _experiment_stats_checked:
+        return
+    from utils.experiment_stats import rebuild
+
+    with _experiment_stats_lock:
+        if _experiment_stats_checked:
+            return
+        conn = get_db()
         try:
-            return json.loads(val)
-        except (json.JSONDecodeError, TypeError):
-            return None
-    return val
+            cursor = get_cursor(conn)
+            if DATABASE_URL is not None:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (_EXPERIMENT_STATS_LOCK_KEY,))
+            rebuild(cursor, DATABASE_URL is not None)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        _experiment_stats_checked = True
 
 
-@app.post("/ml/experiments/batch/generate")
-@app.post("/api/ml/experiments/batch/generate")
-def generate_experiments_batch():
+def _generate_experiments_job(job, params: dict) -> dict:
     """
-    Generera experiment för kundspår (track_source='imported').
-    Begränsar till MAX_PER_BATCH per anrop för att undvika timeout (503).
-    Klicka flera gånger om du har många spår.
+    Jobb: generera experiment för kundspår (track_source='imported').
 
     Väljer spår som **inte** redan har ett pending-experiment, prioriterar spår med
-    färre historiska experiment-rader, och **slumpar** inom samma prioritet så att
-    man efter t.ex. purge inte alltid får exakt samma 15 lägsta track_id.
+    färre historiska experiment-rader, och **slumpar** inom samma prioritet.
+    Varje experiment committas direkt så att ett avbrutet jobb behåller det som
+    redan genererats. max_tracks=None betyder alla valbara spår.
     """
-    MAX_PER_BATCH = 15  # Max antal spår per anrop (undviker proxy timeout)
-    try:
-        import numpy as np
-
-        # Ladda modell
-        ml_dir = Path(__file__).parent.parent / "ml" / "output"
-        model_path = ml_dir / "gps_correction_model_best.pkl"
-        scaler_path = ml_dir / "gps_correction_scaler.pkl"
-        model_info_path = ml_dir / "gps_correction_model_info.json"
-
-        if not model_path.exists():
-            raise HTTPException(
-                status_code=404, 
-                detail="Ingen tränad modell hittades. Kör python ml/analysis.py först."
-            )
-
-        model = _load_ml_pkl(model_path)
-        scaler = _load_ml_pkl(scaler_path)
-        
-        # Hämta model version
-        model_version = "unknown"
-        if model_info_path.exists():
-            with open(model_info_path, "r", encoding="utf-8") as f:
-                model_info = json.load(f)
-                model_version = model_info.get("model_version", "unknown")
+    model, scaler, model_version = _load_experiment_model()
+    max_tracks = params.get("max_tracks")
 
-        conn = get_db()
+    conn = get_db()
+    try:
         cursor = get_cursor(conn)
 
-        # Importerade hundspår med positioner, utan redan *pending* experiment.
-        # ORDER BY: färre tidigare rader i ml_experiments först, sedan slump → varierad batch.
-        lim = int(MAX_PER_BATCH)
-        execute_query(
-            cursor,
-            f"""
-            SELECT t.id, t.name, t.human_track_id
-            FROM tracks t
-            WHERE t.track_source = 'imported' AND t.track_type = 'dog'
-              AND EXISTS (SELECT 1 FROM track_positions p WHERE p.track_id = t.id)
-              AND NOT EXISTS (
-                  SELECT 1 FROM ml_experiments e
-                  WHERE e.track_id = t.id
-                    AND LOWER(TRIM(COALESCE(e.status, ''))) = 'pending'
-              )
-            ORDER BY (
-                SELECT COUNT(*) FROM ml_experiments e2 WHERE e2.track_id = t.id
-            ) ASC,
-            RANDOM()
-            LIMIT {lim}
-            """,
-        )
-        dog_tracks = cursor.fetchall()
-
-        execute_query(
-            cursor,
-            """
-            SELECT COUNT(*) AS cnt
-            FROM tracks t
-            WHERE t.track_source = 'imported' AND t.track_type = 'dog'
-              AND EXISTS (SELECT 1 FROM track_positions p WHERE p.track_id = t.id)
-              AND NOT EXISTS (
-                  SELECT 1 FROM ml_experiments e
-                  WHERE e.track_id = t.id
-                    AND LOWER(TRIM(COALESCE(e.status, ''))) = 'pending'
-              )
-            """,
-        )
-        eligible_row = cursor.fetchone()
-        eligible_total = int(get_row_value(eligible_row, "cnt") or 0)
+        from utils.experiment_stats import counts
 
-        execute_query(
-            cursor,
-            """
-            SELECT COUNT(*) AS cnt FROM tracks
-            WHERE track_source = 'imported' AND track_type = 'dog'
-            """,
-        )
-        all_dog_row = cursor.fetchone()
-        total_imported_dog = int(get_row_value(all_dog_row, "cnt") or 0)
+        dog_tracks = _select_experiment_tracks(cursor, max_tracks)
+        track_counts = counts(cursor)
+        eligible_total = track_counts["eligible"]
+        total_imported_dog = track_counts["total"]
+        conn.commit()
 
         if not dog_tracks:
-            conn.close()
             return {
                 "status": "success",
                 "message": "Inga kundspår att generera för (saknar positioner, eller alla har redan väntande experiment).",
@@ -6399,263 +7338,249 @@ def generate_experiments_batch():
             }
 
         experiments_created = 0
+        job.progress(0.0, f"0 av {len(dog_tracks)} spår")
 
-        for track_row in dog_tracks:
-            track_id = get_row_value(track_row, "id")
-            track_name = get_row_value(track_row, "name") or f"Track_{track_id}"
-            human_track_id = get_row_value(track_row, "human_track_id")
-
-            execute_query(
-                cursor,
-                """
-                SELECT id, position_lat, position_lng, timestamp, accuracy
-                FROM track_positions
-                WHERE track_id = %s
-                ORDER BY timestamp ASC
-                """,
-                (track_id,),
+        for i, track_row in enumerate(dog_tracks):
+            if _create_experiment_for_track(cursor, track_row, model, scaler, model_version):
+                experiments_created += 1
+            conn.commit()
+            job.progress(
+                (i + 1) / len(dog_tracks),
+                f"{i + 1} av {len(dog_tracks)} spår ({experiments_created} experiment)",
             )
-            dog_positions = cursor.fetchall()
+    finally:
+        conn.close()
 
-            if not dog_positions:
-                continue
+    remaining_after = max(0, eligible_total - experiments_created)
+    msg = f"Genererade {experiments_created} experiment (slumpat bland spår utan väntande pending)."
+    if remaining_after > 0:
+        msg += f" {remaining_after} kundspår kan fortfarande få nya experiment."
 
-            # Om human_track_id saknas: hitta matchande människaspår via överlappande tidsintervall
-            if not human_track_id:
-                dog_t_start = get_row_value(dog_positions[0], "timestamp")
-                dog_t_end = get_row_value(dog_positions[-1], "timestamp")
-                execute_query(
-                    cursor,
-                    """
-                    SELECT t.id,
-                        (SELECT MIN(timestamp) FROM track_positions WHERE track_id = t.id) AS t_start,
-                        (SELECT MAX(timestamp) FROM track_positions WHERE track_id = t.id) AS t_end
-                    FROM tracks t
-                    WHERE track_source = 'imported' AND track_type = 'human'
-                    """,
-                )
-                best_match_id = None
-                best_overlap = 0.0
-                try:
-                    for hr in cursor.fetchall():
-                        h_start = get_row_value(hr, "t_start")
-                        h_end = get_row_value(hr, "t_end")
-                        if h_start is None or h_end is None or dog_t_start is None or dog_t_end is None:
-                            continue
-                        ts_dog_s = dog_t_start.timestamp() if hasattr(dog_t_start, "timestamp") else 0
-                        ts_dog_e = dog_t_end.timestamp() if hasattr(dog_t_end, "timestamp") else 1
-                        ts_h_s = h_start.timestamp() if hasattr(h_start, "timestamp") else 0
-                        ts_h_e = h_end.timestamp() if hasattr(h_end, "timestamp") else 1
-                        overlap = max(0.0, min(ts_dog_e, ts_h_e) - max(ts_dog_s, ts_h_s))
-                        if overlap > best_overlap:
-                            best_overlap = overlap
-                            best_match_id = get_row_value(hr, "id")
-                except Exception:
-                    pass
-                if best_match_id:
-                    human_track_id = best_match_id
+    return {
+        "status": "success",
+        "message": msg,
+        "generated": experiments_created,
+        "total_tracks": total_imported_dog,
+        "eligible_tracks": eligible_total,
+        "remaining": remaining_after,
+    }
 
-            # Hämta människaspårets positioner (om det finns)
-            human_positions_db = []
-            if human_track_id:
-                execute_query(
-                    cursor,
-                    """
-                    SELECT id, position_lat, position_lng, timestamp, accuracy
-                    FROM track_positions
-                    WHERE track_id = %s
-                    ORDER BY timestamp ASC
-                    """,
-                    (human_track_id,),
-                )
-                human_positions_db = cursor.fetchall()
 
-            def _positions_to_json(positions, prefix=""):
-                return [
-                    {
-                        "id": get_row_value(p, "id"),
-                        "lat": float(get_row_value(p, "position_lat")),
-                        "lng": float(get_row_value(p, "position_lng")),
-                        "timestamp": _to_iso_str(get_row_value(p, "timestamp")),
-                        "accuracy": float(get_row_value(p, "accuracy")) if get_row_value(p, "accuracy") else None
-                    }
-                    for p in positions
-                ]
+# Förgenererade experiment: jobbet experiments_pool håller EXPERIMENT_POOL_SIZE
+# pending-experiment redo så att ExperimentMode aldrig väntar på generering.
+# Påfyllning begärs vid start, vid /ml/experiments/next och efter rate/skip.
+EXPERIMENT_POOL_SIZE = int(os.getenv("EXPERIMENT_POOL_SIZE", "30"))
+EXPERIMENT_POOL_WORKERS = int(os.getenv("EXPERIMENT_POOL_WORKERS", "2"))
+# Inga valbara spår kvar: nästa försök tidigast efter så här många sekunder
+EXPERIMENT_POOL_RETRY_S = 300.0
 
-            def _run_ml_correction(positions, track_type_int, human_pos_for_target, m, scl):
-                """Kör ML-korrigering på positions. track_type_int: 0=dog, 1=human."""
-                if not positions:
-                    return []
-                mean_lat = np.mean([get_row_value(p, "position_lat") for p in positions])
-                mean_lng = np.mean([get_row_value(p, "position_lng") for p in positions])
-                corrected = []
-                pred_history = []
-                for i, pos in enumerate(positions):
-                    orig_lat = get_row_value(pos, "position_lat")
-                    orig_lng = get_row_value(pos, "position_lng")
-                    accuracy = get_row_value(pos, "accuracy") or 0.0
-                    timestamp_str = _to_iso_str(get_row_value(pos, "timestamp"))
-
-                    features = []
-                    features.append(accuracy)
-                    features.append(accuracy**2)
-                    features.extend([orig_lat, orig_lng])
-                    if len(positions) > 1:
-                        features.extend([orig_lat - mean_lat, orig_lng - mean_lng])
-                    else:
-                        features.extend([0.0, 0.0])
-                    features.append(track_type_int)
-
-                    try:
-                        if timestamp_str:
-                            dt = datetime.fromisoformat(timestamp_str.replace("Z", "+00:00"))
-                            hour, weekday = dt.hour, dt.weekday()
-                            features.append(math.sin(2 * math.pi * hour / 24))
-                            features.append(math.cos(2 * math.pi * hour / 24))
-                            features.append(math.sin(2 * math.pi * weekday / 7))
-                            features.append(math.cos(2 * math.pi * weekday / 7))
-                        else:
-                            features.extend([0.0, 1.0, 0.0, 1.0])
-                    except Exception:
-                        features.extend([0.0, 1.0, 0.0, 1.0])
+_experiment_pool_lock = threading.Lock()
+_experiment_pool_exhausted_at: Optional[float] = None
 
-                    speed = 0.0
-                    dist_prev_1 = 0.0
-                    dist_prev_2 = 0.0
-                    dist_prev_3 = 0.0
-                    if i > 0:
-                        prev_pos = positions[i - 1]
-                        prev_lat = get_row_value(prev_pos, "position_lat")
-                        prev_lng = get_row_value(prev_pos, "position_lng")
-                        dist_prev_1 = haversine_distance(orig_lat, orig_lng, prev_lat, prev_lng)
-                        try:
-                            curr_t = datetime.fromisoformat(timestamp_str.replace("Z", "+00:00")) if timestamp_str else None
-                            prev_ts = _to_iso_str(get_row_value(prev_pos, "timestamp"))
-                            prev_t = datetime.fromisoformat(prev_ts.replace("Z", "+00:00")) if prev_ts else None
-                            if curr_t and prev_t and (curr_t - prev_t).total_seconds() > 0:
-                                speed = dist_prev_1 / (curr_t - prev_t).total_seconds()
-                        except Exception:
-                            pass
-                        if i > 1:
-                            p2 = positions[i - 2]
-                            p2_lat, p2_lng = get_row_value(p2, "position_lat"), get_row_value(p2, "position_lng")
-                            dist_prev_2 = haversine_distance(prev_lat, prev_lng, p2_lat, p2_lng)
-                            if i > 2:
-                                p3 = positions[i - 3]
-                                p3_lat, p3_lng = get_row_value(p3, "position_lat"), get_row_value(p3, "position_lng")
-                                dist_prev_3 = haversine_distance(p2_lat, p2_lng, p3_lat, p3_lng)
-                    features.extend([speed, 0.0, dist_prev_1, dist_prev_2, dist_prev_3, 0.0])
-
-                    if len(pred_history) >= 2:
-                        rm = float(np.mean(pred_history[-2:]))
-                        rs = float(np.std(pred_history[-2:])) if len(pred_history) > 1 else 0.0
-                    else:
-                        rm, rs = 0.0, 0.0
-                    features.extend([rm, rs])
-                    features.extend([accuracy * speed, accuracy * dist_prev_1, speed * dist_prev_1])
-                    features.extend([0.0] * 8)
-                    features.extend([0.0, 0.0, 0.0])
-                    features.extend([999.0, 0.0, 0.0, 0.0])  # human track features default
-
-                    try:
-                        pred_dist = float(m.predict(scl.transform(np.array([features])))[0])
-                    except Exception:
-                        pred_dist = 0.0
-                    pred_history.append(pred_dist)
-
-                    corr_lat, corr_lng = orig_lat, orig_lng
-                    target_lat, target_lng = None, None
-
-                    if pred_dist > 0.1 and len(positions) > 1:
-                        if track_type_int == 0 and human_pos_for_target:
-                            try:
-                                curr_t = datetime.fromisoformat(timestamp_str.replace("Z", "+00:00")) if timestamp_str else None
-                                if curr_t:
-                                    min_td = float('inf')
-                                    for hp in human_pos_for_target:
-                                        h_ts = _to_iso_str(get_row_value(hp, "timestamp"))
-                                        if h_ts:
-                                            h_t = datetime.fromisoformat(h_ts.replace("Z", "+00:00"))
-                                            td = abs((curr_t - h_t).total_seconds())
-                                            if td < min_td:
-                                                min_td = td
-                                                target_lat = get_row_value(hp, "position_lat")
-                                                target_lng = get_row_value(hp, "position_lng")
-                            except Exception:
-                                pass
-                        if target_lat is None:
-                            prev_lat = get_row_value(positions[i - 1], "position_lat") if i > 0 else None
-                            prev_lng = get_row_value(positions[i - 1], "position_lng") if i > 0 else None
-                            next_lat = get_row_value(positions[i + 1], "position_lat") if i < len(positions) - 1 else None
-                            next_lng = get_row_value(positions[i + 1], "position_lng") if i < len(positions) - 1 else None
-                            if prev_lat is not None and next_lat is not None:
-                                target_lat = (prev_lat + next_lat) / 2
-                                target_lng = (prev_lng + next_lng) / 2
-                            elif prev_lat is not None:
-                                target_lat, target_lng = prev_lat, prev_lng
-                            elif next_lat is not None:
-                                target_lat, target_lng = next_lat, next_lng
-                        if target_lat is not None and target_lng is not None:
-                            d = haversine_distance(orig_lat, orig_lng, target_lat, target_lng)
-                            if d > 0.001:
-                                frac = min(1.0, pred_dist / d)
-                                corr_lat = orig_lat + frac * (target_lat - orig_lat)
-                                corr_lng = orig_lng + frac * (target_lng - orig_lng)
-
-                    corrected.append({
-                        "id": get_row_value(pos, "id"),
-                        "lat": float(corr_lat),
-                        "lng": float(corr_lng),
-                        "timestamp": timestamp_str,
-                        "predicted_correction_distance": float(pred_dist)
-                    })
-                return corrected
-
-            dog_corrected = _run_ml_correction(dog_positions, 0, human_positions_db, model, scaler)
-            human_corrected = _run_ml_correction(human_positions_db, 1, None, model, scaler) if human_positions_db else []
-
-            human_original = {"positions": _positions_to_json(human_positions_db)} if human_positions_db else None
-            dog_original = {"positions": _positions_to_json(dog_positions)}
-            original_track = {
-                "track_name": track_name,
-                "human": human_original,
-                "dog": dog_original
-            }
-            corrected_track = {
-                "track_name": track_name,
-                "human": {"positions": human_corrected} if human_corrected else None,
-                "dog": {"positions": dog_corrected}
-            }
 
-            # Spara experiment
-            execute_query(
-                cursor,
-                """
-                INSERT INTO ml_experiments 
-                (track_id, original_track_json, corrected_track_json, model_version, status)
-                VALUES (%s, %s, %s, %s, 'pending')
-                """,
-                (track_id, json.dumps(original_track), json.dumps(corrected_track), model_version)
-            )
-            experiments_created += 1
+def _count_pending_experiments(cursor) -> int:
+    """Pending-experiment som inte är leasade (det poolen ska hålla uppe)."""
+    from utils.experiment_stats import read_counters
+
+    _ensure_experiment_stats()
+    pending = read_counters(cursor, DATABASE_URL is not None, ["status:pending"]).get("status:pending", 0)
+    # Experiment som granskare har leasat räknas inte som tillgängliga
+    execute_query(
+        cursor, "SELECT COUNT(*) AS cnt FROM experiment_leases WHERE expires_at > ?", (time.time(),)
+    )
+    return max(0, pending - int(get_row_value(cursor.fetchone(), "cnt") or 0))
 
+
+def _create_experiment_isolated(track_row, model, scaler, model_version) -> bool:
+    """_create_experiment_for_track på en egen anslutning (en per pool-arbetare)."""
+    conn = get_db()
+    try:
+        created = _create_experiment_for_track(
+            get_cursor(conn), track_row, model, scaler, model_version
+        )
         conn.commit()
+        return created
+    except Exception as e:
+        conn.rollback()
+        print(f"Experimentpool: spår {track_row.get('id')} misslyckades: {e}")
+        return False
+    finally:
         conn.close()
 
-        remaining_after = max(0, eligible_total - experiments_created)
-        msg = f"Genererade {experiments_created} experiment (slumpat bland spår utan väntande pending)."
-        if remaining_after > 0:
-            msg += f" {remaining_after} kundspår kan fortfarande få nya experiment – klicka igen (max {MAX_PER_BATCH} per gång)."
 
+def _experiment_pool_job(job, params: dict) -> dict:
+    """
+    Jobb: fyll på poolen med pending-experiment upp till target.
+
+    Modellen laddas en gång; spåren genereras parallellt av `workers` trådar
+    med var sin anslutning. Nivån läses om efter varje omgång så att betyg som
+    kommer in under tiden också fylls på. Jobbet slutar när poolen är full
+    eller när inga valbara importerade spår finns kvar.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    global _experiment_pool_exhausted_at
+    target = int(params.get("target") or EXPERIMENT_POOL_SIZE)
+    workers = max(1, int(params.get("workers") or EXPERIMENT_POOL_WORKERS))
+    model, scaler, model_version = _load_experiment_model()
+
+    created = 0
+    exhausted = False
+    failed = set()  # Spår som misslyckats i det här jobbet väljs inte igen
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="experiment-pool") as pool:
+        while True:
+            conn = get_db()
+            try:
+                cursor = get_cursor(conn)
+                pending = _count_pending_experiments(cursor)
+                deficit = target - pending
+                dog_tracks = []
+                if deficit > 0:
+                    dog_tracks = [
+                        row
+                        for row in _select_experiment_tracks(cursor, deficit + len(failed))
+                        if row["id"] not in failed
+                    ][:deficit]
+                conn.commit()
+            finally:
+                conn.close()
+            if deficit <= 0:
+                break
+            if not dog_tracks:
+                exhausted = True
+                break
+
+            new_before = created
+            for row, ok in zip(
+                dog_tracks,
+                pool.map(
+                    lambda row: _create_experiment_isolated(row, model, scaler, model_version),
+                    dog_tracks,
+                ),
+            ):
+                if not ok:
+                    failed.add(row["id"])
+                created += int(ok)
+                in_pool = pending + created - new_before
+                job.progress(
+                    min(1.0, in_pool / target),
+                    f"{in_pool} av {target} i poolen ({created} nya experiment)",
+                )
+
+    if exhausted:
+        _experiment_pool_exhausted_at = time.monotonic()
+    return {
+        "status": "success",
+        "message": (
+            f"Genererade {created} experiment"
+            + (" – inga fler valbara kundspår." if exhausted else f", poolen har {target} väntande.")
+        ),
+        "generated": created,
+        "target": target,
+        "exhausted": exhausted,
+    }
+
+
+def _top_up_experiment_pool(force: bool = False) -> Optional[int]:
+    """
+    Köa experiments_pool om poolen är under målet och inget pool-jobb redan är
+    köat eller körs. Returnerar job_id eller None. Genererar aldrig själv.
+    """
+    global _experiment_pool_exhausted_at
+    if EXPERIMENT_POOL_SIZE <= 0:
+        return None
+    # En påfyllningskontroll åt gången; övriga anrop behöver inte vänta
+    if not _experiment_pool_lock.acquire(blocking=False):
+        return None
+    try:
+        if (
+            not force
+            and _experiment_pool_exhausted_at is not None
+            and time.monotonic() - _experiment_pool_exhausted_at < EXPERIMENT_POOL_RETRY_S
+        ):
+            return None
+        if _experiment_pool_active():
+            return None
+        conn = get_db()
+        try:
+            pending = _count_pending_experiments(get_cursor(conn))
+        finally:
+            conn.close()
+        if pending >= EXPERIMENT_POOL_SIZE:
+            return None
+        try:
+            _load_serving_model()
+        except HTTPException:
+            # Ingen tränad modell – inget att generera med
+            return None
+        _experiment_pool_exhausted_at = None
+        return _get_job_runner().enqueue("experiments_pool", {"target": EXPERIMENT_POOL_SIZE})
+    except Exception as e:
+        print(f"Experimentpool: kunde inte fylla på: {e}")
+        return None
+    finally:
+        _experiment_pool_lock.release()
+
+
+def _experiment_pool_active() -> bool:
+    """True om ett experiments_pool-jobb är köat eller körs."""
+    runner = _get_job_runner()
+    return any(
+        runner.list(status=status, job_type="experiments_pool", limit=1)
+        for status in ("queued", "running")
+    )
+
+
+def _request_experiment_pool_top_up() -> None:
+    """Påfyllning i en egen tråd så att request-tråden inte väntar på databasen."""
+    threading.Thread(
+        target=_top_up_experiment_pool, name="experiment-pool-top-up", daemon=True
+    ).start()
+
+
+@app.get("/ml/experiments/pool")
+@app.get("/api/ml/experiments/pool")
+def get_experiment_pool():
+    """Poolens mål, antal väntande experiment och senaste pool-jobbet."""
+    try:
+        conn = get_db()
+        try:
+            pending = _count_pending_experiments(get_cursor(conn))
+        finally:
+            conn.close()
+        jobs = _get_job_runner().list(job_type="experiments_pool", limit=1)
+        exhausted_at = _experiment_pool_exhausted_at
         return {
             "status": "success",
-            "message": msg,
-            "generated": experiments_created,
-            "total_tracks": total_imported_dog,
-            "eligible_tracks": eligible_total,
-            "remaining": remaining_after,
+            "target": EXPERIMENT_POOL_SIZE,
+            "workers": EXPERIMENT_POOL_WORKERS,
+            "pending": pending,
+            "exhausted": exhausted_at is not None
+            and time.monotonic() - exhausted_at < EXPERIMENT_POOL_RETRY_S,
+            "last_job": jobs[0] if jobs else None,
         }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Fel vid hämtning av experimentpool: {str(e)}")
+
+
+@app.post("/ml/experiments/batch/generate")
+@app.post("/api/ml/experiments/batch/generate")
+def generate_experiments_batch(limit: Optional[int] = Query(None, ge=1)):
+    """
+    Starta generering av experiment för kundspår (track_source='imported') som
+    bakgrundsjobb. Returnerar job_id direkt; resultatet hämtas via /jobs/{job_id}.
+
+    Args:
+        limit: Max antal spår i jobbet (None = alla spår utan väntande experiment)
+    """
+    try:
+        # Fånga saknad modell direkt istället för som misslyckat jobb (modellen
+        # cachas då också till jobbet)
+        _load_serving_model()
+        return _enqueue_job("experiments_generate", {"max_tracks": limit})
 
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         raise HTTPException(
@@ -6664,6 +7589,34 @@ def generate_experiments_batch():
         )
 
 
+def _experiment_progress(cursor) -> tuple:
+    """(rated, total) från experiment_counters – en indexerad läsning istället för två COUNT(*)."""
+    from utils.experiment_stats import read_counters
+
+    _ensure_experiment_stats()
+    counters = read_counters(cursor, DATABASE_URL is not None, ["total", "status:rated"])
+    return counters.get("status:rated", 0), counters.get("total", 0)
+
+
+def _no_experiment_response(rated: int, total: int) -> dict:
+    """Svar när inget experiment finns att bedöma (poolen fylls på eller allt är bedömt)."""
+    progress = {"rated": rated, "total": total, "remaining": 0}
+    # Tom pool: köa påfyllning (väntar inte på den) och säg åt klienten att försöka igen
+    if _top_up_experiment_pool() is not None or _experiment_pool_active():
+        return {
+            "status": "generating",
+            "message": "Nya experiment genereras i bakgrunden – försök igen om en stund.",
+            "experiment": None,
+            "progress": progress,
+        }
+    return {
+        "status": "completed",
+        "message": "Alla experiment är bedömda!",
+        "experiment": None,
+        "progress": progress,
+    }
+
+
 @app.get("/ml/experiments/next")
 @app.get("/api/ml/experiments/next")
 def get_next_experiment():
@@ -6675,55 +7628,39 @@ def get_next_experiment():
         conn = get_db()
         cursor = get_cursor(conn)
 
-        # Hämta nästa pending experiment
+        from utils.experiment_leases import active_lease_filter
+
+        # Hämta nästa pending experiment som ingen granskare har leasat
         execute_query(
             cursor,
-            """
-            SELECT id, track_id, original_track_json, corrected_track_json, 
-                   model_version, created_at
-            FROM ml_experiments
-            WHERE LOWER(TRIM(COALESCE(status, ''))) = 'pending'
-            ORDER BY id ASC
+            f"""
+            SELECT e.id, e.track_id, e.original_track_json, e.corrected_track_json,
+                   e.track_snapshot, e.model_version, e.created_at
+            FROM ml_experiments e
+            WHERE LOWER(TRIM(COALESCE(e.status, ''))) = 'pending'
+              AND {active_lease_filter(DATABASE_URL is not None)}
+            ORDER BY e.id ASC
             LIMIT 1
             """,
+            (time.time(),),
         )
         experiment = cursor.fetchone()
 
         if not experiment:
-            # Räkna totalt antal experiment och hur många som är rated
-            execute_query(cursor, "SELECT COUNT(*) as total FROM ml_experiments")
-            total_result = cursor.fetchone()
-            total = get_row_value(total_result, "total") if total_result else 0
-
-            execute_query(cursor, "SELECT COUNT(*) as rated FROM ml_experiments WHERE status = 'rated'")
-            rated_result = cursor.fetchone()
-            rated = get_row_value(rated_result, "rated") if rated_result else 0
-
+            # Totalt antal experiment och hur många som är rated (räknartabellen)
+            rated, total = _experiment_progress(cursor)
             conn.close()
-            return {
-                "status": "completed",
-                "message": "Alla experiment är bedömda!",
-                "experiment": None,
-                "progress": {
-                    "rated": rated,
-                    "total": total,
-                    "remaining": 0
-                }
-            }
+            return _no_experiment_response(rated, total)
 
-        experiment_id = get_row_value(experiment, "id")
-        original_json = get_row_value(experiment, "original_track_json")
-        corrected_json = get_row_value(experiment, "corrected_track_json")
+        # Poolen fylls på i bakgrunden; svaret väntar aldrig på generering
+        _request_experiment_pool_top_up()
 
-        # Räkna progress
-        execute_query(cursor, "SELECT COUNT(*) as total FROM ml_experiments")
-        total_result = cursor.fetchone()
-        total = get_row_value(total_result, "total") if total_result else 0
+        from utils.experiment_snapshot import load_tracks
 
-        execute_query(cursor, "SELECT COUNT(*) as rated FROM ml_experiments WHERE status = 'rated'")
-        rated_result = cursor.fetchone()
-        rated = get_row_value(rated_result, "rated") if rated_result else 0
+        experiment_id = get_row_value(experiment, "id")
+        original_track, corrected_track = load_tracks(cursor, DATABASE_URL is not None, experiment)
 
+        rated, total = _experiment_progress(cursor)
         conn.close()
 
         return {
@@ -6731,8 +7668,8 @@ def get_next_experiment():
             "experiment": {
                 "id": experiment_id,
                 "track_id": get_row_value(experiment, "track_id"),
-                "original_track": _parse_experiment_track_json(original_json),
-                "corrected_track": _parse_experiment_track_json(corrected_json),
+                "original_track": original_track,
+                "corrected_track": corrected_track,
                 "model_version": get_row_value(experiment, "model_version"),
                 "created_at": get_row_value(experiment, "created_at")
             },
@@ -6752,6 +7689,99 @@ def get_next_experiment():
         )
 
 
+@app.post("/ml/experiments/lease")
+@app.post("/api/ml/experiments/lease")
+def lease_experiments(request: ExperimentLeaseRequest):
+    """
+    Leasa nästa experiment åt en granskare (prefetch). Granskaren håller upp
+    till count pending-experiment i ttl_s sekunder; ingen annan granskare
+    får dem under tiden. Experiment i exclude_ids (redan hämtade) förnyas
+    men skickas inte igen. Svaret är kompakt, se _compact_experiment.
+    """
+    try:
+        from utils.experiment_leases import lease
+        from utils.experiment_snapshot import load_tracks_many
+
+        conn = get_db()
+        cursor = get_cursor(conn)
+        is_postgres = DATABASE_URL is not None
+
+        leased_ids = lease(cursor, is_postgres, request.reviewer, request.count, request.ttl_s)
+        expires_at = time.time() + request.ttl_s
+        exclude = set(request.exclude_ids)
+        send_ids = [experiment_id for experiment_id in leased_ids if experiment_id not in exclude]
+        experiments = []
+        if send_ids:
+            placeholders = ", ".join(["?"] * len(send_ids))
+            execute_query(
+                cursor,
+                f"""
+                SELECT id, track_id, original_track_json, corrected_track_json,
+                       track_snapshot, model_version, created_at
+                FROM ml_experiments
+                WHERE id IN ({placeholders})
+                ORDER BY id ASC
+                """,
+                tuple(send_ids),
+            )
+            rows = cursor.fetchall()
+            tracks = load_tracks_many(cursor, is_postgres, rows)
+            experiments = [
+                _compact_experiment(row, original, corrected)
+                for row, (original, corrected) in zip(rows, tracks)
+            ]
+
+        rated, total = _experiment_progress(cursor)
+        conn.commit()
+        conn.close()
+
+        if not leased_ids:
+            return _no_experiment_response(rated, total)
+
+        # Poolen fylls på i bakgrunden; svaret väntar aldrig på generering
+        _request_experiment_pool_top_up()
+
+        return {
+            "status": "success",
+            "reviewer": request.reviewer,
+            "leased_ids": leased_ids,
+            "lease_expires_at": datetime.fromtimestamp(expires_at).isoformat(),
+            "experiments": experiments,
+            "progress": {
+                "current": rated + 1,
+                "total": total,
+                "rated": rated,
+                "remaining": total - rated
+            }
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+        raise HTTPException(
+            status_code=500,
+            detail=f"Fel vid leasing av experiment: {str(e)}\n\n{traceback.format_exc()}"
+        )
+
+
+@app.post("/ml/experiments/lease/release")
+@app.post("/api/ml/experiments/lease/release")
+def release_experiment_leases(request: ExperimentLeaseRelease):
+    """Lämna tillbaka granskarens leasade experiment (t.ex. när vyn stängs)."""
+    try:
+        from utils.experiment_leases import release_reviewer
+
+        conn = get_db()
+        cursor = get_cursor(conn)
+        released = release_reviewer(cursor, DATABASE_URL is not None, request.reviewer)
+        conn.commit()
+        conn.close()
+        return {"status": "success", "released": released}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Fel vid frisläppning av experiment: {str(e)}")
+
+
 def _purge_pending_experiments_impl():
     """Räkna pending, radera dem, returnera hur många som fanns (samma som raderade vid normal körning)."""
     conn = get_db()
@@ -6770,6 +7800,12 @@ def _purge_pending_experiments_impl():
         f"DELETE FROM ml_experiments WHERE {where_pending}",
         ("pending",),
     )
+    deleted = cursor.rowcount
+    from utils.experiment_stats import pending_purged
+
+    pending_purged(cursor, DATABASE_URL is not None, deleted)
+    # Leasar gäller bara pending-experiment
+    execute_query(cursor, "DELETE FROM experiment_leases")
     conn.commit()
     conn.close()
     return pending_before
@@ -6818,6 +7854,21 @@ def post_purge_pending_experiments():
         )
 
 
+def _experiment_before_update(cursor, experiment_id: int) -> Optional[dict]:
+    """
+    track_id, status och rating före en bedömning (för räknarna), None om
+    experimentet saknas. Raden låses så att samtidiga bedömningar räknas en gång.
+    """
+    lock = " FOR UPDATE" if DATABASE_URL else ""
+    execute_query(
+        cursor,
+        f"SELECT track_id, status, rating FROM ml_experiments WHERE id = %s{lock}",
+        (experiment_id,),
+    )
+    row = cursor.fetchone()
+    return dict(row) if row else None
+
+
 @app.post("/ml/experiments/{experiment_id}/rate")
 @app.post("/api/ml/experiments/{experiment_id}/rate")
 def rate_experiment(experiment_id: int, rating_data: ExperimentRating):
@@ -6828,6 +7879,8 @@ def rate_experiment(experiment_id: int, rating_data: ExperimentRating):
         conn = get_db()
         cursor = get_cursor(conn)
 
+        previous = _experiment_before_update(cursor, experiment_id)
+
         # Uppdatera experiment
         execute_query(
             cursor,
@@ -6842,12 +7895,29 @@ def rate_experiment(experiment_id: int, rating_data: ExperimentRating):
             (rating_data.rating, rating_data.feedback_notes, experiment_id)
         )
 
-        if cursor.rowcount == 0:
+        if previous is None or cursor.rowcount == 0:
             conn.close()
             raise HTTPException(status_code=404, detail="Experiment hittades inte")
 
+        from utils.experiment_stats import experiment_updated
+
+        experiment_updated(
+            cursor,
+            DATABASE_URL is not None,
+            previous["track_id"],
+            previous["status"],
+            "rated",
+            previous["rating"],
+            rating_data.rating,
+        )
+
+        from utils.experiment_leases import release
+
+        release(cursor, DATABASE_URL is not None, [experiment_id])
+
         conn.commit()
         conn.close()
+        _request_experiment_pool_top_up()
 
         return {
             "status": "success",
@@ -6874,6 +7944,8 @@ def skip_experiment(experiment_id: int):
         conn = get_db()
         cursor = get_cursor(conn)
 
+        previous = _experiment_before_update(cursor, experiment_id)
+
         execute_query(
             cursor,
             """
@@ -6884,12 +7956,29 @@ def skip_experiment(experiment_id: int):
             (experiment_id,)
         )
 
-        if cursor.rowcount == 0:
+        if previous is None or cursor.rowcount == 0:
             conn.close()
             raise HTTPException(status_code=404, detail="Experiment hittades inte")
 
+        from utils.experiment_stats import experiment_updated
+
+        experiment_updated(
+            cursor,
+            DATABASE_URL is not None,
+            previous["track_id"],
+            previous["status"],
+            "skipped",
+            previous["rating"],
+            previous["rating"],
+        )
+
+        from utils.experiment_leases import release
+
+        release(cursor, DATABASE_URL is not None, [experiment_id])
+
         conn.commit()
         conn.close()
+        _request_experiment_pool_top_up()
 
         return {
             "status": "success",
@@ -6916,37 +8005,22 @@ def get_experiments_stats():
         conn = get_db()
         cursor = get_cursor(conn)
 
-        # Räkna status
-        execute_query(
-            cursor,
-            """
-            SELECT status, COUNT(*) as count
-            FROM ml_experiments
-            GROUP BY status
-            """
-        )
-        status_counts = {get_row_value(row, "status"): get_row_value(row, "count") for row in cursor.fetchall()}
-
-        # Räkna betyg
-        execute_query(
-            cursor,
-            """
-            SELECT rating, COUNT(*) as count
-            FROM ml_experiments
-            WHERE rating IS NOT NULL
-            GROUP BY rating
-            ORDER BY rating
-            """
-        )
-        rating_counts = {get_row_value(row, "rating"): get_row_value(row, "count") for row in cursor.fetchall()}
+        from utils.experiment_stats import read_counters
 
-        # Genomsnittligt betyg
-        execute_query(
-            cursor,
-            "SELECT AVG(rating) as avg_rating FROM ml_experiments WHERE rating IS NOT NULL"
-        )
-        avg_result = cursor.fetchone()
-        avg_rating = float(get_row_value(avg_result, "avg_rating")) if avg_result and get_row_value(avg_result, "avg_rating") else None
+        _ensure_experiment_stats()
+        counters = read_counters(cursor, DATABASE_URL is not None)
+        status_counts = {
+            name.split(":", 1)[1]: value
+            for name, value in counters.items()
+            if name.startswith("status:") and value
+        }
+        rating_counts = dict(sorted(
+            (int(name.split(":", 1)[1]), value)
+            for name, value in counters.items()
+            if name.startswith("rating:") and value
+        ))
+        rating_total = counters.get("rating_count", 0)
+        avg_rating = counters.get("rating_sum", 0) / rating_total if rating_total else None
 
         conn.close()
 
@@ -24,10 +24,13 @@ from pathlib import Path
 from typing import Dict
 
 from main import (
+    DATABASE_URL,
     get_db,
     get_cursor,
     execute_query,
 )
+from utils.position_features import rebuild
+from utils import experiment_stats, track_summary
 
 
 def _parse_latlng(value: str) -> float:
@@ -172,6 +175,14 @@ def import_positions(positions_csv: Path, id_map: Dict[int, int], label: str) ->
             )
             imported_count += 1
 
+    # Feature store: bygg de importerade spåren i ett svep istället för per rad
+    features = rebuild(cursor, DATABASE_URL is not None, sorted(set(id_map.values())))
+    print(f"Beräknade features för {features['rows']} {label}-positioner.")
+    track_summary.rebuild(cursor, DATABASE_URL is not None, sorted(set(id_map.values())))
+    if label == "dog":
+        # Nya hundspår blir valbara för experimentgenerering
+        experiment_stats.add_tracks(cursor, DATABASE_URL is not None, sorted(set(id_map.values())))
+
     conn.commit()
     conn.close()
 
@@ -8,6 +8,10 @@ Skapar ml_experiments tabell för att spara:
 - Användarens betyg (1-10)
 - Feedback-notes
 
+Spåren lagras kompakt i track_snapshot (position-id + float32-deltan, se
+utils/experiment_snapshot.py). Befintliga rader med JSON-blobbar packas om
+och lagring per experiment samt hämtningstid rapporteras före och efter.
+
 Användning:
     export DATABASE_URL="postgresql://..."
     python backend/scripts/migrate_ml_experiments.py
@@ -15,6 +19,7 @@ Användning:
 
 import os
 import sys
+import time
 from pathlib import Path
 
 backend_dir = Path(__file__).parent.parent
@@ -31,6 +36,11 @@ except ImportError:
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
+from utils.experiment_snapshot import load_tracks_many, matches, pack
+
+# Antal experiment per batch vid ompackning och i latensmätningen
+BATCH_SIZE = 100
+
 
 def get_database_url():
     """Hämta DATABASE_URL från environment"""
@@ -71,8 +81,9 @@ def create_ml_experiments_table(cursor):
         CREATE TABLE ml_experiments (
             id SERIAL PRIMARY KEY,
             track_id INTEGER NOT NULL REFERENCES tracks(id) ON DELETE CASCADE,
-            original_track_json JSONB NOT NULL,
-            corrected_track_json JSONB NOT NULL,
+            original_track_json JSONB,
+            corrected_track_json JSONB,
+            track_snapshot BYTEA,
             model_version TEXT,
             rating INTEGER CHECK (rating >= 1 AND rating <= 10),
             feedback_notes TEXT,
@@ -93,6 +104,122 @@ def create_ml_experiments_table(cursor):
     return True
 
 
+def add_snapshot_column(cursor):
+    """Lägg till track_snapshot och tillåt NULL i JSON-kolumnerna (äldre tabeller)"""
+    cursor.execute("ALTER TABLE ml_experiments ADD COLUMN IF NOT EXISTS track_snapshot BYTEA")
+    cursor.execute("ALTER TABLE ml_experiments ALTER COLUMN original_track_json DROP NOT NULL")
+    cursor.execute("ALTER TABLE ml_experiments ALTER COLUMN corrected_track_json DROP NOT NULL")
+    print("  ✓ track_snapshot finns")
+
+
+def measure_storage(cursor):
+    """Lagring per experiment (spårkolumnerna) och hämtningstid för en batch"""
+    cursor.execute(
+        """
+        SELECT COUNT(*) AS experiments,
+               COALESCE(SUM(COALESCE(pg_column_size(original_track_json), 0)
+                          + COALESCE(pg_column_size(corrected_track_json), 0)
+                          + COALESCE(pg_column_size(track_snapshot), 0)), 0) AS track_bytes,
+               pg_total_relation_size('ml_experiments') AS table_bytes
+        FROM ml_experiments
+        """
+    )
+    row = cursor.fetchone()
+    experiments = int(row["experiments"] or 0)
+
+    start = time.perf_counter()
+    cursor.execute(
+        """
+        SELECT id, original_track_json, corrected_track_json, track_snapshot
+        FROM ml_experiments
+        ORDER BY id
+        LIMIT %s
+        """,
+        (BATCH_SIZE,),
+    )
+    rows = cursor.fetchall()
+    load_tracks_many(cursor, True, rows)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        "experiments": experiments,
+        "bytes_per_experiment": int(row["track_bytes"]) / experiments if experiments else 0.0,
+        "table_bytes": int(row["table_bytes"] or 0),
+        "fetch_ms_per_experiment": elapsed_ms / len(rows) if rows else 0.0,
+    }
+
+
+def compact_existing_experiments(conn, cursor):
+    """Packa om experiment som bara har JSON. Rader som inte går att packa exakt behålls."""
+    print("\n" + "=" * 60)
+    print("KOMPAKTERAR BEFINTLIGA EXPERIMENT")
+    print("=" * 60)
+
+    packed = kept = 0
+    last_id = 0
+    while True:
+        cursor.execute(
+            """
+            SELECT id, original_track_json, corrected_track_json, track_snapshot
+            FROM ml_experiments
+            WHERE id > %s AND track_snapshot IS NULL AND original_track_json IS NOT NULL
+            ORDER BY id
+            LIMIT %s
+            """,
+            (last_id, BATCH_SIZE),
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        for row, tracks in zip(rows, load_tracks_many(cursor, True, rows)):
+            try:
+                snapshot = pack(*tracks)
+            except ValueError:
+                kept += 1
+                continue
+            # Kontrollera att snapshoten ger tillbaka samma spår innan JSON tas bort
+            rehydrated = load_tracks_many(cursor, True, [{"track_snapshot": snapshot}])[0]
+            if not matches(rehydrated, tracks):
+                kept += 1
+                continue
+            cursor.execute(
+                """
+                UPDATE ml_experiments
+                SET track_snapshot = %s, original_track_json = NULL, corrected_track_json = NULL
+                WHERE id = %s
+                """,
+                (psycopg2.Binary(snapshot), row["id"]),
+            )
+            packed += 1
+        conn.commit()
+        print(f"  … {packed} packade, {kept} behåller JSON")
+
+    print(f"  ✓ {packed} experiment packade, {kept} behåller JSON (saknade positioner e.d.)")
+    return packed
+
+
+def print_storage_report(before, after):
+    """Skriv ut lagring och hämtningstid före/efter"""
+    print("\n" + "-" * 60)
+    print(f"{'':28}{'före':>14}{'efter':>14}")
+    print(f"{'Experiment':28}{before['experiments']:>14}{after['experiments']:>14}")
+    print(
+        f"{'Spårdata/experiment (kB)':28}"
+        f"{before['bytes_per_experiment'] / 1024:>14.1f}{after['bytes_per_experiment'] / 1024:>14.1f}"
+    )
+    print(
+        f"{'Tabell inkl. TOAST (MB)':28}"
+        f"{before['table_bytes'] / 1024 ** 2:>14.1f}{after['table_bytes'] / 1024 ** 2:>14.1f}"
+    )
+    print(
+        f"{'Hämtning/experiment (ms)':28}"
+        f"{before['fetch_ms_per_experiment']:>14.2f}{after['fetch_ms_per_experiment']:>14.2f}"
+    )
+    print("-" * 60)
+    print("  Tabellstorleken krymper först efter VACUUM FULL ml_experiments.")
+
+
 def main():
     """Huvudfunktion"""
     print("=" * 60)
@@ -121,9 +248,15 @@ def main():
     try:
         # Skapa tabell
         created = create_ml_experiments_table(cursor)
+        add_snapshot_column(cursor)
 
         # Commit
         conn.commit()
+
+        before = measure_storage(cursor)
+        compact_existing_experiments(conn, cursor)
+        after = measure_storage(cursor)
+        print_storage_report(before, after)
         
         print("\n" + "=" * 60)
         print("✓ MIGRATION KLAR!")
@@ -0,0 +1,218 @@
+"""
+Läsning och arkivering av audit_log.
+
+Sidindelning (page) är keyset på (timestamp, id), senaste först: nästa sida
+börjar efter sista raden på föregående, så varje sida är en range-scan på
+indexet (track_id, timestamp, id) eller (position_id, timestamp, id) oavsett
+hur långt bak man bläddrar. Markören är opak för klienten (base64 av
+[timestamp, id]).
+
+Retention (archive) flyttar rader äldre än en brytpunkt till komprimerade
+NDJSON-filer (gzip) och raderar dem ur tabellen, en batch i taget och i
+(timestamp, id)-ordning. Varje batch skrivs till en egen fil som stängs och
+synkas till disk innan raderna raderas, så en rad finns alltid i minst ett
+av ställena. Filerna kan läsas tillbaka med iter_archive.
+
+Indexen skapas i main.init_db. Funktionerna tar en cursor + is_postgres och
+importerar inte main.py. archive committar via commit-callbacken efter varje
+batch; övriga committar inte.
+"""
+
+from __future__ import annotations
+
+import base64
+import gzip
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+COLUMNS = "id, position_id, track_id, action, old_value, new_value, user_id, timestamp"
+
+MAX_PAGE_SIZE = 500
+ARCHIVE_BATCH_SIZE = 50000
+
+
+def _ph(is_postgres: bool) -> str:
+    return "%s" if is_postgres else "?"
+
+
+def _json_value(value: Any) -> Any:
+    """JSONB kommer som dict (Postgres), TEXT som str (SQLite)."""
+    if isinstance(value, str):
+        try:
+            return json.loads(value) if value else None
+        except ValueError:
+            return value
+    return value
+
+
+def row_to_entry(row: Any) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "position_id": row["position_id"],
+        "track_id": row["track_id"],
+        "action": row["action"],
+        "old_value": _json_value(row["old_value"]),
+        "new_value": _json_value(row["new_value"]),
+        "user_id": row["user_id"],
+        "timestamp": row["timestamp"],
+    }
+
+
+def encode_cursor(timestamp: str, row_id: int) -> str:
+    raw = json.dumps([timestamp, int(row_id)], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(value: str) -> Tuple[str, int]:
+    """(timestamp, id) ur en markör. ValueError om den inte går att läsa."""
+    try:
+        raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+        timestamp, row_id = json.loads(raw.decode("utf-8"))
+        return str(timestamp), int(row_id)
+    except Exception as e:
+        raise ValueError(f"Ogiltig markör: {value}") from e
+
+
+def page(
+    cursor,
+    is_postgres: bool,
+    *,
+    track_id: Optional[int] = None,
+    position_id: Optional[int] = None,
+    action: Optional[str] = None,
+    before: Optional[str] = None,
+    limit: int = 100,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    En sida audit-rader (senaste först) och markören till nästa sida (None
+    när det inte finns fler). before är markören från föregående sida.
+    """
+    ph = _ph(is_postgres)
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    where: List[str] = []
+    params: List[Any] = []
+    if track_id is not None:
+        where.append(f"track_id = {ph}")
+        params.append(track_id)
+    if position_id is not None:
+        where.append(f"position_id = {ph}")
+        params.append(position_id)
+    if action:
+        where.append(f"action = {ph}")
+        params.append(action)
+    if before:
+        where.append(f"(timestamp, id) < ({ph}, {ph})")
+        params.extend(decode_cursor(before))
+
+    cursor.execute(
+        f"""
+        SELECT {COLUMNS}
+        FROM audit_log
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY timestamp DESC, id DESC
+        LIMIT {limit + 1}
+        """,
+        tuple(params),
+    )
+    rows = cursor.fetchall()
+    entries = [row_to_entry(r) for r in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = entries[-1]
+        next_cursor = encode_cursor(last["timestamp"], last["id"])
+    return entries, next_cursor
+
+
+def archive(
+    cursor,
+    is_postgres: bool,
+    *,
+    older_than: str,
+    archive_dir: Path,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+    commit: Optional[Callable[[], None]] = None,
+    progress: Optional[Callable[[int], None]] = None,
+) -> Dict[str, Any]:
+    """
+    Flytta rader med timestamp < older_than (ISO-sträng) till
+    archive_dir/audit_log_<första>_<sista>_<id>.ndjson.gz och radera dem.
+    Returnerar antal arkiverade rader och skrivna filer.
+    """
+    ph = _ph(is_postgres)
+    archive_dir = Path(archive_dir)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    archived = 0
+    files: List[str] = []
+    after: Optional[Tuple[str, int]] = None
+
+    while True:
+        params: List[Any] = [older_than]
+        after_sql = ""
+        if after is not None:
+            after_sql = f"AND (timestamp, id) > ({ph}, {ph})"
+            params.extend(after)
+        cursor.execute(
+            f"""
+            SELECT {COLUMNS}
+            FROM audit_log
+            WHERE timestamp < {ph} {after_sql}
+            ORDER BY timestamp ASC, id ASC
+            LIMIT {int(batch_size)}
+            """,
+            tuple(params),
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        entries = [row_to_entry(r) for r in rows]
+        first, last = entries[0], entries[-1]
+        path = archive_dir / (
+            f"audit_log_{_file_stamp(first['timestamp'])}_{_file_stamp(last['timestamp'])}_{last['id']}.ndjson.gz"
+        )
+        _write_archive(path, entries)
+
+        ids = [e["id"] for e in entries]
+        for start in range(0, len(ids), 5000):
+            chunk = ids[start : start + 5000]
+            cursor.execute(
+                f"DELETE FROM audit_log WHERE id IN ({', '.join([ph] * len(chunk))})",
+                tuple(chunk),
+            )
+        if commit is not None:
+            commit()
+        archived += len(entries)
+        files.append(path.name)
+        after = (last["timestamp"], last["id"])
+        if progress is not None:
+            progress(archived)
+        if len(rows) < batch_size:
+            break
+    return {"archived": archived, "files": files, "archive_dir": str(archive_dir)}
+
+
+def _file_stamp(timestamp: Any) -> str:
+    text = timestamp.isoformat() if hasattr(timestamp, "isoformat") else str(timestamp)
+    return "".join(ch for ch in text[:19] if ch.isalnum())
+
+
+def _write_archive(path: Path, entries: List[Dict[str, Any]]) -> None:
+    """Skriv via en temporär fil och byt namn, så att en halvskriven fil aldrig ser färdig ut."""
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as gz:
+            for entry in entries:
+                gz.write((json.dumps(entry, ensure_ascii=False, default=str) + "\n").encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, path)
+
+
+def iter_archive(archive_dir: Path) -> Iterator[Dict[str, Any]]:
+    """Läs tillbaka arkiverade rader (äldst först)."""
+    for path in sorted(Path(archive_dir).glob("audit_log_*.ndjson.gz")):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
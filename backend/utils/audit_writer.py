@@ -0,0 +1,306 @@
+"""
+Buffrad skrivning av audit_log.
+
+Tidigare gjorde varje korrigering/godkännande/underkännande en egen INSERT
+(med json.dumps av old/new) i anroparens transaktion. AuditWriter lägger
+istället raderna i en begränsad kö i minnet och en bakgrundstråd skriver dem
+i batchar med en egen anslutning:
+
+- record() lägger till en rad och returnerar direkt. Tidsstämpeln sätts
+  när raden registreras, inte när den skrivs. Anroparen ska registrera
+  först efter att den egna transaktionen har committats (se
+  main._audit_log_after_commit), annars kan en rollback lämna en audit-rad
+  för en ändring som aldrig skrevs.
+- Arbetaren väntar på första raden och samlar sedan tills batch_size rader
+  finns eller flush_interval_s har gått sedan den första, det som kommer
+  först. En ensam rad skrivs alltså senast efter flush_interval_s.
+- Kön är begränsad (max_buffer). Är den full skriver record() kön själv i
+  anroparens tråd (mottryck) istället för att tappa rader.
+- shutdown() stoppar arbetaren och skriver det som finns kvar (anropas från
+  main.shutdown_event).
+- En batch som inte går att skriva skrivs om rad för rad, så att en enskild
+  rad (t.ex. en position som hunnit raderas) inte fäller resten. Rader som
+  inte gick att skriva läggs i en omförsökslista och försöks igen med
+  exponentiell backoff (retry_delay_s, fördubblas upp till
+  max_retry_delay_s), så att ett kortare databasavbrott inte tappar rader.
+  En rad ges upp först efter max_attempts försök; listan är begränsad till
+  max_buffer rader (äldsta ges upp först). Uppgivna rader räknas i
+  stats()["failed"].
+
+Rader som måste vara skrivna i samma transaktion som ändringen (synkront
+läge, se main._audit_log(sync=True) och AUDIT_LOG_SYNC) skrivs direkt med
+write_entries.
+
+Modulen importerar inte main.py; databas-helpers skickas in vid konstruktion
+(samma mönster som job_runner).
+"""
+
+from __future__ import annotations
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+COLUMNS = "(position_id, track_id, action, old_value, new_value, user_id, timestamp)"
+
+
+def _row(entry: Dict[str, Any], ts: str) -> tuple:
+    old_value = entry.get("old_value")
+    new_value = entry.get("new_value")
+    return (
+        entry.get("position_id"),
+        entry.get("track_id"),
+        entry["action"],
+        json.dumps(old_value) if old_value is not None else None,
+        json.dumps(new_value) if new_value is not None else None,
+        entry.get("user_id"),
+        entry.get("timestamp") or ts,
+    )
+
+
+def write_entries(cursor, is_postgres: bool, entries: List[Dict[str, Any]]) -> None:
+    """
+    Skriv rader till audit_log med en sats (execute_values / executemany).
+    entries: dicts med action och valfritt position_id, track_id, old_value,
+    new_value, user_id, timestamp. Kastar vid fel och committar inte.
+    """
+    if not entries:
+        return
+    ts = datetime.now().isoformat()
+    rows = [_row(e, ts) for e in entries]
+    if is_postgres:
+        # Postgres: JSONB
+        from psycopg2.extras import execute_values
+
+        execute_values(
+            cursor,
+            f"INSERT INTO audit_log {COLUMNS} VALUES %s",
+            rows,
+            template="(%s, %s, %s, %s::jsonb, %s::jsonb, %s, %s)",
+            page_size=1000,
+        )
+    else:
+        # SQLite: TEXT för JSON
+        cursor.executemany(f"INSERT INTO audit_log {COLUMNS} VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+class AuditWriter:
+    """
+    Begränsad kö + bakgrundstråd som skriver audit_log i batchar.
+
+    Användning:
+        writer = AuditWriter(get_db, get_cursor, is_postgres=bool(DATABASE_URL))
+        writer.start()
+        writer.record({"action": "approve_ml", "position_id": 1, ...})
+        writer.shutdown()  # skriver det som är kvar
+    """
+
+    def __init__(
+        self,
+        get_db: Callable[[], Any],
+        get_cursor: Callable[[Any], Any],
+        *,
+        is_postgres: bool,
+        max_buffer: int = 10000,
+        batch_size: int = 500,
+        flush_interval_s: float = 1.0,
+        max_attempts: int = 8,
+        retry_delay_s: float = 1.0,
+        max_retry_delay_s: float = 60.0,
+    ):
+        self._get_db = get_db
+        self._get_cursor = get_cursor
+        self.is_postgres = is_postgres
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval_s = flush_interval_s
+        self.max_buffer = max(1, int(max_buffer))
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_delay_s = retry_delay_s
+        self.max_retry_delay_s = max_retry_delay_s
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=self.max_buffer)
+        # Rader som inte gick att skriva: (antal försök, rad), äldst först
+        self._retry: "deque[tuple]" = deque()
+        self._retry_lock = threading.Lock()
+        self._retry_delay = retry_delay_s
+        self._retry_at = 0.0
+        # En skrivning i taget (arbetaren, flush() och mottryck i record())
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"written": 0, "failed": 0, "overflow_flushes": 0}
+
+    def start(self) -> None:
+        """Starta arbetartråden (idempotent)."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._worker_loop, name="audit-writer", daemon=True)
+        self._thread.start()
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        """Lägg en rad i kön. Skriver kön i anroparens tråd om den är full."""
+        entry = dict(entry)
+        entry.setdefault("timestamp", datetime.now().isoformat())
+        while True:
+            try:
+                self._queue.put_nowait(entry)
+                return
+            except queue.Full:
+                self._stats["overflow_flushes"] += 1
+                self.flush()
+
+    def flush(self) -> int:
+        """
+        Skriv allt som ligger i kön nu, och gör ett försök (utan att vänta ut
+        backoff) med raderna i omförsökslistan. Returnerar antal skrivna rader.
+        """
+        written = 0
+        while True:
+            batch = self._take(block=False)
+            if not batch:
+                break
+            written += self._write(batch)
+        retry = self._take_retry(len(self._retry))
+        for start in range(0, len(retry), self.batch_size):
+            written += self._write_retry(retry[start : start + self.batch_size])
+        return written
+
+    def shutdown(self, timeout_s: float = 5.0) -> None:
+        """Stoppa arbetaren och skriv det som finns kvar i kön."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout_s)
+        self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "queued": self._queue.qsize(),
+            "retrying": len(self._retry),
+            "running": self._thread is not None and self._thread.is_alive(),
+        }
+
+    # ------------------------------------------------------------------
+    # Intern logik
+    # ------------------------------------------------------------------
+
+    def _worker_loop(self) -> None:
+        while not self._stop.is_set():
+            if self._retry and time.monotonic() >= self._retry_at:
+                self._write_retry(self._take_retry(self.batch_size))
+            batch = self._take(block=True)
+            if batch:
+                self._write(batch)
+
+    def _take(self, block: bool) -> List[Dict[str, Any]]:
+        """
+        Upp till batch_size rader. Med block väntar den högst flush_interval_s
+        på den första raden och därefter högst flush_interval_s (räknat från
+        den första) på att fylla batchen; utan block tas bara det som redan
+        ligger i kön.
+        """
+        batch: List[Dict[str, Any]] = []
+        try:
+            if not block:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+                return batch
+            batch.append(self._queue.get(timeout=self.flush_interval_s))
+            deadline = time.monotonic() + self.flush_interval_s
+            while len(batch) < self.batch_size and not self._stop.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                batch.append(self._queue.get(timeout=remaining))
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write(self, batch: List[Dict[str, Any]], attempts: Optional[List[int]] = None) -> int:
+        """
+        Skriv batchen (attempts: tidigare försök per rad, för rader från
+        omförsökslistan). Rader som inte går att skriva läggs i listan.
+        """
+        if attempts is None:
+            attempts = [0] * len(batch)
+        with self._write_lock:
+            try:
+                self._write_batch(batch)
+                self._stats["written"] += len(batch)
+                self._retry_succeeded()
+                return len(batch)
+            except Exception as e:
+                print(f"audit writer: batch på {len(batch)} rader misslyckades, skriver radvis: {e}")
+            written = 0
+            failed_in_row = 0
+            for i, entry in enumerate(batch):
+                if failed_in_row >= 3:
+                    # Databasen nås troligen inte – resten försöks senare
+                    # (räknas inte som försök)
+                    self._defer(list(zip(attempts[i:], batch[i:])))
+                    break
+                try:
+                    self._write_batch([entry])
+                    written += 1
+                    failed_in_row = 0
+                except Exception as e:
+                    failed_in_row += 1
+                    print(f"audit writer: kunde inte skriva {entry.get('action')} för position {entry.get('position_id')}: {e}")
+                    self._defer([(attempts[i] + 1, entry)])
+            self._stats["written"] += written
+            if written:
+                self._retry_succeeded()
+            else:
+                self._retry_failed()
+            return written
+
+    def _write_retry(self, retry: List[tuple]) -> int:
+        if not retry:
+            return 0
+        return self._write([entry for _, entry in retry], [n for n, _ in retry])
+
+    def _take_retry(self, limit: int) -> List[tuple]:
+        with self._retry_lock:
+            n = min(limit, len(self._retry))
+            return [self._retry.popleft() for _ in range(n)]
+
+    def _defer(self, retry: List[tuple]) -> None:
+        """Lägg rader i omförsökslistan."""
+        with self._retry_lock:
+            for attempts, entry in retry:
+                if attempts >= self.max_attempts:
+                    self._stats["failed"] += 1
+                    print(f"audit writer: ger upp {entry.get('action')} för position {entry.get('position_id')} efter {attempts} försök")
+                    continue
+                self._retry.append((attempts, entry))
+            while len(self._retry) > self.max_buffer:
+                attempts, entry = self._retry.popleft()
+                self._stats["failed"] += 1
+                print(f"audit writer: omförsökslistan full, ger upp {entry.get('action')} för position {entry.get('position_id')}")
+
+    def _retry_failed(self) -> None:
+        """Ingen rad kunde skrivas: skjut upp nästa omförsök (exponentiell backoff)."""
+        with self._retry_lock:
+            self._retry_at = time.monotonic() + self._retry_delay
+            self._retry_delay = min(self.max_retry_delay_s, self._retry_delay * 2)
+
+    def _retry_succeeded(self) -> None:
+        with self._retry_lock:
+            self._retry_delay = self.retry_delay_s
+            if self._retry:
+                self._retry_at = 0.0
+
+    def _write_batch(self, entries: List[Dict[str, Any]]) -> None:
+        conn = self._get_db()
+        try:
+            write_entries(self._get_cursor(conn), self.is_postgres, entries)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
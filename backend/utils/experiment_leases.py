@@ -0,0 +1,135 @@
+"""
+Leasing av pending-experiment till granskare (prefetch i ExperimentMode).
+
+En granskare får upp till `count` pending-experiment reserverade i
+tabellen experiment_leases (en rad per experiment) med en utgångstid.
+Ett experiment som är leasat av någon annan och inte har gått ut lämnas
+aldrig ut, varken här eller via /ml/experiments/next. Reservationen görs
+med en villkorad upsert per experiment (ON CONFLICT ... DO UPDATE ... WHERE
+leasen har gått ut eller redan är granskarens). Den är atomär på både
+Postgres och SQLite, så två granskare kan inte få samma experiment även om
+de frågar samtidigt.
+
+Leasen tas bort när experimentet bedöms eller hoppas över, och utgångna
+rader städas bort vid nästa leasing. Tider lagras som epoch-sekunder så
+att jämförelserna fungerar likadant i båda dialekterna.
+
+Tabellen skapas i main.init_db. Funktionerna tar en cursor + is_postgres,
+importerar inte main.py och committar inte – anroparen äger transaktionen.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import List, Sequence
+
+# Samma normalisering som endpoints använder för status
+PENDING_SQL = "LOWER(TRIM(COALESCE(e.status, ''))) = 'pending'"
+
+
+def _ph(is_postgres: bool) -> str:
+    return "%s" if is_postgres else "?"
+
+
+def active_lease_filter(is_postgres: bool) -> str:
+    """SQL-villkor för ml_experiments e: inte leasat just nu. Tar parametern (now,)."""
+    return (
+        "NOT EXISTS (SELECT 1 FROM experiment_leases l "
+        f"WHERE l.experiment_id = e.id AND l.expires_at > {_ph(is_postgres)})"
+    )
+
+
+def lease(
+    cursor,
+    is_postgres: bool,
+    reviewer: str,
+    count: int,
+    ttl_s: float,
+) -> List[int]:
+    """
+    Reservera upp till count pending-experiment åt reviewer (de den redan
+    har förnyas först). Returnerar experiment-id i ordning.
+    """
+    ph = _ph(is_postgres)
+    now = time.time()
+    expires_at = now + ttl_s
+    cursor.execute(f"DELETE FROM experiment_leases WHERE expires_at <= {ph}", (now,))
+
+    # Granskarens egna leasar som fortfarande är pending
+    cursor.execute(
+        f"""
+        SELECT l.experiment_id
+        FROM experiment_leases l
+        JOIN ml_experiments e ON e.id = l.experiment_id
+        WHERE l.reviewer = {ph} AND {PENDING_SQL}
+        ORDER BY l.experiment_id ASC
+        """,
+        (reviewer,),
+    )
+    held = [row["experiment_id"] for row in cursor.fetchall()][:count]
+    if held:
+        cursor.execute(
+            f"""
+            UPDATE experiment_leases SET expires_at = {ph}
+            WHERE reviewer = {ph} AND experiment_id IN ({', '.join([ph] * len(held))})
+            """,
+            (expires_at, reviewer, *held),
+        )
+
+    # Fler kandidater än som behövs: en annan granskare kan hinna före
+    while len(held) < count:
+        wanted = count - len(held)
+        cursor.execute(
+            f"""
+            SELECT e.id
+            FROM ml_experiments e
+            WHERE {PENDING_SQL} AND {active_lease_filter(is_postgres)}
+            ORDER BY e.id ASC
+            LIMIT {int(wanted * 2)}
+            """,
+            (now,),
+        )
+        candidates = [row["id"] for row in cursor.fetchall() if row["id"] not in held]
+        if not candidates:
+            break
+        for experiment_id in candidates:
+            if _try_lease(cursor, is_postgres, experiment_id, reviewer, now, expires_at):
+                held.append(experiment_id)
+                if len(held) >= count:
+                    break
+    return held
+
+
+def _try_lease(cursor, is_postgres, experiment_id, reviewer, now, expires_at) -> bool:
+    ph = _ph(is_postgres)
+    cursor.execute(
+        f"""
+        INSERT INTO experiment_leases (experiment_id, reviewer, expires_at)
+        VALUES ({ph}, {ph}, {ph})
+        ON CONFLICT (experiment_id) DO UPDATE
+            SET reviewer = excluded.reviewer, expires_at = excluded.expires_at
+            WHERE experiment_leases.expires_at <= {ph}
+               OR experiment_leases.reviewer = excluded.reviewer
+        """,
+        (experiment_id, reviewer, expires_at, now),
+    )
+    return cursor.rowcount == 1
+
+
+def release(cursor, is_postgres: bool, experiment_ids: Sequence[int]) -> None:
+    """Ta bort leasar (experimentet är bedömt/överhoppat)."""
+    if not experiment_ids:
+        return
+    ph = _ph(is_postgres)
+    cursor.execute(
+        f"DELETE FROM experiment_leases WHERE experiment_id IN ({', '.join([ph] * len(experiment_ids))})",
+        tuple(experiment_ids),
+    )
+
+
+def release_reviewer(cursor, is_postgres: bool, reviewer: str) -> int:
+    """Lämna tillbaka alla granskarens leasar. Returnerar antal."""
+    cursor.execute(
+        f"DELETE FROM experiment_leases WHERE reviewer = {_ph(is_postgres)}", (reviewer,)
+    )
+    return cursor.rowcount
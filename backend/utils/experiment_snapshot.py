@@ -0,0 +1,252 @@
+"""
+Kompakt lagring av experimentens spår (ml_experiments.track_snapshot).
+
+Tidigare sparades original- och korrigerat spår som två fulla JSON-blobbar
+per experiment, trots att originalpositionerna redan finns i
+track_positions. Snapshoten lagrar istället per del (human/dog):
+
+- positions-id (int64, delta-kodade så att de komprimeras bra)
+- korrigeringsdeltan (korrigerad − original) i grader som float32, [n, 2]
+- predicted_correction_distance som float32
+
+och komprimerar alltihop med zlib. Vid läsning hämtas lat/lng/timestamp/
+accuracy från track_positions och samma JSON-struktur som förut byggs upp
+igen (rehydrate). float32-deltan ger under 1e-9 graders avvikelse från den
+ursprungliga korrigeringen. Positioner som har raderats sedan experimentet
+skapades hoppas över.
+
+Rader utan snapshot (äldre experiment som inte migrerats, eller där
+pack inte gick) läses som förut från JSON-kolumnerna. Migreringen av
+befintliga rader finns i scripts/migrate_ml_experiments.py.
+
+Funktionerna tar en cursor + is_postgres och importerar inte main.py.
+"""
+
+from __future__ import annotations
+
+import json
+import struct
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+MAGIC = b"EXS1"
+SNAPSHOT_VERSION = 1
+PARTS = ("human", "dog")
+
+# Max antal id per IN-lista vid rehydrering
+ID_CHUNK = 5000
+
+
+def _ph(is_postgres: bool) -> str:
+    return "%s" if is_postgres else "?"
+
+
+def _as_dict(value: Any) -> Dict[str, Any]:
+    """JSONB kan komma som dict (Postgres) eller str (SQLite/serialisering)."""
+    if value is None:
+        return {}
+    if isinstance(value, dict):
+        return value
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return {}
+
+
+def _positions(track: Dict[str, Any], part: str) -> List[Dict[str, Any]]:
+    return ((track.get(part) or {}).get("positions")) or []
+
+
+def pack(original_track: Dict[str, Any], corrected_track: Dict[str, Any]) -> bytes:
+    """
+    Packa ett experiments spår. ValueError om spåren inte går att uttrycka
+    som position-id + delta (saknade id eller korrigering som inte följer
+    originalet punkt för punkt) – anroparen sparar då JSON som förut.
+    """
+    header: Dict[str, Any] = {
+        "v": SNAPSHOT_VERSION,
+        "track_name": original_track.get("track_name") or corrected_track.get("track_name"),
+        "parts": {},
+    }
+    chunks: List[bytes] = []
+    for part in PARTS:
+        original = _positions(original_track, part)
+        corrected = _positions(corrected_track, part)
+        if not original:
+            if corrected:
+                raise ValueError(f"{part}: korrigering utan original")
+            continue
+        if corrected and len(corrected) != len(original):
+            raise ValueError(f"{part}: {len(corrected)} korrigerade mot {len(original)} original")
+        ids = []
+        for i, pos in enumerate(original):
+            if pos.get("id") is None:
+                raise ValueError(f"{part}: position utan id")
+            if corrected and corrected[i].get("id") not in (None, pos["id"]):
+                raise ValueError(f"{part}: korrigering följer inte originalet")
+            ids.append(int(pos["id"]))
+        ids_arr = np.asarray(ids, dtype=np.int64)
+        id_deltas = np.diff(ids_arr, prepend=np.int64(0))
+        if corrected:
+            orig_ll = np.array([[p["lat"], p["lng"]] for p in original], dtype=np.float64)
+            corr_ll = np.array([[p["lat"], p["lng"]] for p in corrected], dtype=np.float64)
+            deltas = (corr_ll - orig_ll).astype(np.float32)
+            predicted = np.array(
+                [p.get("predicted_correction_distance") or 0.0 for p in corrected], dtype=np.float32
+            )
+        else:
+            deltas = np.zeros((0, 2), dtype=np.float32)
+            predicted = np.zeros(0, dtype=np.float32)
+        header["parts"][part] = {"n": len(ids), "corrected": bool(corrected)}
+        chunks.extend([id_deltas.tobytes(), deltas.tobytes(), predicted.tobytes()])
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    body = zlib.compress(b"".join(chunks), 6)
+    return MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes + body
+
+
+def unpack(blob: bytes) -> Tuple[Dict[str, Any], Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]]:
+    """(header, {del: (ids, deltas [n, 2], predicted)}) ur en snapshot."""
+    blob = bytes(blob)
+    if blob[:4] != MAGIC:
+        raise ValueError("Okänt snapshot-format")
+    (header_len,) = struct.unpack("<I", blob[4:8])
+    header = json.loads(blob[8 : 8 + header_len].decode("utf-8"))
+    body = zlib.decompress(blob[8 + header_len :])
+    parts = {}
+    offset = 0
+    for part in PARTS:
+        meta = header["parts"].get(part)
+        if not meta:
+            continue
+        n = meta["n"]
+        m = n if meta["corrected"] else 0
+        ids = np.cumsum(np.frombuffer(body, dtype=np.int64, count=n, offset=offset))
+        offset += 8 * n
+        deltas = np.frombuffer(body, dtype=np.float32, count=2 * m, offset=offset).reshape(m, 2)
+        offset += 8 * m
+        predicted = np.frombuffer(body, dtype=np.float32, count=m, offset=offset)
+        offset += 4 * m
+        parts[part] = (ids, deltas, predicted)
+    return header, parts
+
+
+def _iso(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def _fetch_positions(cursor, is_postgres: bool, ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    ids = sorted(set(int(i) for i in ids))
+    ph = _ph(is_postgres)
+    found: Dict[int, Dict[str, Any]] = {}
+    for start in range(0, len(ids), ID_CHUNK):
+        chunk = ids[start : start + ID_CHUNK]
+        cursor.execute(
+            f"""
+            SELECT id, position_lat, position_lng, timestamp, accuracy
+            FROM track_positions
+            WHERE id IN ({', '.join([ph] * len(chunk))})
+            """,
+            tuple(chunk),
+        )
+        for row in cursor.fetchall():
+            found[row["id"]] = row
+    return found
+
+
+def _rehydrate(header, parts, positions) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    original_track: Dict[str, Any] = {"track_name": header.get("track_name")}
+    corrected_track: Dict[str, Any] = {"track_name": header.get("track_name")}
+    for part in PARTS:
+        original_track[part] = None
+        corrected_track[part] = None
+        if part not in parts:
+            continue
+        ids, deltas, predicted = parts[part]
+        original, corrected = [], []
+        for i, position_id in enumerate(ids.tolist()):
+            row = positions.get(position_id)
+            if row is None:
+                continue
+            lat = float(row["position_lat"])
+            lng = float(row["position_lng"])
+            timestamp = _iso(row["timestamp"])
+            accuracy = row["accuracy"]
+            original.append(
+                {
+                    "id": position_id,
+                    "lat": lat,
+                    "lng": lng,
+                    "timestamp": timestamp,
+                    "accuracy": float(accuracy) if accuracy else None,
+                }
+            )
+            if len(deltas):
+                corrected.append(
+                    {
+                        "id": position_id,
+                        "lat": lat + float(deltas[i, 0]),
+                        "lng": lng + float(deltas[i, 1]),
+                        "timestamp": timestamp,
+                        "predicted_correction_distance": float(predicted[i]),
+                    }
+                )
+        original_track[part] = {"positions": original} if original else None
+        corrected_track[part] = {"positions": corrected} if corrected else None
+    return original_track, corrected_track
+
+
+def load_tracks_many(cursor, is_postgres: bool, rows: List[Any]) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """
+    (original_track, corrected_track) per experimentrad (med track_snapshot,
+    original_track_json och corrected_track_json). Positionerna för alla
+    snapshots hämtas i en fråga.
+    """
+    unpacked: List[Optional[tuple]] = []
+    wanted: List[int] = []
+    for row in rows:
+        blob = row["track_snapshot"] if "track_snapshot" in row.keys() else None
+        if blob is None:
+            unpacked.append(None)
+            continue
+        header, parts = unpack(blob)
+        unpacked.append((header, parts))
+        for ids, _, _ in parts.values():
+            wanted.extend(ids.tolist())
+    positions = _fetch_positions(cursor, is_postgres, wanted) if wanted else {}
+
+    result = []
+    for row, item in zip(rows, unpacked):
+        if item is None:
+            result.append((_as_dict(row["original_track_json"]), _as_dict(row["corrected_track_json"])))
+        else:
+            result.append(_rehydrate(item[0], item[1], positions))
+    return result
+
+
+def load_tracks(cursor, is_postgres: bool, row: Any) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """(original_track, corrected_track) för en experimentrad."""
+    return load_tracks_many(cursor, is_postgres, [row])[0]
+
+
+def matches(
+    a: Tuple[Dict[str, Any], Dict[str, Any]],
+    b: Tuple[Dict[str, Any], Dict[str, Any]],
+    tolerance_deg: float = 1e-9,
+) -> bool:
+    """Samma positioner (id, tid) och koordinater inom tolerance_deg i båda spåren."""
+    for track_a, track_b in zip(a, b):
+        for part in PARTS:
+            pa, pb = _positions(track_a, part), _positions(track_b, part)
+            if len(pa) != len(pb):
+                return False
+            for x, y in zip(pa, pb):
+                if x.get("id") != y.get("id") or str(x.get("timestamp")) != str(y.get("timestamp")):
+                    return False
+                if abs(x["lat"] - y["lat"]) > tolerance_deg or abs(x["lng"] - y["lng"]) > tolerance_deg:
+                    return False
+    return True
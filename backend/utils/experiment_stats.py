@@ -0,0 +1,381 @@
+"""
+Experimenträknare per spår och indexerat urval av spår för experimentgenerering.
+
+Tabellen experiment_track_stats har en rad per valbart spår (importerat
+hundspår med positioner) med antal rader i ml_experiments, antal pending och
+en slumpnyckel. Räknarna uppdateras när experiment skapas, bedöms/hoppas
+över och när pending rensas, så urvalet behöver varken räkna ml_experiments
+per spår eller sortera på RANDOM().
+
+Urvalet (select_tracks) följer samma prioritet som tidigare – färre
+experiment först, slump inom samma antal – men som range-scans på indexet
+(pending_count, experiment_count, sample_key):
+
+1. lägsta antalet bland spår utan pending, från en slumpad startnyckel
+2. samma antal, nycklarna före startnyckeln (wrap-around)
+3. spår med fler experiment, i (antal, nyckel)-ordning
+
+Varje steg läser bara så många indexrader som efterfrågas, oberoende av
+korpusens storlek. Spåret får en ny slumpnyckel varje gång ett experiment
+skapas. Tabellen skapas i main.init_db, fylls med rebuild (en gång per
+process) och får nya spår via add_tracks vid CSV-import.
+
+rebuild låser båda tabellerna för skrivning innan den räknar (Postgres:
+LOCK TABLE ... IN EXCLUSIVE MODE, SQLite: databasens skrivlås) och skriver
+med upsert. En samtidig uppdatering väntar alltså tills omräkningen är
+committad och adderar sitt delta till det omräknade värdet, istället för att
+hamna mellan räkningen och skrivningen och gå förlorad; två samtidiga
+omräkningar körs efter varandra.
+
+Tabellen experiment_counters håller globala räknare för ExperimentMode
+(totalt, per status, per betyg och betygssumma) med en rad per räknare.
+De uppdateras i samma transaktioner som ml_experiments, så progress och
+/ml/experiments/stats läser några rader istället för att aggregera
+ml_experiments vid varje bedömning.
+
+Funktionerna tar en cursor + is_postgres, importerar inte main.py och
+committar inte – anroparen äger transaktionen.
+"""
+
+from __future__ import annotations
+
+import random
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+# Samma normalisering som endpoints använder för status
+STATUS_SQL = "LOWER(TRIM(COALESCE(e.status, '')))"
+PENDING_SQL = f"{STATUS_SQL} = 'pending'"
+
+# Valbara spår: importerade hundspår med positioner
+ELIGIBLE_SQL = (
+    "t.track_source = 'imported' AND t.track_type = 'dog' "
+    "AND EXISTS (SELECT 1 FROM track_positions p WHERE p.track_id = t.id)"
+)
+
+# Kolumner från tracks som experimentgenereringen behöver
+TRACK_COLUMNS = "t.id, t.name, t.human_track_id"
+
+
+def _ph(is_postgres: bool) -> str:
+    return "%s" if is_postgres else "?"
+
+
+def _lock_for_rebuild(cursor, is_postgres: bool) -> None:
+    """Ta skrivlås på räknartabellerna (hålls till anroparens commit)."""
+    if is_postgres:
+        cursor.execute("LOCK TABLE experiment_track_stats, experiment_counters IN EXCLUSIVE MODE")
+    else:
+        # En skrivande sats startar transaktionen med SQLites skrivlås
+        cursor.execute("UPDATE experiment_counters SET value = value WHERE 0")
+
+
+def rebuild(cursor, is_postgres: bool) -> int:
+    """Räkna om tabellerna från tracks + ml_experiments. Returnerar antal spår."""
+    _lock_for_rebuild(cursor, is_postgres)
+    cursor.execute(
+        f"""
+        SELECT t.id,
+               COUNT(e.id) AS experiment_count,
+               SUM(CASE WHEN {PENDING_SQL} THEN 1 ELSE 0 END) AS pending_count
+        FROM tracks t
+        LEFT JOIN ml_experiments e ON e.track_id = t.id
+        WHERE {ELIGIBLE_SQL}
+        GROUP BY t.id
+        """
+    )
+    now = datetime.now().isoformat()
+    rows = [
+        (
+            row["id"],
+            int(row["experiment_count"] or 0),
+            int(row["pending_count"] or 0),
+            random.random(),
+            now,
+        )
+        for row in cursor.fetchall()
+    ]
+    ph = _ph(is_postgres)
+    if rows:
+        # Befintliga spår behåller sin slumpnyckel
+        cursor.executemany(
+            f"""
+            INSERT INTO experiment_track_stats
+                (track_id, experiment_count, pending_count, sample_key, updated_at)
+            VALUES ({', '.join([ph] * 5)})
+            ON CONFLICT (track_id) DO UPDATE SET
+                experiment_count = excluded.experiment_count,
+                pending_count = excluded.pending_count,
+                updated_at = excluded.updated_at
+            """,
+            rows,
+        )
+    cursor.execute(
+        f"""
+        DELETE FROM experiment_track_stats
+        WHERE track_id NOT IN (SELECT t.id FROM tracks t WHERE {ELIGIBLE_SQL})
+        """
+    )
+    rebuild_counters(cursor, is_postgres)
+    return len(rows)
+
+
+def add_tracks(cursor, is_postgres: bool, track_ids: List[int]) -> None:
+    """Lägg till nya valbara spår (utan experiment), t.ex. efter import. Befintliga rader behålls."""
+    ph = _ph(is_postgres)
+    now = datetime.now().isoformat()
+    for track_id in track_ids:
+        cursor.execute(
+            f"""
+            INSERT INTO experiment_track_stats
+                (track_id, experiment_count, pending_count, sample_key, updated_at)
+            SELECT {ph}, 0, 0, {ph}, {ph}
+            WHERE NOT EXISTS (SELECT 1 FROM experiment_track_stats WHERE track_id = {ph})
+              AND EXISTS (SELECT 1 FROM track_positions WHERE track_id = {ph})
+            """,
+            (track_id, random.random(), now, track_id, track_id),
+        )
+
+
+def experiment_created(cursor, is_postgres: bool, track_id: int) -> None:
+    """Ett pending-experiment har skapats för spåret; dra en ny slumpnyckel."""
+    ph = _ph(is_postgres)
+    cursor.execute(
+        f"""
+        UPDATE experiment_track_stats
+        SET experiment_count = experiment_count + 1,
+            pending_count = pending_count + 1,
+            sample_key = {ph},
+            updated_at = {ph}
+        WHERE track_id = {ph}
+        """,
+        (random.random(), datetime.now().isoformat(), track_id),
+    )
+    _bump(cursor, is_postgres, {"total": 1, _status_key("pending"): 1})
+
+
+def experiment_updated(
+    cursor,
+    is_postgres: bool,
+    track_id: int,
+    old_status: Optional[str],
+    new_status: str,
+    old_rating: Optional[int] = None,
+    new_rating: Optional[int] = None,
+) -> None:
+    """Ett experiment har bedömts eller hoppats över (status/betyg före och efter)."""
+    old_status = _normalize_status(old_status)
+    new_status = _normalize_status(new_status)
+    if old_status == "pending" and new_status != "pending":
+        ph = _ph(is_postgres)
+        cursor.execute(
+            f"""
+            UPDATE experiment_track_stats
+            SET pending_count = CASE WHEN pending_count > 0 THEN pending_count - 1 ELSE 0 END,
+                updated_at = {ph}
+            WHERE track_id = {ph}
+            """,
+            (datetime.now().isoformat(), track_id),
+        )
+    deltas: Dict[str, int] = {}
+    if old_status != new_status:
+        deltas[_status_key(old_status)] = -1
+        deltas[_status_key(new_status)] = 1
+    if old_rating != new_rating:
+        for rating, sign in ((old_rating, -1), (new_rating, 1)):
+            if rating is not None:
+                deltas[_rating_key(rating)] = deltas.get(_rating_key(rating), 0) + sign
+                deltas["rating_count"] = deltas.get("rating_count", 0) + sign
+                deltas["rating_sum"] = deltas.get("rating_sum", 0) + sign * int(rating)
+    _bump(cursor, is_postgres, deltas)
+
+
+def pending_purged(cursor, is_postgres: bool, deleted: int) -> None:
+    """
+    Alla pending-experiment har raderats (de räknas inte längre). deleted är
+    antalet raderade rader (DELETE:ns rowcount); det dras av från räknarna.
+    """
+    cursor.execute(
+        f"""
+        UPDATE experiment_track_stats
+        SET experiment_count = experiment_count - pending_count,
+            pending_count = 0,
+            updated_at = {_ph(is_postgres)}
+        WHERE pending_count > 0
+        """,
+        (datetime.now().isoformat(),),
+    )
+    pending_key = _status_key("pending")
+    _bump(cursor, is_postgres, {"total": -int(deleted), pending_key: -int(deleted)})
+
+
+def track_deleted(cursor, is_postgres: bool, track_id: int) -> None:
+    """
+    Anropas innan ett spår raderas: dess experiment försvinner via
+    ON DELETE CASCADE och ska dras av från räknarna.
+    """
+    cursor.execute(
+        f"""
+        SELECT {STATUS_SQL} AS status, rating, COUNT(*) AS cnt
+        FROM ml_experiments e
+        WHERE e.track_id = {_ph(is_postgres)}
+        GROUP BY {STATUS_SQL}, rating
+        """,
+        (track_id,),
+    )
+    deltas = _counter_deltas(cursor.fetchall(), sign=-1)
+    cursor.execute(
+        f"DELETE FROM experiment_track_stats WHERE track_id = {_ph(is_postgres)}", (track_id,)
+    )
+    _bump(cursor, is_postgres, deltas)
+
+
+def _select(cursor, where: str, params: List[Any], limit: Optional[int]) -> List[Dict[str, Any]]:
+    limit_sql = f"LIMIT {int(limit)}" if limit else ""
+    cursor.execute(
+        f"""
+        SELECT {TRACK_COLUMNS}
+        FROM experiment_track_stats s
+        JOIN tracks t ON t.id = s.track_id
+        WHERE s.pending_count = 0 AND {where}
+        ORDER BY s.experiment_count ASC, s.sample_key ASC
+        {limit_sql}
+        """,
+        tuple(params),
+    )
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def select_tracks(cursor, is_postgres: bool, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Valbara spår utan pending-experiment: färre experiment först, slumpad
+    ordning inom samma antal. limit=None ger alla.
+    """
+    ph = _ph(is_postgres)
+    cursor.execute(
+        "SELECT MIN(experiment_count) AS lowest FROM experiment_track_stats WHERE pending_count = 0"
+    )
+    row = cursor.fetchone()
+    if row is None or row["lowest"] is None:
+        return []
+    lowest = int(row["lowest"])
+    pivot = random.random()
+
+    picked = _select(
+        cursor, f"s.experiment_count = {ph} AND s.sample_key >= {ph}", [lowest, pivot], limit
+    )
+    for where, params in (
+        (f"s.experiment_count = {ph} AND s.sample_key < {ph}", [lowest, pivot]),
+        (f"s.experiment_count > {ph}", [lowest]),
+    ):
+        remaining = None if limit is None else limit - len(picked)
+        if remaining is not None and remaining <= 0:
+            break
+        picked.extend(_select(cursor, where, params, remaining))
+    return picked
+
+
+def counts(cursor) -> Dict[str, int]:
+    """Antal valbara spår totalt och utan pending-experiment."""
+    cursor.execute(
+        """
+        SELECT COUNT(*) AS total,
+               SUM(CASE WHEN pending_count = 0 THEN 1 ELSE 0 END) AS eligible
+        FROM experiment_track_stats
+        """
+    )
+    row = cursor.fetchone()
+    return {"total": int(row["total"] or 0), "eligible": int(row["eligible"] or 0)}
+
+
+# --- Globala räknare (experiment_counters) ---
+
+
+def _normalize_status(status: Optional[str]) -> str:
+    return (status or "").strip().lower()
+
+
+def _status_key(status: Optional[str]) -> str:
+    return f"status:{_normalize_status(status)}"
+
+
+def _rating_key(rating: int) -> str:
+    return f"rating:{int(rating)}"
+
+
+def _counter_deltas(rows, sign: int = 1) -> Dict[str, int]:
+    """Räknardeltan från rader med status, rating och cnt."""
+    deltas: Dict[str, int] = {}
+
+    def add(key: str, value: int) -> None:
+        deltas[key] = deltas.get(key, 0) + sign * value
+
+    for row in rows:
+        cnt = int(row["cnt"] or 0)
+        add("total", cnt)
+        add(_status_key(row["status"]), cnt)
+        if row["rating"] is not None:
+            add(_rating_key(row["rating"]), cnt)
+            add("rating_count", cnt)
+            add("rating_sum", cnt * int(row["rating"]))
+    return deltas
+
+
+def _bump(cursor, is_postgres: bool, deltas: Dict[str, int]) -> None:
+    """Addera deltan atomärt (upsert per räknare; okända nycklar skapas)."""
+    ph = _ph(is_postgres)
+    for name, delta in sorted(deltas.items()):
+        if not delta:
+            continue
+        cursor.execute(
+            f"""
+            INSERT INTO experiment_counters (name, value) VALUES ({ph}, {ph})
+            ON CONFLICT (name) DO UPDATE SET value = experiment_counters.value + excluded.value
+            """,
+            (name, int(delta)),
+        )
+
+
+def rebuild_counters(cursor, is_postgres: bool) -> Dict[str, int]:
+    """
+    Räkna om experiment_counters från ml_experiments: räknarna sätts till
+    omräknade värden (upsert), räknare som inte längre förekommer till 0.
+    """
+    _lock_for_rebuild(cursor, is_postgres)
+    cursor.execute(
+        f"""
+        SELECT {STATUS_SQL} AS status, rating, COUNT(*) AS cnt
+        FROM ml_experiments e
+        GROUP BY {STATUS_SQL}, rating
+        """
+    )
+    values = _counter_deltas(cursor.fetchall())
+    ph = _ph(is_postgres)
+    for name, value in sorted(values.items()):
+        cursor.execute(
+            f"""
+            INSERT INTO experiment_counters (name, value) VALUES ({ph}, {ph})
+            ON CONFLICT (name) DO UPDATE SET value = excluded.value
+            """,
+            (name, int(value)),
+        )
+    if values:
+        cursor.execute(
+            f"UPDATE experiment_counters SET value = 0 WHERE name NOT IN ({', '.join([ph] * len(values))})",
+            tuple(sorted(values)),
+        )
+    else:
+        cursor.execute("UPDATE experiment_counters SET value = 0")
+    return values
+
+
+def read_counters(cursor, is_postgres: bool, names: Optional[List[str]] = None) -> Dict[str, int]:
+    """Alla räknare, eller bara names (en indexerad läsning)."""
+    if names:
+        ph = ", ".join([_ph(is_postgres)] * len(names))
+        cursor.execute(
+            f"SELECT name, value FROM experiment_counters WHERE name IN ({ph})", tuple(names)
+        )
+    else:
+        cursor.execute("SELECT name, value FROM experiment_counters")
+    return {row["name"]: int(row["value"] or 0) for row in cursor.fetchall()}
@@ -0,0 +1,533 @@
+"""
+Bakgrundsjobb: persistent jobbkö i databasen (Postgres eller SQLite) och en
+liten pool av arbetartrådar i backend-processen.
+
+Långa operationer (ML-analys, tile-konvertering, experimentgenerering) körs
+här istället för i request-tråden, så att HTTP-anropet bara lägger jobbet i kö
+och returnerar ett job_id. Klienten pollar sedan status/progress/resultat.
+
+Ingen extern broker behövs: tabellen `jobs` (skapas i main.init_db) är kön.
+Ett jobb claimas med en villkorad UPDATE (status='queued' → 'running') så att
+två arbetare aldrig kör samma jobb, även med flera backend-processer.
+
+Varje claim får ett eget worker_id (värd:pid:token). En heartbeat-tråd i
+runnern håller heartbeat_at färskt för alla jobb som processen kör, oavsett
+om handlern anropar progress() – ett jobb som räknar länge utan progress
+räknas alltså inte som övergivet. Alla skrivningar från arbetaren
+(progress, heartbeat, slutstatus) är villkorade på worker_id och
+status='running': har jobbet lagts tillbaka i kön och claimats av någon
+annan skriver den gamla arbetaren inte över den nya körningen, och handlern
+avbryts (JobCancelled) vid nästa progress-/avbrottskontroll.
+
+Modulen importerar inte main.py (undviker cirkulär import); databas-helpers
+skickas in vid konstruktion.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+JOB_STATUSES = ("queued", "running", "succeeded", "failed", "cancelled")
+FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+
+JobHandler = Callable[["JobContext", Dict[str, Any]], Optional[Dict[str, Any]]]
+
+
+class JobCancelled(Exception):
+    """Kastas inifrån ett jobb när avbrott har begärts."""
+
+
+def _now_iso() -> str:
+    return datetime.now().isoformat()
+
+
+def _json_default(o: Any) -> Any:
+    if hasattr(o, "isoformat"):
+        return o.isoformat()
+    return str(o)
+
+
+class JobContext:
+    """
+    Skickas till jobb-handlern. Används för att rapportera progress och
+    kontrollera om jobbet ska avbrytas.
+    """
+
+    # Skriv inte progress oftare än så här (sekunder), förutom vid 100 %
+    PROGRESS_MIN_INTERVAL_S = 0.5
+
+    def __init__(self, runner: "JobRunner", job_id: int, job_type: str, worker_id: str):
+        self.runner = runner
+        self.job_id = job_id
+        self.job_type = job_type
+        self.worker_id = worker_id
+        self._last_write = 0.0
+        self._cancelled = False
+        # Sätts av runnerns heartbeat-tråd när jobbet inte längre är vårt
+        self._lost = False
+
+    def progress(self, fraction: Optional[float], message: Optional[str] = None) -> None:
+        """
+        Uppdatera progress (0.0–1.0) och meddelande. Fungerar även som
+        heartbeat och avbrottskontroll: kastar JobCancelled om avbrott begärts
+        eller om jobbet har claimats av en annan arbetare.
+        """
+        if self._lost:
+            raise JobCancelled()
+        now = time.monotonic()
+        final = fraction is not None and fraction >= 1.0
+        if not final and now - self._last_write < self.PROGRESS_MIN_INTERVAL_S:
+            return
+        self._last_write = now
+        if fraction is not None:
+            fraction = max(0.0, min(1.0, float(fraction)))
+        stop = self.runner._write_progress(self.job_id, self.worker_id, fraction, message)
+        if stop:
+            self._cancelled = True
+            raise JobCancelled()
+
+    def is_cancelled(self) -> bool:
+        """Läs avbrottsflaggan från databasen (utan att kasta)."""
+        if self._cancelled or self._lost:
+            return True
+        self._cancelled = self.runner._cancel_requested(self.job_id, self.worker_id)
+        return self._cancelled
+
+    def check_cancelled(self) -> None:
+        """Kasta JobCancelled om avbrott har begärts."""
+        if self.is_cancelled():
+            raise JobCancelled()
+
+
+class JobRunner:
+    """
+    Databasbaserad jobbkö med en pool av arbetartrådar.
+
+    Användning:
+        runner = JobRunner(get_db, get_cursor, is_postgres=bool(DATABASE_URL))
+        runner.register("ml_analyze", handler)
+        job_id = runner.enqueue("ml_analyze", {"track_ids": "1,2"})
+    """
+
+    def __init__(
+        self,
+        get_db: Callable[[], Any],
+        get_cursor: Callable[[Any], Any],
+        *,
+        is_postgres: bool,
+        max_workers: int = 2,
+        poll_interval_s: float = 2.0,
+        stale_after_s: float = 300.0,
+        heartbeat_interval_s: float = 30.0,
+    ):
+        self._get_db = get_db
+        self._get_cursor = get_cursor
+        self.is_postgres = is_postgres
+        self.max_workers = max(1, int(max_workers))
+        self.poll_interval_s = poll_interval_s
+        self.stale_after_s = stale_after_s
+        # Flera heartbeats per stale-fönster, så att en enstaka missad inte räcker
+        self.heartbeat_interval_s = min(heartbeat_interval_s, stale_after_s / 3)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._handlers: Dict[str, JobHandler] = {}
+        self._threads: List[threading.Thread] = []
+        # Jobb som körs i den här processen: job_id -> JobContext
+        self._active: Dict[int, JobContext] = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def _ph(self) -> str:
+        return "%s" if self.is_postgres else "?"
+
+    # ------------------------------------------------------------------
+    # Publikt API
+    # ------------------------------------------------------------------
+
+    def register(self, job_type: str, handler: JobHandler) -> None:
+        self._handlers[job_type] = handler
+
+    def enqueue(self, job_type: str, params: Optional[Dict[str, Any]] = None) -> int:
+        """Lägg ett jobb i kön och väck en arbetare. Returnerar job_id."""
+        if job_type not in self._handlers:
+            raise ValueError(f"Okänd jobbtyp: {job_type}")
+        ph = self._ph
+        conn = self._get_db()
+        try:
+            cursor = self._get_cursor(conn)
+            returning = " RETURNING id" if self.is_postgres else ""
+            cursor.execute(
+                f"""
+                INSERT INTO jobs (job_type, status, params_json, progress, cancel_requested, created_at)
+                VALUES ({ph}, 'queued', {ph}, 0, 0, {ph}){returning}
+                """,
+                (job_type, json.dumps(params or {}, default=_json_default), _now_iso()),
+            )
+            if self.is_postgres:
+                job_id = cursor.fetchone()["id"]
+            else:
+                job_id = cursor.lastrowid
+            conn.commit()
+        finally:
+            conn.close()
+        self.start()
+        self._wake.set()
+        return int(job_id)
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        conn = self._get_db()
+        try:
+            cursor = self._get_cursor(conn)
+            cursor.execute(f"SELECT * FROM jobs WHERE id = {self._ph}", (job_id,))
+            row = cursor.fetchone()
+        finally:
+            conn.close()
+        return self._row_to_job(row) if row else None
+
+    def list(
+        self,
+        *,
+        status: Optional[str] = None,
+        job_type: Optional[str] = None,
+        limit: int = 50,
+    ) -> List[Dict[str, Any]]:
+        ph = self._ph
+        where = []
+        params: List[Any] = []
+        if status:
+            where.append(f"status = {ph}")
+            params.append(status)
+        if job_type:
+            where.append(f"job_type = {ph}")
+            params.append(job_type)
+        sql = "SELECT * FROM jobs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY id DESC LIMIT {ph}"
+        params.append(max(1, min(int(limit), 500)))
+        conn = self._get_db()
+        try:
+            cursor = self._get_cursor(conn)
+            cursor.execute(sql, tuple(params))
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+        return [self._row_to_job(r, include_result=False) for r in rows]
+
+    def cancel(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Begär avbrott. Köade jobb avbryts direkt; pågående jobb får flaggan
+        satt och avbryts vid nästa progress-/avbrottskontroll i handlern.
+        """
+        ph = self._ph
+        now = _now_iso()
+        conn = self._get_db()
+        try:
+            cursor = self._get_cursor(conn)
+            cursor.execute(
+                f"""
+                UPDATE jobs SET status = 'cancelled', cancel_requested = 1, finished_at = {ph}
+                WHERE id = {ph} AND status = 'queued'
+                """,
+                (now, job_id),
+            )
+            cursor.execute(
+                f"UPDATE jobs SET cancel_requested = 1 WHERE id = {ph} AND status = 'running'",
+                (job_id,),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        return self.get(job_id)
+
+    def start(self) -> None:
+        """Starta arbetartrådarna (idempotent)."""
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            if self._threads:
+                return
+            self._stop.clear()
+            for i in range(self.max_workers):
+                t = threading.Thread(
+                    target=self._worker_loop, name=f"job-worker-{i}", daemon=True
+                )
+                t.start()
+                self._threads.append(t)
+            t = threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def shutdown(self, timeout_s: float = 5.0) -> None:
+        """Stoppa arbetarna. Pågående jobb får köra klart inom timeout."""
+        self._stop.set()
+        self._wake.set()
+        for t in list(self._threads):
+            t.join(timeout=timeout_s)
+
+    # ------------------------------------------------------------------
+    # Intern logik
+    # ------------------------------------------------------------------
+
+    def _row_to_job(self, row: Any, include_result: bool = True) -> Dict[str, Any]:
+        d = dict(row)
+        params = d.pop("params_json", None)
+        result = d.pop("result_json", None)
+        d["params"] = json.loads(params) if isinstance(params, str) and params else (params or {})
+        if include_result:
+            d["result"] = json.loads(result) if isinstance(result, str) and result else result
+        d["cancel_requested"] = bool(d.get("cancel_requested"))
+        if d.get("progress") is not None:
+            d["progress"] = float(d["progress"])
+        return d
+
+    def _worker_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self._requeue_stale()
+                job = self._claim()
+            except Exception as e:
+                # Databasen kanske inte är redo än (t.ex. tabellen saknas) – försök igen senare
+                print(f"job runner: kunde inte hämta jobb: {e}")
+                job = None
+            if job is None:
+                self._wake.wait(self.poll_interval_s)
+                self._wake.clear()
+                continue
+            self._run(job)
+
+    def _heartbeat_loop(self) -> None:
+        while not self._stop.wait(self.heartbeat_interval_s):
+            try:
+                self._heartbeat()
+            except Exception as e:
+                print(f"job runner: heartbeat misslyckades: {e}")
+
+    def _heartbeat(self) -> None:
+        """
+        Förnya heartbeat_at för alla jobb som körs i processen. Ett jobb vars
+        rad inte längre är vår (återköad och claimad av någon annan, eller
+        avslutad) markeras som förlorat så att handlern avbryts.
+        """
+        with self._lock:
+            active = list(self._active.values())
+        if not active:
+            return
+        ph = self._ph
+        conn = self._get_db()
+        try:
+            cursor = self._get_cursor(conn)
+            lost = []
+            for ctx in active:
+                cursor.execute(
+                    f"""
+                    UPDATE jobs SET heartbeat_at = {ph}
+                    WHERE id = {ph} AND worker_id = {ph} AND status = 'running'
+                    """,
+                    (_now_iso(), ctx.job_id, ctx.worker_id),
+                )
+                if cursor.rowcount == 0:
+                    lost.append(ctx)
+            conn.commit()
+        finally:
+            conn.close()
+        for ctx in lost:
+            ctx._lost = True
+            print(f"job runner: jobb {ctx.job_id} körs inte längre av {ctx.worker_id}, avbryter")
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """Claima äldsta köade jobbet. Villkorad UPDATE gör det säkert mellan processer."""
+        ph = self._ph
+        conn = self._get_db()
+        try:
+            cursor = self._get_cursor(conn)
+            for _ in range(5):
+                cursor.execute(
+                    "SELECT id, job_type, params_json FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+                )
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                row = dict(row)
+                row["worker_id"] = f"{self.worker_id}:{uuid.uuid4().hex[:8]}"
+                now = _now_iso()
+                cursor.execute(
+                    f"""
+                    UPDATE jobs SET status = 'running', started_at = {ph}, heartbeat_at = {ph}, worker_id = {ph}
+                    WHERE id = {ph} AND status = 'queued'
+                    """,
+                    (now, now, row["worker_id"], row["id"]),
+                )
+                claimed = cursor.rowcount == 1
+                conn.commit()
+                if claimed:
+                    return row
+            return None
+        finally:
+            conn.close()
+
+    def _requeue_stale(self) -> None:
+        """
+        Jobb som står som 'running' utan heartbeat längre än stale_after_s har
+        förlorat sin arbetare (omstart/krasch) – lägg tillbaka dem i kön.
+        """
+        ph = self._ph
+        cutoff = (datetime.now() - timedelta(seconds=self.stale_after_s)).isoformat()
+        conn = self._get_db()
+        try:
+            cursor = self._get_cursor(conn)
+            cursor.execute(
+                f"""
+                UPDATE jobs SET status = 'queued', worker_id = NULL, heartbeat_at = NULL
+                WHERE status = 'running' AND cancel_requested = 0
+                  AND (heartbeat_at IS NULL OR heartbeat_at < {ph})
+                """,
+                (cutoff,),
+            )
+            cursor.execute(
+                f"""
+                UPDATE jobs SET status = 'cancelled', finished_at = {ph}
+                WHERE status = 'running' AND cancel_requested = 1
+                  AND (heartbeat_at IS NULL OR heartbeat_at < {ph})
+                """,
+                (_now_iso(), cutoff),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _run(self, job: Dict[str, Any]) -> None:
+        job_id = int(job["id"])
+        job_type = job["job_type"]
+        raw_params = job.get("params_json")
+        params = json.loads(raw_params) if isinstance(raw_params, str) and raw_params else {}
+        worker_id = job["worker_id"]
+        ctx = JobContext(self, job_id, job_type, worker_id)
+        handler = self._handlers.get(job_type)
+        if handler is None:
+            self._finish(job_id, worker_id, "failed", error=f"Okänd jobbtyp: {job_type}")
+            return
+        with self._lock:
+            self._active[job_id] = ctx
+        try:
+            result = handler(ctx, params)
+            self._finish(job_id, worker_id, "succeeded", result=result)
+        except JobCancelled:
+            self._finish(job_id, worker_id, "cancelled")
+        except Exception as e:
+            self._finish(
+                job_id, worker_id, "failed", error=f"{str(e)}\n\n{traceback.format_exc()}"
+            )
+        finally:
+            with self._lock:
+                self._active.pop(job_id, None)
+
+    def _write_progress(
+        self, job_id: int, worker_id: str, fraction: Optional[float], message: Optional[str]
+    ) -> bool:
+        """
+        Skriv progress + heartbeat. Returnerar True om handlern ska sluta:
+        avbrott begärt, eller jobbet körs inte längre av worker_id.
+        """
+        ph = self._ph
+        sets = [f"heartbeat_at = {ph}"]
+        params: List[Any] = [_now_iso()]
+        if fraction is not None:
+            sets.append(f"progress = {ph}")
+            params.append(fraction)
+        if message is not None:
+            sets.append(f"progress_message = {ph}")
+            params.append(message[:1000])
+        params.extend([job_id, worker_id])
+        conn = self._get_db()
+        try:
+            cursor = self._get_cursor(conn)
+            cursor.execute(
+                f"""
+                UPDATE jobs SET {', '.join(sets)}
+                WHERE id = {ph} AND worker_id = {ph} AND status = 'running'
+                """,
+                tuple(params),
+            )
+            owned = cursor.rowcount == 1
+            row = None
+            if owned:
+                cursor.execute(
+                    f"SELECT cancel_requested FROM jobs WHERE id = {ph}", (job_id,)
+                )
+                row = cursor.fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+        if not owned:
+            print(f"job runner: jobb {job_id} körs inte längre av {worker_id}, avbryter")
+            return True
+        return bool(row and dict(row).get("cancel_requested"))
+
+    def _cancel_requested(self, job_id: int, worker_id: str) -> bool:
+        """True om avbrott begärts eller jobbet inte längre körs av worker_id."""
+        conn = self._get_db()
+        try:
+            cursor = self._get_cursor(conn)
+            cursor.execute(
+                f"SELECT cancel_requested, status, worker_id FROM jobs WHERE id = {self._ph}",
+                (job_id,),
+            )
+            row = cursor.fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return True
+        row = dict(row)
+        if row.get("status") != "running" or row.get("worker_id") != worker_id:
+            return True
+        return bool(row.get("cancel_requested"))
+
+    def _finish(
+        self,
+        job_id: int,
+        worker_id: str,
+        status: str,
+        *,
+        result: Optional[Dict[str, Any]] = None,
+        error: Optional[str] = None,
+    ) -> None:
+        ph = self._ph
+        progress_sql = ", progress = 1" if status == "succeeded" else ""
+        conn = self._get_db()
+        try:
+            cursor = self._get_cursor(conn)
+            cursor.execute(
+                f"""
+                UPDATE jobs SET status = {ph}, result_json = {ph}, error = {ph},
+                    finished_at = {ph}, heartbeat_at = {ph}{progress_sql}
+                WHERE id = {ph} AND worker_id = {ph} AND status = 'running'
+                """,
+                (
+                    status,
+                    json.dumps(result, default=_json_default) if result is not None else None,
+                    error,
+                    _now_iso(),
+                    _now_iso(),
+                    job_id,
+                    worker_id,
+                ),
+            )
+            owned = cursor.rowcount == 1
+            conn.commit()
+            if not owned:
+                # Jobbet har återköats/claimats av en annan arbetare (eller
+                # avbrutits som stale) – den körningens status gäller
+                print(f"job runner: jobb {job_id} ägs inte längre av {worker_id}, resultatet ({status}) sparas inte")
+        except Exception as e:
+            print(f"job runner: kunde inte spara resultat för jobb {job_id}: {e}")
+        finally:
+            conn.close()
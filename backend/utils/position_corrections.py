@@ -0,0 +1,91 @@
+"""
+Mängdbaserad skrivning av ML-korrigeringar till track_positions.
+
+apply_ml_correction räknar fram alla korrigerade positioner i minnet och
+skriver dem här med en sats istället för en UPDATE per position:
+
+- Postgres: UPDATE ... FROM (VALUES ...) via execute_values (en round trip)
+- SQLite: executemany till en temporär tabell och en UPDATE ... FROM som
+  joinar mot den (SQLite ≥ 3.33)
+
+Alla rader får truth_level='T2' och correction_source='ml'. Funktionerna tar
+en cursor + is_postgres, importerar inte main.py och committar inte –
+anroparen äger transaktionen (hela spåret eller inget).
+"""
+
+from __future__ import annotations
+
+from typing import Sequence, Tuple
+
+# (position_id, corrected_lat, corrected_lng, ml_confidence)
+Correction = Tuple[int, float, float, float]
+
+
+def write_ml_corrections(
+    cursor,
+    is_postgres: bool,
+    corrections: Sequence[Correction],
+    *,
+    corrected_at: str,
+    model_version: str,
+) -> int:
+    """Skriv korrigeringarna. Returnerar antal uppdaterade positioner."""
+    if not corrections:
+        return 0
+
+    if is_postgres:
+        from psycopg2.extras import execute_values
+
+        execute_values(
+            cursor,
+            """
+            UPDATE track_positions AS tp
+            SET corrected_lat = v.corrected_lat,
+                corrected_lng = v.corrected_lng,
+                corrected_at = v.corrected_at,
+                truth_level = 'T2',
+                ml_confidence = v.ml_confidence,
+                ml_model_version = v.ml_model_version,
+                correction_source = 'ml'
+            FROM (VALUES %s) AS v(id, corrected_lat, corrected_lng, ml_confidence, corrected_at, ml_model_version)
+            WHERE tp.id = v.id
+            """,
+            [tuple(c) + (corrected_at, model_version) for c in corrections],
+            template="(%s::integer, %s::double precision, %s::double precision, %s::double precision, %s, %s)",
+            page_size=len(corrections),
+        )
+        return cursor.rowcount
+
+    cursor.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS ml_correction_batch (
+            id INTEGER PRIMARY KEY,
+            corrected_lat REAL,
+            corrected_lng REAL,
+            ml_confidence REAL
+        )
+        """
+    )
+    cursor.execute("DELETE FROM ml_correction_batch")
+    cursor.executemany(
+        "INSERT INTO ml_correction_batch (id, corrected_lat, corrected_lng, ml_confidence) VALUES (?, ?, ?, ?)",
+        [tuple(c) for c in corrections],
+    )
+    cursor.execute(
+        """
+        UPDATE track_positions
+        SET corrected_lat = b.corrected_lat,
+            corrected_lng = b.corrected_lng,
+            corrected_at = ?,
+            truth_level = 'T2',
+            ml_confidence = b.ml_confidence,
+            ml_model_version = ?,
+            correction_source = 'ml'
+        FROM ml_correction_batch AS b
+        WHERE track_positions.id = b.id
+        """,
+        (corrected_at, model_version),
+    )
+    updated = cursor.rowcount
+    cursor.execute("DELETE FROM ml_correction_batch")
+    return updated
@@ -0,0 +1,406 @@
+"""
+Feature store: ML-features per position i tabellen position_features.
+
+Kinematiska features (samma definitioner som ml/analysis.py och
+predict-endpointen) beräknas när positioner skrivs istället för vid varje
+förutsägelse. De beror bara på rå GPS (position_lat/lng, timestamp) i spårets
+tidsordning och på grannar inom NEIGHBOUR_RADIUS:
+
+- distance_prev_1..3, speed, acceleration, bearing: upp till 3 positioner bakåt
+- curvature: föregående och nästa position
+- speed_consistency: segmenthastigheter i fönstret i-5..i+5
+
+En ny eller ändrad position på index k påverkar alltså bara k-5..k+5, och de
+raderna beräknas från positionerna k-10..k+10 (refresh_window). Korrigeringar
+(corrected_lat/lng) ändrar inga features.
+
+Varje rad bär FEATURE_SCHEMA_VERSION. Höj den när definitionerna ändras; rader
+med annan version räknas som inaktuella och byggs om av rebuild (jobbet
+features_rebuild) eller vid nästa läsning (load_track_features).
+
+Tabellen skapas i main.init_db. Funktionerna tar en cursor + is_postgres,
+importerar inte main.py och committar inte – anroparen äger transaktionen.
+"""
+
+from __future__ import annotations
+
+import math
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+FEATURE_SCHEMA_VERSION = 1
+
+# Kolumner i position_features (utöver position_id/track_id/schema_version/updated_at)
+FEATURE_COLUMNS = (
+    "speed",
+    "acceleration",
+    "distance_prev_1",
+    "distance_prev_2",
+    "distance_prev_3",
+    "bearing",
+    "curvature",
+    "speed_consistency",
+    "position_jump",
+)
+
+# Fönster för speed_consistency (samma som calculate_speed_consistency i analysis.py)
+SPEED_WINDOW = 5
+NEIGHBOUR_RADIUS = SPEED_WINDOW
+
+# (lat, lng, tid) per position i spårets ordning
+Point = Tuple[float, float, Optional[datetime]]
+
+
+def _ph(is_postgres: bool) -> str:
+    return "%s" if is_postgres else "?"
+
+
+def _parse_time(value: Any) -> Optional[datetime]:
+    """Postgres ger datetime, SQLite ISO-strängar."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def _haversine(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    R = 6371000
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    delta_phi = math.radians(lat2 - lat1)
+    delta_lambda = math.radians(lng2 - lng1)
+    a = (
+        math.sin(delta_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2) ** 2
+    )
+    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def _bearing_radians(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    delta_lng = math.radians(lng2 - lng1)
+    y = math.sin(delta_lng) * math.cos(lat2_rad)
+    x = math.cos(lat1_rad) * math.sin(lat2_rad) - math.sin(lat1_rad) * math.cos(
+        lat2_rad
+    ) * math.cos(delta_lng)
+    return math.atan2(y, x)
+
+
+def _seconds(t1: Optional[datetime], t2: Optional[datetime]) -> float:
+    """t2 - t1 i sekunder; 0 om någon tid saknas eller inte går att jämföra."""
+    if t1 is None or t2 is None:
+        return 0.0
+    try:
+        return (t2 - t1).total_seconds()
+    except TypeError:
+        # Blandning av tidszonsmedvetna och naiva tider
+        return 0.0
+
+
+def compute_features(
+    points: Sequence[Point], indices: Optional[Iterable[int]] = None
+) -> Dict[int, Dict[str, float]]:
+    """
+    Features för positionerna på indices (default alla) i points.
+    Returnerar {index: {kolumn: värde}}.
+    """
+    n = len(points)
+    if indices is None:
+        indices = range(n)
+    indices = list(indices)
+    if not indices:
+        return {}
+
+    # Segment j går från j till j+1; beräknas bara inom det fönster som behövs
+    lo = max(0, min(indices) - NEIGHBOUR_RADIUS)
+    hi = min(n - 1, max(indices) + NEIGHBOUR_RADIUS)
+    seg_dist: Dict[int, float] = {}
+    seg_dt: Dict[int, float] = {}
+    for j in range(lo, hi):
+        lat1, lng1, t1 = points[j]
+        lat2, lng2, t2 = points[j + 1]
+        seg_dist[j] = _haversine(lat1, lng1, lat2, lng2)
+        seg_dt[j] = _seconds(t1, t2)
+
+    out: Dict[int, Dict[str, float]] = {}
+    for i in indices:
+        lat, lng, _ = points[i]
+        speed = 0.0
+        acceleration = 0.0
+        distance_prev = [0.0, 0.0, 0.0]
+        bearing = 0.0
+        curvature = 0.0
+        position_jump = 0.0
+
+        if i > 0:
+            prev_lat, prev_lng, _ = points[i - 1]
+            distance_prev[0] = seg_dist[i - 1]
+            time_diff = seg_dt[i - 1]
+            if time_diff > 0:
+                speed = distance_prev[0] / time_diff
+            bearing = math.degrees(_bearing_radians(prev_lat, prev_lng, lat, lng))
+            if bearing < 0:
+                bearing += 360
+            if i > 1:
+                distance_prev[1] = seg_dist[i - 2]
+                time_diff_prev = seg_dt[i - 2]
+                if time_diff_prev > 0 and time_diff > 0:
+                    acceleration = (speed - distance_prev[1] / time_diff_prev) / time_diff
+                if i > 2:
+                    distance_prev[2] = seg_dist[i - 3]
+            if speed > 0 and time_diff > 0:
+                position_jump = abs(distance_prev[0] - speed * time_diff)
+
+            if i < n - 1:
+                next_lat, next_lng, _ = points[i + 1]
+                curvature = abs(
+                    _bearing_radians(prev_lat, prev_lng, lat, lng)
+                    - _bearing_radians(lat, lng, next_lat, next_lng)
+                )
+                if curvature > math.pi:
+                    curvature = 2 * math.pi - curvature
+
+        speeds = [
+            seg_dist[j] / seg_dt[j]
+            for j in range(max(0, i - SPEED_WINDOW), min(n, i + SPEED_WINDOW + 1) - 1)
+            if seg_dt[j] > 0
+        ]
+        speed_consistency = 0.0
+        if len(speeds) >= 2:
+            mean = sum(speeds) / len(speeds)
+            speed_consistency = math.sqrt(sum((s - mean) ** 2 for s in speeds) / len(speeds))
+
+        out[i] = {
+            "speed": speed,
+            "acceleration": acceleration,
+            "distance_prev_1": distance_prev[0],
+            "distance_prev_2": distance_prev[1],
+            "distance_prev_3": distance_prev[2],
+            "bearing": bearing,
+            "curvature": curvature,
+            "speed_consistency": speed_consistency,
+            "position_jump": position_jump,
+        }
+    return out
+
+
+def _points(rows: Sequence[Any]) -> List[Point]:
+    return [
+        (
+            float(row["position_lat"]),
+            float(row["position_lng"]),
+            _parse_time(row["timestamp"]),
+        )
+        for row in rows
+    ]
+
+
+def _store(
+    cursor, is_postgres: bool, track_id: int, rows: Sequence[Any], features: Dict[int, Dict[str, float]]
+) -> int:
+    """
+    Skriv (ersätt) raderna för features-indexen med en upsert på position_id.
+    Två samtidiga omräkningar av samma spår (t.ex. experimentpoolens trådar)
+    skriver då över varandra istället för att krocka på primärnyckeln, vilket
+    DELETE + INSERT gjorde på Postgres. Returnerar antal rader.
+    """
+    if not features:
+        return 0
+    ph = _ph(is_postgres)
+    now = datetime.now().isoformat()
+    columns = ("position_id", "track_id", "schema_version") + FEATURE_COLUMNS + ("updated_at",)
+    updates = ", ".join(f"{c} = excluded.{c}" for c in columns[1:])
+    values = [
+        (rows[i]["id"], track_id, FEATURE_SCHEMA_VERSION)
+        + tuple(f[c] for c in FEATURE_COLUMNS)
+        + (now,)
+        for i, f in features.items()
+    ]
+    if is_postgres:
+        # En sats per sida istället för en round trip per rad
+        from psycopg2.extras import execute_values
+
+        execute_values(
+            cursor,
+            f"""
+            INSERT INTO position_features ({', '.join(columns)}) VALUES %s
+            ON CONFLICT (position_id) DO UPDATE SET {updates}
+            """,
+            values,
+            page_size=1000,
+        )
+    else:
+        cursor.executemany(
+            f"""
+            INSERT INTO position_features ({', '.join(columns)}) VALUES ({', '.join([ph] * len(columns))})
+            ON CONFLICT (position_id) DO UPDATE SET {updates}
+            """,
+            values,
+        )
+    return len(values)
+
+
+def _track_rows(cursor, is_postgres: bool, track_id: int) -> List[Any]:
+    cursor.execute(
+        f"""
+        SELECT id, position_lat, position_lng, timestamp
+        FROM track_positions
+        WHERE track_id = {_ph(is_postgres)}
+        ORDER BY timestamp ASC, id ASC
+        """,
+        (track_id,),
+    )
+    return cursor.fetchall()
+
+
+def rebuild_track(cursor, is_postgres: bool, track_id: int) -> int:
+    """
+    Beräkna om hela spåret. Returnerar antal skrivna rader. Alla spårets
+    positioner skrivs om (upsert); rader för borttagna positioner försvinner
+    via ON DELETE CASCADE respektive rensningen i rebuild.
+    """
+    rows = _track_rows(cursor, is_postgres, track_id)
+    return _store(cursor, is_postgres, track_id, rows, compute_features(_points(rows)))
+
+
+def refresh_window(cursor, is_postgres: bool, position_id: int) -> int:
+    """
+    Uppdatera features efter att en position lagts till eller flyttats: bara
+    positionen och dess grannar inom NEIGHBOUR_RADIUS åt båda hållen. Hämtar
+    2 * NEIGHBOUR_RADIUS positioner på varje sida (grannarnas egna fönster).
+    """
+    ph = _ph(is_postgres)
+    cursor.execute(
+        f"SELECT id, track_id, timestamp FROM track_positions WHERE id = {ph}",
+        (position_id,),
+    )
+    anchor = cursor.fetchone()
+    if anchor is None:
+        return 0
+    track_id = anchor["track_id"]
+    ts = anchor["timestamp"]
+    context = 2 * NEIGHBOUR_RADIUS
+
+    cursor.execute(
+        f"""
+        SELECT id, position_lat, position_lng, timestamp
+        FROM track_positions
+        WHERE track_id = {ph} AND (timestamp < {ph} OR (timestamp = {ph} AND id <= {ph}))
+        ORDER BY timestamp DESC, id DESC
+        LIMIT {context + 1}
+        """,
+        (track_id, ts, ts, position_id),
+    )
+    before = list(reversed(cursor.fetchall()))
+    cursor.execute(
+        f"""
+        SELECT id, position_lat, position_lng, timestamp
+        FROM track_positions
+        WHERE track_id = {ph} AND (timestamp > {ph} OR (timestamp = {ph} AND id > {ph}))
+        ORDER BY timestamp ASC, id ASC
+        LIMIT {context}
+        """,
+        (track_id, ts, ts, position_id),
+    )
+    rows = before + cursor.fetchall()
+    k = len(before) - 1
+    affected = range(max(0, k - NEIGHBOUR_RADIUS), min(len(rows), k + NEIGHBOUR_RADIUS + 1))
+    return _store(cursor, is_postgres, track_id, rows, compute_features(_points(rows), affected))
+
+
+def load_track_features(
+    cursor, is_postgres: bool, track_id: int, position_ids: Sequence[int]
+) -> Dict[int, Dict[str, float]]:
+    """
+    Lagrade features för spårets positioner, {position_id: {kolumn: värde}}.
+    Saknas någon av position_ids eller har fel schemaversion byggs spåret om
+    först (t.ex. positioner som skrivits innan tabellen fanns).
+    """
+    ph = _ph(is_postgres)
+    query = f"""
+        SELECT position_id, {', '.join(FEATURE_COLUMNS)}
+        FROM position_features
+        WHERE track_id = {ph} AND schema_version = {ph}
+    """
+    cursor.execute(query, (track_id, FEATURE_SCHEMA_VERSION))
+    stored = {row["position_id"]: {c: row[c] for c in FEATURE_COLUMNS} for row in cursor.fetchall()}
+    if any(pid not in stored for pid in position_ids):
+        rebuild_track(cursor, is_postgres, track_id)
+        cursor.execute(query, (track_id, FEATURE_SCHEMA_VERSION))
+        stored = {row["position_id"]: {c: row[c] for c in FEATURE_COLUMNS} for row in cursor.fetchall()}
+    return stored
+
+
+def stale_track_ids(cursor, is_postgres: bool) -> List[int]:
+    """Spår med minst en position utan aktuell feature-rad."""
+    cursor.execute(
+        f"""
+        SELECT DISTINCT tp.track_id
+        FROM track_positions tp
+        LEFT JOIN position_features pf
+          ON pf.position_id = tp.id AND pf.schema_version = {_ph(is_postgres)}
+        WHERE pf.position_id IS NULL
+        ORDER BY tp.track_id
+        """,
+        (FEATURE_SCHEMA_VERSION,),
+    )
+    return [row["track_id"] for row in cursor.fetchall()]
+
+
+def status(cursor, is_postgres: bool) -> Dict[str, Any]:
+    """Antal positioner och hur många som har aktuella/inaktuella features."""
+    ph = _ph(is_postgres)
+    cursor.execute("SELECT COUNT(*) AS cnt FROM track_positions")
+    positions = int(cursor.fetchone()["cnt"] or 0)
+    cursor.execute(
+        f"SELECT COUNT(*) AS cnt FROM position_features WHERE schema_version = {ph}",
+        (FEATURE_SCHEMA_VERSION,),
+    )
+    current = int(cursor.fetchone()["cnt"] or 0)
+    cursor.execute(
+        f"SELECT COUNT(*) AS cnt FROM position_features WHERE schema_version <> {ph}",
+        (FEATURE_SCHEMA_VERSION,),
+    )
+    stale = int(cursor.fetchone()["cnt"] or 0)
+    return {
+        "schema_version": FEATURE_SCHEMA_VERSION,
+        "positions": positions,
+        "current": current,
+        "stale": stale,
+        "missing": max(0, positions - current),
+    }
+
+
+def rebuild(
+    cursor,
+    is_postgres: bool,
+    track_ids: Optional[Sequence[int]] = None,
+    *,
+    commit: Optional[Callable[[], None]] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Dict[str, int]:
+    """
+    Bygg om features spår för spår. track_ids=None: alla spår med saknade
+    eller inaktuella rader (stale_track_ids). commit anropas efter varje spår
+    så att ett avbrutet jobb behåller det som redan är klart.
+    """
+    if track_ids is None:
+        track_ids = stale_track_ids(cursor, is_postgres)
+    track_ids = list(track_ids)
+    rows_written = 0
+    for done, track_id in enumerate(track_ids, start=1):
+        rows_written += rebuild_track(cursor, is_postgres, track_id)
+        if commit is not None:
+            commit()
+        if progress is not None:
+            progress(done, len(track_ids))
+    # Rader vars position har tagits bort (SQLite utan foreign_keys kaskaderar inte)
+    cursor.execute(
+        "DELETE FROM position_features WHERE position_id NOT IN (SELECT id FROM track_positions)"
+    )
+    return {"tracks": len(track_ids), "rows": rows_written}
@@ -0,0 +1,446 @@
+"""
+Prediction store: ML-förutsägelser i databasen istället för som JSON-filer i
+ml/predictions/.
+
+- ml_prediction_runs: en rad per körning (manifest) med sammanfattande mått,
+  identifierad av `filename` (samma namn som de gamla filerna, så API och
+  ml_prediction_feedback.prediction_filename fungerar oförändrat).
+- ml_predictions: en rad per position i körningen (seq bevarar ordningen).
+
+Listning, hämtning av en körning, paginering av positioner och join mot
+ml_prediction_feedback blir indexerade uppslag. Tabellerna skapas i main.init_db.
+
+Funktionerna tar en cursor + is_postgres och importerar inte main.py.
+"""
+
+from __future__ import annotations
+
+import json
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Kolumner i ml_predictions (utöver id/run_id), i insert-ordning
+POSITION_COLUMNS = (
+    "seq",
+    "position_id",
+    "track_id",
+    "track_name",
+    "track_type",
+    "timestamp",
+    "original_lat",
+    "original_lng",
+    "predicted_distance_m",
+    "ml_confidence",
+    "predicted_lat",
+    "predicted_lng",
+    "actual_distance_m",
+    "actual_lat",
+    "actual_lng",
+    "was_approved_as_is",
+    "prediction_error_m",
+    "verified_status",
+    "gps_accuracy",
+)
+
+
+def _ph(is_postgres: bool) -> str:
+    return "%s" if is_postgres else "?"
+
+
+def _json_default(o: Any) -> Any:
+    return o.isoformat() if hasattr(o, "isoformat") else str(o)
+
+
+def _latlng(d: Optional[Dict[str, Any]]) -> Tuple[Optional[float], Optional[float]]:
+    if not d:
+        return None, None
+    return d.get("lat"), d.get("lng")
+
+
+def _position_row(seq: int, p: Dict[str, Any], header: Dict[str, Any]) -> Tuple[Any, ...]:
+    orig_lat, orig_lng = _latlng(p.get("original_position"))
+    pred_lat, pred_lng = _latlng(p.get("predicted_corrected_position"))
+    act_lat, act_lng = _latlng(p.get("actual_corrected_position"))
+    approved = p.get("was_approved_as_is")
+    track_id = p.get("track_id")
+    if track_id is None:
+        track_id = header.get("track_id")
+    return (
+        seq,
+        p.get("position_id"),
+        track_id,
+        p.get("track_name") or header.get("track_name"),
+        p.get("track_type") or header.get("track_type"),
+        p.get("timestamp"),
+        orig_lat,
+        orig_lng,
+        p.get("predicted_correction_distance_meters"),
+        p.get("ml_confidence"),
+        pred_lat,
+        pred_lng,
+        p.get("actual_correction_distance_meters"),
+        act_lat,
+        act_lng,
+        None if approved is None else (1 if approved else 0),
+        p.get("prediction_error_meters"),
+        p.get("verified_status"),
+        p.get("gps_accuracy"),
+    )
+
+
+def _row_to_prediction(row: Dict[str, Any], multi_track: bool) -> Dict[str, Any]:
+    """Återskapa samma dict-form som de gamla predictions-filerna."""
+    p: Dict[str, Any] = {"position_id": row["position_id"]}
+    if multi_track:
+        p["track_id"] = row["track_id"]
+        p["track_name"] = row["track_name"]
+        p["track_type"] = row["track_type"]
+    p["timestamp"] = row["timestamp"]
+    p["original_position"] = {"lat": row["original_lat"], "lng": row["original_lng"]}
+    p["predicted_correction_distance_meters"] = row["predicted_distance_m"]
+    if row["ml_confidence"] is not None:
+        p["ml_confidence"] = row["ml_confidence"]
+    p["predicted_corrected_position"] = (
+        {"lat": row["predicted_lat"], "lng": row["predicted_lng"]}
+        if row["predicted_lat"] is not None
+        else None
+    )
+    p["actual_correction_distance_meters"] = row["actual_distance_m"]
+    p["actual_corrected_position"] = (
+        {"lat": row["actual_lat"], "lng": row["actual_lng"]}
+        if row["actual_lat"] is not None
+        else None
+    )
+    if row["was_approved_as_is"] is not None:
+        p["was_approved_as_is"] = bool(row["was_approved_as_is"])
+    p["prediction_error_meters"] = row["prediction_error_m"]
+    p["verified_status"] = row["verified_status"]
+    p["gps_accuracy"] = row["gps_accuracy"]
+    return p
+
+
+def _run_summary(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "filename": row["filename"],
+        "filepath": f"ml/predictions/{row['filename']}",
+        "size_bytes": row["size_bytes"],
+        "created": row["created_at"],
+        "track_ids": [int(t) for t in (row["track_ids"] or "").split(",") if t],
+        "track_names": row["track_names"],
+        "total_positions": row["total_positions"],
+        "positions_with_actual_corrections": row["positions_with_actual_corrections"],
+        "mean_predicted_m": row["mean_predicted_m"],
+        "mean_error_m": row["mean_error_m"],
+    }
+
+
+def save_run(
+    cursor,
+    is_postgres: bool,
+    filename: str,
+    result: Dict[str, Any],
+    *,
+    created_at: Optional[str] = None,
+) -> int:
+    """
+    Spara en körning (samma struktur som predict-endpoints bygger) och dess
+    positioner. Ersätter en ev. befintlig körning med samma filnamn.
+    Committar inte – anroparen äger transaktionen.
+    """
+    ph = _ph(is_postgres)
+    predictions = result.get("predictions") or []
+    statistics = result.get("statistics") or {}
+    header = {k: v for k, v in result.items() if k not in ("predictions", "statistics")}
+
+    if "track_ids" in header:
+        track_ids = [int(t) for t in header.get("track_ids") or []]
+        track_names = ", ".join(header.get("track_names") or [])
+    else:
+        track_ids = [int(header["track_id"])] if header.get("track_id") is not None else []
+        track_names = header.get("track_name") or ""
+
+    pred_stats = statistics.get("predicted_corrections") or {}
+    acc_stats = statistics.get("prediction_accuracy") or {}
+    size_bytes = len(json.dumps(result, ensure_ascii=False, default=_json_default).encode("utf-8"))
+
+    delete_run(cursor, is_postgres, filename)
+    returning = " RETURNING id" if is_postgres else ""
+    cursor.execute(
+        f"""
+        INSERT INTO ml_prediction_runs (
+            filename, track_ids, track_names, prediction_timestamp,
+            total_positions, positions_with_actual_corrections,
+            mean_predicted_m, max_predicted_m, mean_error_m,
+            size_bytes, header_json, statistics_json, created_at
+        ) VALUES ({", ".join([ph] * 13)}){returning}
+        """,
+        (
+            filename,
+            ",".join(map(str, track_ids)),
+            track_names,
+            header.get("prediction_timestamp"),
+            statistics.get("total_positions", len(predictions)),
+            statistics.get("positions_with_actual_corrections", 0),
+            pred_stats.get("mean_meters"),
+            pred_stats.get("max_meters"),
+            acc_stats.get("mean_error_meters"),
+            size_bytes,
+            json.dumps(header, ensure_ascii=False, default=_json_default),
+            json.dumps(statistics, ensure_ascii=False, default=_json_default),
+            created_at or datetime.now().isoformat(),
+        ),
+    )
+    if is_postgres:
+        run_id = cursor.fetchone()["id"]
+    else:
+        run_id = cursor.lastrowid
+
+    rows = [(run_id,) + _position_row(i, p, header) for i, p in enumerate(predictions)]
+    if rows:
+        cols = ("run_id",) + POSITION_COLUMNS
+        sql = f"INSERT INTO ml_predictions ({', '.join(cols)}) VALUES ({', '.join([ph] * len(cols))})"
+        if is_postgres:
+            from psycopg2.extras import execute_batch
+
+            execute_batch(cursor, sql, rows, page_size=500)
+        else:
+            cursor.executemany(sql, rows)
+    return int(run_id)
+
+
+def get_run_row(cursor, is_postgres: bool, filename: str) -> Optional[Dict[str, Any]]:
+    cursor.execute(
+        f"SELECT * FROM ml_prediction_runs WHERE filename = {_ph(is_postgres)}",
+        (filename,),
+    )
+    row = cursor.fetchone()
+    return dict(row) if row else None
+
+
+def list_runs(
+    cursor, is_postgres: bool, *, limit: int = 200, offset: int = 0
+) -> List[Dict[str, Any]]:
+    """Manifestet, nyaste först."""
+    ph = _ph(is_postgres)
+    cursor.execute(
+        f"""
+        SELECT id, filename, track_ids, track_names, total_positions,
+               positions_with_actual_corrections, mean_predicted_m, mean_error_m,
+               size_bytes, created_at
+        FROM ml_prediction_runs
+        ORDER BY created_at DESC, id DESC
+        LIMIT {ph} OFFSET {ph}
+        """,
+        (limit, offset),
+    )
+    return [_run_summary(dict(r)) for r in cursor.fetchall()]
+
+
+def count_runs(cursor) -> int:
+    cursor.execute("SELECT COUNT(*) AS cnt FROM ml_prediction_runs")
+    row = cursor.fetchone()
+    return int(dict(row)["cnt"] or 0) if row else 0
+
+
+def get_positions(
+    cursor,
+    is_postgres: bool,
+    run: Dict[str, Any],
+    *,
+    offset: int = 0,
+    limit: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Positioner för en körning i ursprunglig ordning (valfritt paginerat)."""
+    ph = _ph(is_postgres)
+    sql = f"SELECT * FROM ml_predictions WHERE run_id = {ph} ORDER BY seq"
+    params: List[Any] = [run["id"]]
+    if limit is not None:
+        sql += f" LIMIT {ph} OFFSET {ph}"
+        params.extend([limit, offset])
+    cursor.execute(sql, tuple(params))
+    multi = "track_ids" in json.loads(run["header_json"] or "{}")
+    return [_row_to_prediction(dict(r), multi) for r in cursor.fetchall()]
+
+
+def load_run(cursor, is_postgres: bool, filename: str) -> Optional[Dict[str, Any]]:
+    """Hela körningen i samma form som de gamla predictions-filerna."""
+    run = get_run_row(cursor, is_postgres, filename)
+    if run is None:
+        return None
+    data = json.loads(run["header_json"] or "{}")
+    data["statistics"] = json.loads(run["statistics_json"] or "{}")
+    data["predictions"] = get_positions(cursor, is_postgres, run)
+    return data
+
+
+def delete_run(cursor, is_postgres: bool, filename: str) -> bool:
+    """Radera körningen och dess positioner. Returnerar False om den saknades."""
+    ph = _ph(is_postgres)
+    run = get_run_row(cursor, is_postgres, filename)
+    if run is None:
+        return False
+    cursor.execute(f"DELETE FROM ml_predictions WHERE run_id = {ph}", (run["id"],))
+    cursor.execute(f"DELETE FROM ml_prediction_runs WHERE id = {ph}", (run["id"],))
+    return True
+
+
+# Max antal id per IN-lista (SQLite har en gräns för antal parametrar)
+ID_CHUNK = 500
+
+
+def upsert_feedback(
+    cursor,
+    is_postgres: bool,
+    filename: str,
+    updates: Sequence[Tuple[int, str]],
+    *,
+    created_at: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Skriv ML-feedback (position_id, verified_status) för en körning i
+    ml_prediction_feedback som en bulk-upsert. Senaste värdet per position
+    gäller. Postgres: en INSERT ... SELECT FROM (VALUES ...) via
+    execute_values, som också filtrerar bort positioner som inte finns.
+    SQLite: existenskontroll + executemany. Positioner som inte finns i
+    track_positions skrivs inte utan returneras i "missing".
+    Committar inte – anroparen äger transaktionen.
+    """
+    latest: Dict[int, str] = {}
+    for position_id, status in updates:
+        latest[int(position_id)] = status
+    if not latest:
+        return {"written": 0, "missing": []}
+    now = created_at or datetime.now().isoformat()
+    rows = [(filename, position_id, status, now) for position_id, status in latest.items()]
+
+    if is_postgres:
+        from psycopg2.extras import execute_values
+
+        written = execute_values(
+            cursor,
+            """
+            INSERT INTO ml_prediction_feedback (prediction_filename, position_id, verified_status, created_at)
+            SELECT v.prediction_filename, v.position_id, v.verified_status, v.created_at
+            FROM (VALUES %s) AS v(prediction_filename, position_id, verified_status, created_at)
+            JOIN track_positions tp ON tp.id = v.position_id
+            ON CONFLICT (prediction_filename, position_id)
+            DO UPDATE SET verified_status = EXCLUDED.verified_status, created_at = EXCLUDED.created_at
+            RETURNING position_id
+            """,
+            rows,
+            template="(%s, %s::integer, %s, %s)",
+            page_size=len(rows),
+            fetch=True,
+        )
+        found = {row["position_id"] for row in written}
+    else:
+        ids = list(latest)
+        found = set()
+        for start in range(0, len(ids), ID_CHUNK):
+            chunk = ids[start : start + ID_CHUNK]
+            cursor.execute(
+                f"SELECT id FROM track_positions WHERE id IN ({', '.join('?' * len(chunk))})",
+                tuple(chunk),
+            )
+            found.update(row["id"] for row in cursor.fetchall())
+        cursor.executemany(
+            """
+            INSERT INTO ml_prediction_feedback (prediction_filename, position_id, verified_status, created_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (prediction_filename, position_id)
+            DO UPDATE SET verified_status = excluded.verified_status, created_at = excluded.created_at
+            """,
+            [row for row in rows if row[1] in found],
+        )
+    return {
+        "written": len(found),
+        "missing": sorted(set(latest) - found),
+    }
+
+
+# Förutsägelser där effektiv status (ml_prediction_feedback överstyr körningens
+# egen verified_status) ger en träningsrad i feedback-exporten:
+# - correct: förutsagd position finns och ingen faktisk korrigering
+# - incorrect: förutsagd position finns (målet blir original, 0 m)
+# Positioner som redan exporteras från track_positions (korrigerade eller
+# verifierade som correct) hoppas över.
+FEEDBACK_POSITIONS_WHERE = """
+    p.predicted_lat IS NOT NULL
+    AND (
+        (COALESCE(f.verified_status, p.verified_status) = 'correct' AND p.actual_lat IS NULL)
+        OR COALESCE(f.verified_status, p.verified_status) = 'incorrect'
+    )
+    AND (
+        p.position_id IS NULL
+        OR NOT EXISTS (
+            SELECT 1 FROM track_positions tp
+            WHERE tp.id = p.position_id
+              AND (
+                  (tp.corrected_lat IS NOT NULL AND tp.corrected_lng IS NOT NULL)
+                  OR tp.verified_status = 'correct'
+              )
+        )
+    )
+"""
+
+FEEDBACK_POSITIONS_FROM = """
+    FROM ml_predictions p
+    JOIN ml_prediction_runs r ON r.id = p.run_id
+    LEFT JOIN ml_prediction_feedback f
+      ON f.prediction_filename = r.filename AND f.position_id = p.position_id
+"""
+
+FEEDBACK_POSITIONS_SQL = (
+    "SELECT r.filename, r.header_json, p.*, "
+    "COALESCE(f.verified_status, p.verified_status) AS effective_status"
+    + FEEDBACK_POSITIONS_FROM
+    + " WHERE "
+    + FEEDBACK_POSITIONS_WHERE
+    + " ORDER BY r.id, p.seq"
+)
+
+FEEDBACK_POSITIONS_COUNT_SQL = (
+    "SELECT COUNT(*) AS cnt" + FEEDBACK_POSITIONS_FROM + " WHERE " + FEEDBACK_POSITIONS_WHERE
+)
+
+
+def feedback_item(row: Dict[str, Any], header_cache: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Gör om en rad från FEEDBACK_POSITIONS_SQL till förutsägelse + körningens header."""
+    fn = row["filename"]
+    if fn not in header_cache:
+        header_cache[fn] = json.loads(row["header_json"] or "{}")
+    return {
+        "filename": fn,
+        "header": header_cache[fn],
+        "effective_status": row["effective_status"],
+        "prediction": _row_to_prediction(row, True),
+    }
+
+
+def import_legacy_files(cursor, is_postgres: bool, predictions_dir: Path) -> int:
+    """
+    Importera gamla predictions_*.json som ännu inte finns i manifestet.
+    Returnerar antal importerade körningar. Committar inte.
+    """
+    if not predictions_dir.exists():
+        return 0
+    cursor.execute("SELECT filename FROM ml_prediction_runs")
+    known = {dict(r)["filename"] for r in cursor.fetchall()}
+    imported = 0
+    for path in sorted(predictions_dir.glob("predictions_*.json")):
+        if path.name in known:
+            continue
+        # Savepoint per fil så att en trasig fil inte avbryter hela transaktionen
+        cursor.execute("SAVEPOINT import_prediction_file")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            created = datetime.fromtimestamp(path.stat().st_mtime).isoformat()
+            save_run(cursor, is_postgres, path.name, data, created_at=created)
+            cursor.execute("RELEASE SAVEPOINT import_prediction_file")
+            imported += 1
+        except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT import_prediction_file")
+            print(f"Kunde inte importera predictions-fil {path.name}: {e}")
+    return imported
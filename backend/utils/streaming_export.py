@@ -0,0 +1,179 @@
+"""
+Strömmande export: läs rader i chunkar via server-side cursor (Postgres) eller
+fetchmany (SQLite) och skicka dem som JSON-array eller NDJSON, valfritt
+gzip-komprimerat. Minnesanvändningen begränsas av chunk-storleken, inte av
+hur stor exporten är.
+
+Används av export-endpoints i main.py tillsammans med StreamingResponse.
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+import json
+import os
+import uuid
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Sequence
+
+DEFAULT_CHUNK_SIZE = 2000
+
+EXPORT_FORMATS = ("json", "ndjson")
+MEDIA_TYPES = {"json": "application/json", "ndjson": "application/x-ndjson"}
+
+
+def iter_rows(
+    conn,
+    query: str,
+    params: Optional[Sequence[Any]] = None,
+    *,
+    is_postgres: bool,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Iterera över resultatet av en SELECT utan att hämta allt på en gång.
+
+    Postgres: namngiven (server-side) cursor – servern håller resultatet och
+    klienten hämtar chunk_size rader åt gången. Kräver att anslutningen inte
+    är i autocommit och att inget annat körs på den under iterationen.
+    SQLite: vanlig cursor med fetchmany.
+    Query ska använda %s på Postgres och ? på SQLite.
+    """
+    if is_postgres:
+        from psycopg2.extras import RealDictCursor
+
+        cursor = conn.cursor(
+            name=f"export_{uuid.uuid4().hex[:12]}", cursor_factory=RealDictCursor
+        )
+        cursor.itersize = chunk_size
+    else:
+        cursor = conn.cursor()
+    try:
+        if params:
+            cursor.execute(query, tuple(params))
+        else:
+            cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
+    finally:
+        cursor.close()
+
+
+def encode_items(
+    items: Iterable[Any],
+    fmt: str = "json",
+    *,
+    default: Optional[Callable[[Any], Any]] = None,
+    indent: Optional[int] = None,
+) -> Iterator[str]:
+    """
+    Serialisera items ett i taget. "json" ger en giltig JSON-array ([...]),
+    "ndjson" ger ett kompakt objekt per rad.
+    """
+    if fmt == "ndjson":
+        for item in items:
+            yield json.dumps(item, ensure_ascii=False, default=default) + "\n"
+        return
+
+    first = True
+    yield "["
+    for item in items:
+        body = json.dumps(item, ensure_ascii=False, default=default, indent=indent)
+        if indent:
+            body = "\n".join(" " * indent + ln for ln in body.split("\n"))
+        yield ("\n" if first else ",\n") + body
+        first = False
+    yield "\n]\n" if not first else "]\n"
+
+
+def encode_csv(
+    header: Sequence[str],
+    rows: Iterable[Sequence[Any]],
+    *,
+    block_rows: int = 1000,
+) -> Iterator[str]:
+    """
+    CSV i block om block_rows rader. Headern skickas direkt (innan första
+    raden hämtats) så att klienten får första byten omedelbart.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    yield buf.getvalue()
+    buf.seek(0)
+    buf.truncate(0)
+    n = 0
+    for row in rows:
+        writer.writerow(row)
+        n += 1
+        if n >= block_rows:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+            n = 0
+    if n:
+        yield buf.getvalue()
+
+
+def to_bytes(chunks: Iterable[str], *, min_chunk_bytes: int = 64 * 1024) -> Iterator[bytes]:
+    """UTF-8-koda och slå ihop små strängar till block av rimlig storlek."""
+    buf = []
+    size = 0
+    for s in chunks:
+        b = s.encode("utf-8")
+        buf.append(b)
+        size += len(b)
+        if size >= min_chunk_bytes:
+            yield b"".join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield b"".join(buf)
+
+
+def gzip_stream(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """Gzip-komprimera en byte-ström inkrementellt (giltig .gz / Content-Encoding: gzip)."""
+    comp = zlib.compressobj(level, zlib.DEFLATED, 31)
+    first = True
+    for chunk in chunks:
+        out = comp.compress(chunk)
+        if first:
+            # Töm första blocket direkt så att klienten får data utan fördröjning
+            out += comp.flush(zlib.Z_SYNC_FLUSH)
+            first = False
+        if out:
+            yield out
+    tail = comp.flush()
+    if tail:
+        yield tail
+
+
+def tee_to_file(chunks: Iterable[bytes], fh, tmp_path: Path, final_path: Path) -> Iterator[bytes]:
+    """
+    Skriv varje block till fh (öppnad på tmp_path) samtidigt som det skickas
+    vidare. Först när strömmen har tagit slut normalt byts tmp_path till
+    final_path (os.replace); avbryts den (klienten kopplar ner → GeneratorExit,
+    eller fel i cursorn) tas tmp_path bort, så att final_path aldrig blir en
+    halv fil.
+    """
+    completed = False
+    try:
+        for chunk in chunks:
+            fh.write(chunk)
+            yield chunk
+        fh.close()
+        os.replace(tmp_path, final_path)
+        completed = True
+    finally:
+        if not completed:
+            fh.close()
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
@@ -0,0 +1,250 @@
+"""
+Spårsammanfattning: tidsintervall, antal positioner och bounding box per spår
+i tabellen track_summaries.
+
+Parning hund ↔ människa (experiment, auto-parning) behöver bara varje spårs
+t_start/t_end. Tidigare beräknades de med MIN/MAX-subqueries över
+track_positions för varje importerat människaspår och jämfördes i Python.
+Här underhålls de när positioner skrivs (extend_track vid append,
+refresh_track/rebuild vid bulkimport).
+
+t_start/t_end lagras som epoch-sekunder (REAL) så att överlapp kan räknas i
+SQL på både Postgres och SQLite. Intervallindexet är ett B-träd på t_start
+plus ett på duration_s: alla intervall som överlappar [a, b] har
+t_start i [a - max(duration_s), b), så find_best_overlap blir en avgränsad
+range-scan istället för en scan över alla spår.
+
+Tabellen skapas i main.init_db. Funktionerna tar en cursor + is_postgres,
+importerar inte main.py och committar inte – anroparen äger transaktionen.
+"""
+
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+
+def _ph(is_postgres: bool) -> str:
+    return "%s" if is_postgres else "?"
+
+
+def _epoch(value: Any) -> Optional[float]:
+    """Postgres ger datetime, SQLite ISO-strängar. Naiva tider tolkas som lokal tid."""
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    return value.timestamp()
+
+
+def get_summary(cursor, is_postgres: bool, track_id: int) -> Optional[Dict[str, Any]]:
+    cursor.execute(
+        f"SELECT * FROM track_summaries WHERE track_id = {_ph(is_postgres)}", (track_id,)
+    )
+    row = cursor.fetchone()
+    return dict(row) if row else None
+
+
+def refresh_track(cursor, is_postgres: bool, track_id: int) -> Optional[Dict[str, Any]]:
+    """Beräkna om spårets sammanfattning från track_positions (ett aggregat)."""
+    ph = _ph(is_postgres)
+    cursor.execute(
+        f"""
+        SELECT MIN(timestamp) AS t_start, MAX(timestamp) AS t_end, COUNT(*) AS cnt,
+               MIN(position_lat) AS min_lat, MAX(position_lat) AS max_lat,
+               MIN(position_lng) AS min_lng, MAX(position_lng) AS max_lng
+        FROM track_positions
+        WHERE track_id = {ph}
+        """,
+        (track_id,),
+    )
+    agg = cursor.fetchone()
+    cursor.execute(f"DELETE FROM track_summaries WHERE track_id = {ph}", (track_id,))
+    if agg is None or not agg["cnt"]:
+        return None
+    t_start = _epoch(agg["t_start"])
+    t_end = _epoch(agg["t_end"])
+    summary = {
+        "track_id": track_id,
+        "t_start": t_start,
+        "t_end": t_end,
+        "duration_s": (t_end - t_start) if t_start is not None and t_end is not None else None,
+        "position_count": int(agg["cnt"]),
+        "min_lat": agg["min_lat"],
+        "max_lat": agg["max_lat"],
+        "min_lng": agg["min_lng"],
+        "max_lng": agg["max_lng"],
+        "updated_at": datetime.now().isoformat(),
+    }
+    cursor.execute(
+        f"INSERT INTO track_summaries ({', '.join(summary)}) VALUES ({', '.join([ph] * len(summary))})",
+        tuple(summary.values()),
+    )
+    return summary
+
+
+def extend_track(
+    cursor, is_postgres: bool, track_id: int, lat: float, lng: float, timestamp: Any
+) -> Optional[Dict[str, Any]]:
+    """
+    Uppdatera sammanfattningen för en tillagd position utan att läsa spårets
+    övriga positioner. Saknas raden (eller tiden) görs en full refresh_track.
+    """
+    ts = _epoch(timestamp)
+    current = get_summary(cursor, is_postgres, track_id)
+    if current is None or ts is None or current["t_start"] is None:
+        return refresh_track(cursor, is_postgres, track_id)
+    summary = dict(current)
+    summary.update(
+        t_start=min(current["t_start"], ts),
+        t_end=max(current["t_end"], ts),
+        position_count=int(current["position_count"]) + 1,
+        min_lat=min(current["min_lat"], lat),
+        max_lat=max(current["max_lat"], lat),
+        min_lng=min(current["min_lng"], lng),
+        max_lng=max(current["max_lng"], lng),
+        updated_at=datetime.now().isoformat(),
+    )
+    summary["duration_s"] = summary["t_end"] - summary["t_start"]
+    ph = _ph(is_postgres)
+    columns = [c for c in summary if c != "track_id"]
+    cursor.execute(
+        f"UPDATE track_summaries SET {', '.join(f'{c} = {ph}' for c in columns)} WHERE track_id = {ph}",
+        tuple(summary[c] for c in columns) + (track_id,),
+    )
+    return summary
+
+
+def missing_track_ids(cursor) -> List[int]:
+    """Spår som har positioner men ingen sammanfattning (t.ex. från före tabellen)."""
+    cursor.execute(
+        """
+        SELECT t.id
+        FROM tracks t
+        WHERE NOT EXISTS (SELECT 1 FROM track_summaries s WHERE s.track_id = t.id)
+          AND EXISTS (SELECT 1 FROM track_positions p WHERE p.track_id = t.id)
+        ORDER BY t.id
+        """
+    )
+    return [row["id"] for row in cursor.fetchall()]
+
+
+def rebuild(
+    cursor,
+    is_postgres: bool,
+    track_ids: Optional[Sequence[int]] = None,
+    *,
+    commit: Optional[Callable[[], None]] = None,
+) -> int:
+    """Beräkna om spårens sammanfattningar; track_ids=None: de som saknas."""
+    if track_ids is None:
+        track_ids = missing_track_ids(cursor)
+    for i, track_id in enumerate(track_ids, start=1):
+        refresh_track(cursor, is_postgres, track_id)
+        if commit is not None and i % 100 == 0:
+            commit()
+    return len(track_ids)
+
+
+def find_best_overlap(
+    cursor,
+    is_postgres: bool,
+    t_start: float,
+    t_end: float,
+    *,
+    track_type: str = "human",
+    track_source: Optional[str] = "imported",
+) -> Optional[Dict[str, Any]]:
+    """
+    Spåret av track_type (och track_source) vars tidsintervall överlappar
+    [t_start, t_end] mest. None om inget överlappar.
+    """
+    ph = _ph(is_postgres)
+    cursor.execute("SELECT MAX(duration_s) AS max_duration FROM track_summaries")
+    row = cursor.fetchone()
+    max_duration = float(row["max_duration"] or 0.0) if row else 0.0
+    least, greatest = ("LEAST", "GREATEST") if is_postgres else ("MIN", "MAX")
+    source_sql = f"AND t.track_source = {ph}" if track_source else ""
+    params: List[Any] = [t_end, t_start, t_end, t_start - max_duration, t_start, track_type]
+    if track_source:
+        params.append(track_source)
+    cursor.execute(
+        f"""
+        SELECT s.track_id, {least}(s.t_end, {ph}) - {greatest}(s.t_start, {ph}) AS overlap_s
+        FROM track_summaries s
+        JOIN tracks t ON t.id = s.track_id
+        WHERE s.t_start < {ph} AND s.t_start >= {ph} AND s.t_end > {ph}
+          AND t.track_type = {ph} {source_sql}
+        ORDER BY overlap_s DESC, s.track_id ASC
+        LIMIT 1
+        """,
+        tuple(params),
+    )
+    best = cursor.fetchone()
+    if best is None:
+        return None
+    return {"track_id": best["track_id"], "overlap_s": float(best["overlap_s"])}
+
+
+def auto_pair(
+    cursor,
+    is_postgres: bool,
+    *,
+    overwrite: bool = False,
+    dry_run: bool = False,
+    commit: Optional[Callable[[], None]] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Dict[str, Any]:
+    """
+    Sätt human_track_id för importerade hundspår till det importerade
+    människaspår som överlappar mest i tid. overwrite=True parar även om spår
+    som redan har ett människaspår; dry_run=True skriver inget.
+    """
+    ph = _ph(is_postgres)
+    rebuild(cursor, is_postgres, commit=commit)
+    unpaired_sql = "" if overwrite else "AND t.human_track_id IS NULL"
+    cursor.execute(
+        f"""
+        SELECT t.id, t.human_track_id, s.t_start, s.t_end
+        FROM tracks t
+        JOIN track_summaries s ON s.track_id = t.id
+        WHERE t.track_source = 'imported' AND t.track_type = 'dog'
+          AND s.t_start IS NOT NULL {unpaired_sql}
+        ORDER BY t.id
+        """
+    )
+    dogs = [dict(row) for row in cursor.fetchall()]
+    pairs = []
+    unmatched = 0
+    for i, dog in enumerate(dogs, start=1):
+        match = find_best_overlap(cursor, is_postgres, dog["t_start"], dog["t_end"])
+        if match is None:
+            unmatched += 1
+        elif match["track_id"] != dog["human_track_id"]:
+            pairs.append(
+                {
+                    "dog_track_id": dog["id"],
+                    "human_track_id": match["track_id"],
+                    "previous_human_track_id": dog["human_track_id"],
+                    "overlap_s": match["overlap_s"],
+                }
+            )
+            if not dry_run:
+                cursor.execute(
+                    f"UPDATE tracks SET human_track_id = {ph} WHERE id = {ph}",
+                    (match["track_id"], dog["id"]),
+                )
+        if progress is not None:
+            progress(i, len(dogs))
+        if commit is not None and not dry_run and i % 100 == 0:
+            commit()
+    return {
+        "dog_tracks": len(dogs),
+        "paired": len(pairs),
+        "unmatched": unmatched,
+        "dry_run": dry_run,
+        "pairs": pairs,
+    }
@@ -1,6 +1,7 @@
 import React, { useState, useEffect, useRef, useMemo } from 'react'
 import L from 'leaflet'
 import 'leaflet/dist/leaflet.css'
+import { waitForJob } from '../jobs'
 
 // Fix för Leaflet ikoner
 delete L.Icon.Default.prototype._getIconUrl
@@ -87,6 +88,57 @@ function summarizeDistances(arr) {
     return { mean, median, p90, max, n: arr.length }
 }
 
+// Prefetch: granskaren håller aktuellt experiment + nästa i kö (leasade i backend)
+const PREFETCH_COUNT = 3
+const REVIEWER_STORAGE_KEY = 'experimentReviewerId'
+
+/** Stabilt granskar-id per webbläsare (leasar i backend knyts till det) */
+function getReviewerId() {
+    try {
+        let id = window.localStorage.getItem(REVIEWER_STORAGE_KEY)
+        if (!id) {
+            id = `reviewer-${Math.random().toString(36).slice(2, 10)}-${Date.now().toString(36)}`
+            window.localStorage.setItem(REVIEWER_STORAGE_KEY, id)
+        }
+        return id
+    } catch {
+        return 'reviewer-anonymous'
+    }
+}
+
+/**
+ * Packa upp kompakt experiment från /ml/experiments/lease till samma form som /ml/experiments/next.
+ * Positioner kommer som [lat, lng, ms sedan t0]; timestamp blir epoch-ms (fungerar med timeMs).
+ */
+function decodeLeasedExperiment(c) {
+    const decodeTrack = (track, which) => {
+        if (!track) return null
+        const t0 = track.t0 ? new Date(track.t0).getTime() : NaN
+        const positions = (track[which] || []).map(([lat, lng, dt]) => ({
+            lat,
+            lng,
+            timestamp: Number.isFinite(t0) && dt != null ? t0 + dt : null,
+        }))
+        return positions.length ? { positions } : null
+    }
+    return {
+        id: c.id,
+        track_id: c.track_id,
+        model_version: c.model_version,
+        created_at: c.created_at,
+        original_track: {
+            track_name: c.track_name,
+            human: decodeTrack(c.tracks?.human, 'original'),
+            dog: decodeTrack(c.tracks?.dog, 'original'),
+        },
+        corrected_track: {
+            track_name: c.track_name,
+            human: decodeTrack(c.tracks?.human, 'corrected'),
+            dog: decodeTrack(c.tracks?.dog, 'corrected'),
+        },
+    }
+}
+
 // Original: heldragna linjer. Modell/korrigerade: andra färger + korta streck (lättare att skilja från original).
 // dashArray i px-längd i Leaflet (kort streck, liten lucka)
 const TRACK_CONFIG = [
@@ -136,10 +188,62 @@ function ExperimentMode() {
     const [mapFullscreen, setMapFullscreen] = useState(false)
     const [ratingPanelOpen, setRatingPanelOpen] = useState(false)
 
+    const reviewerIdRef = useRef(getReviewerId())
+    const queueRef = useRef([])
+    const doneIdsRef = useRef(new Set())
+    const experimentRef = useRef(null)
+    const refillRef = useRef(null)
+
+    useEffect(() => {
+        experimentRef.current = experiment
+    }, [experiment])
+
     useEffect(() => {
         loadStats()
+        return () => releaseLeases()
     }, [])
 
+    /** Lämna tillbaka granskarens leasar (vyn stängs/rensas) */
+    const releaseLeases = () => {
+        queueRef.current = []
+        fetch(`${API_BASE}/ml/experiments/lease/release`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ reviewer: reviewerIdRef.current }),
+            keepalive: true,
+        }).catch(() => { /* leasen går ut av sig själv */ })
+    }
+
+    /** Leasa fler experiment och lägg nya i kön. En begäran i taget. */
+    const refillQueue = () => {
+        if (refillRef.current) return refillRef.current
+        const held = [experimentRef.current?.id, ...queueRef.current.map(e => e.id)].filter(id => id != null)
+        refillRef.current = (async () => {
+            const res = await fetch(`${API_BASE}/ml/experiments/lease`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    reviewer: reviewerIdRef.current,
+                    count: PREFETCH_COUNT,
+                    exclude_ids: held,
+                }),
+            })
+            const data = await res.json()
+            if (!res.ok) throw new Error(data.detail || res.status)
+            if (data.status === 'success') {
+                const known = new Set([experimentRef.current?.id, ...queueRef.current.map(e => e.id)])
+                for (const c of data.experiments || []) {
+                    if (known.has(c.id) || doneIdsRef.current.has(c.id)) continue
+                    queueRef.current.push(decodeLeasedExperiment(c))
+                }
+            }
+            return data
+        })().finally(() => {
+            refillRef.current = null
+        })
+        return refillRef.current
+    }
+
     const loadStats = async () => {
         try {
             const res = await fetch(`${API_BASE}/ml/experiments/stats`)
@@ -162,8 +266,14 @@ function ExperimentMode() {
             const res = await fetch(`${API_BASE}/ml/experiments/batch/generate`, {
                 method: 'POST'
             })
-            const data = await res.json()
-            
+            const queued = await res.json()
+            if (!res.ok) {
+                alert('Fel vid generering: ' + (queued.detail || res.status))
+                return
+            }
+            // Genereringen körs som bakgrundsjobb – vänta på resultatet
+            const data = await waitForJob(API_BASE, queued.job_id)
+
             if (data.status === 'success') {
                 alert(data.message || `Genererade ${data.generated} experiment`)
                 loadStats()
@@ -178,24 +288,58 @@ function ExperimentMode() {
         }
     }
 
+    const showExperiment = (exp) => {
+        setExperiment(exp)
+        setRating(5)
+        setNotes('')
+        setTrackVisibility(Object.fromEntries(TRACK_CONFIG.map(t => [t.key, true])))
+        setMapFullscreen(false)
+        setRatingPanelOpen(false)
+    }
+
+    /** Visa nästa experiment från kön direkt; hämtar (leasar) bara när kön är tom */
     const loadNextExperiment = async () => {
+        const queued = queueRef.current.shift()
+        if (queued) {
+            experimentRef.current = queued
+            showExperiment(queued)
+            setProgress(prev => (prev ? { ...prev, current: prev.rated + 1 } : prev))
+            if (queueRef.current.length < PREFETCH_COUNT - 1) {
+                refillQueue().catch(err => console.warn('Prefetch av experiment misslyckades:', err))
+            }
+            return
+        }
+
         setLoading(true)
         try {
-            const res = await fetch(`${API_BASE}/ml/experiments/next`)
-            const data = await res.json()
+            experimentRef.current = null
+            const data = await refillQueue()
 
             if (data.status === 'completed') {
                 alert('Alla experiment är bedömda!')
                 setExperiment(null)
                 setProgress(data.progress)
+            } else if (data.status === 'generating') {
+                // Poolen fylls på i bakgrunden – försök igen strax
+                setExperiment(null)
+                setProgress(data.progress)
+                setNotice(data.message)
+                window.setTimeout(() => {
+                    setNotice(null)
+                    loadNextExperiment()
+                }, 3000)
             } else if (data.status === 'success') {
-                setExperiment(data.experiment)
                 setProgress(data.progress)
-                setRating(5)
-                setNotes('')
-                setTrackVisibility(Object.fromEntries(TRACK_CONFIG.map(t => [t.key, true])))
-                setMapFullscreen(false)
-                setRatingPanelOpen(false)
+                const next = queueRef.current.shift()
+                if (next) {
+                    experimentRef.current = next
+                    showExperiment(next)
+                    refillQueue().catch(err => console.warn('Prefetch av experiment misslyckades:', err))
+                } else {
+                    // Bara redan bedömda (betyget är på väg) i leasen – försök igen strax
+                    setExperiment(null)
+                    window.setTimeout(() => loadNextExperiment(), 1500)
+                }
             }
         } catch (err) {
             alert('Fel vid laddning: ' + err.message)
@@ -349,9 +493,18 @@ function ExperimentMode() {
     const saveRating = async () => {
         if (!experiment) return
 
-        setLoading(true)
+        // Nästa experiment visas direkt från kön medan betyget skickas
+        const current = experiment
+        doneIdsRef.current.add(current.id)
+        setProgress(prev => (prev ? {
+            ...prev,
+            rated: prev.rated + 1,
+            current: prev.rated + 2,
+            remaining: Math.max(0, prev.remaining - 1),
+        } : prev))
+        const next = loadNextExperiment()
         try {
-            const res = await fetch(`${API_BASE}/ml/experiments/${experiment.id}/rate`, {
+            const res = await fetch(`${API_BASE}/ml/experiments/${current.id}/rate`, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
@@ -363,15 +516,15 @@ function ExperimentMode() {
 
             if (data.status === 'success') {
                 loadStats()
-                loadNextExperiment()
             } else {
-                alert('Fel vid sparande: ' + data.message)
+                doneIdsRef.current.delete(current.id)
+                alert('Fel vid sparande: ' + (data.message || data.detail))
             }
         } catch (err) {
+            doneIdsRef.current.delete(current.id)
             alert('Fel vid sparande: ' + err.message)
-        } finally {
-            setLoading(false)
         }
+        await next
     }
 
     const disposeMapAndResetForm = () => {
@@ -386,6 +539,8 @@ function ExperimentMode() {
             mapInstanceRef.current = null
         }
         layerRefs.current = {}
+        releaseLeases()
+        experimentRef.current = null
         setExperiment(null)
         setProgress(null)
         setRating(5)
@@ -471,22 +626,25 @@ function ExperimentMode() {
     const skipExperiment = async () => {
         if (!experiment) return
 
-        setLoading(true)
+        const current = experiment
+        doneIdsRef.current.add(current.id)
+        const next = loadNextExperiment()
         try {
-            const res = await fetch(`${API_BASE}/ml/experiments/${experiment.id}/skip`, {
+            const res = await fetch(`${API_BASE}/ml/experiments/${current.id}/skip`, {
                 method: 'POST'
             })
             const data = await res.json()
 
             if (data.status === 'success') {
                 loadStats()
-                loadNextExperiment()
+            } else {
+                doneIdsRef.current.delete(current.id)
             }
         } catch (err) {
+            doneIdsRef.current.delete(current.id)
             alert('Fel vid överhoppning: ' + err.message)
-        } finally {
-            setLoading(false)
         }
+        await next
     }
 
     return (
@@ -1,6 +1,7 @@
 import React, { useState, useEffect, useRef } from 'react'
 import axios from 'axios'
 import L from 'leaflet'
+import { waitForJob, formatJobProgress } from '../jobs'
 
 // Säkerställ att Leaflet använder CDN-ikoner
 delete L.Icon.Default.prototype._getIconUrl
@@ -37,6 +38,7 @@ function mlConnectorColor(meters) {
 
 const MLDashboard = () => {
     const [isAnalyzing, setIsAnalyzing] = useState(false)
+    const [analysisProgress, setAnalysisProgress] = useState(null)
     const [analysisResults, setAnalysisResults] = useState(null)
     const [modelInfo, setModelInfo] = useState(null)
     const [error, setError] = useState(null)
@@ -92,11 +94,10 @@ const MLDashboard = () => {
         setBatchFeedbackLoading(true)
         setError(null)
         try {
-            for (const posId of ids) {
-                await axios.put(`${API_BASE}/ml/predictions/${selectedPrediction}/feedback/${posId}`, {
-                    verified_status: verifiedStatus
-                })
-            }
+            // En förfrågan för alla markerade positioner (bulk-upsert i backend)
+            await axios.post(`${API_BASE}/ml/predictions/${selectedPrediction}/feedback`, {
+                updates: [...ids].map(posId => ({ position_id: posId, verified_status: verifiedStatus }))
+            })
             setSelectedPredictionsForFeedback(new Set())
             // Uppdatera lokal state för alla påverkade positioner
             setPredictionDetails(prev => {
@@ -178,28 +179,21 @@ const MLDashboard = () => {
     const runAnalysis = async () => {
         setIsAnalyzing(true)
         setError(null)
+        setAnalysisProgress('I kö...')
         try {
-            const response = await axios.post(`${API_BASE}/ml/analyze`, null, {
-                timeout: 11 * 60 * 1000, // 11 min – backend har 10 min
+            // Analysen körs som bakgrundsjobb – polla tills den är klar
+            const response = await axios.post(`${API_BASE}/ml/analyze`)
+            const result = await waitForJob(API_BASE, response.data.job_id, {
+                onProgress: (job) => setAnalysisProgress(formatJobProgress(job)),
             })
-            setAnalysisResults(response.data)
+            setAnalysisResults(result)
             await loadModelInfo()
         } catch (err) {
-            const isNetwork = err.code === 'ERR_NETWORK' || (err.message && err.message.includes('Network Error'))
-            const isReset = err.message && /ERR_CONNECTION_RESET|ECONNRESET/i.test(String(err.message))
-            const isTimeout = err.code === 'ECONNABORTED' || (err.message && /timeout|timed out/i.test(String(err.message)))
-            if (isNetwork || isReset || isTimeout) {
-                setError(
-                    'Analysen tog för lång tid och anslutningen avbröts (timeout). ' +
-                    'Kör analysen lokalt istället: i terminalen, cd ml och sedan python analysis.py. ' +
-                    'Modellen sparas i ml/output/ – pusha och redeploya om du vill använda den på Railway.'
-                )
-            } else {
-                setError(err.response?.data?.detail || err.message || 'Fel vid analys')
-            }
+            setError(err.response?.data?.detail || err.message || 'Fel vid analys')
             console.error('Fel vid analys:', err)
         } finally {
             setIsAnalyzing(false)
+            setAnalysisProgress(null)
         }
     }
 
@@ -813,6 +807,9 @@ const MLDashboard = () => {
                         <h3 className="text-xl font-bold text-gray-800 mb-2">{mlBusyLabel}</h3>
                         <p className="text-gray-600 text-sm">
                             {isAnalyzing && 'Tränar modell och genererar visualiseringar. Kan ta flera minuter.'}
+                            {isAnalyzing && analysisProgress && (
+                                <span className="block mt-2 text-xs text-gray-500 break-words">{analysisProgress}</span>
+                            )}
                             {isPredicting && 'Beräknar förutsägelser för valda spår. Det kan ta 10–30 sekunder.'}
                             {isApplyingCorrection && 'Uppdaterar positioner i databasen. Nästan klart.'}
                         </p>
@@ -930,10 +927,10 @@ const MLDashboard = () => {
                 <div className="bg-white rounded-lg shadow-md p-6 mb-6 border-2 border-blue-200">
                     <h3 className="text-xl font-semibold text-gray-800 mb-2">🧪 Testa ML-förutsägelser</h3>
                     <p className="text-gray-600 mb-4 text-sm">
-                        Testa hur modellen skulle korrigera spår <strong>utan att ändra något i databasen</strong>.
+                        Testa hur modellen skulle korrigera spår <strong>utan att ändra grunddata</strong>.
                         Välj 1 eller 2 spår som hör ihop (t.ex. människaspår + hundspår), precis som i TestLab.
                         Fungerar på både redan korrigerade spår (jämför förutsägelse vs faktisk) och nya spår.
-                        Resultaten sparas i <code className="bg-gray-100 px-1 rounded">ml/predictions/</code>.
+                        Resultaten sparas som förutsägelsekörningar i databasen (listas under Sparade förutsägelser).
                     </p>
                     <div className="space-y-3 mb-4">
                         <div>
@@ -1028,7 +1025,7 @@ const MLDashboard = () => {
                                 )}
                             </div>
                             <div className="text-xs text-gray-600 mt-2">
-                                📁 Sparad i: <code className="bg-gray-100 px-1 rounded">{predictionResults.filepath}</code>
+                                📁 Sparad som: <code className="bg-gray-100 px-1 rounded">{predictionResults.filename || predictionResults.filepath}</code>
                             </div>
                             {predictionResults.statistics?.positions_with_actual_corrections > 0 && (
                                 <div className="text-xs text-green-700 mt-2">
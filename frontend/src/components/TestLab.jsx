@@ -1,6 +1,7 @@
 import React, { useEffect, useMemo, useRef, useState } from 'react'
 import L from 'leaflet'
 import axios from 'axios'
+import { waitForJob, formatJobProgress } from '../jobs'
 
 // Säkerställ att Leaflet använder CDN-ikoner (samma som GeofenceEditor)
 delete L.Icon.Default.prototype._getIconUrl
@@ -2083,12 +2084,19 @@ const TestLab = () => {
                                                         params: {
                                                             filename,
                                                             track_ids: trackIds.join(',') // Skicka som komma-separerad sträng
-                                                        }
+                                                        },
+                                                        responseType: 'blob', // Backend strömmar filen direkt
                                                     })
 
                                                     // Ladda ner JSON-filen lokalt
-                                                    const jsonStr = JSON.stringify(response.data.data, null, 2)
-                                                    const blob = new Blob([jsonStr], { type: 'application/json' })
+                                                    const annotationCount = response.headers['x-export-count'] || '?'
+                                                    let exportedTracks = []
+                                                    try {
+                                                        exportedTracks = JSON.parse(decodeURIComponent(response.headers['x-export-tracks'] || '[]'))
+                                                    } catch {
+                                                        exportedTracks = []
+                                                    }
+                                                    const blob = new Blob([response.data], { type: 'application/json' })
                                                     const url = URL.createObjectURL(blob)
                                                     const a = document.createElement('a')
                                                     a.href = url
@@ -2098,14 +2106,23 @@ const TestLab = () => {
                                                     document.body.removeChild(a)
                                                     URL.revokeObjectURL(url)
 
-                                                    setMessage(`✅ ${response.data.annotation_count} positioner exporterade!
+                                                    setMessage(`✅ ${annotationCount} positioner exporterade!
                                                                Filen "${filename}" laddades ner.
                                                                Flytta den till ml/data/ mappen i projektet.
-                                                               Spår: ${response.data.tracks.join(', ')}`)
+                                                               Spår: ${exportedTracks.join(', ')}`)
                                                     setTimeout(() => setMessage(null), 8000)
                                                 } catch (err) {
                                                     console.error('Fel vid ML-export:', err)
-                                                    setError(err.response?.data?.detail || 'Kunde inte exportera data.')
+                                                    // Med responseType 'blob' kommer felsvaret som Blob – läs ut detail
+                                                    let detail = err.response?.data?.detail
+                                                    if (!detail && err.response?.data instanceof Blob) {
+                                                        try {
+                                                            detail = JSON.parse(await err.response.data.text()).detail
+                                                        } catch {
+                                                            detail = null
+                                                        }
+                                                    }
+                                                    setError(detail || 'Kunde inte exportera data.')
                                                     setTimeout(() => setError(null), 3000)
                                                 } finally {
                                                     setLoading(false)
@@ -2277,7 +2294,7 @@ const TestLab = () => {
 
                                         setMessage(`Laddar ner tiles för ${allPositions.length} positioner...`)
 
-                                        const response = await axios.post(`${API_BASE}/tiles/convert`, {
+                                        const queued = await axios.post(`${API_BASE}/tiles/convert`, {
                                             bounds: [
                                                 bounds.south,
                                                 bounds.west,
@@ -2288,6 +2305,11 @@ const TestLab = () => {
                                             server: tileSource,
                                             scale_factor: 4, // Ökad från 2 till 4 för 4x bättre zoom (256x256 → 1024x1024)
                                         })
+                                        // Nedladdningen körs som bakgrundsjobb – polla tills den är klar
+                                        const result = await waitForJob(API_BASE, queued.data.job_id, {
+                                            onProgress: (job) => setMessage(`Laddar ner tiles: ${formatJobProgress(job)}`),
+                                        })
+                                        const response = { data: result }
 
                                         setMessage(`✅ ${response.data.message}. Tiles sparade för hela spårområdet (${allPositions.length} positioner). Växla till "Lokal Högupplösning" i kartväljaren.`)
                                         setLocalTilesAvailable(true)
@@ -2308,7 +2330,7 @@ const TestLab = () => {
 
                                     } catch (err) {
                                         console.error('Fel vid konvertering av tiles:', err)
-                                        setError(err.response?.data?.detail || 'Kunde inte konvertera tiles')
+                                        setError(err.response?.data?.detail || err.message || 'Kunde inte konvertera tiles')
                                     } finally {
                                         setConvertingTiles(false)
                                         setTimeout(() => setMessage(null), 8000)
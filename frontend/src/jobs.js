@@ -0,0 +1,36 @@
+/**
+ * Bakgrundsjobb: långa backend-operationer (ML-analys, tile-konvertering,
+ * experimentgenerering) returnerar { status: 'queued', job_id } direkt.
+ * waitForJob pollar /jobs/{job_id} tills jobbet är klart och returnerar resultatet.
+ */
+
+const FINISHED = ['succeeded', 'failed', 'cancelled']
+
+export async function waitForJob(apiBase, jobId, { onProgress, intervalMs = 2000 } = {}) {
+    for (;;) {
+        const res = await fetch(`${apiBase}/jobs/${jobId}`)
+        if (!res.ok) {
+            throw new Error(`Kunde inte hämta jobbstatus (${res.status})`)
+        }
+        const job = await res.json()
+        if (onProgress) onProgress(job)
+        if (FINISHED.includes(job.status)) {
+            if (job.status === 'succeeded') return job.result || {}
+            if (job.status === 'cancelled') throw new Error('Jobbet avbröts')
+            throw new Error(job.error || 'Jobbet misslyckades')
+        }
+        await new Promise((resolve) => setTimeout(resolve, intervalMs))
+    }
+}
+
+export async function cancelJob(apiBase, jobId) {
+    await fetch(`${apiBase}/jobs/${jobId}/cancel`, { method: 'POST' })
+}
+
+/** Kort progress-text, t.ex. "42 % – 120 av 300 tiles" */
+export function formatJobProgress(job) {
+    if (!job) return ''
+    const pct = job.progress != null ? `${Math.round(job.progress * 100)} %` : ''
+    if (job.status === 'queued') return 'I kö...'
+    return [pct, job.progress_message].filter(Boolean).join(' – ')
+}
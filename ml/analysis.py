@@ -12,92 +12,200 @@ Steg-for-steg:
 5. Visualisera data
 """
 
+import hashlib
 import json
 import math
+import os
+import time
+from bisect import bisect_left
 import numpy as np
-import pandas as pd
-from datetime import datetime
+from datetime import datetime, timezone
 from pathlib import Path
 from typing import List, Dict, Tuple, Optional
 
-# Matplotlib for grafer
-import matplotlib.pyplot as plt
-import seaborn as sns
+# matplotlib/seaborn, scikit-learn och XGBoost importeras där de används, så
+# att import av modulen (backend, update_model.py) och headless-träning inte
+# betalar för grafbibliotek eller modeller som aldrig körs.
+_PYPLOT = None
 
-# Scikit-learn for ML
-from sklearn.model_selection import (
-    train_test_split,
-    cross_val_score,
-    GridSearchCV,
-    RandomizedSearchCV,
-    KFold,
-)
-from sklearn.ensemble import (
-    RandomForestRegressor,
-    GradientBoostingRegressor,
-    ExtraTreesRegressor,
-)
-from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
-from sklearn.preprocessing import StandardScaler, RobustScaler
 
-# XGBoost for advanced ML
-try:
-    import xgboost as xgb
+def _pyplot():
+    """matplotlib.pyplot, importerad och konfigurerad vid första grafen."""
+    global _PYPLOT
+    if _PYPLOT is None:
+        import matplotlib.pyplot as plt
+        import seaborn as sns
 
-    XGBOOST_AVAILABLE = True
-except ImportError:
-    XGBOOST_AVAILABLE = False
-    print("Warning: XGBoost not available. Install with: pip install xgboost")
+        # Konfigurera seaborn for snyggare grafer
+        sns.set_style("whitegrid")
+        plt.rcParams["figure.figsize"] = (12, 8)
+        _PYPLOT = plt
+    return _PYPLOT
 
-# Konfigurera seaborn for snyggare grafer
-sns.set_style("whitegrid")
-plt.rcParams["figure.figsize"] = (12, 8)
 
+def headless_mode() -> bool:
+    """ML_HEADLESS=1: inga grafer, bara träning (t.ex. i Railway-containern)."""
+    return os.environ.get("ML_HEADLESS", "").strip().lower() in ("1", "true", "yes")
 
-def load_annotations(filename: Optional[str] = None) -> List[Dict]:
+
+def _read_annotation_file(path: Path) -> List[Dict]:
+    """Las en exportfil: JSON-array (.json) eller ett objekt per rad (.ndjson)."""
+    with open(path, "r", encoding="utf-8") as f:
+        if path.suffix == ".ndjson":
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def load_annotation_columns(
+    columns: Optional[List[str]] = None, input_spans: Optional[List] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Ladda all träningsdata som kolumner (samma källor och ordning som
+    load_annotations): kolumnära partitioner minnesmappas och JSON-filer som
+    inte är konverterade läses in kolumnvis. Inga rad-dicts byggs.
+
+    Args:
+        columns: Kolumner att ladda (default: de som träningen behöver)
+        input_spans: Om angiven läggs (namn, start, stopp) till per indatakälla
+
+    Returns:
+        Dict kolumnnamn -> numpy-array
+    """
+    from columnar_dataset import (
+        PARTITION_PREFIX,
+        TRAINING_COLUMNS,
+        columns_from_rows,
+        concat_columns,
+        load_partition,
+    )
+
+    columns = list(columns or TRAINING_COLUMNS)
+    parts = []
+    start = 0
+    for name, path in annotation_inputs():
+        if name.startswith(PARTITION_PREFIX):
+            part = load_partition(path, columns)
+        else:
+            part = columns_from_rows(_read_annotation_file(path), columns)
+        stop = start + (len(next(iter(part.values()))) if part else 0)
+        if input_spans is not None:
+            input_spans.append((name, start, stop))
+        parts.append(part)
+        start = stop
+    print(f"Laddade {start} annoterade positioner kolumnvis fran {len(parts)} indatakalla(or)")
+    return concat_columns(parts)
+
+
+def annotation_inputs() -> List[Tuple[str, Path]]:
+    """
+    Indatakallorna for load_annotations() i laddningsordning: alla kolumnara
+    partitioner i ml/data/columnar/ och sedan de JSON-filer i ml/data/ som
+    inte redan finns som partition (sorterade pa namn).
+
+    Returns:
+        Lista med (namn, sokvag); namnet for en partition ar batch=<id>
     """
-    STEG 1: Ladda annoterad data fran JSON-fil(er)
+    from columnar_dataset import covered_source_files, list_partitions
+
+    data_dir = Path(__file__).parent / "data"
+    inputs = [(partition.name, partition) for partition in list_partitions()]
+    covered = covered_source_files()
+    json_files = [
+        f
+        for f in list(data_dir.glob("*.json")) + list(data_dir.glob("*.ndjson"))
+        if f.name not in covered
+    ]
+    inputs.extend((f.name, f) for f in sorted(json_files))
+    return inputs
+
 
-    Om filename anges: Ladda den specifika filen
-    Om filename är None: Ladda ALLA JSON-filer i ml/data/ och kombinera dem
+def load_annotation_input(name: str) -> List[Dict]:
+    """Ladda en enskild indatakalla fran annotation_inputs() (utan utskrifter)."""
+    from columnar_dataset import PARTITION_PREFIX, load_rows
+
+    if name.startswith(PARTITION_PREFIX):
+        return load_rows(batches=[name[len(PARTITION_PREFIX):]])
+    return _read_annotation_file(Path(__file__).parent / "data" / name)
+
+
+def load_annotations(
+    filename: Optional[str] = None, input_spans: Optional[List] = None
+) -> List[Dict]:
+    """
+    STEG 1: Ladda annoterad data fran JSON-fil(er) och kolumnara partitioner
+
+    Om filename anges: Ladda den specifika filen (eller partitionen batch=<id>)
+    Om filename är None: Ladda ALLA kolumnara partitioner i ml/data/columnar/
+    samt de JSON-filer i ml/data/ som inte redan finns som partition
 
     Args:
         filename: Namnet pa JSON-filen i ml/data/ (eller None for alla)
+        input_spans: Om angiven (och filename ar None) laggs (namn, start, stopp)
+            till for varje indatakalla, dvs vilka rader i resultatet den gav
 
     Returns:
         Lista med alla annoterade positioner
     """
+    from columnar_dataset import (
+        DEFAULT_ROOT,
+        PARTITION_PREFIX,
+        load_rows,
+        read_schema,
+    )
+
     data_dir = Path(__file__).parent / "data"
 
     if filename:
+        if filename.startswith(PARTITION_PREFIX):
+            data = load_rows(batches=[filename[len(PARTITION_PREFIX):]])
+            print(f"Laddade {len(data)} annoterade positioner fran {DEFAULT_ROOT / filename}")
+            return data
+
         # Ladda specifik fil
         data_path = data_dir / filename
         print(f"Laddar data fran: {data_path}")
 
-        with open(data_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = _read_annotation_file(data_path)
 
         print(f"Laddade {len(data)} annoterade positioner")
         return data
     else:
-        # Ladda ALLA JSON-filer
-        json_files = list(data_dir.glob("*.json"))
-
-        if not json_files:
+        all_data = []
+        inputs = annotation_inputs()
+        partitions = [path for name, path in inputs if name.startswith(PARTITION_PREFIX)]
+        json_files = [path for name, path in inputs if not name.startswith(PARTITION_PREFIX)]
+        if partitions:
+            print(f"Hittade {len(partitions)} kolumnar(a) partition(er) i ml/data/columnar/:")
+            for partition in partitions:
+                print(f"  - {partition.name}")
+            all_data.extend(load_rows())
+            print(f"    Laddade {len(all_data)} positioner")
+            if input_spans is not None:
+                start = 0
+                for partition in partitions:
+                    stop = start + int(read_schema(partition)["rows"])
+                    input_spans.append((partition.name, start, stop))
+                    start = stop
+
+        if not json_files and not partitions:
             raise FileNotFoundError(f"Inga JSON-filer hittades i {data_dir}")
 
+        # JSON-filer som inte redan finns kolumnart
         print(f"Hittade {len(json_files)} JSON-fil(er) i ml/data/:")
-        all_data = []
 
-        for json_file in sorted(json_files):
+        for json_file in json_files:
             print(f"  - {json_file.name}")
-            with open(json_file, "r", encoding="utf-8") as f:
-                file_data = json.load(f)
+            file_data = _read_annotation_file(json_file)
             print(f"    Laddade {len(file_data)} positioner")
+            if input_spans is not None:
+                input_spans.append(
+                    (json_file.name, len(all_data), len(all_data) + len(file_data))
+                )
             all_data.extend(file_data)
 
         print(
-            f"\nTOTALT: {len(all_data)} annoterade positioner fran {len(json_files)} fil(er)"
+            f"\nTOTALT: {len(all_data)} annoterade positioner fran "
+            f"{len(json_files)} fil(er) och {len(partitions)} partition(er)"
         )
         return all_data
 
@@ -376,6 +484,7 @@ def visualize_data(data: List[Dict], track_stats: Dict):
             corrections_with_acc.append(correction)
 
     # Skapa figuren med subplots
+    plt = _pyplot()
     fig, axes = plt.subplots(2, 2, figsize=(16, 12))
     fig.suptitle("GPS-korrigering: Dataanalys", fontsize=16, fontweight="bold")
 
@@ -671,15 +780,15 @@ def calculate_position_jump(curr_pos: Dict, prev_pos: Dict, speed: float, time_d
         return 0.0
 
 
-def find_nearest_human_position(
+def _find_nearest_human_position_scan(
     dog_pos: Dict,
     dog_timestamp: str,
     human_track_data: List[Dict]
 ) -> tuple:
     """
-    Hitta närmaste människaspår-position baserat på timestamp och avstånd.
-    
-    Returns: (nearest_position_dict, distance_meters, speed_ms) eller (None, 999.0, 0.0)
+    Ursprunglig linjär sökning (O(m) per anrop plus list.index). Används som
+    fallback när HumanTrackIndex inte kan garantera samma resultat, t.ex. om
+    spåret har blandade tidszoner, osorterade eller ogiltiga tidsstämplar.
     """
     if not human_track_data:
         return (None, 999.0, 0.0)
@@ -753,6 +862,227 @@ def find_nearest_human_position(
         return (None, 999.0, 0.0)
 
 
+_US_PER_S = 10**6
+_EPOCH_NAIVE = datetime(1970, 1, 1)
+_EPOCH_AWARE = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_EARTH_RADIUS_M = 6371000
+# Kandidater längre bort i tid än så här ger combined_score >= 999 (startvärdet)
+_HUMAN_WINDOW_US = 9991 * _US_PER_S
+# Marginal för undre avståndsgränsen R*|dlat| mot avrundning i haversine
+_LOWER_BOUND_SAFETY = 1.0 - 1e-9
+
+
+def _parse_epoch_us(timestamp: str) -> Tuple[int, bool]:
+    """
+    Tidsstämpel -> (mikrosekunder sedan epoch som heltal, tidszonsmedveten).
+    Heltal gör att abs(a - b) / 1e6 blir exakt samma flyttal som
+    timedelta.total_seconds() i den ursprungliga sökningen.
+    """
+    dt = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    aware = dt.utcoffset() is not None
+    return _epoch_us(dt, aware), aware
+
+
+def _epoch_us(dt: datetime, aware: bool) -> int:
+    delta = dt - (_EPOCH_AWARE if aware else _EPOCH_NAIVE)
+    return (delta.days * 86400 + delta.seconds) * _US_PER_S + delta.microseconds
+
+
+def _is_finite_number(value) -> bool:
+    return isinstance(value, (int, float)) and math.isfinite(value)
+
+
+class HumanTrackIndex:
+    """
+    Förberäknat index över ett människaspår för find_nearest_human_position.
+
+    Byggs en gång per spår: sorterade tider (heltal mikrosekunder), koordinater,
+    och hastighet per segment. En fråga bisectar fram till tidsfönstret där
+    combined_score (avstånd + 0.1 m/s * tidsdiff) kan slå nuvarande bästa och
+    hoppar över kandidater vars undre avståndsgräns (R * |dlat|) redan är för
+    stor. Kandidaterna prövas i samma ordning och med samma jämförelse som den
+    linjära sökningen, så resultatet är identiskt.
+
+    Om spåret inte uppfyller villkoren (sorterade, parsbara tider med samma
+    tidszonstyp, numeriska koordinater) är fast=False och sökningen faller
+    tillbaka på den linjära varianten.
+    """
+
+    def __init__(self, human_track_data: List[Dict]):
+        self.data = human_track_data
+        self.fast = True
+        self.aware: Optional[bool] = None
+        self.list_idx: List[int] = []
+        self.pos: List[Dict] = []
+        self.lat: List[float] = []
+        self.lng: List[float] = []
+        self.us: List[int] = []
+        # (timestamp, lat, lng) -> listindex i ordning; för list.index-semantiken
+        self._groups: Dict[tuple, List[int]] = {}
+        self._times: Dict[int, int] = {}
+        self._speed_cache: Dict[int, Optional[float]] = {}
+        try:
+            self._build()
+        except Exception:
+            self.fast = False
+
+    def _build(self):
+        for li, human_pos in enumerate(self.data):
+            pos = human_pos.get("original_position") or human_pos.get("position", {})
+            if not pos:
+                continue
+            lat = pos.get("lat")
+            lng = pos.get("lng")
+            if not lat or not lng:
+                continue
+            if not (_is_finite_number(lat) and _is_finite_number(lng)):
+                self.fast = False
+                return
+            ts = human_pos.get("timestamp", "")
+            if not ts:
+                # Utan tidsstämpel påverkar positionen aldrig resultatet
+                continue
+            if not isinstance(ts, str):
+                self.fast = False
+                return
+            us, aware = _parse_epoch_us(ts)
+            if self.aware is None:
+                self.aware = aware
+            elif aware != self.aware or us < self.us[-1]:
+                self.fast = False
+                return
+            self.list_idx.append(li)
+            self.pos.append(pos)
+            self.lat.append(lat)
+            self.lng.append(lng)
+            self.us.append(us)
+            self._times[li] = us
+            self._groups.setdefault((ts, lat, lng), []).append(li)
+
+    def _first_equal_index(self, i: int) -> int:
+        """Samma index som human_track_data.index(human_pos) i den linjära sökningen."""
+        li = self.list_idx[i]
+        human_pos = self.data[li]
+        pos = self.pos[i]
+        for g in self._groups[(human_pos.get("timestamp"), pos.get("lat"), pos.get("lng"))]:
+            if g == li or self.data[g] == human_pos:
+                return g
+        return li
+
+    def _segment_speed(self, i: int) -> Optional[float]:
+        """
+        Hastighet (m/s) från föregående listposition till kandidat i, eller None
+        om den linjära sökningen inte skulle uppdatera hastigheten.
+        """
+        human_idx = self._first_equal_index(i)
+        if human_idx in self._speed_cache:
+            return self._speed_cache[human_idx]
+        speed = None
+        if human_idx > 0:
+            try:
+                prev_human = self.data[human_idx - 1]
+                prev_human_pos = prev_human.get("original_position") or prev_human.get("position", {})
+                if prev_human_pos:
+                    prev_human_lat = prev_human_pos.get("lat")
+                    prev_human_lng = prev_human_pos.get("lng")
+                    prev_human_time_str = prev_human.get("timestamp", "")
+                    if prev_human_lat and prev_human_lng and prev_human_time_str:
+                        prev_us, prev_aware = _parse_epoch_us(prev_human_time_str)
+                        if prev_aware == self.aware:
+                            human_dist = haversine_distance(
+                                prev_human_lat, prev_human_lng, self.lat[i], self.lng[i]
+                            )
+                            human_time_diff = (self._times[human_idx] - prev_us) / _US_PER_S
+                            if human_time_diff > 0:
+                                speed = human_dist / human_time_diff
+            except Exception:
+                speed = None
+        self._speed_cache[human_idx] = speed
+        return speed
+
+    def nearest(self, dog_lat: float, dog_lng: float, dog_us: int) -> tuple:
+        us = self.us
+        n = len(us)
+        nearest_pos = None
+        nearest_distance = 999.0
+        nearest_speed = 0.0
+
+        i = bisect_left(us, dog_us - _HUMAN_WINDOW_US)
+        while i < n:
+            delta_us = us[i] - dog_us
+            time_term = (abs(delta_us) / _US_PER_S) * 0.1
+            if time_term >= nearest_distance:
+                if delta_us >= 0:
+                    # Senare kandidater har ännu större tidsdiff
+                    break
+                # Hoppa till första tiden som kan ge combined_score < nearest_distance
+                i = bisect_left(
+                    us, dog_us - int(nearest_distance * 10 * _US_PER_S) - _US_PER_S, i + 1
+                )
+                continue
+
+            lat = self.lat[i]
+            lower_bound = (
+                _EARTH_RADIUS_M * abs(math.radians(lat - dog_lat)) * _LOWER_BOUND_SAFETY
+            )
+            if lower_bound + time_term < nearest_distance:
+                distance = haversine_distance(dog_lat, dog_lng, lat, self.lng[i])
+                combined_score = distance + time_term
+                # Samma jämförelse som tidigare: score mot lagrat avstånd
+                if combined_score < nearest_distance:
+                    nearest_distance = distance
+                    nearest_pos = self.pos[i]
+                    speed = self._segment_speed(i)
+                    if speed is not None:
+                        nearest_speed = speed
+            i += 1
+
+        return (nearest_pos, nearest_distance, nearest_speed)
+
+
+def find_nearest_human_position(
+    dog_pos: Dict,
+    dog_timestamp: str,
+    human_track_data: List[Dict],
+    index: Optional[HumanTrackIndex] = None,
+) -> tuple:
+    """
+    Hitta närmaste människaspår-position baserat på timestamp och avstånd.
+
+    index: förbyggt HumanTrackIndex för human_track_data (återanvänd det när
+    samma spår frågas för många hundpositioner).
+
+    Returns: (nearest_position_dict, distance_meters, speed_ms) eller (None, 999.0, 0.0)
+    """
+    if not human_track_data:
+        return (None, 999.0, 0.0)
+
+    try:
+        if isinstance(dog_pos, dict) and "lat" in dog_pos:
+            dog_lat, dog_lng = dog_pos["lat"], dog_pos["lng"]
+        else:
+            dog_pos_dict = dog_pos.get("original_position") or dog_pos.get("position", {})
+            dog_lat = dog_pos_dict.get("lat")
+            dog_lng = dog_pos_dict.get("lng")
+
+        if not dog_lat or not dog_lng:
+            return (None, 999.0, 0.0)
+
+        dog_us, dog_aware = _parse_epoch_us(dog_timestamp)
+    except Exception:
+        return (None, 999.0, 0.0)
+
+    if index is None:
+        index = HumanTrackIndex(human_track_data)
+    if (
+        not index.fast
+        or (index.aware is not None and index.aware != dog_aware)
+        or not (_is_finite_number(dog_lat) and _is_finite_number(dog_lng))
+    ):
+        return _find_nearest_human_position_scan(dog_pos, dog_timestamp, human_track_data)
+    return index.nearest(dog_lat, dog_lng, dog_us)
+
+
 def training_source_norm_from_row(d: Dict) -> float:
     """Diskret källa kodad 0–1 för trädbaserade modeller."""
     s = (d.get("source") or "").lower()
@@ -781,27 +1111,66 @@ def is_ml_feedback_training_row(d: Dict) -> float:
     return 0.0
 
 
-def prepare_features_advanced(
+# Höj när features ändras (namn, ordning eller beräkning) så att feature-cachen
+# i ml/output/feature_cache/ inte återanvänder matriser från den gamla koden
+# (2: radnycklar sparas i cachen)
+FEATURE_SCHEMA_VERSION = 2
+
+ENVIRONMENT_CATEGORIES = ["urban", "suburban", "forest", "open", "park", "water", "mountain", "mixed"]
+
+FEATURE_NAMES = [
+    "gps_accuracy",
+    "gps_accuracy_squared",
+    "latitude",
+    "longitude",
+    "lat_normalized",
+    "lng_normalized",
+    "track_type_human",
+    "hour_sin",
+    "hour_cos",
+    "weekday_sin",
+    "weekday_cos",
+    "speed_ms",
+    "acceleration_ms2",
+    "distance_prev_1",
+    "distance_prev_2",
+    "distance_prev_3",
+    "bearing_degrees",
+    "rolling_mean_correction",
+    "rolling_std_correction",
+    "accuracy_x_speed",
+    "accuracy_x_distance",
+    "speed_x_distance",
+    *[f"env_{cat}" for cat in ENVIRONMENT_CATEGORIES],
+    "track_curvature",
+    "speed_consistency",
+    "position_jump",
+    "distance_to_human_track",
+    "direction_to_human",
+    "human_track_speed",
+    "human_track_exists",
+    "training_source_norm",
+    "is_ml_feedback_row",
+]
+
+# Sin/cos per timme och veckodag (samma uttryck som radvis, math istället för numpy)
+_HOUR_SIN = [math.sin(2 * math.pi * hour / 24) for hour in range(24)]
+_HOUR_COS = [math.cos(2 * math.pi * hour / 24) for hour in range(24)]
+_WEEKDAY_SIN = [math.sin(2 * math.pi * weekday / 7) for weekday in range(7)]
+_WEEKDAY_COS = [math.cos(2 * math.pi * weekday / 7) for weekday in range(7)]
+
+# Under så här många rader körs feature-beräkningen i en process
+_PARALLEL_MIN_ROWS = 200000
+
+
+def _prepare_features_rowwise(
     data: List[Dict],
 ) -> Tuple[np.ndarray, np.ndarray, List[str]]:
     """
-    Förbättrad feature engineering för kommersiell ML-modell
+    Radvis referensimplementation av prepare_features_advanced. Används som
+    fallback för data som den kolumnära varianten inte hanterar (ogiltiga
+    eller blandade tidszoner i tidsstämplar, icke-numeriska koordinater).
 
-    Features:
-    - GPS accuracy (rapporterad) + accuracy^2 (non-linear)
-    - Original position (lat, lng) + normaliserad position
-    - Track type (human/dog)
-    - Timestamp features (hour, day_of_week, sin/cos encoding)
-    - Hastighet (m/s) baserat på tidigare positioner
-    - Acceleration (m/s²)
-    - Avstånd till tidigare positioner (1, 2, 3 steg bakåt)
-    - Riktning (bearing) i grader
-    - Rolling statistics (medelvärde och std dev för senaste 3 positioner)
-    - Interaktioner: accuracy * speed, accuracy * distance
-    - training_source_norm, is_ml_feedback_row (data_lineage/source från export)
-
-    Target:
-    - Korrigeringsavstånd (correction_distance_meters)
     """
     # Sortera data per spår och timestamp för att kunna beräkna hastighet
     tracks = {}
@@ -815,6 +1184,15 @@ def prepare_features_advanced(
     for track_id in tracks:
         tracks[track_id].sort(key=lambda x: x.get("timestamp", ""), reverse=False)
 
+    # Tidsindex per människaspår, byggs första gången spåret används för matchning
+    human_indexes: Dict = {}
+
+    def _human_index(human_track_id) -> HumanTrackIndex:
+        index = human_indexes.get(human_track_id)
+        if index is None:
+            index = human_indexes[human_track_id] = HumanTrackIndex(tracks[human_track_id])
+        return index
+
     features = []
     targets = []
     sample_weights = []
@@ -1070,7 +1448,7 @@ def prepare_features_advanced(
             # Environment features (one-hot encoding om environment finns)
             # Miljö-kategorier: urban, suburban, forest, open, park, water, mountain, mixed
             environment = d.get("environment")
-            environment_categories = ["urban", "suburban", "forest", "open", "park", "water", "mountain", "mixed"]
+            environment_categories = ENVIRONMENT_CATEGORIES
             
             # One-hot encoding för environment (alla 0 om environment är None eller okänd)
             for env_cat in environment_categories:
@@ -1144,7 +1522,8 @@ def prepare_features_advanced(
                                 nearest_human, dist, human_speed = find_nearest_human_position(
                                     d,
                                     d.get("timestamp", ""),
-                                    other_track_data
+                                    other_track_data,
+                                    index=_human_index(other_track_id),
                                 )
                                 if nearest_human and dist < distance_to_human:
                                     distance_to_human = dist
@@ -1174,7 +1553,8 @@ def prepare_features_advanced(
                         nearest_human, dist, human_speed = find_nearest_human_position(
                             d,
                             d.get("timestamp", ""),
-                            human_track_data
+                            human_track_data,
+                            index=_human_index(human_track_id),
                         )
                         if nearest_human:
                             distance_to_human = dist
@@ -1237,277 +1617,1608 @@ def prepare_features_advanced(
     )
 
 
-def train_ml_model(data: List[Dict]):
+def _bearing_radians(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Riktning från punkt 1 till punkt 2 i radianer (samma formel som i features)."""
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    delta_lng = math.radians(lng2 - lng1)
+    y = math.sin(delta_lng) * math.cos(lat2_rad)
+    x = math.cos(lat1_rad) * math.sin(lat2_rad) - math.sin(lat1_rad) * math.cos(
+        lat2_rad
+    ) * math.cos(delta_lng)
+    return math.atan2(y, x)
+
+
+def _bearing_degrees(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    bearing = math.degrees(_bearing_radians(lat1, lng1, lat2, lng2))
+    if bearing < 0:
+        bearing += 360
+    return bearing
+
+
+def _pairwise(func, lat1, lng1, lat2, lng2) -> np.ndarray:
     """
-    Träna och optimera flera ML-modeller för kommersiell GPS-korrigering
+    func(lat1[k], lng1[k], lat2[k], lng2[k]) för alla k. Trigonometrin körs med
+    math per element: numpy:s sin/atan2 kan skilja sig i sista biten och X ska
+    vara identisk med den radvisa beräkningen.
+    """
+    return np.fromiter(
+        (
+            func(a, b, c, d)
+            for a, b, c, d in zip(lat1.tolist(), lng1.tolist(), lat2.tolist(), lng2.tolist())
+        ),
+        dtype=np.float64,
+        count=len(lat1),
+    )
 
-    Steg:
-    1. Förbättrad feature engineering (22 features)
-    2. Träna flera modeller (Random Forest, Gradient Boosting, Extra Trees, XGBoost)
-    3. Hyperparameter tuning med RandomizedSearchCV
-    4. Cross-validation för robust utvärdering
-    5. Välj bästa modellen baserat på test performance
+
+def _track_key(d: Dict):
+    """Nyckeln som rader grupperas per spår på vid feature-beräkningen."""
+    return d.get("track_id") or d.get("track_name", "unknown")
+
+
+def _row_key(d: Dict) -> int:
     """
-    print("\nForbereder avancerade features...")
-    X, y, feature_names, sw = prepare_features_advanced(data)
+    64-bitars innehållsnyckel för en träningsrad: identitet (id, spår, tid) och
+    facit. En rad vars korrigering eller status ändrats får en ny nyckel, så
+    nycklarna visar vilka rader en modell redan tränats på (se update_model.py).
+    """
+    orig = d.get("original_position") or {}
+    corr = d.get("corrected_position") or d.get("predicted_corrected_position") or {}
+    return _row_key_values(
+        d.get("id"),
+        d.get("track_id"),
+        d.get("track_name"),
+        d.get("timestamp"),
+        d.get("verified_status"),
+        orig.get("lat"),
+        orig.get("lng"),
+        corr.get("lat"),
+        corr.get("lng"),
+        d.get("correction_distance_meters"),
+        d.get("training_weight_suggested"),
+    )
 
-    if len(X) == 0:
-        print("  Ingen data att trana pa!")
-        return
 
-    print(f"  {len(X)} positioner med {len(feature_names)} features")
-    print(
-        f"  Sample weights: min={sw.min():.3f}, max={sw.max():.3f}, medel={sw.mean():.3f} "
-        "(1.0 om training_weight_suggested saknas)"
+def _row_key_values(
+    row_id, track_id, track_name, timestamp, verified_status,
+    original_lat, original_lng, target_lat, target_lng,
+    correction_distance, training_weight,
+) -> int:
+    """
+    Hashen bakom _row_key, för fält som redan plockats ut (den kolumnära
+    vägen anropar den direkt). Värdena ska ha samma Python-typer som i
+    raderna – repr skiljer 3 från 3.0.
+    """
+    payload = repr((
+        row_id,
+        track_id,
+        track_name,
+        timestamp,
+        verified_status,
+        original_lat,
+        original_lng,
+        target_lat,
+        target_lng,
+        correction_distance,
+        training_weight,
+    ))
+    return int.from_bytes(hashlib.blake2b(payload.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _feature_row_plan(tracks: Dict) -> Dict:
+    """
+    Bestäm vilka rader som blir träningsrader (samma regler och ordning som
+    radvis) och fyll i correction_distance_meters där den saknas. Mutationen
+    görs här, i huvudprocessen, precis som den radvisa loopen gör.
+    """
+    plan = {}
+    for track_id, track_data in tracks.items():
+        kept = []
+        for i, d in enumerate(track_data):
+            verified_status = d.get("verified_status", "pending")
+            corrected_pos = d.get("corrected_position")
+            if corrected_pos is None:
+                if verified_status == "correct" and d.get("predicted_corrected_position"):
+                    corrected_pos = d.get("predicted_corrected_position")
+                else:
+                    continue
+            if d.get("correction_distance_meters") is None:
+                orig_pos = d.get("original_position")
+                if orig_pos and corrected_pos:
+                    d["correction_distance_meters"] = haversine_distance(
+                        orig_pos["lat"], orig_pos["lng"],
+                        corrected_pos["lat"], corrected_pos["lng"]
+                    )
+                else:
+                    continue
+            if not d.get("original_position"):
+                continue
+            kept.append(i)
+        plan[track_id] = kept
+    return plan
+
+
+# Människaspår för matchning i den process som beräknar features
+_feature_human_tracks: Dict = {}
+_feature_human_indexes: Dict = {}
+
+
+def _init_feature_worker(human_tracks: Dict):
+    global _feature_human_tracks, _feature_human_indexes
+    _feature_human_tracks = human_tracks
+    _feature_human_indexes = {}
+
+
+def _feature_human_index(track_id) -> HumanTrackIndex:
+    index = _feature_human_indexes.get(track_id)
+    if index is None:
+        index = _feature_human_indexes[track_id] = HumanTrackIndex(
+            _feature_human_tracks[track_id]
+        )
+    return index
+
+
+def _human_match_features(
+    track_type, human_track_id, timestamp, orig_lat: float, orig_lng: float, fallback_human_id
+) -> tuple:
+    """
+    (distance_to_human, direction_to_human, human_track_speed, human_track_exists)
+    för en rad med track_type, human_track_id, timestamp och originalposition.
+    """
+    distance_to_human = 999.0
+    direction_to_human = 0.0
+    human_track_speed = 0.0
+    human_track_exists = 0.0
+    if track_type != "dog":
+        return distance_to_human, direction_to_human, human_track_speed, human_track_exists
+
+    if not human_track_id:
+        # Första spåret (i spårordning) vars första position är ett människaspår
+        if fallback_human_id is None:
+            return distance_to_human, direction_to_human, human_track_speed, human_track_exists
+        match_id = fallback_human_id
+    elif human_track_id in _feature_human_tracks:
+        match_id = human_track_id
+    else:
+        return distance_to_human, direction_to_human, human_track_speed, human_track_exists
+
+    nearest_human, dist, human_speed = find_nearest_human_position(
+        {"lat": orig_lat, "lng": orig_lng},
+        timestamp,
+        _feature_human_tracks[match_id],
+        index=_feature_human_index(match_id),
     )
-    print(
-        f"  Features: {', '.join(feature_names[:5])}... (+ {len(feature_names) - 5} fler)"
+    accept = (nearest_human and dist < distance_to_human) if not human_track_id else nearest_human
+    if accept:
+        distance_to_human = dist
+        human_track_speed = human_speed
+        human_track_exists = 1.0
+        try:
+            human_lat = nearest_human.get("lat")
+            human_lng = nearest_human.get("lng")
+            if human_lat and human_lng:
+                direction_to_human = _bearing_degrees(orig_lat, orig_lng, human_lat, human_lng)
+        except Exception:
+            pass
+    return distance_to_human, direction_to_human, human_track_speed, human_track_exists
+
+
+def _parse_track_times(timestamps) -> Optional[tuple]:
+    """
+    (mikrosekunder, timme, veckodag) per rad, eller None om någon tidsstämpel
+    saknas, inte går att tolka eller om spåret blandar tidszonstyper.
+    """
+    n = len(timestamps)
+    us = np.empty(n, dtype=np.int64)
+    hours = np.empty(n, dtype=np.intp)
+    weekdays = np.empty(n, dtype=np.intp)
+    aware = None
+    for i, ts in enumerate(timestamps):
+        if not ts or not isinstance(ts, str):
+            return None
+        try:
+            dt = datetime.fromisoformat(ts.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        dt_aware = dt.utcoffset() is not None
+        if aware is None:
+            aware = dt_aware
+        elif dt_aware != aware:
+            return None
+        us[i] = _epoch_us(dt, dt_aware)
+        hours[i] = dt.hour
+        weekdays[i] = dt.weekday()
+    return us, hours, weekdays
+
+
+def _track_feature_block(task: tuple) -> Optional[np.ndarray]:
+    """
+    Alla feature-rader för ett spår, beräknade kolumnvis.
+
+    task = (track_data sorterad på timestamp, index för träningsraderna,
+    fallback-människaspår). Värden i index i beror på grannar i-3..i+5 i hela
+    spåret (även rader som inte blir träningsrader), därför beräknas
+    kolumnerna för hela spåret och träningsraderna väljs ut sist.
+
+    Returnerar None om spåret inte uppfyller förutsättningarna för den
+    kolumnära varianten (se _prepare_features_rowwise).
+    """
+    track_data, kept, fallback_human_id = task
+    n = len(track_data)
+    if not kept:
+        return np.zeros((0, len(FEATURE_NAMES)))
+
+    times = _parse_track_times([d.get("timestamp", "") for d in track_data])
+    if times is None:
+        return None
+
+    # --- Koordinater (original_position) ---
+    lat_list = []
+    lng_list = []
+    for d in track_data:
+        pos = d.get("original_position")
+        if not pos:
+            if n > 1:
+                return None
+            lat_list.append(0.0)
+            lng_list.append(0.0)
+            continue
+        lat, lng = pos.get("lat"), pos.get("lng")
+        if not (_is_finite_number(lat) and _is_finite_number(lng)):
+            return None
+        lat_list.append(lat)
+        lng_list.append(lng)
+    lat = np.array(lat_list, dtype=np.float64)
+    lng = np.array(lng_list, dtype=np.float64)
+
+    kept_rows = [track_data[i] for i in kept]
+    accuracy_list = [d.get("accuracy", 0.0) or 0.0 for d in kept_rows]
+    if not all(_is_finite_number(a) for a in accuracy_list):
+        return None
+    corrections = np.array(
+        [
+            np.nan if d.get("correction_distance_meters") is None
+            else float(d.get("correction_distance_meters"))
+            for d in track_data
+        ]
+    )
+    human = [
+        _human_match_features(
+            d.get("track_type"), d.get("human_track_id"), d.get("timestamp", ""),
+            lat[i], lng[i], fallback_human_id,
+        )
+        for i, d in zip(kept, kept_rows)
+    ]
+    return _feature_block(
+        *times,
+        lat,
+        lng,
+        kept,
+        accuracy_list,
+        corrections,
+        [d.get("track_type") for d in kept_rows],
+        [d.get("environment") for d in kept_rows],
+        human,
+        [training_source_norm_from_row(d) for d in kept_rows],
+        [is_ml_feedback_training_row(d) for d in kept_rows],
     )
 
-    # Ta bort outliers (positioner med extremt stora korrigeringar)
-    # Behöll 99% av datan (ta bort top 1% outliers)
-    outlier_threshold = np.percentile(y, 99)
-    mask = y <= outlier_threshold
-    X = X[mask]
-    y = y[mask]
-    sw = sw[mask]
-    print(
-        f"  Efter outlier removal: {len(X)} positioner (removed {np.sum(~mask)} outliers)"
+
+def _feature_block(
+    us: np.ndarray,
+    hours: np.ndarray,
+    weekdays: np.ndarray,
+    lat: np.ndarray,
+    lng: np.ndarray,
+    kept,
+    accuracy_list: List[float],
+    corrections: np.ndarray,
+    track_types,
+    environments,
+    human,
+    source_norm,
+    is_feedback,
+) -> np.ndarray:
+    """
+    Feature-raderna för ett spår ur kolumner (gemensam för rad- och
+    kolumnindata). Tider, lat/lng och corrections (NaN = saknas) gäller hela
+    spåret i tidsordning; övriga argument bara träningsraderna (kept).
+    """
+    n = len(us)
+    nonzero = (lat != 0) & (lng != 0)
+    k = np.asarray(kept, dtype=np.intp)
+    accuracy = np.array(accuracy_list, dtype=np.float64)
+    accuracy_sq = np.array([a**2 for a in accuracy_list], dtype=np.float64)
+
+    # --- Grannar bakåt: avstånd, tid, hastighet, acceleration, riktning ---
+    # back_dist[i] = haversine(i -> i-1), fwd_dist[i] = haversine(i-1 -> i)
+    back_dist = np.zeros(n)
+    fwd_dist = np.zeros(n)
+    bearing_rad = np.zeros(n)
+    time_diff = np.zeros(n)
+    if n > 1:
+        back_dist[1:] = _pairwise(haversine_distance, lat[1:], lng[1:], lat[:-1], lng[:-1])
+        fwd_dist[1:] = _pairwise(haversine_distance, lat[:-1], lng[:-1], lat[1:], lng[1:])
+        bearing_rad[1:] = _pairwise(_bearing_radians, lat[:-1], lng[:-1], lat[1:], lng[1:])
+        time_diff[1:] = np.diff(us) / _US_PER_S
+
+    positive_dt = time_diff > 0
+    speed = np.zeros(n)
+    np.divide(back_dist, time_diff, out=speed, where=positive_dt)
+
+    acceleration = np.zeros(n)
+    if n > 2:
+        ok = positive_dt[2:] & positive_dt[1:-1]
+        np.divide(speed[2:] - speed[1:-1], time_diff[2:], out=acceleration[2:], where=ok)
+
+    distance_prev_2 = np.zeros(n)
+    distance_prev_2[2:] = back_dist[1:-1]
+    distance_prev_3 = np.zeros(n)
+    distance_prev_3[3:] = back_dist[1:-2]
+
+    bearing = np.zeros(n)
+    if n > 1:
+        degrees = np.array([math.degrees(b) for b in bearing_rad[1:].tolist()])
+        bearing[1:] = np.where(degrees < 0, degrees + 360, degrees)
+
+    # --- Rolling mean/std av correction_distance för de två föregående raderna ---
+    rolling_mean = np.zeros(n)
+    rolling_std = np.zeros(n)
+    if n > 2:
+        a = corrections[:-2]
+        b = corrections[1:-1]
+        has_a = ~np.isnan(a)
+        has_b = ~np.isnan(b)
+        both = has_a & has_b
+        # Samma operationer som np.mean/np.std på en lista med två värden
+        mean_ab = (a + b) / 2
+        std_ab = np.sqrt(((a - mean_ab) * (a - mean_ab) + (b - mean_ab) * (b - mean_ab)) / 2)
+        rolling_mean[2:] = np.where(both, mean_ab, np.where(has_a, a, np.where(has_b, b, 0.0)))
+        rolling_std[2:] = np.where(both, std_ab, 0.0)
+
+    # --- Kurvatur: riktningsskillnad mellan segment (i-1 -> i) och (i -> i+1) ---
+    curvature = np.zeros(n)
+    if n > 2:
+        valid = nonzero[:-2] & nonzero[1:-1] & nonzero[2:]
+        diff = np.abs(bearing_rad[1:-1] - bearing_rad[2:])
+        diff = np.where(diff > math.pi, 2 * math.pi - diff, diff)
+        curvature[1:-1] = np.where(valid, diff, 0.0)
+
+    # --- Hastighetsvariation: std av segmenthastigheter i fönster ±5 ---
+    speed_consistency = np.zeros(n)
+    if n > 1:
+        seg_valid = nonzero[:-1] & nonzero[1:] & positive_dt[1:]
+        seg_speed = np.zeros(n - 1)
+        np.divide(fwd_dist[1:], time_diff[1:], out=seg_speed, where=seg_valid)
+        # Giltiga segment i fönstret [start, end) för varje rad; rader med lika
+        # många giltiga segment räknas i samma 2D-anrop till np.std
+        window = 5
+        starts = np.maximum(0, np.arange(n) - window)
+        ends = np.minimum(n, np.arange(n) + window + 1) - 1  # exklusivt segmentindex
+        valid_idx = np.nonzero(seg_valid)[0]
+        lo = np.searchsorted(valid_idx, starts)
+        counts = np.searchsorted(valid_idx, ends) - lo
+        for count in np.unique(counts[counts >= 2]):
+            rows = np.nonzero(counts == count)[0]
+            windows = seg_speed[valid_idx[lo[rows][:, None] + np.arange(count)]]
+            speed_consistency[rows] = np.std(windows, axis=1)
+
+    # --- Position-jump: |faktiskt - förväntat| avstånd från föregående punkt ---
+    position_jump = np.zeros(n)
+    if n > 1:
+        jump_ok = (speed[1:] > 0) & nonzero[1:] & nonzero[:-1]
+        expected = speed[1:] * time_diff[1:]
+        position_jump[1:] = np.where(jump_ok, np.abs(fwd_dist[1:] - expected), 0.0)
+
+    # --- Normaliserad position ---
+    if n > 1:
+        mean_lat = np.mean(lat)
+        mean_lng = np.mean(lng)
+        lat_norm = lat[k] - mean_lat
+        lng_norm = lng[k] - mean_lng
+    else:
+        lat_norm = np.zeros(len(k))
+        lng_norm = np.zeros(len(k))
+
+    hour_k = hours[k]
+    weekday_k = weekdays[k]
+    env_index = {cat: j for j, cat in enumerate(ENVIRONMENT_CATEGORIES)}
+    environment = np.zeros((len(k), len(ENVIRONMENT_CATEGORIES)))
+    for row, env in enumerate(environments):
+        j = env_index.get(env) if isinstance(env, str) else None
+        if j is not None:
+            environment[row, j] = 1.0
+
+    human = np.asarray(human, dtype=np.float64).reshape(len(k), 4)
+
+    speed_k = speed[k]
+    distance_prev_1 = back_dist[k]
+    columns = [
+        accuracy,
+        accuracy_sq,
+        lat[k],
+        lng[k],
+        lat_norm,
+        lng_norm,
+        np.array([1.0 if t == "human" else 0.0 for t in track_types]),
+        np.array(_HOUR_SIN)[hour_k],
+        np.array(_HOUR_COS)[hour_k],
+        np.array(_WEEKDAY_SIN)[weekday_k],
+        np.array(_WEEKDAY_COS)[weekday_k],
+        speed_k,
+        acceleration[k],
+        distance_prev_1,
+        distance_prev_2[k],
+        distance_prev_3[k],
+        bearing[k],
+        rolling_mean[k],
+        rolling_std[k],
+        accuracy * speed_k,
+        accuracy * distance_prev_1,
+        speed_k * distance_prev_1,
+        *environment.T,
+        curvature[k],
+        speed_consistency[k],
+        position_jump[k],
+        *human.T,
+        np.asarray(source_norm, dtype=np.float64),
+        np.asarray(is_feedback, dtype=np.float64),
+    ]
+    return np.column_stack(columns)
+
+
+def prepare_features_advanced(
+    data: List[Dict],
+    workers: Optional[int] = None,
+    stage_stats: Optional[Dict] = None,
+    report: bool = True,
+    only_tracks: Optional[set] = None,
+    row_info: Optional[Dict] = None,
+) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """
+    Förbättrad feature engineering för kommersiell ML-modell
+
+    Features:
+    - GPS accuracy (rapporterad) + accuracy^2 (non-linear)
+    - Original position (lat, lng) + normaliserad position
+    - Track type (human/dog)
+    - Timestamp features (hour, day_of_week, sin/cos encoding)
+    - Hastighet (m/s) baserat på tidigare positioner
+    - Acceleration (m/s²)
+    - Avstånd till tidigare positioner (1, 2, 3 steg bakåt)
+    - Riktning (bearing) i grader
+    - Rolling statistics (medelvärde och std dev för senaste 3 positioner)
+    - Interaktioner: accuracy * speed, accuracy * distance
+    - training_source_norm, is_ml_feedback_row (data_lineage/source från export)
+
+    Beräkningen görs kolumnvis per spår (förskjutna differenser, rolling
+    statistics och interaktioner som array-operationer) och spåren fördelas
+    över processer (workers, default FEATURE_WORKERS eller antal kärnor) när
+    datan är stor. Resultatet är identiskt med _prepare_features_rowwise.
+    Tid och minnestopp per steg skrivs ut (report) och läggs i stage_stats om angivet.
+    Med only_tracks beräknas bara raderna för de spåren; övriga spår i data
+    används endast som människaspår vid matchningen (se load_training_features).
+    Med row_info sätts row_info["row_keys"] till _row_key för varje rad i X.
+
+    Target:
+    - Korrigeringsavstånd (correction_distance_meters)
+    """
+    from profiling import StageProfiler
+
+    profiler = StageProfiler("prepare_features")
+
+    with profiler.stage("group"):
+        # Sortera data per spår och timestamp för att kunna beräkna hastighet
+        tracks = {}
+        for d in data:
+            track_id = _track_key(d)
+            if track_id not in tracks:
+                tracks[track_id] = []
+            tracks[track_id].append(d)
+
+        # Sortera varje spår efter timestamp
+        for track_id in tracks:
+            tracks[track_id].sort(key=lambda x: x.get("timestamp", ""), reverse=False)
+
+    with profiler.stage("targets"):
+        plan = _feature_row_plan(tracks)
+        full_plan = plan
+        if only_tracks is not None:
+            plan = {tid: (kept if tid in only_tracks else []) for tid, kept in plan.items()}
+        if row_info is not None:
+            # Samma ordning som raderna i X (spår för spår, även radvis)
+            row_info["row_keys"] = np.array(
+                [_row_key(tracks[tid][i]) for tid, kept in plan.items() for i in kept],
+                dtype=np.uint64,
+            )
+
+    with profiler.stage("tasks"):
+        human_ids = [
+            tid for tid, td in tracks.items() if td and td[0].get("track_type") == "human"
+        ]
+        needed_human = set()
+        tasks = []
+        for track_id, track_data in tracks.items():
+            fallback_human_id = next((h for h in human_ids if h != track_id), None)
+            kept = plan[track_id]
+            if kept:
+                if fallback_human_id is not None:
+                    needed_human.add(fallback_human_id)
+                for i in kept:
+                    htid = track_data[i].get("human_track_id")
+                    if htid and htid in tracks:
+                        needed_human.add(htid)
+            tasks.append((track_data, kept, fallback_human_id))
+        human_tracks = {tid: tracks[tid] for tid in needed_human}
+
+    n_rows = sum(len(kept) for kept in plan.values())
+    if workers is None:
+        import os
+
+        workers = int(os.environ.get("FEATURE_WORKERS", "") or os.cpu_count() or 1)
+    parallel = workers > 1 and len(tasks) > 1 and n_rows >= _PARALLEL_MIN_ROWS
+
+    with profiler.stage("features"):
+        if parallel:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(
+                max_workers=min(workers, len(tasks)),
+                initializer=_init_feature_worker,
+                initargs=(human_tracks,),
+            ) as executor:
+                blocks = list(
+                    executor.map(
+                        _track_feature_block,
+                        tasks,
+                        chunksize=max(1, len(tasks) // (workers * 4)),
+                    )
+                )
+        else:
+            _init_feature_worker(human_tracks)
+            try:
+                blocks = [_track_feature_block(task) for task in tasks]
+            finally:
+                _init_feature_worker({})
+
+    if any(block is None for block in blocks):
+        print("  Kolumnar feature-berakning stods inte for datan, kor radvis")
+        profiler.stop()
+        if only_tracks is None:
+            return _prepare_features_rowwise(data)
+        # Radvis ger rader för alla spår i samma ordning som full_plan
+        X, y, feature_names, sw = _prepare_features_rowwise(data)
+        mask = np.array(
+            [tid in only_tracks for tid, kept in full_plan.items() for _ in kept], dtype=bool
+        )
+        if not mask.any():
+            return np.array([]), np.array([]), [], np.array([], dtype=np.float64)
+        return X[mask], y[mask], feature_names, sw[mask]
+
+    with profiler.stage("assemble"):
+        targets = []
+        sample_weights = []
+        for (track_data, kept, _), block in zip(tasks, blocks):
+            for i in kept:
+                d = track_data[i]
+                targets.append(d["correction_distance_meters"])
+                w = d.get("training_weight_suggested", 1.0)
+                try:
+                    w = float(w)
+                except (TypeError, ValueError):
+                    w = 1.0
+                if w <= 0 or w > 10:
+                    w = 1.0
+                sample_weights.append(w)
+        if n_rows:
+            X = np.concatenate([b for b in blocks if len(b)], axis=0)
+            feature_names = list(FEATURE_NAMES)
+        else:
+            X = np.array([])
+            feature_names = []
+
+    profiler.stop()
+    if report:
+        profiler.report(
+            extra=f"{n_rows} rader, {len(tasks)} spar, "
+            + (f"{min(workers, len(tasks))} processer" if parallel else "1 process")
+        )
+    if stage_stats is not None:
+        stage_stats.update(profiler.as_dict())
+
+    return (
+        X,
+        np.array(targets),
+        feature_names,
+        np.array(sample_weights, dtype=np.float64),
     )
 
-    # Dela upp i train/test (samma split för sample_weight)
-    X_train, X_test, y_train, y_test, sw_train, sw_test = train_test_split(
-        X, y, sw, test_size=0.2, random_state=42
+
+def _group_columns(cols: Dict[str, np.ndarray]) -> Tuple[list, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Gruppera kolumnrader per spår som prepare_features_advanced: samma
+    spårnyckel (_track_key), spåren i den ordning de först förekommer och
+    raderna inom spåret stabilt sorterade på timestamp.
+
+    Returns:
+        (spårnycklar, spårkod per rad, radordning, gränser) där spår t har
+        raderna order[bounds[t]:bounds[t + 1]]
+    """
+    from columnar_dataset import INT_NULL
+
+    track_id = np.asarray(cols["track_id"])
+    names = np.asarray(cols["track_name"], dtype=object)
+    has_id = (track_id != INT_NULL) & (track_id != 0)
+    keys = np.where(has_id, track_id.astype(object), names)
+    index: Dict = {}
+    codes = np.fromiter(
+        (index.setdefault(key, len(index)) for key in keys.tolist()),
+        dtype=np.int64,
+        count=len(keys),
     )
+    order = np.lexsort((np.asarray(cols["timestamp"]), codes))
+    bounds = np.searchsorted(codes[order], np.arange(len(index) + 1))
+    return list(index), codes, order, bounds
 
-    print(f"\nTrain set: {len(X_train)} positioner")
-    print(f"Test set: {len(X_test)} positioner")
 
-    # Feature scaling (RobustScaler är bättre för outliers)
-    scaler = RobustScaler()
-    X_train_scaled = scaler.fit_transform(X_train)
-    X_test_scaled = scaler.transform(X_test)
+def _track_feature_block_columns(task: tuple) -> Optional[np.ndarray]:
+    """
+    Som _track_feature_block men för ett spår ur kolumner (se
+    prepare_features_columnar). task = (timestamps, lat, lng, original finns,
+    kept, accuracy, corrections, track_type, human_track_id, environment,
+    source_norm, is_feedback, fallback-människaspår); de sex sista per
+    träningsrad utom fallback.
+    """
+    (
+        timestamps, lat, lng, has_original, kept, accuracy, corrections,
+        track_types, human_track_ids, environments, source_norm, is_feedback,
+        fallback_human_id,
+    ) = task
+    n = len(timestamps)
+    if not len(kept):
+        return np.zeros((0, len(FEATURE_NAMES)))
+
+    times = _parse_track_times(timestamps)
+    if times is None:
+        return None
+    if not has_original.all():
+        if n > 1:
+            return None
+        lat = np.where(has_original, lat, 0.0)
+        lng = np.where(has_original, lng, 0.0)
+    if not (np.isfinite(lat).all() and np.isfinite(lng).all()):
+        return None
+    accuracy_list = [0.0 if a != a or not a else a for a in accuracy.tolist()]
+    if not all(_is_finite_number(a) for a in accuracy_list):
+        return None
+
+    lat_k = lat[kept].tolist()
+    lng_k = lng[kept].tolist()
+    human = [
+        _human_match_features(
+            track_types[j], human_track_ids[j], timestamps[i], lat_k[j], lng_k[j], fallback_human_id
+        )
+        for j, i in enumerate(kept.tolist())
+    ]
+    return _feature_block(
+        *times,
+        lat,
+        lng,
+        kept,
+        accuracy_list,
+        corrections,
+        track_types,
+        environments,
+        human,
+        source_norm,
+        is_feedback,
+    )
 
-    # Definiera modeller att testa
-    models = {}
 
-    # 1. Random Forest
-    print("\n" + "=" * 60)
-    print("1. RANDOM FOREST")
-    print("=" * 60)
-    rf_param_grid = {
-        "n_estimators": [100, 200, 300],
-        "max_depth": [10, 15, 20, None],
-        "min_samples_split": [2, 5, 10],
-        "min_samples_leaf": [1, 2, 4],
-    }
-    rf_base = RandomForestRegressor(random_state=42, n_jobs=-1)
-    rf_search = RandomizedSearchCV(
-        rf_base,
-        rf_param_grid,
-        n_iter=20,
-        cv=5,
-        scoring="neg_mean_absolute_error",
-        random_state=42,
-        n_jobs=-1,
-        verbose=1,
+def prepare_features_columnar(
+    cols: Dict[str, np.ndarray],
+    workers: Optional[int] = None,
+    stage_stats: Optional[Dict] = None,
+    report: bool = True,
+    row_info: Optional[Dict] = None,
+) -> Tuple[np.ndarray, np.ndarray, List[str], np.ndarray]:
+    """
+    prepare_features_advanced för kolumnär data (load_annotation_columns).
+
+    Gruppering, urval av träningsrader, targets och vikter görs som
+    array-operationer och spåren skickas till samma kolumnvisa
+    feature-beräkning som slices, så inga rad-dicts byggs. Undantaget är
+    människaspåren som hundspåren matchas mot (HumanTrackIndex arbetar på
+    rader). Resultatet är identiskt med
+    prepare_features_advanced(rows_from_columns(cols)), dit den också faller
+    tillbaka om något spår inte uppfyller förutsättningarna för den kolumnvisa
+    beräkningen.
+    """
+    from columnar_dataset import python_values, rows_from_columns
+    from profiling import StageProfiler
+
+    if not cols or not len(cols["timestamp"]):
+        return np.array([]), np.array([]), [], np.array([], dtype=np.float64)
+
+    profiler = StageProfiler("prepare_features")
+
+    with profiler.stage("group"):
+        track_keys, _, order, bounds = _group_columns(cols)
+        timestamps = np.asarray(cols["timestamp"])
+        orig_lat = np.asarray(cols["original_lat"], dtype=np.float64)
+        orig_lng = np.asarray(cols["original_lng"], dtype=np.float64)
+        has_original = ~(np.isnan(orig_lat) | np.isnan(orig_lng))
+
+    with profiler.stage("targets"):
+        # Samma regler som _feature_row_plan: korrigerad position, annars
+        # förutsagd om raden är verifierad korrekt; originalposition krävs
+        corr_lat = np.asarray(cols["corrected_lat"], dtype=np.float64)
+        corr_lng = np.asarray(cols["corrected_lng"], dtype=np.float64)
+        pred_lat = np.asarray(cols["predicted_lat"], dtype=np.float64)
+        pred_lng = np.asarray(cols["predicted_lng"], dtype=np.float64)
+        has_corr = ~(np.isnan(corr_lat) | np.isnan(corr_lng))
+        has_pred = ~(np.isnan(pred_lat) | np.isnan(pred_lng))
+        verified_correct = np.asarray(cols["verified_status"], dtype=object) == "correct"
+        target_lat = np.where(has_corr, corr_lat, pred_lat)
+        target_lng = np.where(has_corr, corr_lng, pred_lng)
+        is_kept = (has_corr | (verified_correct & has_pred)) & has_original
+
+        corrections = np.asarray(cols["correction_distance_meters"], dtype=np.float64).copy()
+        fill = is_kept & np.isnan(corrections)
+        if fill.any():
+            corrections[fill] = _pairwise(
+                haversine_distance,
+                orig_lat[fill], orig_lng[fill], target_lat[fill], target_lng[fill],
+            )
+
+        # Träningsraderna i samma ordning som X: spår för spår, tidsordning
+        sorted_kept = is_kept[order]
+        kept_rows = order[sorted_kept]
+        if row_info is not None:
+            # Samma värden som _row_key får ur raderna (heltal förblir int)
+            values = {
+                name: python_values(cols, name, kept_rows)
+                for name in (
+                    "id", "track_id", "track_name", "timestamp", "verified_status",
+                    "original_lat", "original_lng", "corrected_lat", "corrected_lng",
+                    "predicted_lat", "predicted_lng", "correction_distance_meters",
+                    "training_weight_suggested",
+                )
+            }
+            corr_k = has_corr[kept_rows].tolist()
+            pred_k = has_pred[kept_rows].tolist()
+            filled_k = fill[kept_rows].tolist()
+            cd_filled = corrections[kept_rows].tolist()
+            row_keys = np.empty(len(kept_rows), dtype=np.uint64)
+            for j in range(len(kept_rows)):
+                target = "corrected" if corr_k[j] else "predicted" if pred_k[j] else None
+                row_keys[j] = _row_key_values(
+                    values["id"][j],
+                    values["track_id"][j],
+                    values["track_name"][j],
+                    values["timestamp"][j],
+                    values["verified_status"][j],
+                    values["original_lat"][j],
+                    values["original_lng"][j],
+                    values[f"{target}_lat"][j] if target else None,
+                    values[f"{target}_lng"][j] if target else None,
+                    cd_filled[j] if filled_k[j] else values["correction_distance_meters"][j],
+                    values["training_weight_suggested"][j],
+                )
+            row_info["row_keys"] = row_keys
+
+    with profiler.stage("tasks"):
+        track_type = np.asarray(cols["track_type"], dtype=object)
+        environment = np.asarray(cols["environment"], dtype=object)
+        accuracy = np.asarray(cols["accuracy"], dtype=np.float64)
+        first_rows = order[bounds[:-1]]
+        human_ids = [
+            key for key, first in zip(track_keys, first_rows.tolist()) if track_type[first] == "human"
+        ]
+        key_to_code = {key: code for code, key in enumerate(track_keys)}
+
+        # training_source_norm / is_ml_feedback_row per unik kombination av kategorier
+        source_cols = [np.asarray(cols[c], dtype=object) for c in ("source", "label_type", "data_lineage")]
+        source_memo: Dict[tuple, tuple] = {}
+
+        def source_features(rows: np.ndarray) -> Tuple[list, list]:
+            norm, feedback = [], []
+            for combo in zip(*(c[rows].tolist() for c in source_cols)):
+                value = source_memo.get(combo)
+                if value is None:
+                    d = dict(zip(("source", "label_type", "data_lineage"), combo))
+                    value = source_memo[combo] = (
+                        training_source_norm_from_row(d),
+                        is_ml_feedback_training_row(d),
+                    )
+                norm.append(value[0])
+                feedback.append(value[1])
+            return norm, feedback
+
+        needed_human = set()
+        tasks = []
+        n_rows = 0
+        for code, key in enumerate(track_keys):
+            rows = order[bounds[code] : bounds[code + 1]]
+            kept = np.nonzero(sorted_kept[bounds[code] : bounds[code + 1]])[0]
+            fallback_human_id = next((h for h in human_ids if h != key), None)
+            kept_idx = rows[kept]
+            htids = python_values(cols, "human_track_id", kept_idx)
+            if len(kept):
+                if fallback_human_id is not None:
+                    needed_human.add(fallback_human_id)
+                needed_human.update(h for h in htids if h and h in key_to_code)
+            norm, feedback = source_features(kept_idx)
+            tasks.append((
+                timestamps[rows].tolist(),
+                orig_lat[rows],
+                orig_lng[rows],
+                has_original[rows],
+                kept,
+                accuracy[kept_idx],
+                corrections[rows],
+                track_type[kept_idx].tolist(),
+                htids,
+                environment[kept_idx].tolist(),
+                norm,
+                feedback,
+                fallback_human_id,
+            ))
+            n_rows += len(kept)
+
+        # Människaspåren som matchas mot, som rader (samma dicts som
+        # rows_from_columns ger; HumanTrackIndex jämför hela rader)
+        human_tracks = {}
+        for key in needed_human:
+            code = key_to_code[key]
+            rows = order[bounds[code] : bounds[code + 1]]
+            human_tracks[key] = rows_from_columns({name: arr[rows] for name, arr in cols.items()})
+            for d, cd in zip(human_tracks[key], corrections[rows].tolist()):
+                if "correction_distance_meters" in d:
+                    d["correction_distance_meters"] = None if cd != cd else cd
+
+    if workers is None:
+        workers = int(os.environ.get("FEATURE_WORKERS", "") or os.cpu_count() or 1)
+    parallel = workers > 1 and len(tasks) > 1 and n_rows >= _PARALLEL_MIN_ROWS
+
+    with profiler.stage("features"):
+        if parallel:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(
+                max_workers=min(workers, len(tasks)),
+                initializer=_init_feature_worker,
+                initargs=(human_tracks,),
+            ) as executor:
+                blocks = list(
+                    executor.map(
+                        _track_feature_block_columns,
+                        tasks,
+                        chunksize=max(1, len(tasks) // (workers * 4)),
+                    )
+                )
+        else:
+            _init_feature_worker(human_tracks)
+            try:
+                blocks = [_track_feature_block_columns(task) for task in tasks]
+            finally:
+                _init_feature_worker({})
+
+    if any(block is None for block in blocks):
+        print("  Kolumnar feature-berakning stods inte for datan, bygger rader")
+        profiler.stop()
+        return prepare_features_advanced(
+            rows_from_columns(cols), workers=workers, stage_stats=stage_stats,
+            report=report, row_info=row_info,
+        )
+
+    with profiler.stage("assemble"):
+        targets = corrections[kept_rows]
+        weights = np.asarray(cols["training_weight_suggested"], dtype=np.float64)[kept_rows]
+        weights = np.where(np.isnan(weights) | (weights <= 0) | (weights > 10), 1.0, weights)
+        if n_rows:
+            X = np.concatenate([b for b in blocks if len(b)], axis=0)
+            feature_names = list(FEATURE_NAMES)
+        else:
+            X = np.array([])
+            feature_names = []
+
+    profiler.stop()
+    if report:
+        profiler.report(
+            extra=f"{n_rows} rader, {len(tasks)} spar (kolumnart), "
+            + (f"{min(workers, len(tasks))} processer" if parallel else "1 process")
+        )
+    if stage_stats is not None:
+        stage_stats.update(profiler.as_dict())
+
+    return X, np.asarray(targets, dtype=np.float64), feature_names, weights.astype(np.float64)
+
+
+def _track_summary_columns(cols: Dict[str, np.ndarray], input_spans: List) -> Tuple[Dict, set]:
+    """_track_summary för kolumnär data (samma resultat utan rad-dicts)."""
+    from columnar_dataset import INT_NULL
+
+    if not cols or not len(cols["timestamp"]):
+        return {}, set()
+    track_keys, codes, order, bounds = _group_columns(cols)
+    track_type = np.asarray(cols["track_type"], dtype=object)
+    is_human = (track_type[order[bounds[:-1]]] == "human").tolist()
+
+    input_index = np.repeat(
+        np.arange(len(input_spans)), [stop - start for _, start, stop in input_spans]
     )
-    rf_search.fit(X_train_scaled, y_train, sample_weight=sw_train)
-    models["Random Forest"] = {
-        "model": rf_search.best_estimator_,
-        "best_params": rf_search.best_params_,
-        "cv_score": -rf_search.best_score_,
-    }
+    pairs = np.unique(codes * max(1, len(input_spans)) + input_index)
+    inputs: List[List[int]] = [[] for _ in track_keys]
+    for pair in pairs.tolist():
+        code, idx = divmod(pair, max(1, len(input_spans)))
+        inputs[code].append(idx)
 
-    # 2. Gradient Boosting
-    print("\n" + "=" * 60)
-    print("2. GRADIENT BOOSTING")
-    print("=" * 60)
-    gb_param_grid = {
-        "n_estimators": [100, 200, 300],
-        "max_depth": [3, 5, 7],
-        "learning_rate": [0.01, 0.05, 0.1],
-        "min_samples_split": [2, 5, 10],
-    }
-    gb_base = GradientBoostingRegressor(random_state=42)
-    gb_search = RandomizedSearchCV(
-        gb_base,
-        gb_param_grid,
-        n_iter=20,
-        cv=5,
-        scoring="neg_mean_absolute_error",
-        random_state=42,
-        n_jobs=-1,
-        verbose=1,
+    human_track_id = np.asarray(cols["human_track_id"])
+    refs = set(np.unique(human_track_id[(human_track_id != INT_NULL) & (human_track_id != 0)]).tolist())
+    return {key: (is_human[code], inputs[code]) for code, key in enumerate(track_keys)}, refs
+
+
+def _track_summary(data: List[Dict], input_spans: List, first_input: int = 0) -> Tuple[Dict, set]:
+    """
+    Per spår (i spårordning): om det räknas som människaspår vid matchningen
+    (första raden efter sortering på timestamp) och vilka indatakällor det har
+    rader i. Dessutom alla human_track_id som raderna refererar till.
+    """
+    tracks = {}
+    refs = set()
+    for input_index, (_, start, stop) in enumerate(input_spans, start=first_input):
+        for d in data[start:stop]:
+            track_id = _track_key(d)
+            ts = d.get("timestamp", "")
+            entry = tracks.get(track_id)
+            if entry is None:
+                tracks[track_id] = entry = {"ts": ts, "human": False, "inputs": []}
+                entry["human"] = d.get("track_type") == "human"
+            elif ts < entry["ts"]:
+                # Stabil sortering: bara en strikt tidigare rad blir först
+                entry["ts"] = ts
+                entry["human"] = d.get("track_type") == "human"
+            if not entry["inputs"] or entry["inputs"][-1] != input_index:
+                entry["inputs"].append(input_index)
+            human_track_id = d.get("human_track_id")
+            if human_track_id:
+                refs.add(human_track_id)
+    return {tid: (e["human"], e["inputs"]) for tid, e in tracks.items()}, refs
+
+
+def _append_cached_features(cache, base: Dict, key: str, inputs: List, fingerprints: List, rows_for):
+    """
+    Bygg cacheposten för inputs från basposten (vars indata är ett prefix) genom
+    att bara beräkna features för spåren i de nya indatakällorna.
+
+    Det är bara korrekt om de gamla raderna får exakt samma features som vid
+    en full beräkning. Returnerar None (full beräkning) om:
+    - ett spår i de nya filerna redan finns (spårets rader och ordning ändras)
+    - en gammal rad refererar till ett human_track_id som nu tillkommer
+    - nya människaspår tillkommer och de gamla spåren hade färre än två
+      (fallback-människaspåret för gamla rader kan då ändras)
+    """
+    n_old = len(base["inputs"])
+    old_tracks = {tid: (human, idx) for tid, human, idx in base["tracks"]}
+    old_humans = [tid for tid, human, _ in base["tracks"] if human]
+
+    new_data = []
+    new_spans = []
+    for name, _ in inputs[n_old:]:
+        rows = rows_for(n_old + len(new_spans))
+        new_spans.append((name, len(new_data), len(new_data) + len(rows)))
+        new_data.extend(rows)
+    new_tracks, new_refs = _track_summary(new_data, new_spans, first_input=n_old)
+
+    if any(tid in old_tracks for tid in new_tracks):
+        reason = "nya filer innehaller befintliga spar"
+    elif any(tid in new_tracks for tid in base["unresolved_refs"]):
+        reason = "befintliga rader refererar till nya spar"
+    elif len(old_humans) < 2 and any(human for human, _ in new_tracks.values()):
+        reason = "nya manniskospar andrar matchningen for befintliga spar"
+    else:
+        reason = None
+    if reason:
+        print(f"  Feature-cache: {reason}, beraknar allt")
+        return None
+
+    # Gamla spår som de nya raderna matchas mot: refererade spår och det
+    # första människaspåret (fallback för rader utan human_track_id)
+    context = {tid for tid in new_refs if tid in old_tracks}
+    if old_humans:
+        context.add(old_humans[0])
+    context_data = []
+    for input_index in sorted({i for tid in context for i in old_tracks[tid][1]}):
+        context_data.extend(d for d in rows_for(input_index) if _track_key(d) in context)
+
+    print(
+        f"  Feature-cache: {len(inputs) - n_old} ny(a) indatakalla(or), beraknar "
+        f"{len(new_tracks)} nya spar (+{len(context)} for matchning)"
+    )
+    new_info = {}
+    X_new, y_new, names_new, sw_new = prepare_features_advanced(
+        context_data + new_data, only_tracks=set(new_tracks), row_info=new_info
     )
-    gb_search.fit(X_train_scaled, y_train, sample_weight=sw_train)
-    models["Gradient Boosting"] = {
-        "model": gb_search.best_estimator_,
-        "best_params": gb_search.best_params_,
-        "cv_score": -gb_search.best_score_,
-    }
 
-    # 3. Extra Trees
-    print("\n" + "=" * 60)
-    print("3. EXTRA TREES")
-    print("=" * 60)
-    et_param_grid = {
-        "n_estimators": [100, 200, 300],
-        "max_depth": [10, 15, 20, None],
-        "min_samples_split": [2, 5, 10],
+    cached = cache.load(base["key"])
+    if cached is None:
+        return None
+    feature_names = cached[2] if base["rows"] else names_new
+    all_ids = set(old_tracks) | set(new_tracks)
+    manifest = {
+        "schema_version": FEATURE_SCHEMA_VERSION,
+        "inputs": fingerprints,
+        "tracks": base["tracks"]
+        + [[tid, human, idx] for tid, (human, idx) in new_tracks.items()],
+        "unresolved_refs": sorted(
+            set(base["unresolved_refs"]) | {r for r in new_refs if r not in all_ids}, key=str
+        ),
+        "base": base["key"],
     }
-    et_base = ExtraTreesRegressor(random_state=42, n_jobs=-1)
-    et_search = RandomizedSearchCV(
-        et_base,
-        et_param_grid,
-        n_iter=20,
-        cv=5,
-        scoring="neg_mean_absolute_error",
-        random_state=42,
-        n_jobs=-1,
-        verbose=1,
+    entry = cache.append(
+        base["key"], key, X_new, y_new, feature_names, sw_new, manifest, new_info["row_keys"]
     )
-    et_search.fit(X_train_scaled, y_train, sample_weight=sw_train)
-    models["Extra Trees"] = {
-        "model": et_search.best_estimator_,
-        "best_params": et_search.best_params_,
-        "cv_score": -et_search.best_score_,
+    X, y, feature_names, sw, _ = cache.load(entry.name)
+    return X, y, feature_names, sw
+
+
+def load_training_features(
+    data: Optional[List[Dict]] = None,
+    input_spans: Optional[List] = None,
+    use_cache: Optional[bool] = None,
+    row_info: Optional[Dict] = None,
+) -> Tuple[np.ndarray, np.ndarray, List[str], np.ndarray]:
+    """
+    Features för all träningsdata i ml/data (samma resultat som
+    prepare_features_advanced(load_annotations())) via feature-cachen i
+    ml/output/feature_cache/ (se feature_cache.py).
+
+    Nyckeln är en hash av indatakällornas innehåll + FEATURE_SCHEMA_VERSION.
+    Vid träff läses X/y/sample_weight minnesmappat och ingen JSON laddas. Om
+    bara nya exportfiler tillkommit sedan en tidigare post beräknas endast de
+    nya spåren och läggs till sist. Annars beräknas allt och sparas; utan
+    data görs det kolumnvis (load_annotation_columns + prepare_features_columnar).
+
+    Args:
+        data: Redan laddad data från load_annotations() (annars laddas den vid behov)
+        input_spans: input_spans från samma load_annotations()-anrop; utan dem
+            går det inte att veta vilka filer data kommer från och cachen används inte
+        use_cache: False = ingen cache (default: FEATURE_CACHE != "0")
+        row_info: Om angiven sätts row_info["row_keys"] (radnyckel per rad i X)
+
+    Returns:
+        (X, y, feature_names, sample_weights) som prepare_features_advanced
+    """
+    if use_cache is None:
+        use_cache = os.environ.get("FEATURE_CACHE", "1") != "0"
+    if not use_cache:
+        if data is None:
+            return prepare_features_columnar(load_annotation_columns(), row_info=row_info)
+        return prepare_features_advanced(data, row_info=row_info)
+
+    from feature_cache import FeatureCache, cache_key, fingerprint_inputs
+
+    inputs = annotation_inputs()
+    if data is not None and (
+        input_spans is None or [span[0] for span in input_spans] != [name for name, _ in inputs]
+    ):
+        return prepare_features_advanced(data, row_info=row_info)
+
+    fingerprints = fingerprint_inputs(inputs)
+    key = cache_key(fingerprints, FEATURE_SCHEMA_VERSION)
+    cache = FeatureCache()
+    cached = cache.load(key)
+    if cached is not None:
+        X, y, feature_names, sw, _ = cached
+        if row_info is not None:
+            row_info["row_keys"] = cache.load_row_keys(key)
+        print(f"  Feature-cache: traff {key[:12]} ({len(y)} rader fran {len(inputs)} indatakallor)")
+        return X, y, feature_names, sw
+
+    def rows_for(input_index: int) -> List[Dict]:
+        if data is not None:
+            _, start, stop = input_spans[input_index]
+            return data[start:stop]
+        return load_annotation_input(inputs[input_index][0])
+
+    base = cache.find_prefix(fingerprints, FEATURE_SCHEMA_VERSION)
+    if base is not None:
+        result = _append_cached_features(cache, base, key, inputs, fingerprints, rows_for)
+        if result is not None:
+            if row_info is not None:
+                row_info["row_keys"] = cache.load_row_keys(key)
+            return result
+
+    info = {}
+    if data is None:
+        # Kolumnvis direkt från partitionerna (minnesmappade) och JSON-filerna
+        input_spans = []
+        cols = load_annotation_columns(input_spans=input_spans)
+        tracks, refs = _track_summary_columns(cols, input_spans)
+        X, y, feature_names, sw = prepare_features_columnar(cols, row_info=info)
+    else:
+        tracks, refs = _track_summary(data, input_spans)
+        X, y, feature_names, sw = prepare_features_advanced(data, row_info=info)
+    if row_info is not None:
+        row_info["row_keys"] = info["row_keys"]
+    manifest = {
+        "schema_version": FEATURE_SCHEMA_VERSION,
+        "inputs": fingerprints,
+        "tracks": [[tid, human, idx] for tid, (human, idx) in tracks.items()],
+        "unresolved_refs": sorted((r for r in refs if r not in tracks), key=str),
     }
+    entry = cache.store(key, X, y, feature_names, sw, manifest, info["row_keys"])
+    print(f"  Feature-cache: sparade {len(y)} rader i {entry}")
+    return X, y, feature_names, sw
 
-    # 4. XGBoost (om tillgängligt)
-    if XGBOOST_AVAILABLE:
-        print("\n" + "=" * 60)
-        print("4. XGBOOST")
-        print("=" * 60)
-        xgb_param_grid = {
-            "n_estimators": [100, 200, 300],
-            "max_depth": [3, 5, 7],
-            "learning_rate": [0.01, 0.05, 0.1],
-            "subsample": [0.8, 0.9, 1.0],
-            "colsample_bytree": [0.8, 0.9, 1.0],
-        }
-        xgb_base = xgb.XGBRegressor(random_state=42, n_jobs=-1)
-        xgb_search = RandomizedSearchCV(
-            xgb_base,
-            xgb_param_grid,
-            n_iter=20,
-            cv=5,
-            scoring="neg_mean_absolute_error",
-            random_state=42,
-            n_jobs=-1,
-            verbose=1,
+
+SEARCH_MODES = ("exhaustive", "budget")
+
+# Radnycklar (_row_key) som den publicerade modellen sett resp. valideras på
+SEEN_ROWS_FILE = "gps_correction_seen_rows.npy"
+HOLDOUT_ROWS_FILE = "gps_correction_holdout_rows.npy"
+DEFAULT_SEARCH_BUDGET_S = 120.0
+
+
+MODEL_KEYS = ("rf", "gb", "et", "xgb")
+
+
+def _estimator(module: str, class_name: str, **params):
+    """Fabrik för en estimator; klassen importeras först när modellen byggs."""
+
+    def build():
+        import importlib
+
+        return getattr(importlib.import_module(module), class_name)(**params)
+
+    return build
+
+
+def _model_search_specs(selected: Optional[List[str]] = None) -> List[Dict]:
+    """
+    Modellerna som train_ml_model jämför och deras sökrymder. Samma grid
+    används i båda söklägena; resource/early_stopping styr budgetläget
+    (se hyperparameter_search.py).
+
+    Args:
+        selected: Nycklar ur MODEL_KEYS (None = alla tillgängliga)
+    """
+    specs = [
+        {
+            "key": "rf",
+            "name": "Random Forest",
+            "estimator": _estimator(
+                "sklearn.ensemble", "RandomForestRegressor", random_state=42, n_jobs=-1
+            ),
+            "grid": {
+                "n_estimators": [100, 200, 300],
+                "max_depth": [10, 15, 20, None],
+                "min_samples_split": [2, 5, 10],
+                "min_samples_leaf": [1, 2, 4],
+            },
+            "resource": "n_estimators",
+        },
+        {
+            "key": "gb",
+            "name": "Gradient Boosting",
+            "estimator": _estimator(
+                "sklearn.ensemble", "GradientBoostingRegressor", random_state=42
+            ),
+            "grid": {
+                "n_estimators": [100, 200, 300],
+                "max_depth": [3, 5, 7],
+                "learning_rate": [0.01, 0.05, 0.1],
+                "min_samples_split": [2, 5, 10],
+            },
+            "resource": "samples",
+            "early_stopping": "sklearn",
+        },
+        {
+            "key": "et",
+            "name": "Extra Trees",
+            "estimator": _estimator(
+                "sklearn.ensemble", "ExtraTreesRegressor", random_state=42, n_jobs=-1
+            ),
+            "grid": {
+                "n_estimators": [100, 200, 300],
+                "max_depth": [10, 15, 20, None],
+                "min_samples_split": [2, 5, 10],
+            },
+            "resource": "n_estimators",
+        },
+        {
+            "key": "xgb",
+            "name": "XGBoost",
+            "estimator": _estimator("xgboost", "XGBRegressor", random_state=42, n_jobs=-1),
+            "grid": {
+                "n_estimators": [100, 200, 300],
+                "max_depth": [3, 5, 7],
+                "learning_rate": [0.01, 0.05, 0.1],
+                "subsample": [0.8, 0.9, 1.0],
+                "colsample_bytree": [0.8, 0.9, 1.0],
+            },
+            "resource": "samples",
+            "early_stopping": "xgboost",
+        },
+    ]
+    if selected is not None:
+        unknown = sorted(set(selected) - set(MODEL_KEYS))
+        if unknown:
+            raise ValueError(
+                f"ML_MODELS: okanda modeller {', '.join(unknown)} ({', '.join(MODEL_KEYS)})"
+            )
+        specs = [spec for spec in specs if spec["key"] in selected]
+
+    if any(spec["key"] == "xgb" for spec in specs):
+        from importlib.util import find_spec
+
+        # Kontrollera utan att importera xgboost
+        if find_spec("xgboost") is None:
+            print("Warning: XGBoost not available. Install with: pip install xgboost")
+            specs = [spec for spec in specs if spec["key"] != "xgb"]
+    if not specs:
+        raise ValueError("ML_MODELS: ingen av de valda modellerna finns tillganglig")
+    return specs
+
+
+def _selected_models() -> Optional[List[str]]:
+    """ML_MODELS=rf,xgb -> ["rf", "xgb"]; tom/saknas = alla modeller."""
+    raw = os.environ.get("ML_MODELS", "")
+    keys = [key.strip().lower() for key in raw.split(",") if key.strip()]
+    return keys or None
+
+
+def train_ml_model(
+    data: Optional[List[Dict]] = None,
+    input_spans: Optional[List] = None,
+    headless: Optional[bool] = None,
+):
+    """
+    Träna och optimera flera ML-modeller för kommersiell GPS-korrigering
+
+    Steg:
+    1. Förbättrad feature engineering (22 features), via feature-cachen om
+       data är None eller input_spans från load_annotations() anges
+    2. Träna flera modeller (Random Forest, Gradient Boosting, Extra Trees, XGBoost)
+    3. Hyperparameter tuning med RandomizedSearchCV (ML_SEARCH_MODE=exhaustive,
+       default) eller successive halving inom ML_SEARCH_BUDGET_S sekunder
+       (ML_SEARCH_MODE=budget, se hyperparameter_search.py)
+    4. Cross-validation för robust utvärdering
+    5. Välj bästa modellen baserat på test performance
+
+    Endast modellerna i ML_MODELS (t.ex. "rf,xgb", default alla) importeras och
+    tränas. headless=True (default ML_HEADLESS) hoppar över förutsägelsegrafen.
+    Tid per steg skrivs ut sist och sparas i model_info["stages"].
+    """
+    from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import RobustScaler
+    from profiling import StageProfiler
+
+    if headless is None:
+        headless = headless_mode()
+    search_mode = os.environ.get("ML_SEARCH_MODE", "exhaustive")
+    if search_mode not in SEARCH_MODES:
+        raise ValueError(f"ML_SEARCH_MODE={search_mode!r} stods inte ({', '.join(SEARCH_MODES)})")
+    specs = _model_search_specs(_selected_models())
+    profiler = StageProfiler("train_ml_model")
+
+    with profiler.stage("features"):
+        print("\nForbereder avancerade features...")
+        row_info = {}
+        X, y, feature_names, sw = load_training_features(data, input_spans, row_info=row_info)
+        row_keys = np.asarray(row_info["row_keys"])
+
+        if len(X) == 0:
+            print("  Ingen data att trana pa!")
+            return
+
+        print(f"  {len(X)} positioner med {len(feature_names)} features")
+        print(
+            f"  Sample weights: min={sw.min():.3f}, max={sw.max():.3f}, medel={sw.mean():.3f} "
+            "(1.0 om training_weight_suggested saknas)"
+        )
+        print(
+            f"  Features: {', '.join(feature_names[:5])}... (+ {len(feature_names) - 5} fler)"
         )
-        xgb_search.fit(X_train_scaled, y_train, sample_weight=sw_train)
-        models["XGBoost"] = {
-            "model": xgb_search.best_estimator_,
-            "best_params": xgb_search.best_params_,
-            "cv_score": -xgb_search.best_score_,
-        }
 
-    # Utvärdera alla modeller på test set
-    print("\n" + "=" * 60)
-    print("JAMFORELSE AV MODELLER")
-    print("=" * 60)
+    with profiler.stage("split"):
+        # Ta bort outliers (positioner med extremt stora korrigeringar)
+        # Behöll 99% av datan (ta bort top 1% outliers)
+        outlier_threshold = np.percentile(y, 99)
+        mask = y <= outlier_threshold
+        X = X[mask]
+        y = y[mask]
+        sw = sw[mask]
+        kept_keys = row_keys[mask]
+        print(
+            f"  Efter outlier removal: {len(X)} positioner (removed {np.sum(~mask)} outliers)"
+        )
 
-    results = []
-    for name, model_info in models.items():
-        model = model_info["model"]
-        y_pred_test = model.predict(X_test_scaled)
-
-        test_mae = mean_absolute_error(y_test, y_pred_test)
-        test_rmse = np.sqrt(mean_squared_error(y_test, y_pred_test))
-        test_r2 = r2_score(y_test, y_pred_test)
-
-        results.append(
-            {
-                "name": name,
-                "model": model,
-                "cv_mae": model_info["cv_score"],
-                "test_mae": test_mae,
-                "test_rmse": test_rmse,
-                "test_r2": test_r2,
-                "params": model_info["best_params"],
-            }
+        # Dela upp i train/test (samma split för sample_weight)
+        X_train, X_test, y_train, y_test, sw_train, sw_test, _, keys_test = train_test_split(
+            X, y, sw, kept_keys, test_size=0.2, random_state=42
         )
 
-        print(f"\n{name}:")
-        print(f"  CV MAE: {model_info['cv_score']:.4f} meter")
-        print(f"  Test MAE: {test_mae:.4f} meter")
-        print(f"  Test RMSE: {test_rmse:.4f} meter")
-        print(f"  Test R²: {test_r2:.4f}")
+        print(f"\nTrain set: {len(X_train)} positioner")
+        print(f"Test set: {len(X_test)} positioner")
+
+        # Feature scaling (RobustScaler är bättre för outliers)
+        scaler = RobustScaler()
+        X_train_scaled = scaler.fit_transform(X_train)
+        X_test_scaled = scaler.transform(X_test)
+
+    with profiler.stage("search"):
+        # Definiera modeller att testa
+        from hyperparameter_search import (
+            SearchCache,
+            data_fingerprint,
+            print_comparison,
+            save_report,
+            successive_halving,
+        )
 
-    # Välj bästa modellen (lägst test MAE)
-    best_model_info = min(results, key=lambda x: x["test_mae"])
-    best_model = best_model_info["model"]
-    best_name = best_model_info["name"]
+        data_key = data_fingerprint(X_train_scaled, y_train, sw_train)
+        budget_s = float(os.environ.get("ML_SEARCH_BUDGET_S", "") or DEFAULT_SEARCH_BUDGET_S)
+        if search_mode == "budget":
+            print(f"\nSoklage: budget ({budget_s:.0f} s totalt, successive halving)")
+            search_cache = SearchCache()
+
+        models = {}
+        search_start = time.perf_counter()
+        for i, spec in enumerate(specs, start=1):
+            print("\n" + "=" * 60)
+            print(f"{i}. {spec['name'].upper()}")
+            print("=" * 60)
+            if search_mode == "budget":
+                # Tid som inte används av en modell går till de följande
+                remaining = budget_s - (time.perf_counter() - search_start)
+                result = successive_halving(
+                    spec,
+                    X_train_scaled,
+                    y_train,
+                    sw_train,
+                    budget_s=max(0.0, remaining) / (len(specs) - i + 1),
+                    cache=search_cache,
+                    data_key=data_key,
+                )
+                for rung in result["rungs"]:
+                    print(
+                        f"  resurs {rung['resource']:>6}: {rung['evaluated']:>3} konfigurationer, "
+                        f"basta CV MAE {rung['best_mae']:.4f}"
+                    )
+                print(
+                    f"  {result['seconds']:.1f} s, {result['fits']} traningar "
+                    f"({result['cached']} konfigurationer fran cache)"
+                )
+                models[spec["name"]] = result
+                continue
 
-    print("\n" + "=" * 60)
-    print(f"BESTA MODELL: {best_name}")
-    print("=" * 60)
-    print(f"  Test MAE: {best_model_info['test_mae']:.4f} meter")
-    print(f"  Test RMSE: {best_model_info['test_rmse']:.4f} meter")
-    print(f"  Test R²: {best_model_info['test_r2']:.4f}")
-    print(f"\n  Hyperparameters:")
-    for param, value in best_model_info["params"].items():
-        print(f"    {param}: {value}")
-
-    # Feature importance för bästa modellen
-    if hasattr(best_model, "feature_importances_"):
-        print(f"\n  Top 10 Viktigaste Features:")
-        importances = best_model.feature_importances_
-        top_indices = np.argsort(importances)[-10:][::-1]
-        for idx in top_indices:
-            print(f"    {feature_names[idx]}: {importances[idx]:.4f}")
-
-    # Visualisera förutsägelser för bästa modellen
-    y_pred_test_best = best_model.predict(X_test_scaled)
-    visualize_predictions(y_test, y_pred_test_best, best_model_info["test_mae"])
-
-    # Spara bästa modellen och scaler
-    import pickle
+            from sklearn.model_selection import RandomizedSearchCV
+
+            started = time.perf_counter()
+            search = RandomizedSearchCV(
+                spec["estimator"](),
+                spec["grid"],
+                n_iter=20,
+                cv=5,
+                scoring="neg_mean_absolute_error",
+                random_state=42,
+                n_jobs=-1,
+                verbose=1,
+            )
+            search.fit(X_train_scaled, y_train, sample_weight=sw_train)
+            models[spec["name"]] = {
+                "model": search.best_estimator_,
+                "best_params": search.best_params_,
+                "cv_score": -search.best_score_,
+                "seconds": time.perf_counter() - started,
+                "fits": len(search.cv_results_["params"]) * 5 + 1,
+            }
+        search_seconds = time.perf_counter() - search_start
 
-    output_dir = Path(__file__).parent / "output"
-    output_dir.mkdir(exist_ok=True)
+    with profiler.stage("evaluate"):
+        # Utvärdera alla modeller på test set
+        print("\n" + "=" * 60)
+        print("JAMFORELSE AV MODELLER")
+        print("=" * 60)
 
-    # Spara modell
-    model_path = output_dir / "gps_correction_model_best.pkl"
-    with open(model_path, "wb") as f:
-        pickle.dump(best_model, f)
-    print(f"\n  Modell sparad till: {model_path}")
-
-    # Spara scaler
-    scaler_path = output_dir / "gps_correction_scaler.pkl"
-    with open(scaler_path, "wb") as f:
-        pickle.dump(scaler, f)
-    print(f"  Scaler sparad till: {scaler_path}")
-
-    # Spara feature names
-    feature_names_path = output_dir / "gps_correction_feature_names.pkl"
-    with open(feature_names_path, "wb") as f:
-        pickle.dump(feature_names, f)
-    print(f"  Feature names sparad till: {feature_names_path}")
-
-    # Spara modellinfo (model_version används av backend för ml_model_version vid T2-korrigeringar)
-    model_info_path = output_dir / "gps_correction_model_info.json"
-    model_version = datetime.now().strftime("%Y%m%d") + "-" + best_name.replace(" ", "").lower()[:12]
-    model_info = {
-        "best_model": best_name,
-        "model_version": model_version,
-        "test_mae": float(best_model_info["test_mae"]),
-        "test_rmse": float(best_model_info["test_rmse"]),
-        "test_r2": float(best_model_info["test_r2"]),
-        "hyperparameters": best_model_info["params"],
-        "feature_names": feature_names,
-    }
-    with open(model_info_path, "w", encoding="utf-8") as f:
-        json.dump(model_info, f, indent=2, ensure_ascii=False)
-    print(f"  Modellinfo sparad till: {model_info_path} (model_version={model_version})")
+        results = []
+        for name, model_info in models.items():
+            model = model_info["model"]
+            y_pred_test = model.predict(X_test_scaled)
+
+            test_mae = mean_absolute_error(y_test, y_pred_test)
+            test_rmse = np.sqrt(mean_squared_error(y_test, y_pred_test))
+            test_r2 = r2_score(y_test, y_pred_test)
+
+            results.append(
+                {
+                    "name": name,
+                    "model": model,
+                    "cv_mae": model_info["cv_score"],
+                    "test_mae": test_mae,
+                    "test_rmse": test_rmse,
+                    "test_r2": test_r2,
+                    "params": model_info["best_params"],
+                    "seconds": model_info["seconds"],
+                    "fits": model_info["fits"],
+                }
+            )
+
+            print(f"\n{name}:")
+            print(f"  CV MAE: {model_info['cv_score']:.4f} meter")
+            print(f"  Test MAE: {test_mae:.4f} meter")
+            print(f"  Test RMSE: {test_rmse:.4f} meter")
+            print(f"  Test R²: {test_r2:.4f}")
+
+        # Välj bästa modellen (lägst test MAE)
+        best_model_info = min(results, key=lambda x: x["test_mae"])
+        best_model = best_model_info["model"]
+        best_name = best_model_info["name"]
+
+        print("\n" + "=" * 60)
+        print(f"BESTA MODELL: {best_name}")
+        print("=" * 60)
+        print(f"  Test MAE: {best_model_info['test_mae']:.4f} meter")
+        print(f"  Test RMSE: {best_model_info['test_rmse']:.4f} meter")
+        print(f"  Test R²: {best_model_info['test_r2']:.4f}")
+        print(f"\n  Hyperparameters:")
+        for param, value in best_model_info["params"].items():
+            print(f"    {param}: {value}")
+
+        # Poäng/tid per sökläge (jämförs med senaste körningen i det andra läget)
+        search_summary = {
+            "mode": search_mode,
+            "data_key": data_key,
+            "seconds": search_seconds,
+            "fits": sum(r["fits"] for r in results),
+            "test_mae": float(best_model_info["test_mae"]),
+            "models": {
+                r["name"]: {
+                    "cv_mae": float(r["cv_mae"]),
+                    "test_mae": float(r["test_mae"]),
+                    "seconds": r["seconds"],
+                    "fits": r["fits"],
+                }
+                for r in results
+            },
+        }
+        if search_mode == "budget":
+            search_summary["budget_s"] = budget_s
+        print(f"\n  Sokning ({search_mode}): {search_seconds:.1f} s, {search_summary['fits']} traningar")
+        print_comparison(save_report(search_mode, search_summary), data_key)
+
+        # Feature importance för bästa modellen
+        if hasattr(best_model, "feature_importances_"):
+            print(f"\n  Top 10 Viktigaste Features:")
+            importances = best_model.feature_importances_
+            top_indices = np.argsort(importances)[-10:][::-1]
+            for idx in top_indices:
+                print(f"    {feature_names[idx]}: {importances[idx]:.4f}")
+
+    if not headless:
+        with profiler.stage("plots"):
+            # Visualisera förutsägelser för bästa modellen
+            y_pred_test_best = best_model.predict(X_test_scaled)
+            visualize_predictions(y_test, y_pred_test_best, best_model_info["test_mae"])
+
+    with profiler.stage("save"):
+        # Spara bästa modellen och scaler
+        import pickle
+
+        output_dir = Path(__file__).parent / "output"
+        output_dir.mkdir(exist_ok=True)
+
+        # Spara modell
+        model_path = output_dir / "gps_correction_model_best.pkl"
+        with open(model_path, "wb") as f:
+            pickle.dump(best_model, f)
+        print(f"\n  Modell sparad till: {model_path}")
+
+        # Spara scaler
+        scaler_path = output_dir / "gps_correction_scaler.pkl"
+        with open(scaler_path, "wb") as f:
+            pickle.dump(scaler, f)
+        print(f"  Scaler sparad till: {scaler_path}")
+
+        # Spara feature names
+        feature_names_path = output_dir / "gps_correction_feature_names.pkl"
+        with open(feature_names_path, "wb") as f:
+            pickle.dump(feature_names, f)
+        print(f"  Feature names sparad till: {feature_names_path}")
+
+        # Spara modellinfo (model_version används av backend för ml_model_version vid T2-korrigeringar)
+        model_info_path = output_dir / "gps_correction_model_info.json"
+        model_version = datetime.now().strftime("%Y%m%d") + "-" + best_name.replace(" ", "").lower()[:12]
+        model_info = {
+            "best_model": best_name,
+            "model_version": model_version,
+            "test_mae": float(best_model_info["test_mae"]),
+            "test_rmse": float(best_model_info["test_rmse"]),
+            "test_r2": float(best_model_info["test_r2"]),
+            "hyperparameters": best_model_info["params"],
+            "feature_names": feature_names,
+            "search": {k: v for k, v in search_summary.items() if k != "data_key"},
+            # Vattenmärke för inkrementella uppdateringar (update_model.py): alla
+            # rader modellen sett och testraderna som hålls utanför träningen
+            "watermark": {
+                "seen_rows": int(len(np.unique(row_keys))),
+                "holdout_rows": int(len(np.unique(keys_test))),
+                "train_rows": int(len(X_train)),
+                "outlier_threshold": float(outlier_threshold),
+                "trained_at": datetime.now().isoformat(),
+            },
+            # Tid per steg fram till sparningen (se profiling.StageProfiler)
+            "headless": headless,
+            "stages": list(profiler.stages),
+        }
+        np.save(output_dir / SEEN_ROWS_FILE, np.unique(row_keys))
+        np.save(output_dir / HOLDOUT_ROWS_FILE, np.unique(keys_test))
+
+        # Kompakt serveringsformat (tree_ensemble.py), paritetskontrollerat på
+        # testraderna. model_version kan upprepas samma dag, så gamla kompakta
+        # filer tas bort innan de ersätts.
+        from tree_ensemble import COMPACT_MODEL_FILE, SERVING_MODEL_FILE, export_to_file
+
+        for name in (COMPACT_MODEL_FILE, SERVING_MODEL_FILE):
+            (output_dir / name).unlink(missing_ok=True)
+        try:
+            model_info["compact_model"] = export_to_file(
+                best_model, scaler, feature_names, model_version, X_test_scaled, output_dir
+            )
+            print(
+                f"  Kompakt modell sparad: {model_info['compact_model']['nodes']} noder, "
+                f"max |diff| {model_info['compact_model']['parity_max_abs_diff']:.2g} m"
+            )
+        except ValueError as e:
+            print(f"  Kompakt modell exporterades inte: {e}")
+        with open(model_info_path, "w", encoding="utf-8") as f:
+            json.dump(model_info, f, indent=2, ensure_ascii=False)
+        print(f"  Modellinfo sparad till: {model_info_path} (model_version={model_version})")
+
+    # Billigare serveringsvariant inom ML_SERVING_MAE_TOLERANCE (distill.py)
+    if os.environ.get("ML_SERVING_MODEL", "1") != "0" and "compact_model" in model_info:
+        with profiler.stage("distill"):
+            from distill import distill_serving_model
+
+            print("\nDestillerar serveringsmodell...")
+            model_info.update(
+                distill_serving_model(
+                    best_model,
+                    scaler,
+                    feature_names,
+                    model_version,
+                    X_train_scaled,
+                    sw_train,
+                    X_test_scaled,
+                    y_test,
+                    output_dir,
+                )
+            )
+            for variant, v in model_info["variants"].items():
+                print(
+                    f"  {variant:<10} MAE {v['test_mae']:.4f} m, {v['trees']} trad, "
+                    f"{v['features']} features, {v['latency_ms_per_1k']:.1f} ms/1000 positioner, "
+                    f"{v.get('bytes', 0) / 1e6:.2f} MB"
+                )
+            print(f"  Serveras: {model_info['serving']['variant']}")
+        model_info["stages"] = list(profiler.stages)
+        with open(model_info_path, "w", encoding="utf-8") as f:
+            json.dump(model_info, f, indent=2, ensure_ascii=False)
+
+    profiler.stop()
+    print("\nTid per steg:")
+    profiler.report()
 
 
 def visualize_predictions(y_true: np.ndarray, y_pred: np.ndarray, mae: float):
     """
     Visualisera ML-modellens förutsägelser
     """
+    plt = _pyplot()
     fig, axes = plt.subplots(1, 2, figsize=(14, 6))
     fig.suptitle(
         f"ML-modell: Förutsägelser (MAE: {mae:.3f}m)", fontsize=14, fontweight="bold"
@@ -1559,72 +3270,89 @@ def main():
     1. Ladda alla data
     2. Analysera varje spår individuellt
     3. Analysera all data kombinerat
+
+    Med ML_HEADLESS=1 hoppas visualiseringarna över (matplotlib importeras
+    aldrig). Tid per steg skrivs ut sist.
     """
+    from profiling import StageProfiler
+
+    headless = headless_mode()
+    profiler = StageProfiler("analysis")
+
     print("\n" + "=" * 60)
     print("ML-ANALYS: GPS-korrigering")
     print("=" * 60)
 
-    # Steg 1: Ladda data (alla JSON-filer automatiskt)
-    print("\nLaddar alla JSON-filer fran ml/data/...")
-    data = load_annotations()  # None = ladda alla filer
+    with profiler.stage("load"):
+        # Steg 1: Ladda data (alla JSON-filer automatiskt)
+        print("\nLaddar alla JSON-filer fran ml/data/...")
+        input_spans = []
+        data = load_annotations(input_spans=input_spans)  # None = ladda alla filer
 
-    # Steg 2: Analysera varje spår individuellt
-    track_stats = analyze_per_track(data)
-
-    # Steg 3: Grundlaggande statistik (TOTALT - alla spår kombinerat)
-    print("\n" + "=" * 60)
-    print("KOMBINERAD ANALYS (ALLA SPAR)")
-    print("=" * 60)
-    stats = basic_statistics(data)
+    with profiler.stage("analyze"):
+        # Steg 2: Analysera varje spår individuellt
+        track_stats = analyze_per_track(data)
 
-    # Steg 4: Analysera felmonster (TOTALT)
-    patterns = analyze_error_patterns(data)
+        # Steg 3: Grundlaggande statistik (TOTALT - alla spår kombinerat)
+        print("\n" + "=" * 60)
+        print("KOMBINERAD ANALYS (ALLA SPAR)")
+        print("=" * 60)
+        stats = basic_statistics(data)
 
-    # Steg 5: Jämför spår
-    print("\n" + "=" * 60)
-    print("JAMFORELSE MELLAN SPAR")
-    print("=" * 60)
+        # Steg 4: Analysera felmonster (TOTALT)
+        patterns = analyze_error_patterns(data)
 
-    # Sortera spår efter genomsnittligt GPS-fel
-    sorted_tracks = sorted(
-        track_stats.items(), key=lambda x: x[1]["avg_correction"], reverse=True
-    )
+        # Steg 5: Jämför spår
+        print("\n" + "=" * 60)
+        print("JAMFORELSE MELLAN SPAR")
+        print("=" * 60)
 
-    print("\nSpar sorterade efter genomsnittligt GPS-fel (storst forst):")
-    for i, (track_name, stats) in enumerate(sorted_tracks, 1):
-        print(
-            f"  {i}. {track_name}: {stats['avg_correction']:.2f}m (n={stats['count']})"
+        # Sortera spår efter genomsnittligt GPS-fel
+        sorted_tracks = sorted(
+            track_stats.items(), key=lambda x: x[1]["avg_correction"], reverse=True
         )
 
-    print("\n" + "=" * 60)
-    print("ANALYS KLAR!")
-    print("=" * 60)
-    print(f"\nSammanfattning (ALLA SPAR KOMBINERAT):")
-    print(f"  - Totalt antal positioner: {len(data)}")
-    print(f"  - Antal unika spar: {len(track_stats)}")
-    if stats['avg_correction'] is not None:
-        print(f"  - Genomsnittligt GPS-fel: {stats['avg_correction']:.2f} meter")
-    if stats['max_correction'] is not None:
-        print(f"  - Max GPS-fel: {stats['max_correction']:.2f} meter")
-    if patterns["correlation_accuracy_correction"]:
-        print(
-            f"  - Korrelation accuracy/fel: {patterns['correlation_accuracy_correction']:.3f}"
-        )
-    # Steg 6: Visualisera data
-    print("\n" + "=" * 60)
-    print("VISUALISERING")
-    print("=" * 60)
-    visualize_data(data, track_stats)
+        print("\nSpar sorterade efter genomsnittligt GPS-fel (storst forst):")
+        for i, (track_name, stats) in enumerate(sorted_tracks, 1):
+            print(
+                f"  {i}. {track_name}: {stats['avg_correction']:.2f}m (n={stats['count']})"
+            )
 
-    # Steg 7: Beräkna features och träna ML-modell
-    print("\n" + "=" * 60)
-    print("ML-MODELL TRÄNING")
-    print("=" * 60)
-    train_ml_model(data)
+        print("\n" + "=" * 60)
+        print("ANALYS KLAR!")
+        print("=" * 60)
+        print(f"\nSammanfattning (ALLA SPAR KOMBINERAT):")
+        print(f"  - Totalt antal positioner: {len(data)}")
+        print(f"  - Antal unika spar: {len(track_stats)}")
+        if stats['avg_correction'] is not None:
+            print(f"  - Genomsnittligt GPS-fel: {stats['avg_correction']:.2f} meter")
+        if stats['max_correction'] is not None:
+            print(f"  - Max GPS-fel: {stats['max_correction']:.2f} meter")
+        if patterns["correlation_accuracy_correction"]:
+            print(
+                f"  - Korrelation accuracy/fel: {patterns['correlation_accuracy_correction']:.3f}"
+            )
+
+    if not headless:
+        with profiler.stage("plots"):
+            # Steg 6: Visualisera data
+            print("\n" + "=" * 60)
+            print("VISUALISERING")
+            print("=" * 60)
+            visualize_data(data, track_stats)
+
+    with profiler.stage("train"):
+        # Steg 7: Beräkna features och träna ML-modell
+        print("\n" + "=" * 60)
+        print("ML-MODELL TRÄNING")
+        print("=" * 60)
+        train_ml_model(data, input_spans, headless=headless)
 
     print("\n" + "=" * 60)
     print("ALLT KLART!")
     print("=" * 60)
+    profiler.stop()
+    profiler.report()
 
 
 if __name__ == "__main__":
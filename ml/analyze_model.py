@@ -238,7 +238,7 @@ def analyze_per_track_performance(
 
     for track_name, track_data in sorted(tracks_dict.items()):
         # Förbered features för detta spår
-        X, y, _, _ = prepare_features_advanced(track_data)
+        X, y, _, _ = prepare_features_advanced(track_data, report=False)
 
         if len(X) == 0:
             continue
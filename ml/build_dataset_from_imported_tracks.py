@@ -9,27 +9,44 @@ För varje hundposition beräknas:
 
 Kombinerar tid + rum så facit blir mer exakt.
 
-Sparar ml/data/imported_tracks_training.json.
+Varje människaspår läses en gång till sorterade tids-/lat-/lng-arrayer och alla
+hundtider interpoleras i ett vektoriserat anrop. Hundpositionerna läses i
+chunkar via server-side cursor, spårparen bearbetas parallellt i en processpool
+och resultatet skrivs inkrementellt (spår för spår) så att hela korpusen aldrig
+behöver ligga i minnet.
+
+Sparar ml/data/imported_tracks_training.json och samma rader kolumnärt i
+ml/data/columnar/batch=imported_tracks/ (se columnar_dataset.py).
 
 Kör:
   export DATABASE_URL="postgresql://..."
   python ml/build_dataset_from_imported_tracks.py
   # Valfritt: export MAX_DISTANCE_M=200  för att filtrera bort punkter > 200m
+  # Valfritt: export BUILD_WORKERS=4     antal processer (default: antal kärnor, 1 = ingen pool)
 """
 
 import json
 import math
 import os
 import sys
+import uuid
 from datetime import datetime
+from multiprocessing import Pool
 from pathlib import Path
 
+import numpy as np
+
 try:
     import psycopg2
     from psycopg2.extras import RealDictCursor
 except ImportError:
     psycopg2 = None
 
+# Antal hundpositioner per fetchmany från server-side cursorn
+DOG_CHUNK_SIZE = 5000
+# Rader per block som ColumnarWriter håller i minnet innan de spoolas till disk
+COLUMNAR_BLOCK_ROWS = 50000
+
 
 def _parse_ts(ts) -> float:
     """Konvertera timestamp till sekunder sedan epoch."""
@@ -59,9 +76,49 @@ def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     return R * c
 
 
-def human_position_at_time(
-    t_dog: float, human_positions: list
-) -> tuple:
+def human_track_arrays(human_positions: list) -> tuple:
+    """
+    Människaspår -> (t, lat, lng) som numpy-arrayer sorterade på tid.
+    Stabil sortering så att punkter med samma tid behåller sin ordning.
+    """
+    t = np.array([_parse_ts(h.get("timestamp")) for h in human_positions], dtype=np.float64)
+    lat = np.array([float(h["lat"]) for h in human_positions], dtype=np.float64)
+    lng = np.array([float(h["lng"]) for h in human_positions], dtype=np.float64)
+    order = np.argsort(t, kind="stable")
+    return t[order], lat[order], lng[order]
+
+
+def human_positions_at_times(t_dogs: np.ndarray, human: tuple) -> tuple:
+    """
+    Vektoriserad interpolation: (lat, lng) där människan var vid varje t_dog.
+
+    Samma regler som tidigare per punkt: sista människapunkten med t <= t_dog
+    och första med t > t_dog interpoleras linjärt; före första / efter sista
+    används närmaste ändpunkt.
+    """
+    t, lat, lng = human
+    n = len(t)
+    if n == 0:
+        empty = np.full(len(t_dogs), np.nan)
+        return empty, empty.copy()
+
+    # Antal människapunkter med t <= t_dog
+    j = np.searchsorted(t, t_dogs, side="right")
+    before = np.clip(j - 1, 0, n - 1)
+    after = np.clip(j, 0, n - 1)
+
+    t1, t2 = t[before], t[after]
+    span = t2 - t1
+    inside = (j > 0) & (j < n) & (span > 0)
+    alpha = np.zeros(len(t_dogs))
+    np.divide(t_dogs - t1, span, out=alpha, where=inside)
+
+    lat_out = np.where(inside, lat[before] + alpha * (lat[after] - lat[before]), lat[before])
+    lng_out = np.where(inside, lng[before] + alpha * (lng[after] - lng[before]), lng[before])
+    return lat_out, lng_out
+
+
+def human_position_at_time(t_dog: float, human_positions: list) -> tuple:
     """
     Returnerar (lat, lng) där människan var vid tid t_dog.
     Interpolerar mellan två människapunkter om t_dog ligger mellan dem.
@@ -69,29 +126,123 @@ def human_position_at_time(
     """
     if not human_positions:
         return (None, None)
+    lat, lng = human_positions_at_times(
+        np.array([t_dog], dtype=np.float64), human_track_arrays(human_positions)
+    )
+    return (float(lat[0]), float(lng[0]))
+
+
+def _iter_dog_chunks(conn, dog_track_id: int):
+    """Hundpositioner i chunkar via namngiven (server-side) cursor."""
+    cur = conn.cursor(
+        name=f"dog_positions_{uuid.uuid4().hex[:12]}", cursor_factory=RealDictCursor
+    )
+    cur.itersize = DOG_CHUNK_SIZE
+    try:
+        cur.execute(
+            """
+            SELECT position_lat AS lat, position_lng AS lng, timestamp, accuracy
+            FROM track_positions
+            WHERE track_id = %s
+            ORDER BY timestamp
+            """,
+            (dog_track_id,),
+        )
+        while True:
+            rows = cur.fetchmany(DOG_CHUNK_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+
 
-    hp_sorted = sorted(
-        [(h["lat"], h["lng"], _parse_ts(h.get("timestamp"))) for h in human_positions],
-        key=lambda x: x[2],
+def build_pair(conn, dog_track_id: int, dog_name: str, human_track_id: int, max_dist_m) -> tuple:
+    """
+    Träningsrader för ett hund-/människaspårpar.
+
+    Returns: (rader, antal bortfiltrerade pga MAX_DISTANCE_M)
+    """
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(
+        """
+        SELECT position_lat AS lat, position_lng AS lng, timestamp
+        FROM track_positions
+        WHERE track_id = %s
+        ORDER BY timestamp
+        """,
+        (human_track_id,),
     )
+    human_positions = cur.fetchall()
+    cur.close()
+
+    if not human_positions:
+        return [], 0
+    human = human_track_arrays(human_positions)
+    del human_positions
+
+    training = []
+    skipped_far = 0
+    for chunk in _iter_dog_chunks(conn, dog_track_id):
+        t_dogs = np.array([_parse_ts(dp.get("timestamp")) for dp in chunk], dtype=np.float64)
+        lat_h, lng_h = human_positions_at_times(t_dogs, human)
+        for dp, lat_hi, lng_hi in zip(chunk, lat_h.tolist(), lng_h.tolist()):
+            dist_m = haversine_m(dp["lat"], dp["lng"], lat_hi, lng_hi)
+            if max_dist_m is not None and dist_m > max_dist_m:
+                skipped_far += 1
+                continue
+            ts = dp["timestamp"]
+            ts_str = ts.isoformat() if hasattr(ts, "isoformat") else str(ts)
+            training.append({
+                "track_id": dog_track_id,
+                "track_name": dog_name,
+                "track_type": "dog",
+                "timestamp": ts_str,
+                "verified_status": "correct",
+                "original_position": {"lat": float(dp["lat"]), "lng": float(dp["lng"])},
+                "corrected_position": {"lat": float(lat_hi), "lng": float(lng_hi)},
+                "correction_distance_meters": round(dist_m, 4),
+                "accuracy": float(dp["accuracy"]) if dp["accuracy"] is not None else None,
+                "annotation_notes": "",
+                "environment": None,
+                "source": "imported_tracks",
+            })
+    # Avsluta läs-transaktionen (server-side cursors kräver en öppen transaktion)
+    conn.rollback()
+    return training, skipped_far
 
-    t_before = [(lat, lng, t) for lat, lng, t in hp_sorted if t <= t_dog]
-    t_after = [(lat, lng, t) for lat, lng, t in hp_sorted if t > t_dog]
-
-    if t_before and t_after:
-        lat1, lng1, t1 = t_before[-1]
-        lat2, lng2, t2 = t_after[0]
-        if t2 > t1:
-            alpha = (t_dog - t1) / (t2 - t1)
-            lat = lat1 + alpha * (lat2 - lat1)
-            lng = lng1 + alpha * (lng2 - lng1)
-            return (lat, lng)
-        return (lat1, lng1)
-    if t_before:
-        return (t_before[-1][0], t_before[-1][1])
-    if t_after:
-        return (t_after[0][0], t_after[0][1])
-    return (hp_sorted[0][0], hp_sorted[0][1])
+
+# Per process: en anslutning som återanvänds för alla par processen får
+_worker_conn = None
+
+
+def _init_worker(database_url: str):
+    global _worker_conn
+    _worker_conn = psycopg2.connect(database_url, connect_timeout=10)
+
+
+def _build_pair_worker(args: tuple) -> tuple:
+    return build_pair(_worker_conn, *args)
+
+
+class _IncrementalJsonArray:
+    """Skriver en JSON-array post för post (samma format som json.dump(indent=2))."""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.count = 0
+
+    def write(self, item: dict):
+        body = json.dumps(item, ensure_ascii=False, indent=2)
+        body = "\n".join("  " + line for line in body.split("\n"))
+        self.fh.write(("[\n" if self.count == 0 else ",\n") + body)
+        self.count += 1
+
+    def close(self):
+        if self.fh.closed:
+            return
+        self.fh.write("\n]" if self.count else "[]")
+        self.fh.close()
 
 
 def main():
@@ -121,88 +272,85 @@ def main():
         """
     )
     dog_tracks = cur.fetchall()
+    conn.close()
     if not dog_tracks:
         print("Inga importerade hundspår med kopplat människaspår hittades.")
-        conn.close()
         sys.exit(0)
 
     max_dist = os.environ.get("MAX_DISTANCE_M", "")
     max_dist_m = float(max_dist) if max_dist else None
+    workers = int(os.environ.get("BUILD_WORKERS", "") or os.cpu_count() or 1)
+    workers = max(1, min(workers, len(dog_tracks)))
 
-    print(f"Hittade {len(dog_tracks)} importerade hundspår. Bygger träningsdata...")
+    print(f"Hittade {len(dog_tracks)} importerade hundspår. Bygger träningsdata ({workers} process(er))...")
     if max_dist_m:
         print(f"  Filter: endast punkter där avstånd < {max_dist_m} m")
 
-    training = []
+    from columnar_dataset import ColumnarWriter
+
+    pairs = [
+        (row["id"], row["name"], row["human_track_id"], max_dist_m) for row in dog_tracks
+    ]
+    # Skriv till tmp-fil och byt namn sist så att en avbruten körning inte
+    # lämnar en halv JSON-array i ml/data/
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    out = _IncrementalJsonArray(open(tmp_path, "w", encoding="utf-8"))
+    columnar_root = data_dir / "columnar"
+    writer = ColumnarWriter(
+        "imported_tracks",
+        source_file=out_path.name,
+        block_rows=COLUMNAR_BLOCK_ROWS,
+        spool_dir=columnar_root,
+    )
     skipped_far = 0
-
-    for row in dog_tracks:
-        dog_track_id = row["id"]
-        dog_name = row["name"]
-        human_track_id = row["human_track_id"]
-
-        cur.execute(
-            """
-            SELECT position_lat AS lat, position_lng AS lng, timestamp, accuracy
-            FROM track_positions
-            WHERE track_id = %s
-            ORDER BY timestamp
-            """,
-            (dog_track_id,),
-        )
-        dog_positions = cur.fetchall()
-
-        cur.execute(
-            """
-            SELECT position_lat AS lat, position_lng AS lng, timestamp
-            FROM track_positions
-            WHERE track_id = %s
-            ORDER BY timestamp
-            """,
-            (human_track_id,),
-        )
-        human_positions = cur.fetchall()
-
-        if not human_positions:
-            continue
-
-        for dp in dog_positions:
-            t_dog = _parse_ts(dp.get("timestamp"))
-            lat_h, lng_h = human_position_at_time(t_dog, human_positions)
-            if lat_h is None or lng_h is None:
-                continue
-            dist_m = haversine_m(dp["lat"], dp["lng"], lat_h, lng_h)
-            if max_dist_m is not None and dist_m > max_dist_m:
-                skipped_far += 1
-                continue
-            ts = dp["timestamp"]
-            ts_str = ts.isoformat() if hasattr(ts, "isoformat") else str(ts)
-            training.append({
-                "track_id": dog_track_id,
-                "track_name": dog_name,
-                "track_type": "dog",
-                "timestamp": ts_str,
-                "verified_status": "correct",
-                "original_position": {"lat": float(dp["lat"]), "lng": float(dp["lng"])},
-                "corrected_position": {"lat": float(lat_h), "lng": float(lng_h)},
-                "correction_distance_meters": round(dist_m, 4),
-                "accuracy": float(dp["accuracy"]) if dp["accuracy"] is not None else None,
-                "annotation_notes": "",
-                "environment": None,
-                "source": "imported_tracks",
-            })
-
-    conn.close()
-
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(training, f, ensure_ascii=False, indent=2)
-
-    print(f"Sparat {len(training)} positioner till {out_path}")
+    dist_sum = 0.0
+    dist_max = 0.0
+
+    pool = None
+    completed = False
+    try:
+        if workers > 1:
+            pool = Pool(workers, initializer=_init_worker, initargs=(database_url,))
+            # imap behåller spårordningen (samma ordning i filen som tidigare)
+            results = pool.imap(_build_pair_worker, pairs)
+        else:
+            _init_worker(database_url)
+            results = (_build_pair_worker(p) for p in pairs)
+
+        for done, (rows, skipped) in enumerate(results, start=1):
+            skipped_far += skipped
+            for item in rows:
+                out.write(item)
+                writer.append(item)
+                dist = item["correction_distance_meters"]
+                dist_sum += dist
+                dist_max = max(dist_max, dist)
+            print(f"  [{done}/{len(pairs)}] {len(rows)} positioner (totalt {out.count})", flush=True)
+        out.close()
+        os.replace(tmp_path, out_path)
+        partition = writer.write(columnar_root)
+        completed = True
+    finally:
+        if pool is not None:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+        elif _worker_conn is not None:
+            _worker_conn.close()
+        if not completed:
+            # Avbruten körning: släng halvfärdig tmp-fil och spoolade block
+            out.close()
+            tmp_path.unlink(missing_ok=True)
+            writer.discard()
+
+    print(f"Sparat {out.count} positioner till {out_path}")
+    print(f"  Kolumnärt: {partition}")
     if skipped_far > 0:
         print(f"  Hoppade över {skipped_far} punkter med avstånd > {max_dist_m} m")
-    if training:
-        dists = [d["correction_distance_meters"] for d in training]
-        print(f"  correction_distance: snitt {sum(dists)/len(dists):.1f} m, max {max(dists):.1f} m")
+    if out.count:
+        print(f"  correction_distance: snitt {dist_sum/out.count:.1f} m, max {dist_max:.1f} m")
     print("Klar. Träna sedan: python ml/analysis.py")
 
 
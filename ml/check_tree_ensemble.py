@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Paritetskontroll för det kompakta trädformatet (tree_ensemble.py).
+
+Tränar små modeller av varje typ som träningen kan välja (Random Forest,
+Extra Trees, Gradient Boosting och XGBoost om det är installerat) på
+syntetiska data, exporterar dem med export_to_file till en temporär katalog,
+laddar filen igen och kräver att check_parity håller PARITY_TOLERANCE mot
+originalmodellen – även med beskuret feature-set (columns, som distill.py
+använder) och med NaN i indata.
+
+Med --saved kontrolleras istället den publicerade modellen i ml/output/ mot
+den sparade kompakta filen, på ett urval av träningsraderna.
+
+Kör:
+  python ml/check_tree_ensemble.py
+  python ml/check_tree_ensemble.py --saved
+"""
+
+import argparse
+import json
+import pickle
+import sys
+import tempfile
+from importlib.util import find_spec
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from tree_ensemble import (  # noqa: E402
+    COMPACT_MODEL_FILE,
+    OUTPUT_DIR,
+    PARITY_TOLERANCE,
+    TreeEnsemble,
+    check_parity,
+    export_to_file,
+)
+
+N_ROWS = 2000
+N_FEATURES = 12
+
+
+def _synthetic(seed: int = 0):
+    """Features i olika skalor (som GPS-features) och ett icke-linjärt mål."""
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(N_ROWS, N_FEATURES)) * rng.uniform(0.1, 100.0, N_FEATURES)
+    y = np.abs(X[:, 0]) * 0.05 + np.where(X[:, 1] > 0, X[:, 2] * 0.01, 3.0) + rng.normal(0, 0.5, N_ROWS)
+    return X, y
+
+
+def _models():
+    from sklearn.ensemble import ExtraTreesRegressor, GradientBoostingRegressor, RandomForestRegressor
+
+    models = [
+        ("Random Forest", RandomForestRegressor(n_estimators=20, max_depth=8, random_state=0)),
+        ("Extra Trees", ExtraTreesRegressor(n_estimators=20, max_depth=8, random_state=0)),
+        ("Gradient Boosting", GradientBoostingRegressor(n_estimators=30, max_depth=4, random_state=0)),
+    ]
+    if find_spec("xgboost") is not None:
+        from xgboost import XGBRegressor
+
+        models.append(("XGBoost", XGBRegressor(n_estimators=30, max_depth=5, random_state=0)))
+    else:
+        print("  XGBoost saknas – hoppas över")
+    return models
+
+
+def _check(name: str, model, scaler, X_scaled: np.ndarray, out_dir: Path, columns=None) -> float:
+    feature_names = [f"f{i}" for i in range(X_scaled.shape[1])]
+    summary = export_to_file(
+        model, scaler, feature_names, "parity-check", X_scaled, out_dir, columns=columns
+    )
+    ensemble = TreeEnsemble.load(out_dir / summary["file"])
+    # Kontrollera den inlästa filen, inte bara objektet som exporterades
+    diff = check_parity(model, ensemble, X_scaled, columns)
+    tolerance = PARITY_TOLERANCE[ensemble.kind]
+    assert diff <= tolerance, f"{name}: {diff:.3g} > {tolerance}"
+    # Scalern i filen ska skala som originalet
+    raw = scaler.inverse_transform(np.nan_to_num(X_scaled[:100]))
+    assert np.allclose(ensemble.scaler.transform(raw), scaler.transform(raw)), f"{name}: scaler avviker"
+    print(f"  OK {name:<28} {ensemble.n_trees:>4} trad  max |diff| {diff:.3g} (tolerans {tolerance:g})")
+    return diff
+
+
+def check_synthetic() -> None:
+    from sklearn.preprocessing import RobustScaler
+
+    X, y = _synthetic()
+    scaler = RobustScaler().fit(X)
+    X_scaled = scaler.transform(X)
+    columns = list(range(0, N_FEATURES, 2))
+    X_nan = X_scaled.copy()
+    X_nan[::7, 1] = np.nan
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out_dir = Path(tmp)
+        for name, model in _models():
+            model.fit(X_scaled, y)
+            _check(name, model, scaler, X_scaled, out_dir)
+            if _handles_nan(model):
+                _check(f"{name} (NaN)", model, scaler, X_nan, out_dir)
+
+            pruned = type(model)(**model.get_params()).fit(X_scaled[:, columns], y)
+            _check(f"{name} (columns)", pruned, scaler, X_scaled, out_dir, columns=columns)
+
+
+def _handles_nan(model) -> bool:
+    """XGBoost tar alltid NaN; sklearn-ensembler först i nyare versioner."""
+    try:
+        model.predict(np.full((1, model.n_features_in_), np.nan))
+        return True
+    except ValueError:
+        return False
+
+
+def check_saved() -> None:
+    """Publicerad modell mot sparad kompakt fil, på upp till 5000 träningsrader."""
+    from analysis import load_training_features
+
+    with open(OUTPUT_DIR / "gps_correction_model_best.pkl", "rb") as f:
+        model = pickle.load(f)
+    with open(OUTPUT_DIR / "gps_correction_scaler.pkl", "rb") as f:
+        scaler = pickle.load(f)
+    with open(OUTPUT_DIR / "gps_correction_model_info.json", "r", encoding="utf-8") as f:
+        info = json.load(f)
+    path = OUTPUT_DIR / COMPACT_MODEL_FILE
+    if not path.exists():
+        raise SystemExit(f"{path} saknas – kör python ml/tree_ensemble.py forst")
+    ensemble = TreeEnsemble.load(path)
+    if ensemble.model_version != info.get("model_version"):
+        raise SystemExit(
+            f"{path.name} ({ensemble.model_version}) matchar inte modellinfo ({info.get('model_version')})"
+        )
+
+    X, _, _, _ = load_training_features()
+    rows = np.sort(np.random.default_rng(0).permutation(len(X))[:5000])
+    X_check = scaler.transform(np.asarray(X)[rows])
+    diff = check_parity(model, ensemble, X_check)
+    print(
+        f"  OK {ensemble.model_version}: {ensemble.kind}, {ensemble.n_trees} trad, "
+        f"max |diff| {diff:.3g} over {len(X_check)} rader (tolerans {PARITY_TOLERANCE[ensemble.kind]:g})"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--saved", action="store_true", help="kontrollera publicerad modell i ml/output/"
+    )
+    args = parser.parse_args()
+    if args.saved:
+        print("Paritet: publicerad modell mot kompakt fil")
+        check_saved()
+    else:
+        print("Paritet: syntetiska modeller mot kompakt format")
+        check_synthetic()
+    print("Klar.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,587 @@
+"""
+Kolumnärt dataset-format for ML-traning.
+
+JSON-exporterna i ml/data/ maste parsas i sin helhet vid varje traning och
+hamnar i minnet som Python-dicts. Har lagras samma rader som typade kolumner,
+en .npy-fil per kolumn, partitionerat per exportbatch:
+
+    ml/data/columnar/batch=<export_batch_id>/
+        _schema.json          schema_version, antal rader, kategorier, kallfil
+        original_lat.npy      float64
+        accuracy.npy          float32
+        track_type.npy        int32-koder (kategorier i _schema.json)
+        timestamp.npy         fast bredd unicode
+        ...
+
+.npy-filer kan minnesmappas (np.load(mmap_mode="r")) och bara de kolumner
+som behovs laddas. Formatet kraver bara numpy (inget pyarrow).
+
+Koordinater lagras som float64: float32 ger ~0.5 m kvantisering pa vara
+latituder, vilket ar samma storleksordning som korrigeringarna.
+Saknade varden: NaN (flyttal), -1 (heltal och kategorikoder), "" (strangar).
+
+Anvands av:
+- backend (export-feedback, annotations-export med format=columnar)
+- build_dataset_from_imported_tracks.py
+- analysis.load_annotation_columns -> prepare_features_columnar (traning)
+- analysis.load_annotations (analys/statistik, som List[Dict])
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+SCHEMA_VERSION = 1
+
+DEFAULT_ROOT = Path(__file__).parent / "data" / "columnar"
+SCHEMA_FILE = "_schema.json"
+PARTITION_PREFIX = "batch="
+ARCHIVE_SUFFIX = ".columnar.zip"
+
+INT_NULL = -1
+# Markeringskolumn for heltal i en flyttalskolumn (endast i minnet, se columns_from_rows)
+INT_FLAG_SUFFIX = ":int"
+
+# Kolumnnamn -> typ. Nastlade positioner plattas ut till <namn>_lat/_lng.
+COLUMNS: Dict[str, str] = {
+    "id": "int64",
+    "track_id": "int64",
+    "human_track_id": "int64",
+    "track_name": "category",
+    "track_type": "category",
+    "verified_status": "category",
+    "environment": "category",
+    "source": "category",
+    "label_type": "category",
+    "data_lineage": "category",
+    "timestamp": "string",
+    "original_lat": "float64",
+    "original_lng": "float64",
+    "corrected_lat": "float64",
+    "corrected_lng": "float64",
+    "predicted_lat": "float64",
+    "predicted_lng": "float64",
+    "correction_distance_meters": "float32",
+    "accuracy": "float32",
+    "training_weight_suggested": "float32",
+}
+
+# Kolumner som traningen (analysis.prepare_features_columnar) laser:
+TRAINING_COLUMNS = (
+    # gruppering per spar och ordning inom sparet
+    "track_id",
+    "track_name",
+    "timestamp",
+    # vilka rader som blir traningsrader och deras target/vikt
+    "verified_status",
+    "original_lat",
+    "original_lng",
+    "corrected_lat",
+    "corrected_lng",
+    "predicted_lat",
+    "predicted_lng",
+    "correction_distance_meters",
+    "training_weight_suggested",
+    # features
+    "accuracy",
+    "track_type",
+    "human_track_id",
+    "environment",
+    "source",
+    "label_type",
+    "data_lineage",
+    # radnyckel (analysis._row_key)
+    "id",
+)
+
+# Nastlade positionsfalt i exportraderna -> kolumnprefix
+_POSITION_FIELDS = {
+    "original_position": "original",
+    "corrected_position": "corrected",
+    "predicted_corrected_position": "predicted",
+}
+
+_ARRAY_TYPECODES = {"int64": "q", "float64": "d", "float32": "f"}
+
+
+def _float_or_nan(value) -> float:
+    if value is None:
+        return float("nan")
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def _int_or_null(value) -> int:
+    if value is None or value == "":
+        return INT_NULL
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return INT_NULL
+
+
+def partition_name(batch_id: str) -> str:
+    return f"{PARTITION_PREFIX}{batch_id}"
+
+
+class ColumnarWriter:
+    """
+    Samlar exportrader (samma dicts som JSON-exporten) kolumnvis och skriver
+    en partition. Numeriska kolumner halls i array.array – ca 8 byte per
+    varde i stallet for ett Python-objekt per falt.
+
+    Med block_rows skrivs kolumnerna till spool-filer (i spool_dir, default
+    systemets tmp) var block_rows:e rad, sa att minnet begransas av blocket
+    och inte av hela datasetet; write() bygger .npy-filerna block for block.
+    discard() tar bort spool-filerna om partitionen aldrig skrivs.
+    """
+
+    def __init__(
+        self,
+        batch_id: str,
+        source_file: Optional[str] = None,
+        block_rows: Optional[int] = None,
+        spool_dir: Optional[Path] = None,
+    ):
+        self.batch_id = str(batch_id)
+        self.source_file = source_file
+        self.block_rows = block_rows
+        self.spool_dir = spool_dir
+        self._spool: Optional[Path] = None
+        self._spooled = 0
+        # Langsta strangen per strangkolumn (bredden pa U-dtypen)
+        self._str_width: Dict[str, int] = {}
+        self._n = 0
+        self._numeric = {
+            name: array(_ARRAY_TYPECODES[kind])
+            for name, kind in COLUMNS.items()
+            if kind in _ARRAY_TYPECODES
+        }
+        self._codes = {
+            name: array("i") for name, kind in COLUMNS.items() if kind == "category"
+        }
+        self._categories: Dict[str, Dict[str, int]] = {name: {} for name in self._codes}
+        self._strings = {
+            name: [] for name, kind in COLUMNS.items() if kind == "string"
+        }
+
+    def __len__(self) -> int:
+        return self._n
+
+    def append(self, item: Dict) -> None:
+        flat = dict(item)
+        for field, prefix in _POSITION_FIELDS.items():
+            pos = item.get(field) or {}
+            flat[f"{prefix}_lat"] = pos.get("lat")
+            flat[f"{prefix}_lng"] = pos.get("lng")
+
+        for name, values in self._numeric.items():
+            if COLUMNS[name] == "int64":
+                values.append(_int_or_null(flat.get(name)))
+            else:
+                values.append(_float_or_nan(flat.get(name)))
+        for name, codes in self._codes.items():
+            value = flat.get(name)
+            if value is None:
+                codes.append(INT_NULL)
+                continue
+            cats = self._categories[name]
+            code = cats.get(value)
+            if code is None:
+                code = cats[value] = len(cats)
+            codes.append(code)
+        for name, values in self._strings.items():
+            value = flat.get(name)
+            values.append("" if value is None else str(value))
+        self._n += 1
+        if self.block_rows and self._n - self._spooled >= self.block_rows:
+            self._flush_block()
+
+    def extend(self, items: Iterable[Dict]) -> None:
+        for item in items:
+            self.append(item)
+
+    def discard(self) -> None:
+        """Ta bort spool-filerna (partitionen skrivs inte)."""
+        if self._spool is not None:
+            shutil.rmtree(self._spool, ignore_errors=True)
+            self._spool = None
+
+    def _flush_block(self) -> None:
+        """Flytta raderna i minnet till spool-filerna."""
+        if self._spool is None:
+            if self.spool_dir is not None:
+                Path(self.spool_dir).mkdir(parents=True, exist_ok=True)
+            self._spool = Path(
+                tempfile.mkdtemp(prefix=f".spool-{self.batch_id}-", dir=self.spool_dir)
+            )
+        for name, values in list(self._numeric.items()) + list(self._codes.items()):
+            with open(self._spool / f"{name}.bin", "ab") as f:
+                values.tofile(f)
+            del values[:]
+        for name, values in self._strings.items():
+            with open(self._spool / f"{name}.jsonl", "a", encoding="utf-8") as f:
+                for value in values:
+                    f.write(json.dumps(value, ensure_ascii=False) + "\n")
+            self._str_width[name] = max(
+                self._str_width.get(name, 1), max((len(v) for v in values), default=1)
+            )
+            values.clear()
+        self._spooled = self._n
+
+    def _dtype(self, name: str) -> np.dtype:
+        kind = COLUMNS[name]
+        if kind == "category":
+            return np.dtype(np.int32)
+        if kind == "string":
+            width = max(
+                self._str_width.get(name, 1),
+                max((len(v) for v in self._strings[name]), default=1),
+            )
+            return np.dtype(f"U{width}")
+        return np.dtype(kind)
+
+    def _blocks(self, name: str) -> Iterator[np.ndarray]:
+        """Kolumnen i block: spoolade block forst, sedan raderna i minnet."""
+        dtype = self._dtype(name)
+        if self._spool is not None and self._spooled:
+            block = self.block_rows or self._spooled
+            if name in self._strings:
+                with open(self._spool / f"{name}.jsonl", "r", encoding="utf-8") as f:
+                    buf: List[str] = []
+                    for line in f:
+                        buf.append(json.loads(line))
+                        if len(buf) >= block:
+                            yield np.array(buf, dtype=dtype)
+                            buf = []
+                    if buf:
+                        yield np.array(buf, dtype=dtype)
+            else:
+                with open(self._spool / f"{name}.bin", "rb") as f:
+                    while True:
+                        arr = np.fromfile(f, dtype=dtype, count=block)
+                        if not len(arr):
+                            break
+                        yield arr
+        tail = self._numeric.get(name, self._codes.get(name))
+        if tail is None:
+            tail = self._strings[name]
+        if len(tail):
+            yield np.array(tail, dtype=dtype)
+
+    def _arrays(self) -> Dict[str, np.ndarray]:
+        out = {}
+        for name in COLUMNS:
+            blocks = list(self._blocks(name))
+            out[name] = np.concatenate(blocks) if blocks else np.zeros(0, self._dtype(name))
+        return out
+
+    def _save_column(self, path: Path, name: str) -> None:
+        """Skriv kolumnen som .npy block for block (utan att hela kolumnen ligger i minnet)."""
+        if self._n == 0:
+            np.save(path, np.zeros(0, self._dtype(name)), allow_pickle=False)
+            return
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=self._dtype(name), shape=(self._n,))
+        pos = 0
+        for block in self._blocks(name):
+            out[pos : pos + len(block)] = block
+            pos += len(block)
+        out.flush()
+        del out
+
+    def _schema(self) -> Dict:
+        return {
+            "schema_version": SCHEMA_VERSION,
+            "batch_id": self.batch_id,
+            "source_file": self.source_file,
+            "rows": self._n,
+            "columns": COLUMNS,
+            "categories": {
+                name: list(cats) for name, cats in self._categories.items()
+            },
+        }
+
+    def write(self, root: Optional[Path] = None) -> Path:
+        """
+        Skriv partitionen under root (default ml/data/columnar). En befintlig
+        partition med samma batch_id ersatts; skrivningen gors i en tmp-katalog
+        som byter namn sist sa att lasare aldrig ser en halvskriven partition.
+        """
+        root = Path(root) if root else DEFAULT_ROOT
+        root.mkdir(parents=True, exist_ok=True)
+        final = root / partition_name(self.batch_id)
+        tmp = root / f".{final.name}.tmp{os.getpid()}"
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.mkdir()
+        try:
+            for name in COLUMNS:
+                self._save_column(tmp / f"{name}.npy", name)
+            with open(tmp / SCHEMA_FILE, "w", encoding="utf-8") as f:
+                json.dump(self._schema(), f, ensure_ascii=False, indent=2)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        if final.exists():
+            shutil.rmtree(final)
+        os.replace(tmp, final)
+        self.discard()
+        return final
+
+    def write_zip(self, fh) -> None:
+        """
+        Skriv partitionen som okomprimerat zip-arkiv (for nedladdning).
+        Lagg filen i ml/data/columnar/ – den packas upp vid nasta laddning.
+        """
+        prefix = partition_name(self.batch_id)
+        with zipfile.ZipFile(fh, "w", compression=zipfile.ZIP_STORED) as zf:
+            for name, arr in self._arrays().items():
+                with zf.open(f"{prefix}/{name}.npy", "w") as member:
+                    np.save(member, arr, allow_pickle=False)
+            zf.writestr(
+                f"{prefix}/{SCHEMA_FILE}",
+                json.dumps(self._schema(), ensure_ascii=False, indent=2),
+            )
+
+
+def unpack_archives(root: Optional[Path] = None) -> List[Path]:
+    """Packa upp nedladdade *.columnar.zip i root till partitioner (en gang)."""
+    root = Path(root) if root else DEFAULT_ROOT
+    if not root.exists():
+        return []
+    unpacked = []
+    for archive in sorted(root.glob(f"*{ARCHIVE_SUFFIX}")):
+        with zipfile.ZipFile(archive) as zf:
+            names = [n for n in zf.namelist() if n.startswith(PARTITION_PREFIX)]
+            partitions = {n.split("/", 1)[0] for n in names}
+            if partitions and all((root / p / SCHEMA_FILE).exists() for p in partitions):
+                continue
+            for name in names:
+                if ".." in Path(name).parts:
+                    continue
+                zf.extract(name, root)
+            unpacked.extend(root / p for p in sorted(partitions))
+    return unpacked
+
+
+def list_partitions(root: Optional[Path] = None) -> List[Path]:
+    root = Path(root) if root else DEFAULT_ROOT
+    if not root.exists():
+        return []
+    unpack_archives(root)
+    return sorted(
+        p
+        for p in root.glob(f"{PARTITION_PREFIX}*")
+        if p.is_dir() and (p / SCHEMA_FILE).exists()
+    )
+
+
+def read_schema(partition: Path) -> Dict:
+    with open(Path(partition) / SCHEMA_FILE, "r", encoding="utf-8") as f:
+        schema = json.load(f)
+    if schema.get("schema_version") != SCHEMA_VERSION:
+        raise ValueError(
+            f"{partition}: schema_version {schema.get('schema_version')} stods inte "
+            f"(forvantat {SCHEMA_VERSION})"
+        )
+    return schema
+
+
+def covered_source_files(root: Optional[Path] = None) -> set:
+    """Namn pa JSON-exporter som redan finns som kolumnar partition."""
+    files = set()
+    for partition in list_partitions(root):
+        source = read_schema(partition).get("source_file")
+        if source:
+            files.add(source)
+    return files
+
+
+def _decode_categories(codes: np.ndarray, categories: Sequence[str]) -> np.ndarray:
+    # Sista elementet ar None sa att kod -1 avkodas till None
+    lookup = np.array(list(categories) + [None], dtype=object)
+    return lookup[np.asarray(codes, dtype=np.int64)]
+
+
+def load_partition(
+    partition: Path,
+    columns: Optional[Sequence[str]] = None,
+    mmap: bool = True,
+) -> Dict[str, np.ndarray]:
+    """
+    Ladda valda kolumner fran en partition. Numeriska kolumner minnesmappas
+    (mmap=True); kategorikolumner avkodas till object-arrayer med strangar/None.
+    """
+    partition = Path(partition)
+    schema = read_schema(partition)
+    wanted = list(columns) if columns else list(schema["columns"])
+    out = {}
+    for name in wanted:
+        kind = schema["columns"].get(name)
+        if kind is None:
+            continue
+        arr = np.load(
+            partition / f"{name}.npy",
+            mmap_mode="r" if mmap else None,
+            allow_pickle=False,
+        )
+        if kind == "category":
+            arr = _decode_categories(arr, schema["categories"].get(name, []))
+        out[name] = arr
+    return out
+
+
+def load_columns(
+    root: Optional[Path] = None,
+    columns: Optional[Sequence[str]] = None,
+    batches: Optional[Sequence[str]] = None,
+    mmap: bool = True,
+) -> Dict[str, np.ndarray]:
+    """
+    Ladda valda kolumner fran alla partitioner (eller bara angivna batches)
+    och konkatenera. En enda partition returneras utan kopiering.
+    """
+    partitions = list_partitions(root)
+    if batches is not None:
+        wanted = {partition_name(b) for b in batches}
+        partitions = [p for p in partitions if p.name in wanted]
+    return concat_columns([load_partition(p, columns, mmap=mmap) for p in partitions])
+
+
+def python_values(cols: Dict[str, np.ndarray], name: str, rows=None) -> list:
+    """
+    Kolumnen som Python-varden (valfritt bara raderna rows), None dar varde
+    saknas. Heltal i flyttalskolumner (markerade av columns_from_rows) blir int.
+    """
+    arr = cols[name] if rows is None else cols[name][rows]
+    kind = COLUMNS.get(name)
+    if kind in ("float64", "float32"):
+        values = [None if v != v else v for v in np.asarray(arr, dtype=np.float64).tolist()]
+        flags = cols.get(name + INT_FLAG_SUFFIX)
+        if flags is not None:
+            flags = flags if rows is None else flags[rows]
+            for i in np.nonzero(flags)[0].tolist():
+                values[i] = int(values[i])
+        return values
+    if kind == "int64":
+        return [None if v == INT_NULL else v for v in np.asarray(arr).tolist()]
+    if kind == "string":
+        return np.asarray(arr).tolist()
+    return list(arr)
+
+
+def rows_from_columns(cols: Dict[str, np.ndarray]) -> List[Dict]:
+    """
+    Bygg exportrader (samma nycklar som JSON-exporten) fran kolumner sa att
+    befintlig kod som arbetar pa List[Dict] kan anvanda kolumnar data.
+    Saknade varden utelamnas eller blir None som i JSON-filerna.
+    """
+    if not cols:
+        return []
+    n = len(next(iter(cols.values())))
+    plain = {
+        name: python_values(cols, name) for name in cols if not name.endswith(INT_FLAG_SUFFIX)
+    }
+
+    rows = []
+    for i in range(n):
+        row = {}
+        for name, values in plain.items():
+            if name.endswith("_lat") or name.endswith("_lng"):
+                continue
+            row[name] = values[i]
+        for field, prefix in _POSITION_FIELDS.items():
+            lat = plain.get(f"{prefix}_lat")
+            lng = plain.get(f"{prefix}_lng")
+            if lat is None or lng is None:
+                continue
+            if lat[i] is None or lng[i] is None:
+                row[field] = None
+            else:
+                row[field] = {"lat": lat[i], "lng": lng[i]}
+        rows.append(row)
+    return rows
+
+
+def columns_from_rows(
+    rows: Iterable[Dict], columns: Optional[Sequence[str]] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Exportrader (t.ex. en JSON-fil som inte ar konverterad) som kolumner i
+    minnet, utan forlust: flyttal hålls som float64 och heltal i
+    flyttalskolumner markeras i <namn>:int, sa att python_values och
+    rows_from_columns ger tillbaka samma varden som i raderna.
+    """
+    names = list(columns or COLUMNS)
+    values: Dict[str, list] = {name: [] for name in names}
+    for item in rows:
+        flat = dict(item)
+        for field, prefix in _POSITION_FIELDS.items():
+            pos = item.get(field) or {}
+            flat[f"{prefix}_lat"] = pos.get("lat")
+            flat[f"{prefix}_lng"] = pos.get("lng")
+        for name in names:
+            values[name].append(flat.get(name))
+
+    out: Dict[str, np.ndarray] = {}
+    for name in names:
+        kind = COLUMNS[name]
+        vals = values[name]
+        if kind in ("float64", "float32"):
+            out[name] = np.array([_float_or_nan(v) for v in vals], dtype=np.float64)
+            flags = np.array(
+                [isinstance(v, int) and not isinstance(v, bool) for v in vals], dtype=bool
+            )
+            if flags.any():
+                out[name + INT_FLAG_SUFFIX] = flags
+        elif kind == "int64":
+            out[name] = np.array([_int_or_null(v) for v in vals], dtype=np.int64)
+        elif kind == "string":
+            strings = ["" if v is None else str(v) for v in vals]
+            out[name] = np.array(strings, dtype=np.str_) if strings else np.zeros(0, "U1")
+        else:
+            arr = np.empty(len(vals), dtype=object)
+            arr[:] = vals
+            out[name] = arr
+    return out
+
+
+def concat_columns(parts: Sequence[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    """Konkatenera kolumner fran flera kallor. En enda kalla returneras utan kopiering."""
+    parts = [p for p in parts if p]
+    if not parts:
+        return {}
+    if len(parts) == 1:
+        return parts[0]
+    names = [n for n in parts[0] if all(n in p for p in parts) and not n.endswith(INT_FLAG_SUFFIX)]
+    out = {name: np.concatenate([p[name] for p in parts]) for name in names}
+    # Heltalsmarkeringar finns bara for kallor som har heltal; ovriga far False
+    for flag in {n for p in parts for n in p if n.endswith(INT_FLAG_SUFFIX)}:
+        if flag[: -len(INT_FLAG_SUFFIX)] in out:
+            out[flag] = np.concatenate(
+                [p.get(flag, np.zeros(len(next(iter(p.values()))), dtype=bool)) for p in parts]
+            )
+    return out
+
+
+def load_rows(
+    root: Optional[Path] = None,
+    columns: Optional[Sequence[str]] = None,
+    batches: Optional[Sequence[str]] = None,
+) -> List[Dict]:
+    """
+    Kolumnar data som List[Dict] (endast de kolumner som anges, default alla).
+    For analys och statistik; traningen laser kolumnerna direkt.
+    """
+    return rows_from_columns(load_columns(root, columns, batches))
@@ -0,0 +1,215 @@
+"""
+Destillerad serveringsmodell med en noggrannhetsbudget.
+
+train_ml_model väljer bästa modellen enbart på test-MAE. Här tränas billigare
+elever av samma modelltyp på lärarens (bästa modellens) förutsägelser:
+
+- färre träd (10, 25, 50 % av lärarens)
+- grundare träd
+- beskuret feature-set: features med importance >= 0.01 (samma gräns som
+  analyze_model.py föreslår att ta bort under) resp. 99 % av summerad importance
+
+Kandidaterna prövas i ordning efter uppskattad kostnad (träd x djup, sedan
+antal features) och den första vars test-MAE mot de riktiga målen ligger inom
+ML_SERVING_MAE_TOLERANCE (relativt, default 5 %) av lärarens blir
+serveringsvariant, dvs. den billigaste inom budgeten. Prövningen avbryts efter
+ML_SERVING_BUDGET_S sekunder; hittas ingen serveras bästa modellen.
+
+Varianten sparas i kompakt format (tree_ensemble.SERVING_MODEL_FILE) med
+noderna ompekade till hela feature-vektorn, så backend kan byta modell utan
+att ändra feature-bygget. ML_SERVING_MODEL=0 hoppar över destilleringen.
+"""
+
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+DEFAULT_TOLERANCE = 0.05
+DEFAULT_BUDGET_S = 60.0
+
+TREE_FRACTIONS = (0.1, 0.25, 0.5)
+# analyze_model.generate_improvement_suggestions: importance < 0.01 = låg
+MIN_IMPORTANCE = 0.01
+IMPORTANCE_COVERAGE = 0.99
+
+
+def _feature_sets(importances: Optional[np.ndarray], n_features: int) -> List[np.ndarray]:
+    """Kolumnindex per kandidat, minst först; hela feature-setet sist."""
+    every = np.arange(n_features)
+    if importances is None:
+        return [every]
+    order = np.argsort(importances)[::-1]
+    cumulative = np.cumsum(importances[order]) / max(float(importances.sum()), 1e-12)
+    sets = [
+        np.sort(order[importances[order] >= MIN_IMPORTANCE]),
+        np.sort(order[: int(np.searchsorted(cumulative, IMPORTANCE_COVERAGE)) + 1]),
+        every,
+    ]
+    unique = []
+    for cols in sets:
+        if len(cols) and not any(np.array_equal(cols, u) for u in unique):
+            unique.append(cols)
+    return sorted(unique, key=len)
+
+
+def _candidates(teacher, n_trees: int, depth: int, feature_sets: List[np.ndarray]) -> List[Dict]:
+    boosting = hasattr(teacher, "learning_rate")
+    tree_counts = sorted({max(1, round(n_trees * f)) for f in TREE_FRACTIONS} - {n_trees})
+    if boosting:
+        depths = sorted({max(2, depth - 2), depth})
+    else:
+        depths = sorted({d for d in (8, 12) if d < depth} | {depth})
+    candidates = []
+    for trees in tree_counts:
+        for d in depths:
+            params = {"n_estimators": trees, "max_depth": d}
+            if boosting:
+                # Färre steg: större steglängd så att summan når samma nivå
+                rate = float(teacher.get_params()["learning_rate"] or 0.3)
+                params["learning_rate"] = min(0.3, rate * n_trees / trees)
+            for cols in feature_sets:
+                candidates.append({"params": params, "columns": cols, "cost": trees * d})
+    candidates.sort(key=lambda c: (c["cost"], len(c["columns"])))
+    return candidates
+
+
+def latency_ms_per_1k(predict, X: np.ndarray, repeat: int = 3) -> float:
+    """Bästa tiden av repeat för predict på 1000 rader (upprepade om X är kortare)."""
+    rows = np.resize(np.asarray(X), (1000, X.shape[1]))
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        predict(rows)
+        best = min(best, time.perf_counter() - start)
+    return best * 1e3
+
+
+def distill_serving_model(
+    teacher,
+    scaler,
+    feature_names: List[str],
+    model_version: str,
+    X_train: np.ndarray,
+    sw_train: np.ndarray,
+    X_test: np.ndarray,
+    y_test: np.ndarray,
+    output_dir: Path,
+    tolerance: Optional[float] = None,
+    budget_s: Optional[float] = None,
+) -> Dict:
+    """
+    Välj serveringsvariant och spara den i kompakt format.
+
+    X_train/X_test är skalade och har alla features. Returnerar
+    {"serving": {...}, "variants": {"best": {...}, "distilled": {...}}} för
+    model_info; variants har test-MAE, latens per 1000 positioner (kompakt
+    evaluator) och storlek för båda varianterna.
+    """
+    from sklearn.base import clone
+    from tree_ensemble import (
+        COMPACT_MODEL_FILE,
+        SERVING_MODEL_FILE,
+        TreeEnsemble,
+        export_model,
+        export_to_file,
+    )
+
+    if tolerance is None:
+        tolerance = float(os.environ.get("ML_SERVING_MAE_TOLERANCE", "") or DEFAULT_TOLERANCE)
+    if budget_s is None:
+        budget_s = float(os.environ.get("ML_SERVING_BUDGET_S", "") or DEFAULT_BUDGET_S)
+
+    started = time.perf_counter()
+    teacher_ensemble = export_model(teacher, scaler, feature_names, model_version)
+    teacher_mae = float(np.mean(np.abs(teacher.predict(X_test) - y_test)))
+    variants = {
+        "best": {
+            "test_mae": teacher_mae,
+            "trees": teacher_ensemble.n_trees,
+            "max_depth": teacher_ensemble.max_depth,
+            "features": len(feature_names),
+            "latency_ms_per_1k": latency_ms_per_1k(teacher_ensemble.predict, X_test),
+            "pickle_latency_ms_per_1k": latency_ms_per_1k(teacher.predict, X_test),
+        }
+    }
+    compact_path = Path(output_dir) / COMPACT_MODEL_FILE
+    if compact_path.exists():
+        variants["best"]["bytes"] = compact_path.stat().st_size
+    pickle_path = Path(output_dir) / "gps_correction_model_best.pkl"
+    if pickle_path.exists():
+        variants["best"]["pickle_bytes"] = pickle_path.stat().st_size
+
+    # Eleverna tränas på lärarens förutsägelser (mjuka mål)
+    soft_targets = teacher.predict(X_train)
+    importances = getattr(teacher, "feature_importances_", None)
+    candidates = _candidates(
+        teacher,
+        teacher_ensemble.n_trees,
+        teacher_ensemble.max_depth,
+        _feature_sets(None if importances is None else np.asarray(importances), X_train.shape[1]),
+    )
+    limit = teacher_mae * (1 + tolerance)
+    chosen = None
+    evaluated = 0
+    for candidate in candidates:
+        if time.perf_counter() - started > budget_s:
+            break
+        cols = candidate["columns"]
+        student = clone(teacher).set_params(**candidate["params"])
+        # Antalet träd är kandidatens, utan early stopping från sökningen
+        for name in ("n_iter_no_change", "early_stopping_rounds"):
+            if name in student.get_params():
+                student.set_params(**{name: None})
+        student.fit(X_train[:, cols], soft_targets, sample_weight=sw_train)
+        evaluated += 1
+        mae = float(np.mean(np.abs(student.predict(X_test[:, cols]) - y_test)))
+        print(
+            f"  {candidate['params']['n_estimators']:>4} trad, djup {candidate['params']['max_depth']:>2}, "
+            f"{len(cols):>2} features: MAE {mae:.4f} (grans {limit:.4f})"
+        )
+        if mae <= limit:
+            chosen = (candidate, student, mae)
+            break
+
+    serving = {
+        "tolerance": tolerance,
+        "candidates": len(candidates),
+        "evaluated": evaluated,
+        "seconds": time.perf_counter() - started,
+    }
+    serving_path = Path(output_dir) / SERVING_MODEL_FILE
+    if chosen is None:
+        # Ingen elev inom budgeten: backend serverar bästa modellen
+        if serving_path.exists():
+            serving_path.unlink()
+        serving["variant"] = "best"
+        return {"serving": serving, "variants": variants}
+
+    candidate, student, mae = chosen
+    cols = candidate["columns"]
+    summary = export_to_file(
+        student, scaler, feature_names, model_version, X_test, output_dir,
+        columns=cols, filename=SERVING_MODEL_FILE,
+    )
+    ensemble = TreeEnsemble.load(serving_path)
+    variants["distilled"] = {
+        "test_mae": mae,
+        "trees": ensemble.n_trees,
+        "max_depth": ensemble.max_depth,
+        "features": len(cols),
+        "feature_names": [feature_names[i] for i in cols],
+        "params": dict(candidate["params"]),
+        "latency_ms_per_1k": latency_ms_per_1k(ensemble.predict, X_test),
+        "bytes": summary["bytes"],
+    }
+    if variants["distilled"]["latency_ms_per_1k"] >= variants["best"]["latency_ms_per_1k"]:
+        # Billigare på papperet men inte uppmätt: servera bästa modellen
+        serving_path.unlink()
+        serving["variant"] = "best"
+    else:
+        serving["variant"] = "distilled"
+        serving["file"] = SERVING_MODEL_FILE
+    return {"serving": serving, "variants": variants}
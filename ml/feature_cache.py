@@ -0,0 +1,297 @@
+"""
+Innehallsadresserad cache for feature-matrisen (X, y, sample_weight, feature_names).
+
+Nyckeln ar en hash av indatakallornas innehall (JSON-filer och kolumnara
+partitioner, i laddningsordning) plus feature-schemats version. Samma data och
+samma feature-kod ger samma nyckel, och traningen kan da lasa matrisen direkt
+i stallet for att ladda all JSON och berakna om features:
+
+    ml/output/feature_cache/
+        _digests.json           sha256 per fil, ateranvands sa lange storlek och mtime ar oforandrade
+        <nyckel>/
+            manifest.json       schema-version, indata (namn + sha256), spar, rader
+            X.npy               float64 (rader x features), minnesmappas vid lasning
+            y.npy
+            sample_weight.npy
+            row_keys.npy        uint64 innehållsnyckel per rad (analysis._row_key)
+            feature_names.json
+
+En post kan ocksa byggas fran en aldre post vars indata ar ett prefix av de
+nuvarande (bara nya exportfiler har tillkommit): de nya raderna laggs till sist
+i en kopia av den gamla matrisen. Vilka spar som maste beraknas, och om det
+alls ar sakert, avgors av analysis.load_training_features.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_ROOT = Path(__file__).parent / "output" / "feature_cache"
+DIGEST_FILE = "_digests.json"
+MANIFEST_FILE = "manifest.json"
+
+# Antal poster som behalls (aldst anvanda tas bort forst)
+DEFAULT_KEEP = 3
+
+# Rader per block nar en gammal matris kopieras in i en utokad
+_COPY_BLOCK_ROWS = 65536
+
+
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class _DigestCache:
+    """sha256 per fil, sparad med (storlek, mtime) sa att oforandrade filer inte lases om."""
+
+    def __init__(self, root: Path):
+        self.path = root / DIGEST_FILE
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        self.dirty = False
+
+    def file_digest(self, path: Path) -> str:
+        st = path.stat()
+        key = str(path.resolve())
+        known = self.entries.get(key)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        digest = _file_sha256(path)
+        self.entries[key] = [st.st_size, st.st_mtime_ns, digest]
+        self.dirty = True
+        return digest
+
+    def digest(self, path: Path) -> str:
+        """En fil: dess sha256. En katalog (partition): hash over filnamn + sha256."""
+        path = Path(path)
+        if not path.is_dir():
+            return self.file_digest(path)
+        h = hashlib.sha256()
+        for child in sorted(p for p in path.iterdir() if p.is_file()):
+            h.update(child.name.encode("utf-8"))
+            h.update(self.file_digest(child).encode("ascii"))
+        return h.hexdigest()
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + f".tmp{os.getpid()}")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+def fingerprint_inputs(
+    inputs: Sequence[Tuple[str, Path]], root: Optional[Path] = None
+) -> List[List[str]]:
+    """[(namn, sokvag), ...] -> [[namn, sha256], ...] i samma ordning."""
+    digests = _DigestCache(Path(root) if root else DEFAULT_ROOT)
+    fingerprints = [[name, digests.digest(path)] for name, path in inputs]
+    digests.save()
+    return fingerprints
+
+
+def cache_key(fingerprints: Sequence[Sequence[str]], schema_version: int) -> str:
+    payload = json.dumps(
+        {"schema_version": schema_version, "inputs": [list(fp) for fp in fingerprints]},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class FeatureCache:
+    def __init__(self, root: Optional[Path] = None, keep: Optional[int] = None):
+        self.root = Path(root) if root else DEFAULT_ROOT
+        if keep is None:
+            keep = int(os.environ.get("FEATURE_CACHE_KEEP", "") or DEFAULT_KEEP)
+        self.keep = max(1, keep)
+
+    def _entries(self) -> List[Path]:
+        if not self.root.exists():
+            return []
+        return [
+            p for p in self.root.iterdir()
+            if p.is_dir() and not p.name.startswith(".") and (p / MANIFEST_FILE).exists()
+        ]
+
+    @staticmethod
+    def read_manifest(entry: Path) -> Dict:
+        with open(entry / MANIFEST_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def load(self, key: str) -> Optional[Tuple]:
+        """
+        (X, y, feature_names, sample_weight, manifest) for nyckeln, eller None.
+        Arrayerna ar minnesmappade (skrivskyddade).
+        """
+        entry = self.root / key
+        if not (entry / MANIFEST_FILE).exists():
+            return None
+        try:
+            manifest = self.read_manifest(entry)
+            with open(entry / "feature_names.json", "r", encoding="utf-8") as f:
+                feature_names = json.load(f)
+            X = np.load(entry / "X.npy", mmap_mode="r")
+            y = np.load(entry / "y.npy", mmap_mode="r")
+            sw = np.load(entry / "sample_weight.npy", mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        # mtime = senast anvand (styr vilka poster prune behaller)
+        os.utime(entry / MANIFEST_FILE)
+        return X, y, feature_names, sw, manifest
+
+    def load_row_keys(self, key: str) -> Optional[np.ndarray]:
+        path = self.root / key / "row_keys.npy"
+        if not path.exists():
+            return None
+        return np.load(path, mmap_mode="r")
+
+    def find_prefix(
+        self, fingerprints: Sequence[Sequence[str]], schema_version: int
+    ) -> Optional[Dict]:
+        """
+        Manifestet for den post vars indata ar det langsta akta prefixet av
+        fingerprints (samma namn, innehall och ordning), eller None.
+        """
+        current = [list(fp) for fp in fingerprints]
+        best = None
+        for entry in self._entries():
+            try:
+                manifest = self.read_manifest(entry)
+            except (OSError, ValueError):
+                continue
+            inputs = manifest.get("inputs") or []
+            if manifest.get("schema_version") != schema_version:
+                continue
+            if not 0 < len(inputs) < len(current) or current[: len(inputs)] != inputs:
+                continue
+            if best is None or len(inputs) > len(best["inputs"]):
+                best = manifest
+        return best
+
+    def _write(self, key: str, write_arrays, feature_names: List[str], manifest: Dict) -> Path:
+        self.root.mkdir(parents=True, exist_ok=True)
+        final = self.root / key
+        tmp = self.root / f".{key}.tmp{os.getpid()}"
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.mkdir()
+        write_arrays(tmp)
+        with open(tmp / "feature_names.json", "w", encoding="utf-8") as f:
+            json.dump(list(feature_names), f, ensure_ascii=False)
+        manifest = dict(manifest, key=key, created=time.time())
+        with open(tmp / MANIFEST_FILE, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        if final.exists():
+            shutil.rmtree(final)
+        os.replace(tmp, final)
+        self.prune(protect=key)
+        return final
+
+    def store(
+        self,
+        key: str,
+        X: np.ndarray,
+        y: np.ndarray,
+        feature_names: List[str],
+        sample_weight: np.ndarray,
+        manifest: Dict,
+        row_keys: Optional[np.ndarray] = None,
+    ) -> Path:
+        def write_arrays(tmp: Path):
+            np.save(tmp / "X.npy", np.asarray(X), allow_pickle=False)
+            np.save(tmp / "y.npy", np.asarray(y), allow_pickle=False)
+            np.save(tmp / "sample_weight.npy", np.asarray(sample_weight), allow_pickle=False)
+            if row_keys is not None:
+                np.save(tmp / "row_keys.npy", np.asarray(row_keys, dtype=np.uint64), allow_pickle=False)
+
+        return self._write(key, write_arrays, feature_names, dict(manifest, rows=len(y)))
+
+    def append(
+        self,
+        base_key: str,
+        key: str,
+        X_new: np.ndarray,
+        y_new: np.ndarray,
+        feature_names: List[str],
+        sw_new: np.ndarray,
+        manifest: Dict,
+        row_keys_new: Optional[np.ndarray] = None,
+    ) -> Path:
+        """
+        Ny post = basens rader foljda av de nya. X kopieras blockvis fran den
+        minnesmappade basen till en minnesmappad utfil, sa att hela matrisen
+        aldrig behover ligga i minnet.
+        """
+        base = self.load(base_key)
+        if base is None:
+            raise FileNotFoundError(f"Feature-cachepost {base_key} saknas")
+        X_old, y_old, _, sw_old, _ = base
+        keys_old = self.load_row_keys(base_key)
+        row_keys = None
+        if keys_old is not None and row_keys_new is not None:
+            row_keys = np.concatenate([keys_old, np.asarray(row_keys_new, dtype=np.uint64)])
+        if len(y_old) == 0 or len(y_new) == 0:
+            X = X_new if len(y_old) == 0 else X_old
+            return self.store(
+                key,
+                X,
+                np.concatenate([y_old, y_new]),
+                feature_names,
+                np.concatenate([sw_old, sw_new]),
+                manifest,
+                row_keys,
+            )
+
+        def write_arrays(tmp: Path):
+            X_new_arr = np.asarray(X_new)
+            out = np.lib.format.open_memmap(
+                tmp / "X.npy",
+                mode="w+",
+                dtype=np.result_type(X_old.dtype, X_new_arr.dtype),
+                shape=(len(X_old) + len(X_new_arr), X_old.shape[1]),
+            )
+            for start in range(0, len(X_old), _COPY_BLOCK_ROWS):
+                stop = min(start + _COPY_BLOCK_ROWS, len(X_old))
+                out[start:stop] = X_old[start:stop]
+            out[len(X_old):] = X_new_arr
+            out.flush()
+            del out
+            np.save(tmp / "y.npy", np.concatenate([y_old, y_new]), allow_pickle=False)
+            np.save(
+                tmp / "sample_weight.npy", np.concatenate([sw_old, sw_new]), allow_pickle=False
+            )
+            if row_keys is not None:
+                np.save(tmp / "row_keys.npy", row_keys, allow_pickle=False)
+
+        return self._write(
+            key, write_arrays, feature_names, dict(manifest, rows=len(y_old) + len(y_new))
+        )
+
+    def prune(self, protect: Optional[str] = None):
+        """Behall de self.keep senast anvanda posterna."""
+        entries = sorted(
+            self._entries(),
+            key=lambda p: (p / MANIFEST_FILE).stat().st_mtime,
+            reverse=True,
+        )
+        others = [entry for entry in entries if entry.name != protect]
+        for entry in others[self.keep - (protect is not None):]:
+            shutil.rmtree(entry, ignore_errors=True)
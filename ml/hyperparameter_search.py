@@ -0,0 +1,324 @@
+"""
+Budgeterad hyperparametersökning (successive halving) för train_ml_model.
+
+Det uttömmande läget kör RandomizedSearchCV med 20 konfigurationer x 5 folds
+per modell, dvs ca 400 fulla träningar. Här provas i stället många
+konfigurationer billigt och bara de bästa får mer resurser:
+
+    rung 0: alla kandidater, minsta resurs
+    rung 1: bästa 1/eta, resurs x eta
+    ...
+    sista:  ca eta kandidater, full resurs
+
+Resursen är antal träd (n_estimators) för Random Forest / Extra Trees och
+antal träningsrader för boosting-modellerna, som i stället får early stopping
+(n_iter_no_change resp. early_stopping_rounds) så att antalet träd bestäms av
+valideringsfelet och inte av gridden.
+
+Sökningen har en tidsbudget i sekunder. När budgeten är slut utvärderas inga
+fler kandidater när den återstående tiden bara räcker till omträningen (som
+uppskattas från tidigare utvärderingar); bästa kandidaten i den högsta rung
+som hunnits tränas om på all träningsdata. Varje utvärderad (modell, parametrar, resurs, data) sparas
+i ml/output/search_cache.json, så en ny körning på samma data hoppar över allt
+som redan provats.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import math
+import os
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from sklearn.metrics import mean_absolute_error
+from sklearn.model_selection import KFold, ParameterGrid, ParameterSampler
+
+DEFAULT_CACHE_PATH = Path(__file__).parent / "output" / "search_cache.json"
+DEFAULT_REPORT_PATH = Path(__file__).parent / "output" / "search_report.json"
+
+# Andel av träningsfolden som hålls undan för early stopping (XGBoost)
+_EARLY_STOPPING_FRACTION = 0.1
+_EARLY_STOPPING_ROUNDS = 10
+
+
+def data_fingerprint(*arrays: np.ndarray) -> str:
+    """sha256 över arrayernas form, dtype och innehåll."""
+    h = hashlib.sha256()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(f"{arr.shape}{arr.dtype}".encode("ascii"))
+        h.update(arr.data)
+    return h.hexdigest()
+
+
+class SearchCache:
+    """Resultat per provad konfiguration, sparat mellan körningar."""
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = Path(path) if path else DEFAULT_CACHE_PATH
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        self.dirty = False
+
+    @staticmethod
+    def key(model_name: str, params: Dict, resource: int, cv: int, data_key: str) -> str:
+        payload = json.dumps(
+            [model_name, params, resource, cv, data_key], sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self.entries.get(key)
+
+    def put(self, key: str, result: Dict):
+        self.entries[key] = result
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + f".tmp{os.getpid()}")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+def _fit(estimator, X, y, sw, early_stopping: Optional[str]):
+    """Träna, med early stopping-holdout från träningsdatan för XGBoost."""
+    if early_stopping == "xgboost" and len(y) >= 20:
+        n_es = max(1, int(len(y) * _EARLY_STOPPING_FRACTION))
+        rng = np.random.RandomState(0)
+        order = rng.permutation(len(y))
+        fit_idx, es_idx = order[n_es:], order[:n_es]
+        estimator.set_params(early_stopping_rounds=_EARLY_STOPPING_ROUNDS)
+        estimator.fit(
+            X[fit_idx],
+            y[fit_idx],
+            sample_weight=sw[fit_idx],
+            eval_set=[(X[es_idx], y[es_idx])],
+            verbose=False,
+        )
+    else:
+        estimator.fit(X, y, sample_weight=sw)
+    return estimator
+
+
+def _trees_used(estimator, early_stopping: Optional[str]) -> Optional[int]:
+    if early_stopping == "sklearn":
+        return int(getattr(estimator, "n_estimators_", estimator.n_estimators))
+    if early_stopping == "xgboost":
+        best = getattr(estimator, "best_iteration", None)
+        return int(best) + 1 if best is not None else None
+    return None
+
+
+def _cv_mae(spec: Dict, params: Dict, X, y, sw, cv: int) -> Dict:
+    """Medel-MAE över cv folds (samma mått som neg_mean_absolute_error)."""
+    start = time.perf_counter()
+    maes = []
+    trees = []
+    for train_idx, val_idx in KFold(cv, shuffle=True, random_state=42).split(X):
+        est = spec["estimator"]().set_params(**params)
+        _fit(est, X[train_idx], y[train_idx], sw[train_idx], spec.get("early_stopping"))
+        maes.append(mean_absolute_error(y[val_idx], est.predict(X[val_idx])))
+        used = _trees_used(est, spec.get("early_stopping"))
+        if used is not None:
+            trees.append(used)
+    seconds = time.perf_counter() - start
+    result = {"mae": float(np.mean(maes)), "seconds": seconds, "fits": cv}
+    if trees:
+        result["trees"] = int(round(float(np.mean(trees))))
+    # Sekunder per (rad x träd) – används för att uppskatta omträningens tid
+    n_trees = result.get("trees") or params.get("n_estimators") or 100
+    result["unit_s"] = seconds / (cv * len(y) * (cv - 1) / cv * n_trees)
+    return result
+
+
+def _refit_seconds(result: Dict, n_rows: int, n_trees: int) -> float:
+    return result.get("unit_s", 0.0) * n_rows * n_trees
+
+
+def _resources(spec: Dict, n_candidates: int, n_samples: int, eta: int) -> List[int]:
+    """Resurs per rung, stigande med faktor eta och sista rung = max."""
+    # Sista rung får ca eta kandidater (en ensam kandidat behöver ingen rung)
+    n_rungs = max(1, int(math.floor(math.log(max(n_candidates, 1)) / math.log(eta) + 1e-9)))
+    if spec["resource"] == "n_estimators":
+        max_r, min_r = spec["max_estimators"], spec.get("min_estimators", 30)
+    else:
+        max_r, min_r = n_samples, min(n_samples, spec.get("min_samples", 500))
+    resources = []
+    for k in reversed(range(n_rungs)):
+        r = max(min_r, int(max_r / eta**k))
+        if not resources or r > resources[-1]:
+            resources.append(r)
+    return resources
+
+
+def successive_halving(
+    spec: Dict,
+    X: np.ndarray,
+    y: np.ndarray,
+    sw: np.ndarray,
+    *,
+    budget_s: float,
+    cache: SearchCache,
+    data_key: str,
+    n_candidates: int = 27,
+    eta: int = 3,
+    cv: int = 3,
+    random_state: int = 42,
+) -> Dict:
+    """
+    Sök bästa konfiguration för en modell inom budget_s sekunder.
+
+    spec: {"name", "estimator" (fabrik), "grid" (samma som i uttömmande läget),
+    "resource": "n_estimators" | "samples", "early_stopping": None | "sklearn" |
+    "xgboost"}. n_estimators i gridden ersätts av resursen respektive (med
+    early stopping) av sitt maxvärde som övre gräns.
+
+    Returns:
+        {"model" (omtränad på all data), "best_params", "cv_score" (MAE i
+        den högsta rung som hanns med), "seconds", "fits", "cached", "rungs"}
+    """
+    start = time.perf_counter()
+    deadline = start + budget_s
+    grid = {k: v for k, v in spec["grid"].items() if k != "n_estimators"}
+    spec = dict(spec, max_estimators=max(spec["grid"].get("n_estimators", [100])))
+    fixed = {}
+    if spec["resource"] == "samples" and spec.get("early_stopping"):
+        fixed["n_estimators"] = spec["max_estimators"]
+        if spec["early_stopping"] == "sklearn":
+            fixed["n_iter_no_change"] = _EARLY_STOPPING_ROUNDS
+    n_candidates = min(n_candidates, len(ParameterGrid(grid)))
+    candidates = list(ParameterSampler(grid, n_iter=n_candidates, random_state=random_state))
+    resources = _resources(spec, len(candidates), len(y), eta)
+    order = np.random.RandomState(random_state).permutation(len(y))
+
+    fits = 0
+    cached = 0
+    rungs = []
+    best = None
+    alive = list(range(len(candidates)))
+    reserve = 0.0
+    for resource in resources:
+        if spec["resource"] == "samples":
+            idx = np.sort(order[:resource])
+            Xr, yr, swr = X[idx], y[idx], sw[idx]
+        else:
+            Xr, yr, swr = X, y, sw
+        scores = []
+        for c in alive:
+            # Stanna när återstående tid bara räcker till att träna om bästa kandidaten
+            if scores and time.perf_counter() + reserve > deadline:
+                break
+            params = dict(candidates[c], **fixed)
+            if spec["resource"] == "n_estimators":
+                params["n_estimators"] = resource
+            key = SearchCache.key(spec["name"], params, resource, cv, data_key)
+            result = cache.get(key)
+            if result is None:
+                result = _cv_mae(spec, params, Xr, yr, swr, cv)
+                cache.put(key, result)
+                fits += result["fits"]
+            else:
+                cached += 1
+            scores.append((result["mae"], c, params, result))
+            best_result = min(scores, key=lambda s: (s[0], s[1]))[3]
+            if spec["resource"] == "n_estimators":
+                # Minst lika många träd som i rungen
+                reserve = _refit_seconds(best_result, len(y), resource)
+            else:
+                reserve = _refit_seconds(
+                    best_result, len(y), best_result.get("trees") or fixed.get("n_estimators", 100)
+                )
+        scores.sort(key=lambda s: (s[0], s[1]))
+        rungs.append({"resource": resource, "evaluated": len(scores), "best_mae": scores[0][0]})
+        best = scores[0]
+        if len(scores) < len(alive) or time.perf_counter() + reserve > deadline:
+            break
+        alive = [c for _, c, _, _ in scores[: max(1, len(scores) // eta)]]
+
+    # Bästa kandidaten tränas om på all träningsdata med full resurs; för
+    # n_estimators så många träd (upp till max) som ryms i återstående budget
+    best_mae, _, params, result = best
+    params = dict(params)
+    if spec["resource"] == "n_estimators":
+        per_tree = _refit_seconds(result, len(y), 1)
+        left = deadline - time.perf_counter()
+        affordable = int(left / per_tree) if per_tree > 0 else spec["max_estimators"]
+        params["n_estimators"] = max(
+            params["n_estimators"], min(spec["max_estimators"], affordable)
+        )
+    model = _fit(spec["estimator"]().set_params(**params), X, y, sw, spec.get("early_stopping"))
+    fits += 1
+    cache.save()
+
+    best_params = dict(params)
+    used = _trees_used(model, spec.get("early_stopping"))
+    if used is not None:
+        best_params["n_estimators"] = used
+    return {
+        "model": model,
+        "best_params": best_params,
+        "cv_score": best_mae,
+        "seconds": time.perf_counter() - start,
+        "fits": fits,
+        "cached": cached,
+        "rungs": rungs,
+    }
+
+
+def load_report(path: Optional[Path] = None) -> Dict:
+    try:
+        with open(Path(path) if path else DEFAULT_REPORT_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_report(mode: str, summary: Dict, path: Optional[Path] = None) -> Dict:
+    """Spara senaste körningens sammanfattning per läge; returnerar hela rapporten."""
+    path = Path(path) if path else DEFAULT_REPORT_PATH
+    report = load_report(path)
+    report[mode] = summary
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    return report
+
+
+def print_comparison(report: Dict, data_key: str, print_fn: Callable = print):
+    """Poäng/tid för budget- mot uttömmande läge (om båda körts på samma data)."""
+    budget = report.get("budget")
+    exhaustive = report.get("exhaustive")
+    if not budget or not exhaustive:
+        return
+    if budget.get("data_key") != data_key or exhaustive.get("data_key") != data_key:
+        print_fn("  (Jamforelse saknas: lagena har inte korts pa samma data)")
+        return
+    print_fn(f"  {'':<20}{'uttommande':>16}{'budget':>16}")
+    print_fn(
+        f"  {'Tid (s)':<20}{exhaustive['seconds']:>16.1f}{budget['seconds']:>16.1f}"
+    )
+    print_fn(f"  {'Traningar':<20}{exhaustive['fits']:>16}{budget['fits']:>16}")
+    print_fn(
+        f"  {'Basta test MAE':<20}{exhaustive['test_mae']:>16.4f}{budget['test_mae']:>16.4f}"
+    )
+    for name in exhaustive.get("models", {}):
+        e = exhaustive["models"][name]
+        b = budget.get("models", {}).get(name)
+        if not b:
+            continue
+        print_fn(
+            f"  {name:<20}{e['test_mae']:>8.4f} ({e['seconds']:>4.0f}s)"
+            f"{b['test_mae']:>8.4f} ({b['seconds']:>4.0f}s)"
+        )
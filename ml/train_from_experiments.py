@@ -30,18 +30,9 @@ except ImportError:
     print("psycopg2 krävs: pip install psycopg2-binary")
     sys.exit(1)
 
-def _as_dict(val):
-    """JSONB kan komma som dict eller str beroende på drivrutin."""
-    if val is None:
-        return {}
-    if isinstance(val, dict):
-        return val
-    if isinstance(val, str):
-        try:
-            return json.loads(val)
-        except json.JSONDecodeError:
-            return {}
-    return {}
+# Experimentens spår lagras kompakt (track_snapshot) och byggs upp via backend
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+from utils.experiment_snapshot import load_tracks_many
 
 
 def main():
@@ -67,7 +58,7 @@ def main():
     cur.execute(
         """
         SELECT id, track_id, original_track_json, corrected_track_json,
-               rating, feedback_notes, model_version, status
+               track_snapshot, rating, feedback_notes, model_version, status
         FROM ml_experiments
         WHERE LOWER(TRIM(COALESCE(status, ''))) = 'rated'
           AND rating IS NOT NULL
@@ -75,6 +66,7 @@ def main():
         """
     )
     experiments = cur.fetchall()
+    tracks = load_tracks_many(cur, True, experiments)
     conn.close()
     print("  OK, fråga körd.\n", flush=True)
 
@@ -100,11 +92,9 @@ def main():
     # Samma id för hela filen – spårbarhet och “ny batch” vs äldre exporter
     export_batch_id = datetime.now().strftime("%Y%m%dT%H%M%S")
 
-    for exp in experiments:
+    for exp, (original, corrected) in zip(experiments, tracks):
         rating = exp["rating"]
         track_id = exp["track_id"]
-        original = _as_dict(exp["original_track_json"])
-        corrected = _as_dict(exp["corrected_track_json"])
         track_name = original.get("track_name", f"Track_{track_id}")
 
         # Ny struktur: original/corrected har .dog och .human med .positions
@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 """Kör endast ML-träning (snabbare än full analysis)"""
+import os
 import sys
 from pathlib import Path
 
+# Headless som default (inga grafer); ML_HEADLESS=0 ritar förutsägelsegrafen
+os.environ.setdefault("ML_HEADLESS", "1")
+
 # Samma som analysis.py main men bara träning
 sys.path.insert(0, str(Path(__file__).parent))
-from analysis import load_annotations, train_ml_model
+from analysis import train_ml_model
 
 if __name__ == "__main__":
-    print("Laddar data...")
-    data = load_annotations()
-    print(f"Tränar med {len(data)} positioner...")
-    train_ml_model(data)
+    # Data laddas bara om feature-cachen i ml/output/feature_cache/ saknar
+    # en matris för nuvarande filer i ml/data/
+    print("Tränar...")
+    train_ml_model()
     print("Klar!")
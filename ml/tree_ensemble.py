@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+"""
+Kompakt, array-baserat format för trädensemblen och en ren NumPy-evaluator.
+
+sklearn/XGBoost har hög fast kostnad per predict-anrop (validering, joblib,
+ett anrop per träd för confidence) och de picklade objekten är stora. Här
+plattas ensemblen ut till sammanhängande arrayer med en rad per nod:
+
+    feature       int16    feature-index (0 för löv)
+    threshold     float32  gå vänster om x <= threshold (+inf för löv)
+    children      int32    vänster barn; höger barn är children + 1 (löv: sig själv)
+    missing_left  bool     NaN går vänster
+    value         float64  lövvärde
+    roots         int32    rotnod per träd
+
+Noderna numreras nivå för nivå så att syskon ligger intill varandra; ett steg
+ner i alla träd för alla rader är då tre np.take och en jämförelse.
+
+plus scalerns center/scale och metadata (typ, base_score, skala, version).
+Förutsägelsen är base + scale * (medel eller summa av trädens lövvärden):
+
+    Random Forest / Extra Trees:  medel,  base 0, skala 1
+    Gradient Boosting:            summa,  base init_-konstanten, skala learning_rate
+    XGBoost:                      summa,  base base_score, skala 1
+
+sklearn jämför float32(x) <= float64-tröskeln och XGBoost float32(x) < tröskeln;
+båda lagras som den största float32 som ger samma utfall, så vägen genom
+trädet blir bitexakt densamma som originalets.
+
+Kör (exporterar nuvarande modell i ml/output/ och kontrollerar paritet):
+  python ml/tree_ensemble.py
+
+Fristående paritetskontroll (syntetiska modeller av varje typ, eller den
+publicerade modellen med --saved): python ml/check_tree_ensemble.py
+"""
+
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+OUTPUT_DIR = Path(__file__).parent / "output"
+COMPACT_MODEL_FILE = "gps_correction_model_compact.npz"
+# Destillerad serveringsvariant (distill.py), samma format
+SERVING_MODEL_FILE = "gps_correction_model_serving.npz"
+FORMAT_VERSION = 1
+
+# Största tillåtna avvikelse mot originalmodellen vid export (meter). XGBoost
+# summerar i float32, sklearn i float64.
+PARITY_TOLERANCE = {"forest": 1e-9, "gradient_boosting": 1e-9, "xgboost": 1e-4}
+
+# Rader per block i tree_outputs (minnet växer med rader x träd)
+_BLOCK_ROWS = 2048
+
+# XGBoost-mål där förutsägelsen är summan av löven utan länkfunktion
+_XGB_IDENTITY_OBJECTIVES = ("reg:squarederror", "reg:absoluteerror", "reg:pseudohubererror")
+
+
+class LinearScaler:
+    """(X - center) / scale – samma aritmetik som RobustScaler/StandardScaler.transform."""
+
+    def __init__(self, center: Optional[np.ndarray], scale: Optional[np.ndarray]):
+        self.center = center
+        self.scale = scale
+
+    def transform(self, X) -> np.ndarray:
+        X = np.array(X, dtype=np.float64)
+        if self.center is not None:
+            X -= self.center
+        if self.scale is not None:
+            X /= self.scale
+        return X
+
+
+class TreeEnsemble:
+    def __init__(self, arrays: Dict[str, np.ndarray], meta: Dict):
+        self.feature = np.ascontiguousarray(arrays["feature"], dtype=np.int16)
+        self.threshold = np.ascontiguousarray(arrays["threshold"], dtype=np.float32)
+        self.children = np.ascontiguousarray(arrays["children"], dtype=np.int32)
+        self.missing_left = np.ascontiguousarray(arrays["missing_left"], dtype=bool)
+        self.value = np.ascontiguousarray(arrays["value"], dtype=np.float64)
+        self.roots = np.ascontiguousarray(arrays["roots"], dtype=np.int32)
+        self.meta = meta
+        self.kind = meta["kind"]
+        self.base = float(meta["base"])
+        self.scale = float(meta["scale"])
+        self.aggregation = meta["aggregation"]
+        self.max_depth = int(meta["max_depth"])
+        self.n_features = int(meta["n_features"])
+        self.model_version = meta.get("model_version")
+        self.scaler = None
+        if "scaler_scale" in arrays or "scaler_center" in arrays:
+            self.scaler = LinearScaler(arrays.get("scaler_center"), arrays.get("scaler_scale"))
+
+    @property
+    def n_trees(self) -> int:
+        return len(self.roots)
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.value)
+
+    def tree_outputs(self, X) -> np.ndarray:
+        """Lövvärdet i varje träd, shape (rader, träd). Används även för confidence."""
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X[None, :]
+        if X.shape[1] != self.n_features:
+            raise ValueError(f"X har {X.shape[1]} features, modellen {self.n_features}")
+        out = np.empty((len(X), self.n_trees), dtype=np.float64)
+        for start in range(0, len(X), _BLOCK_ROWS):
+            block = X[start:start + _BLOCK_ROWS]
+            out[start:start + len(block)] = self.value[self._leaves(block)]
+        return out
+
+    def _leaves(self, X: np.ndarray) -> np.ndarray:
+        # Alla rader och träd stegar en nivå i taget; löv pekar på sig själva
+        # (tröskel +inf), så max_depth steg räcker för varje träd
+        flat = np.ascontiguousarray(X).ravel()
+        row_offset = (np.arange(len(X), dtype=np.intp) * X.shape[1])[:, None]
+        idx = np.repeat(self.roots[None, :], len(X), axis=0)
+        has_nan = bool(np.isnan(flat).any())
+        for _ in range(self.max_depth):
+            x = np.take(flat, np.take(self.feature, idx) + row_offset)
+            go_right = x > np.take(self.threshold, idx)
+            if has_nan:
+                go_right |= np.isnan(x) & ~np.take(self.missing_left, idx)
+            idx = np.take(self.children, idx) + go_right
+        return idx
+
+    def combine(self, outputs: np.ndarray) -> np.ndarray:
+        """Förutsägelse från tree_outputs (utan ny trädgenomgång)."""
+        total = outputs.mean(axis=1) if self.aggregation == "mean" else outputs.sum(axis=1)
+        return self.base + self.scale * total
+
+    def predict(self, X) -> np.ndarray:
+        return self.combine(self.tree_outputs(X))
+
+    def save(self, path: Path):
+        path = Path(path)
+        arrays = {
+            "feature": self.feature,
+            "threshold": self.threshold,
+            "children": self.children,
+            "missing_left": self.missing_left,
+            "value": self.value,
+            "roots": self.roots,
+        }
+        if self.scaler is not None:
+            if self.scaler.center is not None:
+                arrays["scaler_center"] = self.scaler.center
+            if self.scaler.scale is not None:
+                arrays["scaler_scale"] = self.scaler.scale
+        tmp = path.with_name(path.name + f".tmp{os.getpid()}")
+        with open(tmp, "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(self.meta)), **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "TreeEnsemble":
+        with np.load(path, allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        meta = json.loads(str(arrays.pop("meta")))
+        if meta.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"{Path(path).name}: formatversion {meta.get('format_version')} stods inte")
+        return cls(arrays, meta)
+
+
+def _float32_at_most(threshold: np.ndarray) -> np.ndarray:
+    """Största float32 <= threshold: float32(x) <= t  <=>  float32(x) <= resultatet."""
+    t32 = threshold.astype(np.float32)
+    above = t32.astype(np.float64) > threshold
+    t32[above] = np.nextafter(t32[above], np.float32(-np.inf))
+    return t32
+
+
+def _empty_nodes() -> Dict[str, List[np.ndarray]]:
+    return {k: [] for k in ("feature", "threshold", "left", "right", "missing_left", "value")}
+
+
+def _concat(nodes: Dict[str, List[np.ndarray]], roots: List[int]) -> Dict[str, np.ndarray]:
+    """
+    Slå ihop träden (left/right i global numrering, löv pekar på sig själva)
+    och numrera om nivå för nivå så att höger barn alltid är vänster + 1.
+    """
+    old = {k: np.concatenate(v) for k, v in nodes.items()}
+    left, right = old["left"], old["right"]
+    is_leaf = left == np.arange(len(left))
+
+    # order[nytt index] = gammalt index
+    roots = np.asarray(roots, dtype=np.int64)
+    levels = [roots]
+    frontier = roots
+    while len(frontier):
+        internal = frontier[~is_leaf[frontier]]
+        frontier = np.column_stack([left[internal], right[internal]]).ravel()
+        levels.append(frontier)
+    order = np.concatenate(levels)
+    new_index = np.empty(len(left), dtype=np.int64)
+    new_index[order] = np.arange(len(order))
+
+    leaf = is_leaf[order]
+    return {
+        "feature": np.where(leaf, 0, old["feature"][order]).astype(np.int16),
+        "threshold": np.where(leaf, np.float32(np.inf), old["threshold"][order]).astype(np.float32),
+        "children": np.where(leaf, np.arange(len(order)), new_index[left[order]]).astype(np.int32),
+        "missing_left": np.where(leaf, True, old["missing_left"][order]),
+        "value": old["value"][order],
+        "roots": new_index[roots].astype(np.int32),
+    }
+
+
+def _sklearn_tree_arrays(trees) -> Tuple[Dict[str, np.ndarray], int]:
+    nodes = _empty_nodes()
+    roots = []
+    offset = 0
+    max_depth = 0
+    for tree in trees:
+        n = tree.node_count
+        ids = np.arange(n, dtype=np.int32)
+        leaf = tree.children_left == -1
+        missing = getattr(tree, "missing_go_to_left", None)
+        nodes["feature"].append(np.where(leaf, 0, tree.feature).astype(np.int16))
+        nodes["threshold"].append(np.where(leaf, 0.0, _float32_at_most(tree.threshold)).astype(np.float32))
+        nodes["left"].append(np.where(leaf, ids, tree.children_left).astype(np.int32) + offset)
+        nodes["right"].append(np.where(leaf, ids, tree.children_right).astype(np.int32) + offset)
+        nodes["missing_left"].append(
+            np.zeros(n, dtype=bool) if missing is None else np.asarray(missing, dtype=bool) & ~leaf
+        )
+        nodes["value"].append(np.asarray(tree.value[:, 0, 0], dtype=np.float64))
+        roots.append(offset)
+        offset += n
+        max_depth = max(max_depth, int(tree.max_depth))
+    return _concat(nodes, roots), max_depth
+
+
+def _xgboost_tree_arrays(
+    model, feature_names: Optional[List[str]]
+) -> Tuple[Dict[str, np.ndarray], int, float]:
+    booster = model.get_booster()
+    config = json.loads(booster.save_config())
+    objective = config["learner"]["objective"]["name"]
+    if objective not in _XGB_IDENTITY_OBJECTIVES:
+        raise ValueError(f"XGBoost-målet {objective} stods inte (kraver identitetslank)")
+    base_score = float(str(config["learner"]["learner_model_param"]["base_score"]).strip("[]"))
+
+    dumps = booster.get_dump(dump_format="json")
+    try:
+        # Samma trädintervall som XGBRegressor.predict efter early stopping
+        dumps = dumps[: int(model.best_iteration) + 1]
+    except (AttributeError, TypeError):
+        pass
+
+    names = list(booster.feature_names or feature_names or [])
+    index = {name: i for i, name in enumerate(names)}
+
+    def feature_index(split: str) -> int:
+        if split in index:
+            return index[split]
+        return int(split[1:])  # "f12" när modellen tränats på en numpy-array
+
+    nodes = _empty_nodes()
+    roots = []
+    offset = 0
+    max_depth = 0
+    for dump in dumps:
+        flat = []
+        stack = [(json.loads(dump), 0)]
+        while stack:
+            node, depth = stack.pop()
+            flat.append(node)
+            max_depth = max(max_depth, depth)
+            for child in node.get("children", []):
+                stack.append((child, depth + 1))
+        n = max(node["nodeid"] for node in flat) + 1
+        feature = np.zeros(n, dtype=np.int16)
+        threshold = np.zeros(n, dtype=np.float64)
+        left = np.arange(n, dtype=np.int32)
+        right = np.arange(n, dtype=np.int32)
+        missing_left = np.zeros(n, dtype=bool)
+        value = np.zeros(n, dtype=np.float64)
+        for node in flat:
+            i = node["nodeid"]
+            if "leaf" in node:
+                value[i] = node["leaf"]
+                continue
+            feature[i] = feature_index(node["split"])
+            threshold[i] = node["split_condition"]
+            left[i], right[i] = node["yes"], node["no"]
+            missing_left[i] = node["missing"] == node["yes"]
+        # XGBoost: gå vänster om float32(x) < float32(villkoret)
+        t32 = threshold.astype(np.float32)
+        nodes["feature"].append(feature)
+        nodes["threshold"].append(np.nextafter(t32, np.float32(-np.inf)))
+        nodes["left"].append(left + offset)
+        nodes["right"].append(right + offset)
+        nodes["missing_left"].append(missing_left)
+        nodes["value"].append(value)
+        roots.append(offset)
+        offset += n
+    return _concat(nodes, roots), max_depth, base_score
+
+
+def export_model(
+    model,
+    scaler=None,
+    feature_names: Optional[List[str]] = None,
+    model_version: Optional[str] = None,
+    columns: Optional[Sequence[int]] = None,
+) -> TreeEnsemble:
+    """
+    TreeEnsemble från en tränad RF/ET-, GradientBoosting- eller XGBoost-regressor.
+
+    columns: modellen är tränad på X[:, columns] (beskuret feature-set). Noderna
+    pekas om till kolumnerna i hela X, så ensemblen tar samma indata som
+    originalmodellen; feature_names ska då vara hela listan.
+    """
+    if hasattr(model, "get_booster"):
+        arrays, max_depth, base = _xgboost_tree_arrays(model, feature_names)
+        kind, aggregation, scale = "xgboost", "sum", 1.0
+    elif hasattr(model, "learning_rate") and hasattr(model, "init_"):
+        init = model.init_
+        if isinstance(init, str) and init == "zero":
+            base = 0.0
+        elif hasattr(init, "constant_"):
+            base = float(np.ravel(init.constant_)[0])
+        else:
+            raise ValueError(f"GradientBoosting med init={type(init).__name__} stods inte")
+        arrays, max_depth = _sklearn_tree_arrays([stage[0].tree_ for stage in model.estimators_])
+        kind, aggregation, scale = "gradient_boosting", "sum", float(model.learning_rate)
+    elif hasattr(model, "estimators_"):
+        arrays, max_depth = _sklearn_tree_arrays([est.tree_ for est in model.estimators_])
+        kind, aggregation, base, scale = "forest", "mean", 0.0, 1.0
+    else:
+        raise ValueError(f"{type(model).__name__} kan inte exporteras till kompakt format")
+
+    n_features = int(getattr(model, "n_features_in_", 0) or len(feature_names or []))
+    if columns is not None:
+        arrays["feature"] = np.asarray(columns, dtype=np.int16)[arrays["feature"]]
+        n_features = len(feature_names) if feature_names is not None else int(max(columns)) + 1
+    if scaler is not None:
+        center = getattr(scaler, "center_", None)
+        if center is None:
+            center = getattr(scaler, "mean_", None)
+        if center is not None:
+            arrays["scaler_center"] = np.asarray(center, dtype=np.float64)
+        if getattr(scaler, "scale_", None) is not None:
+            arrays["scaler_scale"] = np.asarray(scaler.scale_, dtype=np.float64)
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "kind": kind,
+        "model_class": type(model).__name__,
+        "aggregation": aggregation,
+        "base": base,
+        "scale": scale,
+        "max_depth": max_depth,
+        "n_features": n_features,
+        "feature_names": list(feature_names) if feature_names is not None else None,
+        "model_version": model_version,
+        "columns": None if columns is None else [int(c) for c in columns],
+    }
+    return TreeEnsemble(arrays, meta)
+
+
+def check_parity(
+    model, ensemble: TreeEnsemble, X_scaled: np.ndarray, columns: Optional[Sequence[int]] = None
+) -> float:
+    """Största absoluta skillnad mot model.predict; ValueError över PARITY_TOLERANCE."""
+    X_scaled = np.asarray(X_scaled)
+    if len(X_scaled) == 0:
+        return 0.0
+    X_model = X_scaled if columns is None else X_scaled[:, columns]
+    diff = float(np.max(np.abs(model.predict(X_model) - ensemble.predict(X_scaled))))
+    if not diff <= PARITY_TOLERANCE[ensemble.kind]:
+        raise ValueError(f"Kompakt modell avviker {diff:.3g} m fran originalet")
+    return diff
+
+
+def export_to_file(
+    model,
+    scaler,
+    feature_names: List[str],
+    model_version: Optional[str],
+    X_check: Optional[np.ndarray] = None,
+    output_dir: Path = OUTPUT_DIR,
+    columns: Optional[Sequence[int]] = None,
+    filename: str = COMPACT_MODEL_FILE,
+) -> Dict:
+    """
+    Exportera, kontrollera paritet på X_check (skalade rader, alla features)
+    och spara filename atomiskt. Returnerar en sammanfattning för model_info.
+    """
+    ensemble = export_model(model, scaler, feature_names, model_version, columns)
+    max_diff = None
+    if X_check is not None:
+        max_diff = check_parity(model, ensemble, X_check, columns)
+    path = Path(output_dir) / filename
+    ensemble.save(path)
+    return {
+        "file": filename,
+        "kind": ensemble.kind,
+        "trees": ensemble.n_trees,
+        "nodes": ensemble.n_nodes,
+        "bytes": path.stat().st_size,
+        "parity_rows": 0 if X_check is None else int(len(X_check)),
+        "parity_max_abs_diff": max_diff,
+    }
+
+
+def _time_per_call(predict, X: np.ndarray, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        predict(X)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    """Exportera publicerad modell, kontrollera paritet och jämför latens."""
+    import pickle
+
+    sys.path.insert(0, str(Path(__file__).parent))
+    from analysis import load_training_features
+
+    with open(OUTPUT_DIR / "gps_correction_model_best.pkl", "rb") as f:
+        model = pickle.load(f)
+    with open(OUTPUT_DIR / "gps_correction_scaler.pkl", "rb") as f:
+        scaler = pickle.load(f)
+    with open(OUTPUT_DIR / "gps_correction_model_info.json", "r", encoding="utf-8") as f:
+        info = json.load(f)
+
+    print("Laddar features for paritetskontroll...")
+    X, _, feature_names, _ = load_training_features()
+    rows = np.random.default_rng(0).permutation(len(X))[:5000]
+    X_check = scaler.transform(np.asarray(X)[np.sort(rows)])
+
+    summary = export_to_file(model, scaler, feature_names, info.get("model_version"), X_check)
+    ensemble = TreeEnsemble.load(OUTPUT_DIR / COMPACT_MODEL_FILE)
+    print(
+        f"  {summary['kind']}: {summary['trees']} trad, {summary['nodes']} noder, "
+        f"{summary['bytes'] / 1e6:.2f} MB"
+    )
+    print(f"  Paritet: max |diff| {summary['parity_max_abs_diff']:.3g} m over {len(X_check)} rader")
+
+    X_1k = X_check[:1000]
+    single = X_check[:1]
+    for name, predict in (("original", model.predict), ("kompakt", ensemble.predict)):
+        print(
+            f"  {name:<9} 1 rad {_time_per_call(predict, single) * 1e3:8.2f} ms   "
+            f"1000 rader {_time_per_call(predict, X_1k) * 1e3:8.2f} ms"
+        )
+
+    info["compact_model"] = summary
+    with open(OUTPUT_DIR / "gps_correction_model_info.json", "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2, ensure_ascii=False)
+    print(f"Klar: {OUTPUT_DIR / COMPACT_MODEL_FILE}")
+
+
+if __name__ == "__main__":
+    main()
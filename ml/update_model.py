@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Inkrementell uppdatering av den publicerade modellen med ny feedback.
+
+En full träning (analysis.py) sparar, utöver modellen, radnycklar för alla
+rader den sett och för testraderna (vattenmärket, se analysis._row_key). Det
+här scriptet laddar samma data (feature-cachen gör det billigt när bara nya
+exportfiler tillkommit), tar ut raderna som modellen inte sett och tränar
+vidare på ENDAST dem:
+
+- Random Forest / Extra Trees: nya träd (warm_start) tränade på de nya raderna
+- Gradient Boosting: fler boosting-steg (warm_start) på de nya raderna
+- XGBoost: fler boosting-rundor ovanpå befintlig booster (xgb_model)
+
+Antalet nya träd/steg är proportionellt mot andelen ny data, så tiden styrs av
+mängden ny data och inte av hela korpusen. Var femte ny rad (på radnyckel)
+hålls utanför och läggs till valideringsmängden tillsammans med de gamla
+testraderna. Den nya modellen publiceras bara om MAE på valideringsmängden
+inte blir sämre än för nuvarande modell (plus INCREMENTAL_MAX_REGRESSION).
+
+Kör:
+  python ml/update_model.py
+  # Valfritt: export INCREMENTAL_MAX_REGRESSION=0.01  tillåt 1 % sämre MAE
+  # Valfritt: export INCREMENTAL_MIN_ROWS=50          minst så många nya rader
+"""
+
+import copy
+import json
+import math
+import os
+import pickle
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+OUTPUT_DIR = Path(__file__).parent / "output"
+MODEL_FILE = "gps_correction_model_best.pkl"
+SCALER_FILE = "gps_correction_scaler.pkl"
+MODEL_INFO_FILE = "gps_correction_model_info.json"
+# Senaste körningens sammanfattning (läses av backend-jobbet ml_update)
+REPORT_FILE = "incremental_update.json"
+
+DEFAULT_MIN_ROWS = 50
+DEFAULT_MAX_REGRESSION = 0.0
+MIN_ADDED_TREES = 1
+# Var HOLDOUT_MODULUS:e nya rad (radnyckel % HOLDOUT_MODULUS == 0) valideras
+HOLDOUT_MODULUS = 5
+# Antal uppdateringar som sparas i model_info["incremental_updates"]
+HISTORY_LENGTH = 50
+
+
+def _save_atomic(path: Path, write):
+    tmp = path.with_name(path.name + f".tmp{os.getpid()}")
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def tree_count(model) -> int:
+    """Antal träd / boosting-steg i modellen."""
+    if hasattr(model, "get_booster"):
+        return int(model.get_booster().num_boosted_rounds())
+    estimators = getattr(model, "estimators_", None)
+    if estimators is None:
+        raise ValueError(f"{type(model).__name__} stods inte for inkrementell uppdatering")
+    return len(estimators)
+
+
+def warm_start(model, X: np.ndarray, y: np.ndarray, sw: np.ndarray, n_add: int):
+    """
+    Kopia av modellen med n_add nya träd/steg tränade på (X, y).
+    Den publicerade modellen ändras inte.
+    """
+    new = copy.deepcopy(model)
+    n_trees = tree_count(model)
+    if hasattr(new, "get_booster"):
+        # XGBoost: fortsätt från befintlig booster
+        new.set_params(n_estimators=n_add, early_stopping_rounds=None)
+        new.fit(X, y, sample_weight=sw, xgb_model=model.get_booster(), verbose=False)
+    elif hasattr(new, "warm_start"):
+        new.set_params(warm_start=True, n_estimators=n_trees + n_add)
+        new.fit(X, y, sample_weight=sw)
+        new.set_params(warm_start=False)
+    else:
+        raise ValueError(f"{type(model).__name__} stods inte for inkrementell uppdatering")
+    return new
+
+
+def _mae(model, X: np.ndarray, y: np.ndarray) -> Optional[float]:
+    if len(y) == 0:
+        return None
+    return float(np.mean(np.abs(model.predict(X) - y)))
+
+
+def incremental_update(
+    max_regression: Optional[float] = None,
+    min_rows: Optional[int] = None,
+    dry_run: bool = False,
+) -> Dict:
+    """
+    Träna vidare på rader som inte finns i vattenmärket och publicera om
+    valideringsfelet inte ökar.
+
+    Returns:
+        Sammanfattning: status (published | rejected | skipped), antal rader,
+        tillagda träd, MAE före/efter och tid per steg
+    """
+    from analysis import HOLDOUT_ROWS_FILE, SEEN_ROWS_FILE, load_training_features
+    from profiling import StageProfiler
+
+    if max_regression is None:
+        max_regression = float(
+            os.environ.get("INCREMENTAL_MAX_REGRESSION", "") or DEFAULT_MAX_REGRESSION
+        )
+    if min_rows is None:
+        min_rows = int(os.environ.get("INCREMENTAL_MIN_ROWS", "") or DEFAULT_MIN_ROWS)
+
+    profiler = StageProfiler("update_model")
+    summary = {"started_at": datetime.now().isoformat()}
+
+    with profiler.stage("load"):
+        with open(OUTPUT_DIR / MODEL_INFO_FILE, "r", encoding="utf-8") as f:
+            info = json.load(f)
+        watermark = info.get("watermark")
+        if not watermark:
+            raise RuntimeError(
+                "Modellen saknar vattenmarke (tranad fore inkrementella uppdateringar). "
+                "Kor en full traning med python ml/analysis.py forst."
+            )
+        with open(OUTPUT_DIR / MODEL_FILE, "rb") as f:
+            model = pickle.load(f)
+        with open(OUTPUT_DIR / SCALER_FILE, "rb") as f:
+            scaler = pickle.load(f)
+        seen = np.load(OUTPUT_DIR / SEEN_ROWS_FILE)
+        holdout = np.load(OUTPUT_DIR / HOLDOUT_ROWS_FILE)
+
+    with profiler.stage("features"):
+        row_info = {}
+        X, y, feature_names, sw = load_training_features(row_info=row_info)
+        if list(feature_names) != list(info.get("feature_names", [])):
+            raise RuntimeError(
+                "Feature-schemat har andrats sedan modellen tranades. Kor full traning."
+            )
+        keys = np.asarray(row_info["row_keys"], dtype=np.uint64)
+
+    with profiler.stage("select"):
+        y = np.asarray(y)
+        within = y <= watermark["outlier_threshold"]
+        is_new = ~np.isin(keys, seen)
+        new_holdout = is_new & (keys % np.uint64(HOLDOUT_MODULUS) == 0)
+        train_mask = is_new & ~new_holdout & within
+        val_mask = (np.isin(keys, holdout) | new_holdout) & within
+        n_train = int(train_mask.sum())
+        summary.update(
+            new_rows=int(is_new.sum()),
+            train_rows=n_train,
+            validation_rows=int(val_mask.sum()),
+        )
+        print(
+            f"  {int(is_new.sum())} nya rader sedan {watermark.get('updated_at') or watermark.get('trained_at')}: "
+            f"{n_train} for traning, {int(new_holdout.sum())} till validering"
+        )
+
+    if n_train < min_rows:
+        profiler.stop()
+        summary.update(status="skipped", reason=f"farre an {min_rows} nya traningsrader")
+        print(f"  Ingen uppdatering: {summary['reason']}")
+        return summary
+    if not val_mask.any():
+        # Utan valideringsrader går det inte att visa att felet inte ökar
+        profiler.stop()
+        summary.update(status="skipped", reason="inga valideringsrader")
+        print(f"  Ingen uppdatering: {summary['reason']}")
+        return summary
+
+    with profiler.stage("train"):
+        X_new = scaler.transform(np.asarray(X[train_mask]))
+        n_trees = tree_count(model)
+        # Nya träd i proportion till ny data mot den modellen redan tränats på
+        n_add = math.ceil(n_trees * n_train / max(1, watermark["train_rows"]))
+        n_add = max(MIN_ADDED_TREES, min(n_trees, n_add))
+        updated = warm_start(model, X_new, y[train_mask], np.asarray(sw[train_mask]), n_add)
+        summary.update(trees_before=n_trees, trees_added=tree_count(updated) - n_trees)
+
+    with profiler.stage("validate"):
+        X_val = scaler.transform(np.asarray(X[val_mask]))
+        y_val = y[val_mask]
+        mae_before = _mae(model, X_val, y_val)
+        mae_after = _mae(updated, X_val, y_val)
+        new_val = new_holdout[val_mask]
+        summary.update(
+            mae_before=mae_before,
+            mae_after=mae_after,
+            new_rows_mae_before=_mae(model, X_val[new_val], y_val[new_val]),
+            new_rows_mae_after=_mae(updated, X_val[new_val], y_val[new_val]),
+        )
+        accept = mae_after <= mae_before * (1 + max_regression)
+        print(
+            f"  Validerings-MAE: {mae_before:.4f} -> {mae_after:.4f} m "
+            f"({summary['trees_added']} nya trad/steg)"
+        )
+
+    if not accept:
+        profiler.stop()
+        summary.update(status="rejected", reason="valideringsfelet okade")
+        print("  Ej publicerad: valideringsfelet okade (vattenmarket oforandrat)")
+        profiler.report()
+        summary["stages"] = profiler.as_dict()["stages"]
+        return summary
+
+    if dry_run:
+        profiler.stop()
+        summary.update(status="accepted_dry_run")
+        return summary
+
+    with profiler.stage("publish"):
+        now = datetime.now()
+        base = info.get("best_model", "model").replace(" ", "").lower()[:12]
+        model_version = now.strftime("%Y%m%d%H%M") + "-" + base + "-inc"
+        _save_atomic(OUTPUT_DIR / MODEL_FILE, lambda f: pickle.dump(updated, f))
+        seen = np.union1d(seen, keys)
+        holdout = np.union1d(holdout, keys[new_holdout])
+        _save_atomic(OUTPUT_DIR / SEEN_ROWS_FILE, lambda f: np.save(f, seen))
+        _save_atomic(OUTPUT_DIR / HOLDOUT_ROWS_FILE, lambda f: np.save(f, holdout))
+        watermark.update(
+            seen_rows=int(len(seen)),
+            holdout_rows=int(len(holdout)),
+            train_rows=int(watermark["train_rows"] + n_train),
+            updated_at=now.isoformat(),
+        )
+        # Kompakt serveringsformat för den nya versionen (annars serverar
+        # backend pickle-filen tills nästa export)
+        from tree_ensemble import SERVING_MODEL_FILE, export_to_file
+
+        # Den destillerade varianten (distill.py) och dess jämförelse hör till
+        # föregående version; den byggs om först vid nästa fulla träning
+        (OUTPUT_DIR / SERVING_MODEL_FILE).unlink(missing_ok=True)
+        info.pop("serving", None)
+        info.pop("variants", None)
+
+        try:
+            info["compact_model"] = export_to_file(
+                updated, scaler, feature_names, model_version, X_val, OUTPUT_DIR
+            )
+        except ValueError as e:
+            info.pop("compact_model", None)
+            print(f"  Kompakt modell exporterades inte: {e}")
+        history = info.get("incremental_updates", [])
+        history.append(
+            {
+                "model_version": model_version,
+                "previous_version": info.get("model_version"),
+                "at": now.isoformat(),
+                "train_rows": n_train,
+                "trees_added": summary["trees_added"],
+                "mae_before": mae_before,
+                "mae_after": mae_after,
+            }
+        )
+        info.update(
+            model_version=model_version,
+            # test_mae hör till den fulla träningens testmängd och lämnas orörd;
+            # valideringsmängden här (gamla testrader + nya holdout-rader) är en annan
+            incremental_val_mae=mae_after,
+            incremental_val_rows=int(val_mask.sum()),
+            watermark=watermark,
+            incremental_updates=history[-HISTORY_LENGTH:],
+        )
+        _save_atomic(
+            OUTPUT_DIR / MODEL_INFO_FILE,
+            lambda f: f.write(json.dumps(info, indent=2, ensure_ascii=False).encode("utf-8")),
+        )
+        summary.update(status="published", model_version=model_version)
+        print(f"  Publicerad: model_version={model_version}")
+
+    profiler.stop()
+    profiler.report()
+    summary["stages"] = profiler.as_dict()["stages"]
+    return summary
+
+
+def main():
+    print("Inkrementell modelluppdatering...")
+    summary = incremental_update()
+    summary["finished_at"] = datetime.now().isoformat()
+    OUTPUT_DIR.mkdir(exist_ok=True)
+    with open(OUTPUT_DIR / REPORT_FILE, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    print(f"Klar ({summary['status']}).")
+
+
+if __name__ == "__main__":
+    main()